@@ -0,0 +1,6 @@
+""" Бенчмарки сервиса опросов.
+
+Запуск из корня проекта, например:
+    python -m benchmarks.schema_cache
+Каждый бенчмарк создает временную тестовую БД и печатает результаты в формате JSON.
+"""
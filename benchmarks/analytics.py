@@ -0,0 +1,89 @@
+""" Аналитика опроса на большом числе попыток (poll/analytics.py): столбцы NumPy (ArrayColumns), битовые маски
+без NumPy (ListColumns) и построчный расчет на Python по строкам AnswerChoice.
+
+    python -m benchmarks.analytics [--attempts 1000000] [--questions 6] [--new 1000]
+
+cold - первый запрос: загрузка столбцов и расчет; compute - другие таблицы сопряженности при загруженных
+столбцах; cached - повторный запрос (готовая аналитика из кэша); incremental - запрос после new новых попыток.
+"""
+import argparse
+import time
+from collections import Counter
+from unittest import mock
+
+from .base import test_database, create_poll, create_attempts, measure, report
+
+from django.core.cache import caches
+from rest_framework.test import APIClient
+
+from poll import analytics
+from poll.analytics import analytics_engine
+from poll.models import MyUser, Question, AnswerChoice
+
+
+def per_row(poll, pairs):
+    """ Построчный расчет: распределения и таблицы сопряженности по строкам (попытка, вопрос, вариант)"""
+    counts, answers = Counter(), {}
+    for attempt_id, question_id, choice_id in AnswerChoice.objects.filter(
+            answer__attempt__poll=poll).values_list('answer__attempt_id', 'answer__question_id', 'choice_id'):
+        counts[choice_id] += 1
+        answers.setdefault(attempt_id, {}).setdefault(question_id, []).append(choice_id)
+    tables = []
+    for question_a, question_b in pairs:
+        table = Counter()
+        for selected in answers.values():
+            for choice_a in selected.get(question_a, ()):
+                for choice_b in selected.get(question_b, ()):
+                    table[choice_a, choice_b] += 1
+        tables.append(table)
+    return counts, tables
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+def run(attempts, questions, new):
+    admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+    poll = create_poll(questions=questions)
+    start = time.perf_counter()
+    create_attempts(poll, attempts, admin)
+    results = {'attempts': attempts, 'data_seconds': round(time.perf_counter() - start, 1)}
+    client = APIClient()
+    client.force_authenticate(admin)
+    url = '/api/v1/polls/%d/analytics/' % poll.pk
+    question_objs = list(poll.questions.exclude(question_type=Question.TEXT).order_by('position'))
+    pairs = [(a, b) for i, a in enumerate(question_objs) for b in question_objs[i + 1:]]
+    crosstabs = ['%d,%d' % (a.position, b.position) for a, b in pairs]
+
+    def get(params):
+        response = client.get(url, params)
+        assert response.status_code == 200, response.data
+        return response
+
+    engines = {'numpy': analytics.numpy, 'lists': None} if analytics.numpy is not None else {'lists': None}
+    for name, module in engines.items():
+        with mock.patch.object(analytics, 'numpy', module):
+            analytics_engine.clear()
+            caches['default'].clear()
+            results[name] = {
+                'cold_ms': timed(lambda: get({'crosstab': crosstabs[:1]})),
+                'compute_ms': timed(lambda: get({'crosstab': crosstabs, 'bucket': 'hour'})),
+                'cached': measure(lambda: get({'crosstab': crosstabs}), repeat=50),
+            }
+            create_attempts(poll, new, admin)
+            results[name]['incremental_ms'] = timed(lambda: get({'crosstab': crosstabs}))
+    results['per_row_ms'] = timed(lambda: per_row(poll, [(a.id, b.id) for a, b in pairs]))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--attempts', type=int, default=1000000)
+    parser.add_argument('--questions', type=int, default=6, help='Вопросов в опросе (каждый третий - текстовый)')
+    parser.add_argument('--new', type=int, default=1000, help='Новых попыток перед incremental')
+    args = parser.parse_args()
+    with test_database():
+        report('analytics', run(args.attempts, args.questions, args.new))
@@ -0,0 +1,54 @@
+""" Скорость записи анонимных голосов: пользователь MyUser на каждый голос (прежняя схема)
+против анонимного участника Attempt.voter.
+
+    python -m benchmarks.anonymous_votes [--votes 2000] [--questions 10]
+"""
+import argparse
+from uuid import uuid4
+
+from .base import test_database, create_poll, make_answers, measure, report
+
+from django.db import transaction
+from rest_framework.test import APIClient
+
+from poll.models import MyUser
+from poll.schema import schema_cache
+from poll.votes import Vote, write_votes
+
+
+def legacy_vote(schema, answers):
+    """ Прежняя запись анонимного голоса: создание пользователя и переименование его в id"""
+    with transaction.atomic():
+        user = MyUser.objects.create_user(username='auto_username', password=None)
+        user.username = str(user.id)
+        user.save()
+        write_votes([Vote(poll=schema, user_id=user.id, answers=answers)])
+
+
+def voter_vote(schema, answers):
+    with transaction.atomic():
+        write_votes([Vote(poll=schema, user_id=None, answers=answers, voter=uuid4())])
+
+
+def run(votes, questions):
+    poll = create_poll(questions=questions)
+    schema = schema_cache.get(poll.pk)
+    answers = make_answers(poll)
+    client = APIClient()
+    url = '/api/v1/polls/%d/vote/' % poll.pk
+    return {
+        'votes': votes,
+        'legacy_user_per_vote': measure(lambda: legacy_vote(schema, answers), votes),
+        'anonymous_voter': measure(lambda: voter_vote(schema, answers), votes),
+        'api_anonymous_voter': measure(lambda: client.post(url, {'answers': answers}, format='json'), votes),
+        'auth_users_created': MyUser.objects.count(),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--votes', type=int, default=2000)
+    parser.add_argument('--questions', type=int, default=10)
+    args = parser.parse_args()
+    with test_database():
+        report('anonymous_votes', run(args.votes, args.questions))
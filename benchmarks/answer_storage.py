@@ -0,0 +1,89 @@
+""" Размер таблиц ответов и скорость подсчета итогов: строковое представление списка
+в Answer.answer (прежний формат) против выбранных вариантов в AnswerChoice.
+
+    python -m benchmarks.answer_storage [--attempts 20000] [--questions 10]
+"""
+import argparse
+import ast
+import time
+from collections import Counter
+
+from .base import test_database, create_poll, report
+
+from django.db import connection
+
+from poll.models import Question, Attempt, Answer, AnswerChoice, MyUser
+from poll.tallies import compute_tallies
+
+
+def table_size(*models):
+    """ Размер таблиц вместе с индексами в байтах"""
+    tables = [model._meta.db_table for model in models]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT SUM(pg_total_relation_size(t)) FROM unnest(%s) AS t', [tables])
+        else:
+            cursor.execute('SELECT SUM(pgsize) FROM dbstat WHERE name IN '
+                           '(SELECT name FROM sqlite_master WHERE tbl_name IN (%s))' % ', '.join(['%s'] * len(tables)),
+                           tables)
+        return cursor.fetchone()[0]
+
+
+def fill(poll, attempts, legacy):
+    """ Записать попытки с ответами в прежнем (legacy=True) или нормализованном формате"""
+    user = MyUser.objects.create_user(username='bench-%s' % legacy, password=None)
+    questions = list(poll.questions.exclude(question_type=Question.TEXT).prefetch_related('choices'))
+    attempt_objs = Attempt.objects.bulk_create([Attempt(user=user, poll=poll) for _ in range(attempts)])
+    answers, selected = [], []
+    for n, attempt in enumerate(attempt_objs):
+        for question in questions:
+            choices = list(question.choices.all())
+            picked = choices[n % len(choices):][:1 if question.question_type == Question.SINGLE_CHOICE else 2]
+            answer = Answer(attempt=attempt, question=question,
+                            answer=str([c.choice_text for c in picked]) if legacy else '')
+            answers.append(answer)
+            selected.extend((answer, choice) for choice in picked)
+    Answer.objects.bulk_create(answers, batch_size=5000)
+    if not legacy:
+        AnswerChoice.objects.bulk_create([AnswerChoice(answer=answer, choice=choice) for answer, choice in selected],
+                                         batch_size=5000)
+
+
+def legacy_tallies(poll):
+    """ Подсчет итогов в прежнем формате: полный просмотр ответов и разбор строк в Python"""
+    choices = {q.id: {c.choice_text: c.id for c in q.choices.all()}
+               for q in poll.questions.exclude(question_type=Question.TEXT).prefetch_related('choices')}
+    counts = Counter()
+    for question_id, text in Answer.objects.filter(attempt__poll=poll, question_id__in=choices).values_list(
+            'question_id', 'answer').iterator(chunk_size=2000):
+        for part in ast.literal_eval(text):
+            counts[choices[question_id][part]] += 1
+    return counts
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+def run(attempts, questions):
+    results = {}
+    for legacy in (True, False):
+        poll = create_poll(questions=questions, title='legacy' if legacy else 'normalized')
+        Answer.objects.all().delete()
+        fill(poll, attempts, legacy)
+        results['legacy' if legacy else 'normalized'] = {
+            'table_bytes': table_size(Answer, AnswerChoice),
+            'tally_ms': timed(legacy_tallies if legacy else lambda p: compute_tallies(p.id), poll),
+        }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--attempts', type=int, default=20000)
+    parser.add_argument('--questions', type=int, default=10)
+    args = parser.parse_args()
+    with test_database():
+        report('answer_storage', run(args.attempts, args.questions))
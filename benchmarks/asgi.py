@@ -0,0 +1,125 @@
+""" Один воркер gunicorn под нагрузкой медленных клиентов: синхронный WSGI (mysite.wsgi) против ASGI
+(mysite.asgi, uvicorn) с асинхронными представлениями (poll/aio.py).
+
+    python -m benchmarks.asgi [--slow 20] [--fast 10] [--chunks 5] [--delay 0.1] [--seconds 10]
+
+Сервер запускается на временной БД SQLite. slow клиентов голосуют, передавая тело запроса частями по chunks
+с паузой delay секунд (медленная сеть), fast клиентов в это время без пауз читают опрос и его итоги.
+Для каждого режима выводятся запросы в секунду и задержки p50/p99 быстрых чтений и голосов. Синхронный воркер
+занят все время, пока медленный клиент передает тело, поэтому чтения ждут в очереди; в production перед
+сервисом стоит nginx, который буферизует тела запросов (кроме /api/v1/import/).
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import tempfile
+import time
+
+from .concurrency import create_database
+
+SERVERS = {
+    'wsgi': ['mysite.wsgi:application'],
+    'asgi': ['mysite.asgi:application', '--worker-class', 'uvicorn.workers.UvicornWorker'],
+}
+
+
+def summary(latencies, seconds):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {'rps': 0}
+    return {'rps': round(len(latencies) / seconds, 1),
+            'p50_ms': round(latencies[len(latencies) // 2] * 1000, 1),
+            'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 1)}
+
+
+async def request(port, method, path, body=b'', chunks=1, delay=0.0):
+    """ HTTP-запрос с передачей тела частями: (статус, секунды)"""
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(('%s %s HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\nContent-Type: application/json\r\n'
+                  'Content-Length: %d\r\n\r\n' % (method, path, len(body))).encode())
+    size = -(-len(body) // chunks) if body else 0
+    for start_byte in range(0, len(body), size or 1):
+        await writer.drain()
+        if start_byte:
+            await asyncio.sleep(delay)
+        writer.write(body[start_byte:start_byte + size])
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b' ', 2)[1]), time.perf_counter() - start
+
+
+async def load(port, args, poll_id, answers):
+    deadline = time.monotonic() + args.seconds
+    results = {'reads': [], 'votes': [], 'errors': 0}
+
+    async def slow(number):
+        body = json.dumps({'user': number + 1, 'answers': answers}).encode()
+        while time.monotonic() < deadline:
+            status, elapsed = await request(port, 'POST', '/api/v1/polls/%d/vote/' % poll_id, body,
+                                            args.chunks, args.delay)
+            results['votes' if status == 200 else 'errors'] += [elapsed] if status == 200 else 1
+
+    async def fast(number):
+        paths = ['/api/v1/polls/%d/' % poll_id, '/api/v1/polls/%d/results/' % poll_id]
+        while time.monotonic() < deadline:
+            status, elapsed = await request(port, 'GET', paths[number % len(paths)])
+            results['reads' if status == 200 else 'errors'] += [elapsed] if status == 200 else 1
+
+    await asyncio.gather(*[slow(n) for n in range(args.slow)], *[fast(n) for n in range(args.fast)])
+    return {'reads': summary(results['reads'], args.seconds), 'votes': summary(results['votes'], args.seconds),
+            'errors': results['errors']}
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        time.sleep(0.2)
+    raise RuntimeError('Server did not start on port %d' % port)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_mode(mode, args, directory):
+    env = dict(os.environ, SQL_ENGINE='django.db.backends.sqlite3', SQL_DATABASE=os.path.join(directory, 'db.sqlite3'),
+               DEBUG='0', DJANGO_ALLOWED_HOSTS='localhost', POLL_VOTE_BUFFER='0', POLL_RESPONSE_CACHE='0')
+    create_database(env, args.slow)
+    port = free_port()
+    server = subprocess.Popen(['gunicorn', *SERVERS[mode], '--workers', '1',
+                               '--bind', '127.0.0.1:%d' % port, '--log-level', 'warning'], env=env)
+    try:
+        wait_for_port(port)
+        # Опрос из create_database: первый, вопросы 1..10 по кругу: текст, один вариант, несколько вариантов
+        answers = [{'position': position, 'answer': ['Ответ'] if position % 3 == 1 else ['0']}
+                   for position in range(1, 11)]
+        return asyncio.run(load(port, args, 1, answers))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--slow', type=int, default=20, help='Медленных голосующих клиентов')
+    parser.add_argument('--fast', type=int, default=10, help='Быстрых читающих клиентов')
+    parser.add_argument('--chunks', type=int, default=5, help='Частей тела голоса')
+    parser.add_argument('--delay', type=float, default=0.1, help='Пауза между частями, секунд')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--modes', nargs='+', choices=sorted(SERVERS), default=['wsgi', 'asgi'])
+    args = parser.parse_args()
+    results = {}
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory() as directory:
+            results[mode] = run_mode(mode, args, directory)
+    print(json.dumps({'benchmark': 'asgi', 'results': results}, ensure_ascii=False, indent=2))
@@ -0,0 +1,116 @@
+import contextlib
+import json
+import os
+import statistics
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db import connection  # noqa: E402
+from django.test.utils import setup_test_environment, teardown_test_environment  # noqa: E402
+
+from poll.models import Poll, Question, Choice, Attempt, Answer, AnswerChoice  # noqa: E402
+
+
+@contextlib.contextmanager
+def test_database():
+    """ Временная тестовая БД на время бенчмарка"""
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def create_poll(questions=10, choices=4, **kwargs):
+    """ Создать опрос с вопросами всех типов по кругу: текст, один вариант, несколько вариантов"""
+    poll = Poll.objects.create(title=kwargs.pop('title', 'Опрос'), **kwargs)
+    types = (Question.TEXT, Question.SINGLE_CHOICE, Question.MULTI_CHOICE)
+    question_objs = Question.objects.bulk_create([
+        Question(poll=poll, position=position, question_type=types[(position - 1) % len(types)],
+                 main_text='Вопрос %d' % position)
+        for position in range(1, questions + 1)
+    ])
+    Choice.objects.bulk_create([
+        Choice(question=question, choice_text=str(n), position=n)
+        for question in question_objs if question.question_type != Question.TEXT
+        for n in range(choices)
+    ])
+    return poll
+
+
+def make_answers(poll):
+    """ Корректный набор ответов на все вопросы опроса"""
+    answers = []
+    for question in poll.questions.order_by('position'):
+        if question.question_type == Question.TEXT:
+            answer = ['текст']
+        elif question.question_type == Question.SINGLE_CHOICE:
+            answer = ['0']
+        else:
+            answer = ['1', '2']
+        answers.append({'position': question.position, 'answer': answer})
+    return answers
+
+
+def create_attempts(poll, count, user, batch_size=2000):
+    """ Быстро записать count попыток с ответами на все вопросы опроса через bulk_create"""
+    questions = list(poll.questions.order_by('position').prefetch_related('choices'))
+    choices = {question.id: [choice.id for choice in question.choices.all()] for question in questions}
+    for start in range(0, count, batch_size):
+        attempts = Attempt.objects.bulk_create([Attempt(user=user, poll=poll)
+                                                for _ in range(min(batch_size, count - start))])
+        answers, selected = [], []
+        for n, attempt in enumerate(attempts, start):
+            for question in questions:
+                if question.question_type == Question.TEXT:
+                    answers.append(Answer(attempt=attempt, question=question, answer="['ответ %d']" % n))
+                    continue
+                answer = Answer(attempt=attempt, question=question, answer='')
+                answers.append(answer)
+                options = choices[question.id]
+                picked = 1 if question.question_type == Question.SINGLE_CHOICE else 2
+                selected.extend((answer, options[(n + k) % len(options)]) for k in range(picked))
+        Answer.objects.bulk_create(answers)
+        AnswerChoice.objects.bulk_create([AnswerChoice(answer_id=answer.id, choice_id=choice_id)
+                                          for answer, choice_id in selected])
+
+
+def measure(func, repeat=200, setup=None):
+    """ Выполнить func repeat раз и вернуть сводку по задержкам в миллисекундах"""
+    latencies = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return summary(latencies)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def summary(latencies):
+    total = sum(latencies)
+    return {
+        'count': len(latencies),
+        'mean_ms': round(statistics.mean(latencies), 3),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'rps': round(len(latencies) / total * 1000, 1) if total else None,
+    }
+
+
+def report(name, results):
+    print(json.dumps({'benchmark': name, 'results': results}, ensure_ascii=False, indent=2))
@@ -0,0 +1,123 @@
+""" Голосование из нескольких процессов на одной БД SQLite: настройки Django по умолчанию против PRAGMA
+и постоянных подключений из poll/db_connections.py.
+
+    python -m benchmarks.concurrency [--workers 8] [--readers 4] [--seconds 10] [--modes django tuned]
+
+Для каждого режима создается отдельный файл БД (режим журнала WAL сохраняется в файле), в него применяются
+миграции, затем workers процессов голосуют через тестовый клиент, а readers процессов читают итоги опроса.
+Выводятся голоса в секунду, доля ошибок (в основном "database is locked") и задержки голосования.
+Режимы: django - без PRAGMA и с новым подключением на каждый запрос, tuned - настройки по умолчанию.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+MODES = {
+    'django': {'SQLITE_PRAGMAS': '0', 'SQL_CONN_MAX_AGE': '0'},
+    'tuned': {},
+}
+
+
+def worker(role, number, seconds):
+    """ Процесс нагрузки: голосует или читает итоги до истечения времени, печатает результат в JSON"""
+    from .base import summary
+
+    from django.core.signals import got_request_exception
+    from rest_framework.test import APIClient
+
+    from poll.models import Poll, MyUser, Question
+
+    errors = Counter()
+    got_request_exception.connect(lambda sender, **kwargs: errors.update([str(sys.exc_info()[1])[:60]]),
+                                  weak=False)
+    client = APIClient(HTTP_HOST='localhost', raise_request_exception=False)
+    poll = Poll.objects.get()
+    user = MyUser.objects.get(username='bench-%d' % number)
+    answers = [{'position': position, 'answer': ['Ответ'] if question_type == Question.TEXT else ['0']}
+               for position, question_type in poll.questions.values_list('position', 'question_type')]
+    statuses, latencies = Counter(), []
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        if role == 'writer':
+            response = client.post('/api/v1/polls/%d/vote/' % poll.pk, {'user': user.pk, 'answers': answers},
+                                   format='json')
+        else:
+            response = client.get('/api/v1/polls/%d/results/' % poll.pk)
+        latencies.append((time.perf_counter() - start) * 1000)
+        statuses[response.status_code] += 1
+    print(json.dumps({'statuses': statuses, 'errors': errors, 'latency': summary(latencies)}))
+
+
+def prepare(workers):
+    from .base import create_poll
+
+    from poll.models import MyUser
+
+    create_poll(questions=10, finished_at=None)
+    for number in range(workers):
+        MyUser.objects.create_user(username='bench-%d' % number, password=None)
+
+
+def create_database(env, users):
+    """ Применить миграции к БД из env и создать опрос и пользователей bench-0 ... bench-<users - 1>"""
+    manage = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'manage.py')
+    subprocess.run([sys.executable, manage, 'migrate', '--verbosity', '0'], env=env, check=True)
+    subprocess.run([sys.executable, '-m', 'benchmarks.concurrency', '--prepare', '--workers', str(users)],
+                   env=env, check=True)
+
+
+def run_mode(env, workers, readers, seconds):
+    create_database(env, workers)
+    processes = [subprocess.Popen([sys.executable, '-m', 'benchmarks.concurrency', '--role', role,
+                                   '--number', str(number), '--seconds', str(seconds)],
+                                  env=env, stdout=subprocess.PIPE, text=True)
+                 for role, count in (('writer', workers), ('reader', readers)) for number in range(count)]
+    outputs = [json.loads(process.communicate()[0]) for process in processes]
+    writes, reads = outputs[:workers], outputs[workers:]
+    total = sum(sum(output['statuses'].values()) for output in writes)
+    ok = sum(output['statuses'].get('200', 0) for output in writes)
+    errors = Counter()
+    for output in outputs:
+        errors.update(output['errors'])
+    return {
+        'votes_per_second': round(ok / seconds, 1),
+        'vote_error_rate': round(1 - ok / total, 4) if total else None,
+        'reads_per_second': round(sum(output['statuses'].get('200', 0) for output in reads) / seconds, 1),
+        'vote_p50_ms': sorted(output['latency']['p50_ms'] for output in writes)[len(writes) // 2],
+        'vote_p99_ms': max(output['latency']['p99_ms'] for output in writes),
+        'errors': errors,
+    }
+
+
+def main(args):
+    results = {}
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ, SQL_ENGINE='django.db.backends.sqlite3',
+                       SQL_DATABASE=os.path.join(directory, 'db.sqlite3'), POLL_VOTE_BUFFER='0', **MODES[mode])
+            results[mode] = run_mode(env, args.workers, args.readers, args.seconds)
+    print(json.dumps({'benchmark': 'concurrency', 'results': results}, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=8, help='Голосующих процессов')
+    parser.add_argument('--readers', type=int, default=4, help='Процессов, читающих итоги')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--modes', nargs='+', choices=sorted(MODES), default=['django', 'tuned'])
+    parser.add_argument('--role', choices=['writer', 'reader'], help=argparse.SUPPRESS)
+    parser.add_argument('--number', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--prepare', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.prepare:
+        prepare(args.workers)
+    elif args.role:
+        worker(args.role, args.number, args.seconds)
+    else:
+        main(args)
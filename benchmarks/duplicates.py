@@ -0,0 +1,90 @@
+""" Один голос на участника (poll/duplicates.py) и повтор голосования с Idempotency-Key (poll/idempotency.py).
+
+    python -m benchmarks.duplicates [--voters 200000] [--votes 1000]
+
+В опросе уже голосовали voters участников. Голоса votes новых авторизованных пользователей измеряются в опросе
+без ограничения, с ограничением и фильтром Блума и с ограничением, но с проверкой каждого голоса запросом к БД
+(без фильтра).
+duplicate - отклонение повторного голоса, replay - повтор запроса с тем же Idempotency-Key.
+filter_bytes - размер фильтра опроса против множества ключей участников в памяти.
+"""
+import argparse
+import sys
+from unittest import mock
+from uuid import uuid4
+
+from .base import test_database, create_poll, make_answers, measure, report
+
+from rest_framework.test import APIClient
+
+from poll.duplicates import voter_filters, voter_key
+from poll.models import MyUser, PollVoter
+
+
+def create_voters(poll, count, batch_size=10000):
+    keys = []
+    for start in range(0, count, batch_size):
+        voters = [PollVoter(poll=poll, voter=uuid4()) for _ in range(min(batch_size, count - start))]
+        PollVoter.objects.bulk_create(voters)
+        keys.extend(voter_key(None, voter.voter) for voter in voters)
+    return keys
+
+
+def run(voters, votes):
+    client = APIClient()
+    users = MyUser.objects.bulk_create([MyUser(username='user%d' % n) for n in range(4 * votes)])
+    results = {'voters': voters, 'votes': votes}
+
+    def new_votes(poll, users):
+        url = '/api/v1/polls/%d/vote/' % poll.pk
+        answers = make_answers(poll)
+        users = iter(users)
+
+        def vote():
+            client.force_authenticate(next(users))
+            response = client.post(url, {'answers': answers}, format='json')
+            assert response.status_code == 200, response.data
+
+        return measure(vote, repeat=votes)
+
+    results['no_limit'] = new_votes(create_poll(), users[:votes])
+    poll = create_poll(one_vote=True)
+    keys = create_voters(poll, voters)
+    results['bloom_filter'] = new_votes(poll, users[votes:2 * votes])
+    bloom = voter_filters.get(poll.pk)
+    results['filter_bytes'] = len(bloom.bits)
+    results['set_bytes'] = sys.getsizeof(set(keys)) + sum(sys.getsizeof(key) for key in keys)
+    with mock.patch.object(voter_filters, 'might_have_voted', return_value=True):
+        results['database_check'] = new_votes(poll, users[2 * votes:3 * votes])
+
+    url = '/api/v1/polls/%d/vote/' % poll.pk
+    answers = make_answers(poll)
+
+    def duplicate():
+        client.force_authenticate(users[votes])
+        response = client.post(url, {'answers': answers}, format='json')
+        assert response.status_code == 409, response.data
+
+    results['duplicate'] = measure(duplicate, repeat=votes)
+    replay_users = iter(users[3 * votes:])
+
+    def replay():
+        client.force_authenticate(next(replay_users))
+        data = {'answers': answers}
+        key = uuid4().hex
+        for _ in range(2):
+            response = client.post(url, data, format='json', HTTP_IDEMPOTENCY_KEY=key)
+        assert response['Idempotent-Replayed'] == 'true'
+
+    # Голос с ключом и его повтор
+    results['vote_and_replay'] = measure(replay, repeat=votes)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--voters', type=int, default=200000, help='Участников, уже голосовавших в опросе')
+    parser.add_argument('--votes', type=int, default=1000)
+    args = parser.parse_args()
+    with test_database():
+        report('duplicates', run(args.voters, args.votes))
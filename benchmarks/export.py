@@ -0,0 +1,63 @@
+""" Пиковое потребление памяти и скорость потоковой выгрузки ответов опроса.
+
+Скорость меряется отдельным проходом без tracemalloc. Пиковый RSS процесса включает генерацию данных,
+поэтому рост памяти самой выгрузки показывает peak_heap_mb - пик выделенной Python-памяти по tracemalloc.
+
+    python -m benchmarks.export [--answers 1000000] [--questions 20] [--format csv ndjson]
+"""
+import argparse
+import resource
+import time
+import tracemalloc
+
+from .base import test_database, create_poll, create_attempts, report
+
+from rest_framework.test import APIClient
+
+from poll.models import MyUser
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(answers, questions, formats):
+    admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+    poll = create_poll(questions=questions)
+    attempts = answers // questions
+    create_attempts(poll, attempts, admin)
+    client = APIClient()
+    client.force_authenticate(admin)
+    results = {'attempts': attempts, 'answers': attempts * questions}
+    url = '/api/v1/polls/%d/export/' % poll.pk
+    for export_format in formats:
+        start = time.perf_counter()
+        response = client.get(url, {'format': export_format})
+        size = sum(len(chunk) for chunk in response.streaming_content)
+        elapsed = time.perf_counter() - start
+
+        tracemalloc.start()
+        response = client.get(url, {'format': export_format})
+        for _ in response.streaming_content:
+            pass
+        _, peak_heap = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results[export_format] = {
+            'seconds': round(elapsed, 2),
+            'rows_per_second': round(attempts / elapsed),
+            'bytes': size,
+            'peak_heap_mb': round(peak_heap / 2 ** 20, 1),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--answers', type=int, default=1000000)
+    parser.add_argument('--questions', type=int, default=20)
+    parser.add_argument('--format', nargs='+', default=['csv', 'ndjson'])
+    args = parser.parse_args()
+    with test_database():
+        report('export', run(args.answers, args.questions, args.format))
@@ -0,0 +1,70 @@
+""" Загрузка выгрузки dumpdata: loaddata против потокового импорта import_polls (poll/importer.py).
+
+    python -m benchmarks.importer [--attempts 20000] [--questions 10] [--batch-size 2000]
+
+На временной БД создается опрос с попытками, выгружается через dumpdata в XML и jsonl, после чего каждая выгрузка
+загружается заново обоими способами. Для каждого способа выводятся время, объектов в секунду и пиковая память
+Python (tracemalloc). loaddata сохраняет объекты по одному и держит XML-документ целиком; import_polls
+дополнительно пересчитывает итоги и снимки ответов.
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+from io import StringIO
+
+from .base import test_database, create_poll, create_attempts, report
+
+from django.core.management import call_command
+
+from poll.models import Poll, MyUser
+
+FORMATS = {'xml': '.xml', 'jsonl': '.jsonl'}
+
+
+def load(command, path, **options):
+    """ Загрузить выгрузку в пустую БД опросов: (секунды, пиковая память в МБ)"""
+    Poll.objects.all().delete()
+    tracemalloc.start()
+    start = time.perf_counter()
+    call_command(command, path, stdout=StringIO(), **options)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, round(peak / 2 ** 20, 1)
+
+
+def run(attempts, questions, batch_size, directory):
+    user = MyUser.objects.create_user(username='bench', password=None)
+    create_attempts(create_poll(questions=questions), attempts, user)
+    paths = {}
+    for format, extension in FORMATS.items():
+        paths[format] = os.path.join(directory, 'dump' + extension)
+        with open(paths[format], 'w') as file:
+            call_command('dumpdata', 'poll', format=format, stdout=file)
+    results = {}
+    for format, path in paths.items():
+        with open(path) as file:
+            objects = sum(1 for line in file if line.strip()) if format == 'jsonl' else None
+        result = {}
+        for name, command, options in (('loaddata', 'loaddata', {}),
+                                       ('import_polls', 'import_polls', {'batch_size': batch_size})):
+            elapsed, peak = load(command, path, **options)
+            result[name] = {'seconds': round(elapsed, 2), 'peak_mb': peak}
+            if objects:
+                result[name]['objects_per_second'] = round(objects / elapsed)
+        result['gain'] = round(result['loaddata']['seconds'] / result['import_polls']['seconds'], 2)
+        result['size_mb'] = round(os.path.getsize(path) / 2 ** 20, 1)
+        results[format] = result
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--attempts', type=int, default=20000)
+    parser.add_argument('--questions', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=2000)
+    args = parser.parse_args()
+    with test_database(), tempfile.TemporaryDirectory() as directory:
+        report('importer', run(args.attempts, args.questions, args.batch_size, directory))
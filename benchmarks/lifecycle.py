@@ -0,0 +1,108 @@
+""" Архивация закрытых опросов (poll/lifecycle.py): размер горячих таблиц ответов и задержки голосования
+и чтения итогов до и после архивации.
+
+    python -m benchmarks.lifecycle [--polls 10] [--attempts 50000] [--repeat 200]
+
+Создаются polls закрытых опросов по attempts попыток и один действующий опрос. before и after - число строк
+и размер таблиц poll_answer и poll_answerchoice с индексами (SQLite: dbstat после VACUUM, PostgreSQL:
+pg_total_relation_size), задержки голосования в действующем опросе и итогов закрытого опроса. archive_seconds -
+архивация всех закрытых опросов фоновыми задачами, rehydrate_seconds - возврат ответов одного опроса.
+"""
+import argparse
+import tempfile
+import time
+from datetime import date, timedelta
+
+from .base import test_database, create_poll, create_attempts, make_answers, measure, report
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.test import override_settings
+from rest_framework.test import APIClient
+
+from poll.jobs import submit, claim, run as run_job
+from poll.models import MyUser, Poll, PollArchive, Answer, AnswerChoice, Job
+
+TABLES = ('poll_answer', 'poll_answerchoice')
+
+
+def table_sizes():
+    """ Строки и байты таблиц ответов вместе с их индексами"""
+    sizes = {'answer_rows': Answer.objects.count(), 'answerchoice_rows': AnswerChoice.objects.count()}
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('VACUUM')
+            cursor.execute("SELECT SUM(pgsize) FROM dbstat JOIN sqlite_master m ON m.name = dbstat.name "
+                           "WHERE m.tbl_name IN ('%s', '%s')" % TABLES)
+        else:
+            cursor.execute('VACUUM ANALYZE')
+            cursor.execute(' + '.join("pg_total_relation_size('%s')" % table for table in TABLES))
+        sizes['bytes'] = cursor.fetchone()[0]
+    return sizes
+
+
+def latencies(client, active, closed, repeat):
+    answers = make_answers(active)
+    vote_url = '/api/v1/polls/%d/vote/' % active.pk
+    results_url = '/api/v1/polls/%d/results/' % closed.pk
+
+    def vote():
+        response = client.post(vote_url, {'answers': answers}, format='json')
+        assert response.status_code == 200, response.data
+
+    def results():
+        caches['default'].clear()
+        response = client.get(results_url)
+        assert response.status_code == 200, response.data
+
+    return {'vote': measure(vote, repeat=repeat), 'results_uncached': measure(results, repeat=repeat)}
+
+
+def run_jobs():
+    while True:
+        job = claim('benchmark')
+        if job is None:
+            return
+        run_job(job)
+
+
+def run(polls, attempts, repeat):
+    admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+    client = APIClient()
+    client.force_authenticate(admin)
+    start = time.perf_counter()
+    closed = [create_poll(title='Закрытый %d' % n, finished_at=date.today() - timedelta(days=1))
+              for n in range(polls)]
+    for poll in closed:
+        create_attempts(poll, attempts, admin)
+    active = create_poll(title='Действующий')
+    create_attempts(active, attempts, admin)
+    results = {'polls': polls, 'attempts': attempts, 'data_seconds': round(time.perf_counter() - start, 1)}
+    results['before'] = dict(table_sizes(), **latencies(client, active, closed[0], repeat))
+
+    start = time.perf_counter()
+    submit('close_polls')
+    run_jobs()
+    results['archive_seconds'] = round(time.perf_counter() - start, 1)
+    assert Poll.objects.filter(is_archived=True).count() == polls
+    results['archive_bytes'] = sum(PollArchive.objects.values_list('size', flat=True))
+    results['after'] = dict(table_sizes(), **latencies(client, active, closed[0], repeat))
+
+    start = time.perf_counter()
+    job = submit('rehydrate_poll', {'poll_id': closed[0].pk})
+    run_jobs()
+    assert Job.objects.get(pk=job.pk).status == Job.DONE
+    results['rehydrate_seconds'] = round(time.perf_counter() - start, 1)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--polls', type=int, default=10, help='Закрытых опросов')
+    parser.add_argument('--attempts', type=int, default=50000, help='Попыток в каждом опросе')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+    with test_database(), tempfile.TemporaryDirectory() as directory, \
+            override_settings(POLL_LIFECYCLE=dict(settings.POLL_LIFECYCLE, DIR=directory, REQUIRE_PERSISTENT=0)):
+        report('lifecycle', run(args.polls, args.attempts, args.repeat))
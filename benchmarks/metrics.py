@@ -0,0 +1,65 @@
+""" Накладные расходы MetricsMiddleware: задержка запросов с метриками и без них
+и стоимость одной записи в реестр метрик.
+
+    python -m benchmarks.metrics [--repeat 2000]
+"""
+import argparse
+import time
+
+from .base import test_database, create_poll, summary, report
+
+from django.conf import settings
+from django.test import override_settings
+from rest_framework.test import APIClient
+
+from poll.metrics import registry
+
+
+def endpoints(poll):
+    return {
+        'poll_list': '/api/v1/polls/',
+        'poll_detail': '/api/v1/polls/%d/' % poll.pk,
+        'poll_results': '/api/v1/polls/%d/results/' % poll.pk,
+    }
+
+
+def observe_cost(repeat):
+    """ Среднее время registry.observe в микросекундах"""
+    start = time.perf_counter()
+    for n in range(repeat):
+        registry.observe('bench', 0.001 * (n % 100), 3, 0.0005, 1024)
+    return round((time.perf_counter() - start) / repeat * 1e6, 3)
+
+
+def client(enabled):
+    """ Клиент с MetricsMiddleware или без: промежуточные слои загружаются клиентом при первом запросе"""
+    with override_settings(POLL_METRICS=dict(settings.POLL_METRICS, ENABLED=enabled)):
+        api_client = APIClient()
+        api_client.get('/api/v1/polls/')
+    return api_client
+
+
+def run(repeat):
+    poll = create_poll(questions=10)
+    clients = {'plain': client(False), 'metrics': client(True)}
+    results = {}
+    for name, url in endpoints(poll).items():
+        # Запросы с метриками и без чередуются, чтобы фоновая нагрузка одинаково влияла на оба варианта
+        latencies = {mode: [] for mode in clients}
+        for _ in range(repeat):
+            for mode, api_client in clients.items():
+                start = time.perf_counter()
+                api_client.get(url)
+                latencies[mode].append((time.perf_counter() - start) * 1000)
+        for mode, values in latencies.items():
+            results['%s_%s' % (name, mode)] = summary(values)
+    results['observe_us'] = observe_cost(repeat * 10)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+    with test_database():
+        report('metrics', run(args.repeat))
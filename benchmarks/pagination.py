@@ -0,0 +1,56 @@
+""" Стоимость первой и глубокой страницы истории попыток: keyset-пагинация против OFFSET.
+
+    python -m benchmarks.pagination [--attempts 10000000] [--repeat 50]
+
+Генерация 10 млн попыток занимает несколько минут; для быстрой проверки используйте --attempts 1000000.
+"""
+import argparse
+
+from .base import test_database, create_poll, measure, report
+
+from rest_framework.test import APIClient
+
+from poll.models import Attempt, MyUser
+from poll.pagination import KeysetPagination
+
+
+def fill(poll, user, count, batch_size=50000):
+    for start in range(0, count, batch_size):
+        Attempt.objects.bulk_create([Attempt(user=user, poll=poll) for _ in range(min(batch_size, count - start))])
+
+
+def cursor_at(offset):
+    """ Курсор страницы, начинающейся после записи с номером offset"""
+    paginator = KeysetPagination()
+    paginator.ordering = ('-time', '-id')
+    paginator.model = Attempt
+    return paginator.encode_cursor(Attempt.objects.order_by('-time', '-id')[offset])
+
+
+def run(attempts, repeat):
+    user = MyUser.objects.create_user(username='bench', password=None)
+    poll = create_poll(questions=1)
+    fill(poll, user, attempts)
+    client = APIClient()
+    data = {'user': user.pk}
+    page_size = KeysetPagination.page_size
+    deep = attempts - page_size * 2
+    deep_cursor = cursor_at(deep)
+    history = Attempt.objects.filter(user=user).order_by('-time', '-id')
+    return {
+        'attempts': attempts,
+        'keyset_first_page': measure(lambda: client.post('/api/v1/results/', data, format='json'), repeat),
+        'keyset_deep_page': measure(lambda: client.post('/api/v1/results/?cursor=%s' % deep_cursor, data,
+                                                        format='json'), repeat),
+        'offset_first_page_query': measure(lambda: list(history[:page_size]), repeat),
+        'offset_deep_page_query': measure(lambda: list(history[deep:deep + page_size]), repeat),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--attempts', type=int, default=10000000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+    with test_database():
+        report('pagination', run(args.attempts, args.repeat))
@@ -0,0 +1,221 @@
+""" Нагрузочные сценарии API на синтетических данных.
+
+    python -m benchmarks.scenarios [--polls 20] [--questions 10] [--choices 4] [--attempts 100000] [--users 1000]
+                                   [--repeat 500] [--scenarios list retrieve ...] [--output run.json]
+                                   [--baseline previous.json]
+
+Данные создаются командой generate_data во временной тестовой БД: SQLite или PostgreSQL, если он задан
+переменными окружения SQL_*. Каждый сценарий выполняет repeat запросов через тестовый клиент в том же процессе
+и сообщает задержку (p50/p95/p99), пропускную способность и количество SQL-запросов на запрос.
+Результат - JSON с номером коммита; с --baseline к каждому сценарию добавляется отношение p50/p95 к прошлому запуску.
+"""
+import argparse
+import json
+import platform
+import random
+import subprocess
+import time
+from datetime import datetime, timezone
+from io import StringIO
+
+from .base import test_database, summary, report
+
+import django
+from django.core.management import call_command
+from django.db import connection
+from rest_framework.test import APIClient
+
+from poll.models import Poll, Question, MyUser
+from poll.schema import schema_cache
+
+SCENARIOS = {}
+
+
+def scenario(name):
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+class Context:
+    """ Общие данные сценариев: клиенты, активные опросы и пользователи"""
+
+    def __init__(self, seed):
+        self.rnd = random.Random(seed)
+        self.client = APIClient()
+        self.admin = APIClient()
+        self.admin.force_authenticate(MyUser.objects.create_user(username='bench-admin', password=None,
+                                                                 is_staff=True))
+        self.polls = list(Poll.objects.active().values_list('id', flat=True))
+        self.users = list(MyUser.objects.filter(is_staff=False).values_list('id', flat=True))
+
+    def poll(self):
+        return self.rnd.choice(self.polls)
+
+    def answers(self, poll_id):
+        answers = []
+        for question in schema_cache.get(poll_id).questions:
+            if question.question_type == Question.TEXT:
+                answer = ['Ответ']
+            elif question.question_type == Question.SINGLE_CHOICE:
+                answer = [self.rnd.choice(question.choices)]
+            else:
+                answer = self.rnd.sample(question.choices, self.rnd.randint(1, len(question.choices)))
+            answers.append({'position': question.position, 'answer': answer})
+        return answers
+
+
+@scenario('list')
+def poll_list(context, repeat):
+    return lambda: context.client.get('/api/v1/polls/')
+
+
+@scenario('retrieve')
+def poll_retrieve(context, repeat):
+    return lambda: context.client.get('/api/v1/polls/%d/' % context.poll())
+
+
+@scenario('poll_results')
+def poll_results(context, repeat):
+    return lambda: context.client.get('/api/v1/polls/%d/results/' % context.poll())
+
+
+@scenario('vote')
+def vote(context, repeat):
+    def step():
+        poll_id = context.poll()
+        data = {'user': context.rnd.choice(context.users), 'answers': context.answers(poll_id)}
+        return context.client.post('/api/v1/polls/%d/vote/' % poll_id, data, format='json')
+    return step
+
+
+@scenario('vote_anonymous')
+def vote_anonymous(context, repeat):
+    def step():
+        poll_id = context.poll()
+        return context.client.post('/api/v1/polls/%d/vote/' % poll_id, {'answers': context.answers(poll_id)},
+                                   format='json')
+    return step
+
+
+@scenario('history')
+def history(context, repeat):
+    return lambda: context.client.post('/api/v1/results/', {'user': context.rnd.choice(context.users)},
+                                       format='json')
+
+
+def _free_positions(poll_id, count):
+    start = (Question.objects.filter(poll_id=poll_id).order_by('-position').values_list(
+        'position', flat=True).first() or 0) + 1
+    return iter(range(start, start + count))
+
+
+@scenario('question_create')
+def question_create(context, repeat):
+    poll_id = context.poll()
+    positions = _free_positions(poll_id, repeat)
+    return lambda: context.admin.post('/api/v1/polls/%d/questions/' % poll_id, {
+        'position': next(positions), 'question_type': 'Ответ с выбором одного варианта',
+        'main_text': 'Новый вопрос', 'choices': ['Да', 'Нет']}, format='json')
+
+
+@scenario('question_update')
+def question_update(context, repeat):
+    poll_id = context.poll()
+    return lambda: context.admin.patch('/api/v1/polls/%d/questions/1/' % poll_id,
+                                       {'main_text': 'Вопрос %d' % context.rnd.randrange(1000)}, format='json')
+
+
+@scenario('question_delete')
+def question_delete(context, repeat):
+    poll_id = context.poll()
+    positions = list(_free_positions(poll_id, repeat))
+    Question.objects.bulk_create([Question(poll_id=poll_id, position=position, main_text='Удаляемый вопрос')
+                                  for position in positions])
+    schema_cache.invalidate(poll_id)
+    positions = iter(positions)
+    return lambda: context.admin.delete('/api/v1/polls/%d/questions/%d/' % (poll_id, next(positions)))
+
+
+def run_scenario(step, repeat):
+    """ Выполнить шаг сценария repeat раз: задержки, SQL-запросы на запрос и ответы с ошибкой"""
+    queries, latencies, errors = [0], [], 0
+
+    def count(execute, *args):
+        queries[0] += 1
+        return execute(*args)
+
+    # Журнал запросов соединения сбрасывается сигналом request_started, поэтому считаем запросы обёрткой
+    with connection.execute_wrapper(count):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = step()
+            latencies.append((time.perf_counter() - start) * 1000)
+            errors += response.status_code >= 400
+    return dict(summary(latencies), queries_per_request=round(queries[0] / repeat, 2), errors=errors)
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """ Отношение p50/p95 к прошлому запуску: меньше 1 - быстрее"""
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if previous:
+            for key in ('p50_ms', 'p95_ms'):
+                if previous.get(key):
+                    current['%s_ratio' % key[:-3]] = round(current[key] / previous[key], 3)
+    results['baseline_commit'] = baseline.get('commit')
+    return results
+
+
+def run(options):
+    dataset = {key: options[key] for key in ('polls', 'questions', 'choices', 'attempts', 'users')}
+    started = time.monotonic()
+    call_command('generate_data', seed=options['seed'], stdout=StringIO(), **dataset)
+    generated = round(time.monotonic() - started, 1)
+    context = Context(options['seed'])
+    scenarios = {}
+    for name in options['scenarios']:
+        scenarios[name] = run_scenario(SCENARIOS[name](context, options['repeat']), options['repeat'])
+    return {
+        'commit': commit(),
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'database': connection.vendor,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'dataset': dict(dataset, generate_seconds=generated),
+        'repeat': options['repeat'],
+        'scenarios': scenarios,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--polls', type=int, default=20)
+    parser.add_argument('--questions', type=int, default=10)
+    parser.add_argument('--choices', type=int, default=4)
+    parser.add_argument('--attempts', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--output', help='Сохранить результат в файл')
+    parser.add_argument('--baseline', help='Результат прошлого запуска для сравнения')
+    args = parser.parse_args()
+    with test_database():
+        results = run(vars(args))
+    if args.baseline:
+        with open(args.baseline) as file:
+            results = compare(results, json.load(file))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+    report('scenarios', results)
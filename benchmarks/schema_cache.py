@@ -0,0 +1,45 @@
+""" Задержка retrieve и vote с холодным и прогретым кэшем схем опросов.
+
+    python -m benchmarks.schema_cache [--questions 10 40 100] [--repeat 200]
+"""
+import argparse
+
+from .base import test_database, create_poll, make_answers, measure, report
+
+from django.core.cache import caches
+from rest_framework.test import APIClient
+
+from poll.models import MyUser
+from poll.schema import schema_cache
+
+
+def cold():
+    caches['default'].clear()
+    schema_cache.local.clear()
+
+
+def run(sizes, repeat):
+    client = APIClient()
+    user = MyUser.objects.create_user(username='bench', password=None)
+    results = {}
+    for size in sizes:
+        poll = create_poll(questions=size)
+        url = '/api/v1/polls/%d/' % poll.pk
+        vote = {'user': user.pk, 'answers': make_answers(poll)}
+        results[size] = {
+            'retrieve_cold': measure(lambda: client.get(url), repeat, setup=cold),
+            'retrieve_warm': measure(lambda: client.get(url), repeat),
+            'vote_cold': measure(lambda: client.post(url + 'vote/', vote, format='json'), repeat, setup=cold),
+            'vote_warm': measure(lambda: client.post(url + 'vote/', vote, format='json'), repeat),
+        }
+    results['stats'] = dict(schema_cache.stats)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--questions', type=int, nargs='+', default=[10, 40, 100])
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+    with test_database():
+        report('schema_cache', run(args.questions, args.repeat))
@@ -0,0 +1,94 @@
+""" Поиск по ответам на текстовый вопрос: индекс FTS5 (poll/search.py) против сканирования LIKE '%слово%'.
+
+    python -m benchmarks.search [--answers 1000000] [--vocabulary 20000] [--repeat 20]
+
+Ответы - от 3 до 15 слов из словаря vocabulary слов с частотами по закону Ципфа. Для слов разной частоты
+(частое, среднее, редкое, два слова) измеряется первая страница результатов вместе с числом найденных,
+как ее получает /answers/search/. write - запись ответов с триггерами индекса и без них.
+"""
+import argparse
+import itertools
+import random
+import time
+
+from .base import test_database, create_poll, measure, report
+
+from django.db import connection
+
+from poll.models import MyUser, Attempt, Answer
+from poll.search import FTS5Search, LikeSearch, SearchResults
+
+WORDS = 'абвгдежзиклмнопрстуфхцчшэюя'
+
+
+def vocabulary(size, rng):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(WORDS) for _ in range(rng.randint(4, 9))))
+    return sorted(words)
+
+
+def create_answers(poll, user, count, words, rng, batch_size=5000):
+    question = poll.questions.get()
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+    for start in range(0, count, batch_size):
+        attempts = Attempt.objects.bulk_create([Attempt(user=user, poll=poll)
+                                                for _ in range(min(batch_size, count - start))])
+        Answer.objects.bulk_create([
+            Answer(attempt=attempt, question=question,
+                   answer=str([' '.join(rng.choices(words, cum_weights=weights, k=rng.randint(3, 15)))]))
+            for attempt in attempts])
+    return question
+
+
+def timed_write(poll, user, words, rng, count, triggers):
+    """ Запись count ответов с триггерами индекса или без них (после замера индекс строится заново)"""
+    search = FTS5Search('default')
+    if not triggers:
+        with connection.cursor() as cursor:
+            for name in ('insert', 'delete', 'update'):
+                cursor.execute('DROP TRIGGER poll_answer_fts_%s' % name)
+    start = time.perf_counter()
+    create_answers(poll, user, count, words, rng)
+    seconds = time.perf_counter() - start
+    if not triggers:
+        search.rebuild()
+    return round(count / seconds)
+
+
+def run(answers, size, repeat):
+    rng = random.Random(1)
+    user = MyUser.objects.create_user(username='bench', password=None)
+    poll = create_poll(questions=1)
+    words = vocabulary(size, rng)
+    start = time.perf_counter()
+    question = create_answers(poll, user, answers, words, rng)
+    results = {'answers': answers, 'data_seconds': round(time.perf_counter() - start, 1)}
+    queries = {
+        'common': [words[0]],
+        'medium': [words[size // 100]],
+        'rare': [words[-1]],
+        'two_words': [words[1], words[size // 50]],
+    }
+    for name, terms in queries.items():
+        results[name] = {}
+        for engine, search in (('fts5', FTS5Search('default')), ('like', LikeSearch('default'))):
+            search_results = SearchResults(question.id, terms, search=search)
+            results[name][engine] = measure(lambda: (search_results.count(), search_results[0:20]),
+                                            repeat=repeat)
+            results[name][engine]['found'] = search_results.count()
+    results['write_answers_per_second'] = {
+        'with_index': timed_write(poll, user, words, rng, 20000, triggers=True),
+        'without_index': timed_write(poll, user, words, rng, 20000, triggers=False),
+    }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--answers', type=int, default=1000000)
+    parser.add_argument('--vocabulary', type=int, default=20000, help='Слов в словаре ответов')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    with test_database():
+        report('search', run(args.answers, args.vocabulary, args.repeat))
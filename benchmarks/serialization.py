@@ -0,0 +1,72 @@
+""" Сериализация ответов чтения: сериализаторы DRF и JSONRenderer против строк .values() (fast.py)
+и FastJSONRenderer, по размеру опроса.
+
+    python -m benchmarks.serialization [--sizes 10 50 200] [--polls 100] [--repeat 200]
+
+Для каждого размера опроса измеряется построение и рендеринг страницы истории (20 попыток) и списка вопросов,
+вместе с чтением из БД; отдельно - страница списка опросов из --polls записей. FastJSONRenderer использует
+orjson, если он установлен (в отчете поле orjson).
+"""
+import argparse
+from io import StringIO
+
+from .base import test_database, create_poll, create_attempts, measure, report
+
+from django.core.management import call_command
+from rest_framework.renderers import JSONRenderer
+
+from poll import renderers
+from poll.fast import POLL_FIELDS, ATTEMPT_FIELDS, poll_rows, question_rows, attempt_rows
+from poll.models import Poll, Attempt, MyUser
+from poll.renderers import FastJSONRenderer
+from poll.serializers import PollSerializer, WriteQuestionSerializer, AttemptSerializer
+
+PAGE_SIZE = 20
+
+
+def compare(drf, fast, repeat):
+    """ Оба варианта должны давать одинаковый ответ; gain - отношение p50"""
+    assert drf() == fast()
+    result = {'drf': measure(drf, repeat), 'fast': measure(fast, repeat)}
+    result['gain'] = round(result['drf']['p50_ms'] / result['fast']['p50_ms'], 2)
+    return result
+
+
+def run(sizes, polls, repeat):
+    user = MyUser.objects.create_user(username='bench', password=None)
+    drf_json, fast_json = JSONRenderer(), FastJSONRenderer()
+    results = {'orjson': renderers.orjson is not None, 'sizes': {}}
+    for size in sizes:
+        poll = create_poll(questions=size)
+        create_attempts(poll, PAGE_SIZE, user)
+        call_command('backfill_snapshots', poll.pk, stdout=StringIO())
+        attempts = Attempt.objects.filter(poll=poll).order_by('-time', '-id')
+        questions = poll.questions.order_by('position').prefetch_related('choices')
+        results['sizes'][size] = {
+            'history': compare(
+                lambda: drf_json.render(AttemptSerializer(attempts.select_related('poll'), many=True).data),
+                lambda: fast_json.render(attempt_rows(list(attempts.values(*ATTEMPT_FIELDS)))),
+                repeat),
+            'questions': compare(
+                lambda: drf_json.render(WriteQuestionSerializer(questions.all(), many=True).data),
+                lambda: fast_json.render(question_rows(poll.pk)),
+                repeat),
+        }
+    for n in range(polls):
+        Poll.objects.create(title='Опрос %d' % n, description='Описание опроса %d' % n)
+    page = Poll.objects.order_by('-started_at', '-id')[:polls]
+    results['poll_list'] = compare(
+        lambda: drf_json.render(PollSerializer(page.all(), many=True).data),
+        lambda: fast_json.render(poll_rows(page.values(*POLL_FIELDS))),
+        repeat)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50, 200], help='Вопросов в опросе')
+    parser.add_argument('--polls', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+    with test_database():
+        report('serialization', run(args.sizes, args.polls, args.repeat))
@@ -0,0 +1,46 @@
+""" Пропускная способность GET /polls/ с аутентификацией по токену: TokenAuthentication
+против CachedTokenAuthentication.
+
+    python -m benchmarks.token_auth [--polls 20] [--repeat 2000]
+"""
+import argparse
+
+from .base import test_database, create_poll, measure, report
+
+from django.db import connection
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from poll.authentication import CachedTokenAuthentication, token_cache
+from poll.models import MyUser
+from poll.views import PollViewSet
+
+
+def run(polls, repeat):
+    for _ in range(polls):
+        create_poll(questions=1)
+    user = MyUser.objects.create_user(username='bench', password=None)
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=user).key)
+    results = {'polls': polls}
+    for name, authentication in (('token', TokenAuthentication), ('cached_token', CachedTokenAuthentication)):
+        # Классы аутентификации читаются из настроек при импорте представления, подменяем их напрямую
+        PollViewSet.authentication_classes = [authentication]
+        token_cache.clear()
+        client.get('/api/v1/polls/')
+        # Журнал запросов сбрасывается сигналом request_started, поэтому считаем запросы обёрткой
+        queries = []
+        with connection.execute_wrapper(lambda execute, sql, *args: queries.append(sql) or execute(sql, *args)):
+            client.get('/api/v1/polls/')
+        results[name] = dict(measure(lambda: client.get('/api/v1/polls/'), repeat), queries=len(queries))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--polls', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+    with test_database():
+        report('token_auth', run(args.polls, args.repeat))
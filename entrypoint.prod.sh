@@ -7,4 +7,10 @@ then
     done
     echo "PostgreSQL started"
 fi
+# Метрики прежних воркеров не должны попасть в сумму (см. poll/metrics.py)
+if [ -n "$POLL_METRICS_DIR" ]
+then
+    rm -rf "$POLL_METRICS_DIR"
+    mkdir -p "$POLL_METRICS_DIR"
+fi
 exec "$@"
\ No newline at end of file
@@ -12,5 +12,14 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+# Голосование, опросы, итоги и история - асинхронными представлениями (см. poll/aio.py)
+os.environ.setdefault('POLL_ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
+
+from django.core.signals import request_finished  # noqa: E402
+from poll.aio import close_request_connections  # noqa: E402
+
+# Поток, в котором Django выполняет синхронный код запроса, завершается вместе с запросом: его подключения
+# к БД закрываются, а подключения пула poll/aio.py переиспользуются в пределах CONN_MAX_AGE
+request_finished.connect(close_request_connections)
@@ -47,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'poll.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -54,6 +55,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'poll.response_cache.ResponseCacheMiddleware',
+    'poll.db_routing.ReplicaRoutingMiddleware',
 ]
 
 ROOT_URLCONF = 'mysite.urls'
@@ -94,8 +97,49 @@ DATABASES = {
         "PASSWORD": os.environ.get("SQL_PASSWORD", "password"),
         "HOST": os.environ.get("SQL_HOST", "localhost"),
         "PORT": os.environ.get("SQL_PORT", "5432"),
+        # Секунд, которые подключение переиспользуется между запросами (0 - новое подключение на каждый запрос)
+        "CONN_MAX_AGE": int(os.environ.get("SQL_CONN_MAX_AGE", 60)),
     }
 }
+# Реплики для чтения (см. poll/db_routing.py): SQL_REPLICAS - через запятую хосты реплик (остальные параметры
+# как у default), для SQLite - пути к файлам реплик. В тестах реплики читают тестовую БД default
+for number, replica in enumerate(filter(None, os.environ.get("SQL_REPLICAS", "").split(",")), 1):
+    DATABASES["replica%d" % number] = dict(DATABASES["default"], TEST={"MIRROR": "default"}, **{
+        "NAME" if DATABASES["default"]["ENGINE"].endswith("sqlite3") else "HOST": replica.strip()})
+
+DATABASE_ROUTERS = ["poll.db_routing.ReplicaRouter"]
+
+# Асинхронные представления под ASGI (см. poll/aio.py): ENABLED - включаются в mysite/asgi.py,
+# THREADS - потоков для вызовов представлений в процессе (у каждого свое подключение к БД)
+POLL_ASYNC = {
+    "ENABLED": int(os.environ.get("POLL_ASYNC_VIEWS", 0)),
+    "THREADS": int(os.environ.get("POLL_ASYNC_THREADS", 8)),
+}
+
+# Настройка подключений (см. poll/db_connections.py): HEALTH_CHECKS - проверять постоянные подключения перед
+# запросом, SQLITE_PRAGMAS - PRAGMA каждого нового подключения к SQLite (None - не выполнять)
+POLL_DB_CONNECTIONS = {
+    "HEALTH_CHECKS": int(os.environ.get("SQL_HEALTH_CHECKS", 1)),
+    "SQLITE_PRAGMAS": {
+        "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "wal"),
+        "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000)),
+        "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "normal"),
+        # Отрицательное значение - размер в КиБ
+        "cache_size": int(os.environ.get("SQLITE_CACHE_SIZE", -16000)),
+        "mmap_size": int(os.environ.get("SQLITE_MMAP_SIZE", 0)) or None,
+    } if int(os.environ.get("SQLITE_PRAGMAS", 1)) else {},
+}
+
+# REPLICAS - псевдонимы реплик в DATABASES, PIN_SECONDS - сколько секунд клиент после записи читает из основной БД,
+# ALIAS - бэкенд из CACHES для этих отметок (с несколькими воркерами - общий для них, например Redis)
+# TRUSTED_PROXIES - адреса/сети прокси (nginx), которым верим X-Forwarded-For; без них анонимный клиент без токена
+# участника определяется по REMOTE_ADDR
+POLL_DB_ROUTING = {
+    "REPLICAS": [alias for alias in DATABASES if alias != "default"],
+    "PIN_SECONDS": int(os.environ.get("POLL_DB_PIN_SECONDS", 5)),
+    "ALIAS": os.environ.get("POLL_DB_PIN_CACHE_ALIAS", "default"),
+    "TRUSTED_PROXIES": os.environ.get("POLL_DB_TRUSTED_PROXIES", "").split(),
+}
 # DATABASES = {
 #     'default': {
 #         'ENGINE': 'django.db.backends.postgresql_psycopg2',
@@ -107,6 +151,135 @@ DATABASES = {
 #     }
 # }
 
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get("CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": os.environ.get("CACHE_LOCATION", ""),
+    },
+    # Ответы на запросы голосования с Idempotency-Key (см. poll/idempotency.py). LocMemCache по умолчанию -
+    # только для разработки: в нем не больше MAX_ENTRIES ключей, и повтор, попавший в другой процесс,
+    # исходного ответа не найдет. В продакшене - Redis (.env.prod)
+    "idempotency": {
+        "BACKEND": os.environ.get("IDEMPOTENCY_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": os.environ.get("IDEMPOTENCY_CACHE_LOCATION", "idempotency"),
+    },
+}
+if CACHES["idempotency"]["BACKEND"] == "django.core.cache.backends.locmem.LocMemCache":
+    # RedisCache передает OPTIONS клиенту Redis, MAX_ENTRIES понимает только LocMemCache
+    CACHES["idempotency"]["OPTIONS"] = {"MAX_ENTRIES": int(os.environ.get("IDEMPOTENCY_CACHE_MAX_ENTRIES", 100000))}
+
+# Кэш скомпилированных схем опросов (см. poll/schema.py):
+# ALIAS - бэкенд из CACHES, MAX_SIZE - размер LRU-кэша в памяти процесса, TIMEOUT - время жизни схемы в бэкенде
+POLL_SCHEMA_CACHE = {
+    "ALIAS": os.environ.get("POLL_SCHEMA_CACHE_ALIAS", "default"),
+    "MAX_SIZE": int(os.environ.get("POLL_SCHEMA_CACHE_SIZE", 512)),
+    "TIMEOUT": 24 * 60 * 60,
+}
+
+# Кэш ответов списка опросов и опроса (см. poll/response_cache.py): ALIAS - бэкенд из CACHES,
+# TIMEOUT - наибольшее время жизни ответа в бэкенде
+POLL_RESPONSE_CACHE = {
+    "ENABLED": int(os.environ.get("POLL_RESPONSE_CACHE", 1)),
+    "ALIAS": os.environ.get("POLL_RESPONSE_CACHE_ALIAS", "default"),
+    "TIMEOUT": int(os.environ.get("POLL_RESPONSE_CACHE_TIMEOUT", 5 * 60)),
+}
+
+# Буферизованное голосование (см. poll/ingest.py): голоса ставятся в очередь размером MAX_SIZE
+# и записываются пакетами до BATCH_SIZE голосов не реже чем раз в FLUSH_INTERVAL секунд.
+# Если очередь заполнена дольше PUT_TIMEOUT секунд, голос отклоняется с кодом 503.
+POLL_VOTE_BUFFER = {
+    "ENABLED": int(os.environ.get("POLL_VOTE_BUFFER", 0)),
+    "MAX_SIZE": int(os.environ.get("POLL_VOTE_BUFFER_SIZE", 10000)),
+    "BATCH_SIZE": int(os.environ.get("POLL_VOTE_BUFFER_BATCH", 500)),
+    "FLUSH_INTERVAL": float(os.environ.get("POLL_VOTE_BUFFER_INTERVAL", 0.5)),
+    "PUT_TIMEOUT": 0.05,
+    "DRAIN_TIMEOUT": 30,
+}
+
+# Анонимные участники опросов (см. poll/voters.py): подписанный токен участника передается
+# в заголовке HEADER или в cookie COOKIE_NAME
+POLL_VOTER = {
+    "HEADER": "X-Voter-Token",
+    "COOKIE_NAME": os.environ.get("POLL_VOTER_COOKIE", "poll_voter"),
+    "COOKIE_MAX_AGE": 365 * 24 * 60 * 60,
+}
+
+# Один голос на участника в опросах с Poll.one_vote (см. poll/duplicates.py): фильтры Блума по участникам
+# опросов в памяти процесса - не больше MAX_POLLS, на число участников не меньше MIN_CAPACITY, с долей ложных
+# срабатываний ERROR_RATE
+POLL_ONE_VOTE = {
+    "MAX_POLLS": int(os.environ.get("POLL_ONE_VOTE_MAX_POLLS", 64)),
+    "MIN_CAPACITY": 10000,
+    "ERROR_RATE": 0.01,
+    "BATCH_SIZE": 1000,
+}
+
+# Повтор голосования с заголовком Idempotency-Key (см. poll/idempotency.py): ALIAS - бэкенд из CACHES
+# (с несколькими воркерами - общий для них), TIMEOUT - время хранения ответа, PENDING_TIMEOUT - наибольшее время,
+# на которое ключ занимает выполняющийся запрос
+POLL_IDEMPOTENCY = {
+    "HEADER": "Idempotency-Key",
+    "ALIAS": os.environ.get("POLL_IDEMPOTENCY_CACHE_ALIAS", "idempotency"),
+    "TIMEOUT": int(os.environ.get("POLL_IDEMPOTENCY_TIMEOUT", 24 * 60 * 60)),
+    "PENDING_TIMEOUT": 60,
+    "MAX_KEY_LENGTH": 255,
+}
+
+# Метрики запросов по маршрутам (см. poll/metrics.py, адрес /metrics). Для gunicorn с несколькими воркерами
+# задайте общий каталог POLL_METRICS_DIR: воркеры сохраняют туда метрики не реже чем раз в FLUSH_INTERVAL секунд
+POLL_METRICS = {
+    "ENABLED": int(os.environ.get("POLL_METRICS", 1)),
+    "DIR": os.environ.get("POLL_METRICS_DIR", ""),
+    "FLUSH_INTERVAL": float(os.environ.get("POLL_METRICS_FLUSH_INTERVAL", 5)),
+    "BUCKETS": (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+}
+
+# Аналитика ответов опросов (см. poll/analytics.py): MAX_POLLS - опросов, столбцы ответов которых хранятся в памяти
+# процесса, ALIAS и TIMEOUT - бэкенд из CACHES и время жизни посчитанной аналитики, CHUNK_SIZE - попыток в запросе
+POLL_ANALYTICS = {
+    "MAX_POLLS": int(os.environ.get("POLL_ANALYTICS_MAX_POLLS", 8)),
+    "ALIAS": os.environ.get("POLL_ANALYTICS_ALIAS", "default"),
+    "TIMEOUT": 60 * 60,
+    "CHUNK_SIZE": 5000,
+}
+
+# Архивация закрытых опросов (см. poll/lifecycle.py): INTERVAL - секунд между поисками закрытых опросов (0 - не
+# искать), DIR - каталог файлов с ответами, CHUNK_SIZE - попыток в пакете, MAX_CROSSTABS - наибольшее число
+# замораживаемых таблиц сопряженности, KEEP_REHYDRATED_DAYS - дней до повторной архивации возвращенного опроса,
+# REQUIRE_PERSISTENT - не архивировать, если DIR на файловой системе контейнера (overlay, tmpfs), а не на томе
+POLL_LIFECYCLE = {
+    "INTERVAL": int(os.environ.get("POLL_LIFECYCLE_INTERVAL", 60 * 60)),
+    "DIR": os.environ.get("POLL_LIFECYCLE_DIR", os.path.join(BASE_DIR, "db", "archive")),
+    "CHUNK_SIZE": int(os.environ.get("POLL_LIFECYCLE_CHUNK_SIZE", 1000)),
+    "MAX_CROSSTABS": 55,
+    "KEEP_REHYDRATED_DAYS": int(os.environ.get("POLL_LIFECYCLE_KEEP_REHYDRATED_DAYS", 7)),
+    "REQUIRE_PERSISTENT": int(os.environ.get("POLL_LIFECYCLE_REQUIRE_PERSISTENT", 1)),
+}
+
+# Полнотекстовый поиск по ответам на текстовые вопросы (см. poll/search.py): MAX_TERMS - слов запроса
+POLL_SEARCH = {
+    "MAX_TERMS": int(os.environ.get("POLL_SEARCH_MAX_TERMS", 8)),
+}
+
+# Фоновые задачи (см. poll/jobs.py, команда runjobs): PROCESSES - число процессов, MAX_ATTEMPTS - попыток задачи,
+# повтор после ошибки через BACKOFF * 2^(n - 1), но не больше MAX_BACKOFF секунд; задача без отметок прогресса
+# дольше STALE_SECONDS выполняется заново. CHUNK_SIZE - попыток в транзакции удаления опроса, DIR - каталог выгрузок,
+# SCHEDULE_INTERVAL - секунд между проверками периодических задач
+POLL_JOBS = {
+    "PROCESSES": int(os.environ.get("POLL_JOBS_PROCESSES", 2)),
+    "MAX_ATTEMPTS": int(os.environ.get("POLL_JOBS_MAX_ATTEMPTS", 3)),
+    "BACKOFF": float(os.environ.get("POLL_JOBS_BACKOFF", 10)),
+    "MAX_BACKOFF": 10 * 60,
+    "STALE_SECONDS": int(os.environ.get("POLL_JOBS_STALE_SECONDS", 5 * 60)),
+    "POLL_INTERVAL": 1,
+    "CHUNK_SIZE": int(os.environ.get("POLL_JOBS_CHUNK_SIZE", 500)),
+    "DIR": os.environ.get("POLL_JOBS_DIR", os.path.join(BASE_DIR, "db", "jobs")),
+    "SCHEDULE_INTERVAL": 60,
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -125,12 +298,30 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Аутентификация по токену с кэшированием пользователя (см. poll/authentication.py).
+# Без кэша: AUTHENTICATION_CLASS=rest_framework.authentication.TokenAuthentication
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        os.environ.get('AUTHENTICATION_CLASS', 'poll.authentication.CachedTokenAuthentication'),
+    ),
+    # JSON через orjson из requirements.txt; если он не установлен - через JSONRenderer (см. poll/renderers.py)
+    'DEFAULT_RENDERER_CLASSES': (
+        'poll.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
     ),
 }
 
+# Кэш пользователей токенов: MAX_SIZE и LOCAL_TTL - размер и время жизни записи LRU-кэша в памяти процесса,
+# ALIAS - бэкенд из CACHES, общий для процессов (пусто - без него), TIMEOUT - время жизни записи в бэкенде.
+# Сброс записи при выходе или деактивации другие процессы видят только через ALIAS, а их LRU-кэш отдает прежнюю
+# запись до LOCAL_TTL секунд, поэтому с несколькими воркерами нужны ALIAS и LOCAL_TTL=0 (так в .env.prod)
+POLL_AUTH_CACHE = {
+    "ALIAS": os.environ.get("POLL_AUTH_CACHE_ALIAS", ""),
+    "MAX_SIZE": int(os.environ.get("POLL_AUTH_CACHE_SIZE", 10000)),
+    "LOCAL_TTL": float(os.environ.get("POLL_AUTH_CACHE_TTL", 30)),
+    "TIMEOUT": 5 * 60,
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/4.0/topics/i18n/
 
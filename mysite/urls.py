@@ -16,10 +16,13 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include, re_path
 
+from poll.views import metrics_view
+
 urlpatterns = [
     # path('admin/', admin.site.urls),
     path('api/v1/', include('poll.urls')),
     path('api/v1/auth/', include('djoser.urls')),
     re_path(r'^api/v1/auth/', include('djoser.urls.authtoken')),
+    path('metrics', metrics_view, name='metrics'),
 
 ]
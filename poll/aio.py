@@ -0,0 +1,87 @@
+""" Асинхронный путь запросов под ASGI (mysite/asgi.py).
+
+В Django 4.0 нет асинхронного ORM (aget, acreate появились в 4.1), а DRF не поддерживает асинхронные
+представления, поэтому async_view выполняет представление DRF целиком - проверку данных сериализатором, запросы
+к БД и рендеринг ответа - одним вызовом в пуле потоков (settings.POLL_ASYNC['THREADS']). Медленных клиентов
+(чтение тела запроса, отправку ответа) обслуживает цикл событий ASGI-сервера, не занимая поток.
+
+Синхронные представления и middleware Django под ASGI выполняет в потоке, который создается для каждого запроса
+(ThreadSensitiveContext) и завершается вместе с ним. Число таких потоков, а значит и подключений к БД, ничем
+не ограничено, и подключение из потока запроса нельзя переиспользовать: close_request_connections закрывает его
+в конце запроса, независимо от CONN_MAX_AGE. Потоки пула живут все время работы процесса, их не больше THREADS,
+и их подключения переиспользуются между запросами. До и после вызова в пуле подключения проверяются
+и закрываются по тем же правилам, что в начале и в конце запроса (как database_sync_to_async в Django Channels).
+Переменные контекста запроса (маршрутизация по репликам, счетчик SQL-запросов метрик) передаются в поток
+копией контекста.
+"""
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.urls import URLPattern
+
+from .db_connections import check_connections
+from .metrics import count_queries
+
+_executor = None
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'POLL_ASYNC', {}).get('THREADS', 8),
+                                       thread_name_prefix='poll-async')
+    return _executor
+
+
+def _call(func, args, kwargs):
+    check_connections()
+    close_old_connections()
+    try:
+        with count_queries():
+            return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+def close_request_connections(**kwargs):
+    """ Закрыть подключения к БД потока запроса (сигнал request_finished под ASGI, см. mysite/asgi.py).
+    Подключение внутри транзакции (тесты) не трогается"""
+    for connection in connections.all():
+        if not connection.in_atomic_block:
+            connection.close()
+
+
+def database_sync_to_async(func):
+    """ Асинхронная функция, которая выполняет синхронную func с доступом к БД в пуле потоков"""
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            executor(), partial(context.run, _call, func, args, kwargs))
+
+    return wrapper
+
+
+def async_view(view):
+    """ Асинхронная версия представления: ответ рендерится в том же потоке пула. Атрибуты представления
+    (cls, csrf_exempt и др.) сохраняются, их читают middleware"""
+
+    def render(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if hasattr(response, 'render') and not response.is_rendered:
+            response.render()
+        return response
+
+    return wraps(view)(database_sync_to_async(render))
+
+
+def async_routes(patterns, names):
+    """ Маршруты patterns, в которых представления маршрутов с именами names заменены асинхронными"""
+    return [URLPattern(pattern.pattern, async_view(pattern.callback), pattern.default_args, pattern.name)
+            if isinstance(pattern, URLPattern) and pattern.name in names else pattern
+            for pattern in patterns]
@@ -0,0 +1,341 @@
+""" Аналитика ответов опроса: распределения ответов на вопросы с выбором, таблицы сопряженности двух вопросов
+("из выбравших X в вопросе 3 - что ответили в вопросе 7") и динамика прохождения по времени (Attempt.time).
+
+Ответы опроса один раз загружаются в столбцы (PollColumns): строка - попытка в порядке id, столбец - вариант
+ответа вопроса с выбором (выбран или нет), плюс время попытки. Распределение вопроса - суммы его столбцов,
+таблица сопряженности вопросов A и B - произведение матриц A^T·B (для вопросов с несколькими вариантами
+учитываются все пары выбранных вариантов), динамика - число попыток по интервалам времени. С NumPy (зависимость
+из requirements.txt) столбцы хранятся в массивах и все расчеты векторные (ArrayColumns); если он не установлен -
+битовые маски выбранных вариантов, одинаковые маски группируются (ListColumns).
+
+Столбцы хранятся в памяти процесса (LRU на MAX_POLLS опросов) вместе с id последней загруженной попытки,
+и при новых голосах догружаются только новые попытки. Распределения и таблицы - суммы по строкам, поэтому
+и они досчитываются только по новым строкам. Заново столбцы загружаются при изменении схемы опроса (версия
+кэша схем) и если число попыток не сходится со счетчиком итогов (PollTally): попытки удалялись или транзакции
+записали их не по порядку id. Посчитанная аналитика хранится в бэкенде кэша (ALIAS) под ключом из версии
+схемы, id последней попытки и счетчика попыток, поэтому новый голос сам делает старую запись ненужной.
+"""
+from abc import ABC, abstractmethod
+from collections import Counter
+from threading import Lock
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .lru import LRUCache
+from .models import Question, Attempt, AnswerChoice, PollTally
+from .schema import PollSchema
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Интервалы динамики прохождения, секунды
+BUCKETS = {
+    'hour': 60 * 60,
+    'day': 24 * 60 * 60,
+    'week': 7 * 24 * 60 * 60,
+}
+
+
+class PollAnalytics(NamedTuple):
+    schema: PollSchema
+    attempts: int
+    last_attempt: int
+    # {question_id: число попыток с ответом на вопрос}
+    answered: dict
+    # {question_id: [число выборов каждого варианта в порядке схемы]}
+    counts: dict
+    # [(QuestionSchema строк, QuestionSchema столбцов, [[число попыток с парой вариантов]])]
+    crosstabs: list
+    bucket: str
+    # [(начало интервала в секундах от эпохи, число попыток)]
+    timeline: list
+
+
+def options():
+    return getattr(settings, 'POLL_ANALYTICS', {})
+
+
+class PollColumns(ABC):
+    """ Ответы на вопросы с выбором по столбцам. Варианты вопроса занимают соседние столбцы (spans).
+    Хранение строк и суммы по диапазону строк [start, stop) определяют подклассы"""
+
+    def __init__(self, schema):
+        self.version = schema.version
+        self.spans = {}
+        self.choice_ids = []
+        for question in schema.questions:
+            if question.question_type != Question.TEXT:
+                start = len(self.choice_ids)
+                self.choice_ids.extend(question.choice_ids)
+                self.spans[question.id] = (start, len(self.choice_ids))
+        self.column = {choice_id: column for column, choice_id in enumerate(self.choice_ids)}
+        self.last_id = 0
+        self.count = 0
+        # Посчитанные суммы: {ключ: (число учтенных строк, значение)}
+        self.memo = {}
+
+    def load(self, poll_id, last_id, chunk_size):
+        """ Догрузить попытки опроса с id больше загруженных и не больше last_id. Попытки читаются пакетами
+        по id, выбранные варианты - одним запросом на пакет по диапазону id его попыток"""
+        attempts = Attempt.objects.filter(poll_id=poll_id, id__lte=last_id).order_by('id')
+        chunks = []
+        while True:
+            batch = list(attempts.filter(id__gt=self.last_id).values_list('id', 'time')[:chunk_size])
+            if not batch:
+                break
+            ids = [attempt_id for attempt_id, _ in batch]
+            # Диапазоном id, а не списком: построение запроса с тысячами параметров дороже самого запроса
+            selected = list(AnswerChoice.objects.filter(
+                answer__attempt__poll_id=poll_id, answer__attempt_id__gt=self.last_id,
+                answer__attempt_id__lte=ids[-1]).values_list('answer__attempt_id', 'choice_id'))
+            chunks.append(self.chunk(ids, [int(time.timestamp()) for _, time in batch], selected))
+            self.last_id = ids[-1]
+            self.count += len(ids)
+        if chunks:
+            self.extend(chunks)
+
+    @abstractmethod
+    def chunk(self, ids, times, selected):
+        """ Пакет попыток во внутреннем формате: ids и times - по возрастанию id, selected - [(id, choice_id)]"""
+
+    @abstractmethod
+    def extend(self, chunks):
+        """ Добавить пакеты попыток в конец столбцов"""
+
+    @abstractmethod
+    def _choice_counts(self, span, start, stop):
+        """ Число выборов каждого варианта в столбцах span по строкам [start, stop)"""
+
+    @abstractmethod
+    def _answered(self, span, start, stop):
+        """ Число строк [start, stop), в которых выбран вариант из столбцов span"""
+
+    @abstractmethod
+    def _crosstab(self, rows, columns, start, stop):
+        """ Таблица сопряженности столбцов rows и columns по строкам [start, stop)"""
+
+    @abstractmethod
+    def _timeline(self, seconds, start, stop):
+        """ Counter {начало интервала: число строк [start, stop)}"""
+
+    def aggregate(self, key, compute, merge):
+        """ Сумма по строкам: считается только по строкам, добавленным после прошлого расчета.
+        compute(start, stop) - значение по строкам [start, stop), merge - сложение двух значений"""
+        rows, value = self.memo.get(key, (0, None))
+        if rows < self.count:
+            delta = compute(rows, self.count)
+            value = delta if value is None else merge(value, delta)
+            self.memo[key] = (self.count, value)
+        return value
+
+    def choice_counts(self, span):
+        """ Число выборов каждого варианта в столбцах span"""
+        return self.aggregate(('counts', span), lambda start, stop: self._choice_counts(span, start, stop),
+                              lambda a, b: [x + y for x, y in zip(a, b)]) or [0] * (span[1] - span[0])
+
+    def answered(self, span):
+        """ Число попыток, в которых выбран хотя бы один вариант из столбцов span"""
+        return self.aggregate(('answered', span), lambda start, stop: self._answered(span, start, stop),
+                              lambda a, b: a + b) or 0
+
+    def crosstab(self, rows, columns):
+        """ Таблица сопряженности: [[число попыток, выбравших вариант строки и вариант столбца]]"""
+        return self.aggregate(
+            ('crosstab', rows, columns), lambda start, stop: self._crosstab(rows, columns, start, stop),
+            lambda a, b: [[x + y for x, y in zip(row_a, row_b)] for row_a, row_b in zip(a, b)],
+        ) or [[0] * (columns[1] - columns[0]) for _ in range(rows[1] - rows[0])]
+
+    def timeline(self, seconds):
+        """ [(начало интервала, число попыток)] по интервалам длиной seconds"""
+        counts = self.aggregate(('timeline', seconds), lambda start, stop: self._timeline(seconds, start, stop),
+                                lambda a, b: a + b) or Counter()
+        return sorted(counts.items())
+
+
+class ArrayColumns(PollColumns):
+    """ Столбцы в массивах NumPy: матрица попыток на варианты ответа (bool) и массив времени попыток"""
+
+    def __init__(self, schema):
+        super().__init__(schema)
+        self.times = numpy.empty(0, dtype=numpy.int64)
+        self.cells = numpy.zeros((0, len(self.choice_ids)), dtype=bool)
+        # Номер столбца варианта через поиск в отсортированных id вариантов
+        choice_ids = numpy.array(self.choice_ids, dtype=numpy.int64)
+        self.order = numpy.argsort(choice_ids)
+        self.sorted_ids = choice_ids[self.order]
+
+    def chunk(self, ids, times, selected):
+        ids = numpy.array(ids, dtype=numpy.int64)
+        cells = numpy.zeros((len(ids), len(self.choice_ids)), dtype=bool)
+        if selected and len(self.sorted_ids):
+            selected = numpy.array(selected, dtype=numpy.int64)
+            positions = numpy.searchsorted(self.sorted_ids, selected[:, 1]).clip(max=len(self.sorted_ids) - 1)
+            # Варианты, которых нет в схеме, пропускаются
+            known = self.sorted_ids[positions] == selected[:, 1]
+            cells[numpy.searchsorted(ids, selected[known, 0]), self.order[positions[known]]] = True
+        return numpy.array(times, dtype=numpy.int64), cells
+
+    def extend(self, chunks):
+        times, cells = zip(*chunks)
+        self.times = numpy.concatenate((self.times, ) + times)
+        self.cells = numpy.concatenate((self.cells, ) + cells)
+
+    def _choice_counts(self, span, start, stop):
+        return numpy.count_nonzero(self.cells[start:stop, slice(*span)], axis=0).tolist()
+
+    def _answered(self, span, start, stop):
+        return int(numpy.count_nonzero(self.cells[start:stop, slice(*span)].any(axis=1)))
+
+    def _crosstab(self, rows, columns, start, stop):
+        # Произведение матриц в float64 (BLAS) точно до 2^53 попыток и быстрее целочисленного
+        table = numpy.dot(self.cells[start:stop, slice(*rows)].T.astype(numpy.float64),
+                          self.cells[start:stop, slice(*columns)].astype(numpy.float64))
+        return table.astype(numpy.int64).tolist()
+
+    def _timeline(self, seconds, start, stop):
+        buckets = self.times[start:stop] // seconds
+        first = buckets.min()
+        counts = numpy.bincount(buckets - first)
+        nonzero = numpy.flatnonzero(counts)
+        return Counter(dict(zip(((nonzero + first) * seconds).tolist(), counts[nonzero].tolist())))
+
+
+class ListColumns(PollColumns):
+    """ Столбцы без NumPy: битовая маска выбранных вариантов каждой попытки и список времени попыток.
+    Расчеты идут по группам одинаковых масок, которых обычно намного меньше, чем попыток"""
+
+    def __init__(self, schema):
+        super().__init__(schema)
+        self.masks = []
+        self.times = []
+
+    def chunk(self, ids, times, selected):
+        rows = {attempt_id: row for row, attempt_id in enumerate(ids)}
+        masks = [0] * len(ids)
+        for attempt_id, choice_id in selected:
+            column = self.column.get(choice_id)
+            if column is not None:
+                masks[rows[attempt_id]] |= 1 << column
+        return masks, times
+
+    def extend(self, chunks):
+        for masks, times in chunks:
+            self.masks.extend(masks)
+            self.times.extend(times)
+
+    @staticmethod
+    def _bits(span):
+        return ((1 << span[1]) - 1) ^ ((1 << span[0]) - 1)
+
+    @staticmethod
+    def _columns(mask, span):
+        return [column - span[0] for column in range(*span) if mask >> column & 1]
+
+    def _choice_counts(self, span, start, stop):
+        bits = self._bits(span)
+        counts = [0] * (span[1] - span[0])
+        for mask, count in Counter(mask & bits for mask in self.masks[start:stop]).items():
+            for column in self._columns(mask, span):
+                counts[column] += count
+        return counts
+
+    def _answered(self, span, start, stop):
+        bits = self._bits(span)
+        return sum(1 for mask in self.masks[start:stop] if mask & bits)
+
+    def _crosstab(self, rows, columns, start, stop):
+        row_bits, column_bits = self._bits(rows), self._bits(columns)
+        table = [[0] * (columns[1] - columns[0]) for _ in range(rows[1] - rows[0])]
+        for (row_mask, column_mask), count in Counter(
+                (mask & row_bits, mask & column_bits) for mask in self.masks[start:stop]).items():
+            for row in self._columns(row_mask, rows):
+                for column in self._columns(column_mask, columns):
+                    table[row][column] += count
+        return table
+
+    def _timeline(self, seconds, start, stop):
+        return Counter(time // seconds * seconds for time in self.times[start:stop])
+
+
+class AnalyticsEngine:
+    """ Аналитика опросов с кэшем столбцов в памяти процесса и кэшем результатов в бэкенде"""
+
+    def __init__(self):
+        self._columns = None
+        # Столбцы опроса изменяются при догрузке, поэтому расчеты в процессе идут по одному
+        self._lock = Lock()
+
+    @property
+    def columns(self):
+        if self._columns is None:
+            self._columns = LRUCache(maxsize=options().get('MAX_POLLS', 8))
+        return self._columns
+
+    @property
+    def backend(self):
+        return caches[options().get('ALIAS', 'default')]
+
+    @staticmethod
+    def columns_class():
+        return ArrayColumns if numpy is not None else ListColumns
+
+    def load_columns(self, schema, last_id, count):
+        """ Столбцы опроса с попытками до last_id: из кэша с догрузкой новых попыток или заново.
+        count - число попыток по счетчику итогов; если он расходится с загруженными, попытки пересчитываются"""
+        columns = self.columns.get(schema.id)
+        if columns is None or columns.version != schema.version or columns.last_id > last_id \
+                or not isinstance(columns, self.columns_class()):
+            columns = self.columns_class()(schema)
+        chunk_size = options().get('CHUNK_SIZE', 5000)
+        columns.load(schema.id, last_id, chunk_size)
+        if columns.count != count and columns.count != Attempt.objects.filter(
+                poll_id=schema.id, id__lte=last_id).count():
+            # Пропущены попытки с меньшими id или часть попыток удалена
+            columns = self.columns_class()(schema)
+            columns.load(schema.id, last_id, chunk_size)
+        self.columns.set(schema.id, columns)
+        return columns
+
+    @staticmethod
+    def state(poll_id):
+        """ id последней попытки и число попыток по счетчику итогов (без подсчета всех попыток опроса)"""
+        last_id = Attempt.objects.filter(poll_id=poll_id).order_by('-id').values_list('id', flat=True).first()
+        count = PollTally.objects.filter(poll_id=poll_id).values_list('attempts', flat=True).first()
+        return last_id or 0, count or 0
+
+    def get(self, schema, crosstabs=(), bucket='day'):
+        """ Аналитика опроса по схеме. crosstabs - пары QuestionSchema вопросов с выбором"""
+        last_id, count = self.state(schema.id)
+        key = 'poll-analytics:%d:%d:%d:%d:%s:%s' % (schema.id, schema.version, last_id, count, bucket, ','.join(
+            '%d-%d' % (question_a.id, question_b.id) for question_a, question_b in crosstabs))
+        analytics = self.backend.get(key)
+        if analytics is None:
+            with self._lock:
+                analytics = self.compute(self.load_columns(schema, last_id, count), schema, crosstabs, bucket)
+            self.backend.set(key, analytics, options().get('TIMEOUT', 60 * 60))
+        return analytics
+
+    @staticmethod
+    def compute(columns, schema, crosstabs, bucket):
+        spans = columns.spans
+        return PollAnalytics(
+            schema=schema,
+            attempts=columns.count,
+            last_attempt=columns.last_id,
+            answered={question_id: columns.answered(span) for question_id, span in spans.items()},
+            counts={question_id: columns.choice_counts(span) for question_id, span in spans.items()},
+            crosstabs=[(question_a, question_b, columns.crosstab(spans[question_a.id], spans[question_b.id]))
+                       for question_a, question_b in crosstabs],
+            bucket=bucket,
+            timeline=columns.timeline(BUCKETS[bucket]),
+        )
+
+    def clear(self):
+        self.columns.clear()
+
+
+analytics_engine = AnalyticsEngine()
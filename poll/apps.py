@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class PollConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'poll'
+
+    def ready(self):
+        # lifecycle регистрирует фоновые задачи архивации (см. jobs.job)
+        from . import db_connections, lifecycle, signals  # noqa: F401
@@ -0,0 +1,133 @@
+""" Аутентификация по токену с кэшированием пользователя токена.
+
+TokenAuthentication на каждый запрос читает токен вместе с пользователем из БД. CachedTokenAuthentication
+хранит результат в LRU-кэше процесса с ограниченным временем жизни (settings.POLL_AUTH_CACHE['LOCAL_TTL'])
+и, если задан ALIAS, в бэкенде Django cache, общем для всех процессов.
+
+Запись сбрасывается при удалении токена (выход через djoser token/logout) и при сохранении пользователя
+(деактивация, смена пароля), см. signals.py. Другие процессы узнают об этом из бэкенда, но их LRU-кэш может
+отдавать прежнюю запись до истечения LOCAL_TTL секунд. Хэш пароля в кэш не попадает: поле password
+загружается из БД при первом обращении.
+"""
+import hashlib
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from .lru import LRUCache
+from .models import MyUser
+
+# Поля пользователя, которые хранятся в кэше
+USER_FIELDS = tuple(field.attname for field in MyUser._meta.concrete_fields if field.attname != 'password')
+
+
+class TokenCache:
+    """ Двухуровневый кэш пользователей токенов: LRU с TTL в памяти процесса и бэкенд Django cache"""
+
+    def __init__(self):
+        self._local = None
+        self.stats = Counter()
+
+    @property
+    def options(self):
+        return getattr(settings, 'POLL_AUTH_CACHE', {})
+
+    @property
+    def backend(self):
+        alias = self.options.get('ALIAS')
+        return caches[alias] if alias else None
+
+    @property
+    def local(self):
+        if self._local is None:
+            self._local = LRUCache(self.options.get('MAX_SIZE', 10000), ttl=self.options.get('LOCAL_TTL', 30))
+        return self._local
+
+    @staticmethod
+    def _backend_key(key):
+        # Сам токен в ключах общего кэша не храним
+        return 'auth-token:%s' % hashlib.sha256(key.encode()).hexdigest()
+
+    @staticmethod
+    def _dump(token):
+        return token.created, tuple(getattr(token.user, name) for name in USER_FIELDS)
+
+    @staticmethod
+    def _load(key, entry):
+        created, values = entry
+        user = MyUser.from_db(None, USER_FIELDS, values)
+        token = Token.from_db(None, ('key', 'user_id', 'created'), (key, user.pk, created))
+        Token.user.field.set_cached_value(token, user)
+        return token
+
+    def get(self, key):
+        """ Токен с загруженным пользователем или None"""
+        entry = self.local.get(key)
+        if entry is not None:
+            self.stats['local_hits'] += 1
+            return self._load(key, entry)
+        backend = self.backend
+        if backend is not None:
+            entry = backend.get(self._backend_key(key))
+            if entry is not None:
+                self.stats['shared_hits'] += 1
+                self.local.set(key, entry)
+                return self._load(key, entry)
+        self.stats['misses'] += 1
+        return None
+
+    def set(self, token):
+        entry = self._dump(token)
+        self.local.set(token.key, entry)
+        if self.backend is not None:
+            self.backend.set(self._backend_key(token.key), entry, self.options.get('TIMEOUT', 5 * 60))
+
+    def _delete(self, keys):
+        for key in keys:
+            self.local.pop(key)
+        if self.backend is not None and keys:
+            self.backend.delete_many([self._backend_key(key) for key in keys])
+
+    def invalidate(self, *keys):
+        """ Сбросить записи токенов.
+
+        Внутри транзакции записи сбрасываются еще раз после фиксации, иначе конкурентный запрос
+        мог бы закэшировать пользователя в состоянии до фиксации"""
+        self._delete(keys)
+        if transaction.get_connection().in_atomic_block:
+            transaction.on_commit(lambda: self._delete(keys))
+
+    def invalidate_user(self, user_id):
+        """ Сбросить записи всех токенов пользователя"""
+        self.invalidate(*Token.objects.filter(user_id=user_id).values_list('key', flat=True))
+
+    def clear(self):
+        """ Сбросить кэш процесса; следующий get создаст его заново по текущим настройкам"""
+        self._local = None
+        self.stats.clear()
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """ TokenAuthentication с кэшированием токена и пользователя (см. TokenCache).
+    В кэш попадают только токены активных пользователей. Если пользователя запроса уже определил
+    ResponseCacheMiddleware (request.authenticated_token), токен второй раз не проверяется"""
+
+    def authenticate(self, request):
+        authenticated = getattr(request, 'authenticated_token', None)
+        if authenticated is not None:
+            return authenticated
+        return super().authenticate(request)
+
+    def authenticate_credentials(self, key):
+        token = token_cache.get(key)
+        if token is None:
+            user, token = super().authenticate_credentials(key)
+            token_cache.set(token)
+        return token.user, token
@@ -0,0 +1,55 @@
+""" Настройка подключений к БД.
+
+При создании подключения к SQLite (сигнал connection_created) выполняются PRAGMA из
+settings.POLL_DB_CONNECTIONS['SQLITE_PRAGMAS']. По умолчанию это журнал WAL (читатели не блокируют писателя
+и друг друга), ожидание занятой БД вместо ошибки "database is locked" (busy_timeout), synchronous=NORMAL
+(в режиме WAL данные не теряются при падении процесса, только при отказе ОС или питания) и размер кэша страниц.
+mmap_size включает чтение файла БД через отображение в память. Для БД в памяти (тесты) журнал не меняется.
+
+Подключения переиспользуются между запросами в пределах CONN_MAX_AGE. Перед запросом (сигнал request_started)
+открытые подключения проверяются (HEALTH_CHECKS): разорванное подключение, например после перезапуска
+PostgreSQL, закрывается и открывается заново при первом обращении к БД, а не дает ошибку запросу.
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+def options():
+    return getattr(settings, 'POLL_DB_CONNECTIONS', {})
+
+
+def sqlite_pragmas(in_memory=False):
+    """ Команды PRAGMA для нового подключения к SQLite"""
+    statements = []
+    for name, value in options().get('SQLITE_PRAGMAS', {}).items():
+        if value is None or (in_memory and name in ('journal_mode', 'mmap_size')):
+            continue
+        if not (isinstance(value, int) or str(value).isalnum()):
+            raise ImproperlyConfigured('Invalid value of PRAGMA %s: %r' % (name, value))
+        statements.append('PRAGMA %s = %s' % (name, value))
+    return statements
+
+
+@receiver(connection_created)
+def configure_connection(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for statement in sqlite_pragmas(connection.is_in_memory_db()):
+            cursor.execute(statement)
+
+
+@receiver(request_started)
+def check_connections(**kwargs):
+    """ Закрыть разорванные постоянные подключения. Подключение внутри транзакции (тесты) не трогается"""
+    if not options().get('HEALTH_CHECKS', True):
+        return
+    for connection in connections.all():
+        if connection.connection is None or connection.in_atomic_block or not connection.settings_dict['CONN_MAX_AGE']:
+            continue
+        if not connection.is_usable():
+            connection.close()
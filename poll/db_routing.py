@@ -0,0 +1,183 @@
+""" Чтение с реплик БД.
+
+ReplicaRouter направляет чтение моделей приложения poll на реплики (settings.POLL_DB_ROUTING['REPLICAS'],
+случайная реплика на каждый запрос к БД), только если запрос пометил ReplicaRoutingMiddleware: метод запроса
+входит в replica_methods представления (GET и HEAD у PollViewSet и QuestionViewSet, POST истории AttemptAPIView).
+Все остальное - запись, чтение в запросах с записью, пользователи и токены - идет в основную БД (default).
+
+Реплики отстают от основной БД, поэтому:
+- после первой записи все последующие чтения того же запроса идут в основную БД;
+- клиент, который что-то записал (например, проголосовал), PIN_SECONDS секунд читает только из основной БД.
+  Клиент определяется по заголовку Authorization, без него - по анонимному участнику (токен запроса или выданный
+  в ответе, см. voters.py), и только в последнюю очередь - по адресу: за nginx адрес у всех клиентов один,
+  поэтому за доверенными прокси (TRUSTED_PROXIES) берется адрес из X-Forwarded-For. Отметка хранится в бэкенде
+  кэша (ALIAS), общем для всех воркеров;
+- ответы, которые сохранит кэш ответов, и схемы опросов для кэша схем собираются по основной БД, иначе
+  данные отставшей реплики попали бы в кэш с новым поколением.
+"""
+import asyncio
+import hashlib
+import ipaddress
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.deprecation import MiddlewareMixin
+from rest_framework.permissions import SAFE_METHODS
+
+from .voters import parse_voter_token, request_voter, voter_header
+
+
+class RoutingState:
+    """ Маршрутизация запроса: read_only - метод представления только читает, replica - читать с реплик,
+    wrote - в запросе была запись"""
+
+    def __init__(self):
+        self.read_only = False
+        self.replica = False
+        self.wrote = False
+
+
+# Состояние текущего запроса; вне запросов (команды, фоновые потоки) все идет в основную БД
+_state = ContextVar('db_routing', default=None)
+
+
+def options():
+    return getattr(settings, 'POLL_DB_ROUTING', {})
+
+
+def replicas():
+    return tuple(options().get('REPLICAS', ()))
+
+
+@contextmanager
+def primary():
+    """ Чтение внутри блока - из основной БД"""
+    state = _state.get()
+    if state is None or not state.replica:
+        yield
+        return
+    state.replica = False
+    try:
+        yield
+    finally:
+        state.replica = not state.wrote
+
+
+def is_trusted_proxy(address):
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network, strict=False)
+               for network in options().get('TRUSTED_PROXIES', ()))
+
+
+def client_address(request):
+    """ Адрес клиента: REMOTE_ADDR, а если это доверенный прокси - ближайший к нему адрес из X-Forwarded-For,
+    добавленный не доверенным прокси. Адреса левее подставляет сам клиент, им верить нельзя"""
+    address = request.META.get('REMOTE_ADDR', '')
+    forwarded = [part.strip() for part in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if part.strip()]
+    while forwarded and is_trusted_proxy(address):
+        address = forwarded.pop()
+    return address
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        aliases = replicas()
+        if state is None or not state.replica or not aliases or model._meta.app_label != 'poll' \
+                or model._meta.label == settings.AUTH_USER_MODEL:
+            return DEFAULT_DB_ALIAS
+        return random.choice(aliases)
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.replica, state.wrote = False, True
+        # Явно, иначе объект, прочитанный с реплики, сохранялся бы в нее же
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # На репликах те же данные, что и в основной БД
+        aliases = {DEFAULT_DB_ALIAS, *replicas()}
+        return obj1._state.db in aliases and obj2._state.db in aliases
+
+    def allow_migrate(self, db, app_label, **hints):
+        # Схему реплик переносит репликация
+        return False if db in replicas() else None
+
+
+class ReplicaRoutingMiddleware(MiddlewareMixin):
+    """ Отмечает запросы, которые читают с реплик, и закрепляет за основной БД писавших клиентов.
+    Стоит после ResponseCacheMiddleware: ответы, которые будут сохранены в кэш, собираются по основной БД"""
+
+    def __init__(self, get_response):
+        if not replicas():
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    @staticmethod
+    def _pin_key(request, response=None):
+        """ Ключ отметки клиента. Анонимный участник, которому токен выдан в ответе response, отмечается по нему"""
+        client = request.headers.get('Authorization')
+        if not client:
+            voter = request_voter(request)
+            if voter is None and response is not None and response.has_header(voter_header()):
+                voter = parse_voter_token(response[voter_header()])
+            client = 'voter:%s' % voter.hex if voter is not None else 'address:%s' % client_address(request)
+        return 'db-pin:%s' % hashlib.sha256(client.encode()).hexdigest()
+
+    @property
+    def backend(self):
+        return caches[options().get('ALIAS', 'default')]
+
+    @staticmethod
+    def should_pin(request, response, state):
+        # Голоса через буфер записываются позже, поэтому закрепляется и любой успешный изменяющий запрос
+        changed = request.method not in SAFE_METHODS and not state.read_only and response.status_code < 400
+        return state.wrote or changed
+
+    def pin(self, request, response):
+        self.backend.set(self._pin_key(request, response), 1, options().get('PIN_SECONDS', 5))
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+        state = RoutingState()
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        if self.should_pin(request, response, state):
+            self.pin(request, response)
+        return response
+
+    async def __acall__(self, request):
+        state = RoutingState()
+        token = _state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        if self.should_pin(request, response, state):
+            await sync_to_async(self.pin)(request, response)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state = _state.get()
+        if state is None or request.method not in getattr(getattr(view_func, 'cls', None), 'replica_methods', ()):
+            return None
+        state.read_only = True
+        if getattr(request, '_response_cache_key', None) is not None:
+            return None
+        state.replica = self.backend.get(self._pin_key(request)) is None
+        return None
@@ -0,0 +1,181 @@
+""" Один голос на участника опроса (Poll.one_vote).
+
+Голос в таком опросе записывается вместе со строкой PollVoter, уникальной по (опрос, пользователь)
+и (опрос, анонимный участник), поэтому повторный голос, в том числе одновременный с первым из другого процесса,
+отклоняет сама БД (409 already_voted). При включении ограничения в PollVoter заносятся участники, которые уже
+голосовали (record_existing_voters), при выключении строки опроса удаляются.
+
+Чтобы голос нового участника не требовал лишнего запроса к БД, процесс держит для опросов фильтры Блума
+по их участникам (не больше MAX_POLLS фильтров, вероятность ложного срабатывания ERROR_RATE). Если участника
+в фильтре нет, проверка пропускается: повтор, записанный другим процессом после построения фильтра, все равно
+отклонит уникальный индекс. Если участник в фильтре есть, это проверяется запросом.
+
+Голосовать в таком опросе может только авторизованный пользователь (см. VoteSerializer.validate): пользователя
+из тела запроса можно подменить, а новый токен анонимного участника (см. voters.py) получить повторным запросом.
+Участники-анонимы остаются в PollVoter для опросов, где ограничение включено после их голосов.
+"""
+import hashlib
+import math
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from .lru import LRUCache
+from .models import Attempt, PollVoter
+
+
+class AlreadyVoted(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'You have already voted in this poll.'
+    default_code = 'already_voted'
+
+
+def options():
+    return getattr(settings, 'POLL_ONE_VOTE', {})
+
+
+def voter_key(user_id, voter):
+    return 'u%d' % user_id if user_id is not None else 'v' + voter.hex
+
+
+class BloomFilter:
+    """ Фильтр Блума на capacity ключей: ключа, которого нет в фильтре, точно не добавляли,
+    ключ из фильтра мог и не добавляться с вероятностью error_rate"""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # Двойное хеширование: позиции h1 + i * h2 по одному 128-битному хешу
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class VoterFilters:
+    """ Фильтры Блума по участникам опросов с ограничением "один голос" в памяти процесса"""
+
+    def __init__(self):
+        self._filters = None
+        self.stats = Counter()
+
+    @property
+    def filters(self):
+        if self._filters is None:
+            self._filters = LRUCache(options().get('MAX_POLLS', 64))
+        return self._filters
+
+    def build(self, poll_id):
+        """ Фильтр по участникам опроса из БД. Емкость - вдвое больше текущего числа участников,
+        при ее исчерпании фильтр строится заново"""
+        voters = PollVoter.objects.filter(poll_id=poll_id)
+        bloom = BloomFilter(max(options().get('MIN_CAPACITY', 10000), 2 * voters.count()),
+                            options().get('ERROR_RATE', 0.01))
+        for user_id, voter in voters.values_list('user_id', 'voter').iterator(chunk_size=10000):
+            bloom.add(voter_key(user_id, voter))
+        self.stats['built'] += 1
+        return bloom
+
+    def get(self, poll_id):
+        bloom = self.filters.get(poll_id)
+        if bloom is None or bloom.count > bloom.capacity:
+            bloom = self.build(poll_id)
+            self.filters.set(poll_id, bloom)
+        return bloom
+
+    def might_have_voted(self, poll_id, key):
+        found = key in self.get(poll_id)
+        self.stats['checked' if found else 'skipped'] += 1
+        return found
+
+    def add(self, poll_id, keys):
+        bloom = self.filters.get(poll_id)
+        if bloom is not None:
+            for key in keys:
+                bloom.add(key)
+
+    def discard(self, poll_id):
+        self.filters.pop(poll_id)
+
+    def clear(self):
+        self._filters = None
+        self.stats.clear()
+
+
+voter_filters = VoterFilters()
+
+
+def check_voter(poll, user_id, voter):
+    """ Отклонить (AlreadyVoted) повторный голос в опросе poll (схема опроса) с ограничением "один голос".
+    Запрос к БД выполняется, только если участник есть в фильтре опроса"""
+    if not poll.one_vote or (user_id is None and voter is None):
+        return
+    if not voter_filters.might_have_voted(poll.id, voter_key(user_id, voter)):
+        return
+    lookup = {'user_id': user_id} if user_id is not None else {'voter': voter}
+    if PollVoter.objects.filter(poll_id=poll.id, **lookup).exists():
+        raise AlreadyVoted()
+
+
+def record_voters(votes):
+    """ Записать участников голосов в опросы с ограничением "один голос" (в транзакции votes.write_votes).
+    Повторный голос - IntegrityError. После фиксации транзакции участники добавляются в фильтры"""
+    voters = [PollVoter(poll_id=vote.poll.id, user_id=vote.user_id, voter=vote.voter) for vote in votes
+              if vote.poll.one_vote and (vote.user_id is not None or vote.voter is not None)]
+    if not voters:
+        return
+    PollVoter.objects.bulk_create(voters)
+
+    def add():
+        for voter in voters:
+            voter_filters.add(voter.poll_id, [voter_key(voter.user_id, voter.voter)])
+
+    transaction.on_commit(add)
+
+
+def has_voted(vote):
+    """ Есть ли уже голос участника vote в его опросе (после IntegrityError при записи)"""
+    if not vote.poll.one_vote or (vote.user_id is None and vote.voter is None):
+        return False
+    lookup = {'user_id': vote.user_id} if vote.user_id is not None else {'voter': vote.voter}
+    return PollVoter.objects.filter(poll_id=vote.poll.id, **lookup).exists()
+
+
+def record_existing_voters(poll_id):
+    """ Заменить участников опроса в PollVoter участниками его сохраненных попыток (при включении ограничения).
+    Возвращает число участников"""
+    batch_size = options().get('BATCH_SIZE', 1000)
+    attempts = Attempt.objects.filter(poll_id=poll_id)
+    with transaction.atomic():
+        PollVoter.objects.filter(poll_id=poll_id).delete()
+        users = attempts.filter(user__isnull=False).values_list('user_id', flat=True).distinct()
+        PollVoter.objects.bulk_create((PollVoter(poll_id=poll_id, user_id=user_id) for user_id in users.iterator()),
+                                      batch_size=batch_size)
+        voters = attempts.filter(user__isnull=True, voter__isnull=False).values_list('voter', flat=True).distinct()
+        PollVoter.objects.bulk_create((PollVoter(poll_id=poll_id, voter=voter) for voter in voters.iterator()),
+                                      batch_size=batch_size)
+        transaction.on_commit(lambda: voter_filters.discard(poll_id))
+    return PollVoter.objects.filter(poll_id=poll_id).count()
+
+
+def forget_voters(poll_id):
+    """ Удалить участников опроса из PollVoter (при выключении ограничения)"""
+    with transaction.atomic():
+        PollVoter.objects.filter(poll_id=poll_id).delete()
+        transaction.on_commit(lambda: voter_filters.discard(poll_id))
@@ -0,0 +1,96 @@
+""" Потоковая выгрузка попыток и ответов опроса в CSV и NDJSON.
+
+Одна строка выгрузки - одна попытка: id попытки, пользователь, анонимный участник (см. voters.py), время
+и по одной колонке на каждый вопрос. Попытки читаются пакетами по id (keyset), ответы и выбранные варианты -
+двумя запросами на пакет, поэтому потребление памяти ограничено размером пакета и не зависит от размера опроса.
+
+Текст в CSV вводят участники и авторы опросов, а табличные редакторы выполняют ячейку, начинающуюся
+с =, +, - или @, как формулу. Перед такой ячейкой CSV ставится апостроф (escape_formula), NDJSON выгружается как есть.
+"""
+import csv
+import json
+
+from .models import Attempt, Answer, AnswerChoice
+from .votes import parse_answer
+
+CHUNK_SIZE = 2000
+
+# Первые символы ячейки, с которых табличные редакторы начинают формулу
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def iter_attempts(schema, chunk_size=CHUNK_SIZE, progress=None):
+    """ Попытки опроса по порядку id: (id, user_id, voter, time, {question_id: [ответы]}).
+    progress - функция, которой после каждого пакета передается число прочитанных попыток"""
+    choice_texts = {choice_id: text for question in schema.questions
+                    for choice_id, text in zip(question.choice_ids, question.choices)}
+    attempts = Attempt.objects.filter(poll_id=schema.id).order_by('id')
+    last_id, count = 0, 0
+    while True:
+        batch = list(attempts.filter(id__gt=last_id).values_list('id', 'user_id', 'voter', 'time')[:chunk_size])
+        if not batch:
+            return
+        last_id = batch[-1][0]
+        answers = {attempt[0]: {} for attempt in batch}
+        for attempt_id, question_id, text in Answer.objects.filter(attempt_id__in=answers).exclude(
+                answer='').values_list('attempt_id', 'question_id', 'answer'):
+            answers[attempt_id][question_id] = parse_answer(text)
+        for attempt_id, question_id, choice_id in AnswerChoice.objects.filter(
+                answer__attempt_id__in=answers).values_list('answer__attempt_id', 'answer__question_id', 'choice_id'):
+            answers[attempt_id].setdefault(question_id, []).append(choice_texts.get(choice_id, ''))
+        for attempt_id, user_id, voter, time in batch:
+            yield attempt_id, user_id, voter, time, answers[attempt_id]
+        count += len(batch)
+        if progress is not None:
+            progress(count)
+
+
+class _Echo:
+    """ Буфер для csv.writer, возвращающий записанную строку"""
+    def write(self, value):
+        return value
+
+
+def escape_formula(value):
+    """ Текст ячейки CSV, который табличный редактор не выполнит как формулу"""
+    return "'" + value if value.startswith(FORMULA_PREFIXES) else value
+
+
+def export_csv(schema, chunk_size=CHUNK_SIZE, progress=None):
+    """ Выгрузка в CSV. Несколько выбранных вариантов ответа разделяются "; " """
+    writer = csv.writer(_Echo())
+    header = [escape_formula('%d. %s' % (question.position, question.main_text)) for question in schema.questions]
+    yield writer.writerow(['attempt', 'user', 'voter', 'time'] + header)
+    rows = []
+    for attempt_id, user_id, voter, time, answers in iter_attempts(schema, chunk_size, progress):
+        rows.append(writer.writerow([attempt_id, user_id, voter, time.isoformat()] + [
+            escape_formula('; '.join(answers.get(question.id, ()))) for question in schema.questions]))
+        if len(rows) >= chunk_size:
+            yield ''.join(rows)
+            rows = []
+    if rows:
+        yield ''.join(rows)
+
+
+def export_ndjson(schema, chunk_size=CHUNK_SIZE, progress=None):
+    """ Выгрузка в NDJSON: ответы - словарь {position: [ответы]}"""
+    rows = []
+    for attempt_id, user_id, voter, time, answers in iter_attempts(schema, chunk_size, progress):
+        rows.append(json.dumps({
+            'attempt': attempt_id,
+            'user': user_id,
+            'voter': str(voter) if voter is not None else None,
+            'time': time.isoformat(),
+            'answers': {question.position: answers.get(question.id, []) for question in schema.questions},
+        }, ensure_ascii=False) + '\n')
+        if len(rows) >= chunk_size:
+            yield ''.join(rows)
+            rows = []
+    if rows:
+        yield ''.join(rows)
+
+
+EXPORTERS = {
+    'csv': export_csv,
+    'ndjson': export_ndjson,
+}
@@ -0,0 +1,82 @@
+""" Быстрая сериализация ответов эндпоинтов чтения.
+
+Списки опросов, вопросов и история попыток строятся из строк .values() по заранее собранным картам полей,
+без создания объектов моделей и без полей ModelSerializer. Формат ответа совпадает с PollSerializer,
+WriteQuestionSerializer и AttemptSerializer побайтно (см. тесты FastSerializationTests).
+"""
+from rest_framework import serializers
+
+from .models import Poll, Question, Choice, Attempt
+from .snapshots import ANSWERS_PREFETCH, QUESTION_TYPE_LABELS, answers_snapshot, expand_snapshot
+
+# Поля моделей, значения которых в ответе форматируются полем DRF: {класс поля модели: поле DRF}
+FORMATTED_FIELDS = serializers.ModelSerializer.serializer_field_mapping
+
+
+class RowSerializer:
+    """ Представление строк .values() как у ModelSerializer: значения полей дат форматируются
+    соответствующими полями DRF, остальные отдаются как есть"""
+
+    def __init__(self, model, fields, prefix=''):
+        self.fields = tuple(fields)
+        self.keys = tuple(prefix + name for name in self.fields)
+        self.formats = {}
+        for name in self.fields:
+            for field_class in type(model._meta.get_field(name)).__mro__:
+                drf_field = FORMATTED_FIELDS.get(field_class)
+                if drf_field in (serializers.DateField, serializers.DateTimeField):
+                    self.formats[name] = drf_field().to_representation
+                    break
+
+    def __call__(self, row):
+        data = {}
+        for name, key in zip(self.fields, self.keys):
+            value = row[key]
+            if value is not None and name in self.formats:
+                value = self.formats[name](value)
+            data[name] = value
+        return data
+
+
+POLL_FIELDS = tuple(field.name for field in Poll._meta.concrete_fields
+                    if field.name not in ('is_deleted', 'is_archived'))
+poll_row = RowSerializer(Poll, POLL_FIELDS)
+
+
+def poll_rows(rows):
+    """ Опросы в формате PollSerializer из строк .values(*POLL_FIELDS)"""
+    return [poll_row(row) for row in rows]
+
+
+def question_rows(poll_id):
+    """ Вопросы опроса в формате WriteQuestionSerializer: два запроса"""
+    choices = {}
+    for question_id, choice_text in Choice.objects.filter(question__poll_id=poll_id).order_by(
+            'position', 'id').values_list('question_id', 'choice_text'):
+        choices.setdefault(question_id, []).append(choice_text)
+    return [{'position': position,
+             'question_type': QUESTION_TYPE_LABELS.get(question_type, question_type),
+             'main_text': main_text,
+             'choices': choices.get(question_id, [])}
+            for question_id, position, question_type, main_text in Question.objects.filter(
+                poll_id=poll_id).order_by('position').values_list('id', 'position', 'question_type', 'main_text')]
+
+
+ATTEMPT_FIELDS = ('id', 'user', 'time', 'snapshot') + tuple('poll__' + name for name in POLL_FIELDS)
+attempt_poll_row = RowSerializer(Poll, POLL_FIELDS, prefix='poll__')
+attempt_time = serializers.DateTimeField(format='%Y-%m-%d').to_representation
+
+
+def attempt_rows(rows):
+    """ История попыток в формате AttemptSerializer из строк .values(*ATTEMPT_FIELDS).
+    Ответы попыток без снимка загружаются из БД одним набором запросов"""
+    missing = [row['id'] for row in rows if row['snapshot'] is None]
+    snapshots = {}
+    if missing:
+        snapshots = {attempt.id: answers_snapshot(attempt)
+                     for attempt in Attempt.objects.filter(id__in=missing).prefetch_related(*ANSWERS_PREFETCH)}
+    return [{'user': row['user'],
+             'time': attempt_time(row['time']),
+             'poll': attempt_poll_row(row),
+             'answers': expand_snapshot(row['snapshot'] if row['snapshot'] is not None else snapshots[row['id']])}
+            for row in rows]
@@ -0,0 +1,65 @@
+""" Фильтры списков опросов и попыток по параметрам запроса"""
+from datetime import datetime, time, timedelta
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from rest_framework.exceptions import ValidationError
+
+
+def date_param(params, name):
+    """ Дата из параметра запроса в формате Y-m-d или None"""
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        parsed = parse_date(value)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValidationError({name: 'Date has wrong format. Use YYYY-MM-DD.'})
+    return parsed
+
+
+def day_start(day):
+    """ Начало дня в текущем часовом поясе"""
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def bool_param(params, name):
+    value = params.get(name)
+    if value is None or value == '':
+        return None
+    if value.lower() in ('1', 'true', 'yes'):
+        return True
+    if value.lower() in ('0', 'false', 'no'):
+        return False
+    raise ValidationError({name: 'Must be a valid boolean.'})
+
+
+def filter_polls(queryset, params):
+    """ ?active=true|false, ?started_from=Y-m-d, ?started_to=Y-m-d"""
+    active = bool_param(params, 'active')
+    if active is not None:
+        queryset = queryset.active() if active else queryset.inactive()
+    started_from, started_to = date_param(params, 'started_from'), date_param(params, 'started_to')
+    if started_from:
+        queryset = queryset.filter(started_at__gte=started_from)
+    if started_to:
+        queryset = queryset.filter(started_at__lte=started_to)
+    return queryset
+
+
+def filter_attempts(queryset, params):
+    """ ?poll=id, ?date_from=Y-m-d, ?date_to=Y-m-d (включительно)"""
+    poll = params.get('poll')
+    if poll:
+        if not str(poll).isdigit():
+            raise ValidationError({'poll': 'A valid integer is required.'})
+        queryset = queryset.filter(poll_id=poll)
+    # Диапазон по самому полю time, а не по time__date, чтобы работал индекс (poll, time, id)
+    date_from, date_to = date_param(params, 'date_from'), date_param(params, 'date_to')
+    if date_from:
+        queryset = queryset.filter(time__gte=day_start(date_from))
+    if date_to:
+        queryset = queryset.filter(time__lt=day_start(date_to + timedelta(days=1)))
+    return queryset
@@ -0,0 +1,107 @@
+""" Повтор запроса голосования с заголовком Idempotency-Key.
+
+Клиент, не получивший ответ (таймаут, обрыв соединения), повторяет запрос с тем же ключом и получает исходный
+ответ с заголовком Idempotent-Replayed, а голос второй раз не записывается. Ответы хранятся TIMEOUT секунд
+в бэкенде ALIAS из CACHES (с несколькими воркерами - общем для них, например Redis); число ключей ограничивает
+бэкенд (MAX_ENTRIES у LocMemCache, maxmemory у Redis). Ключ действует в пределах опроса, анонимного участника
+(см. voters.py) и авторизованного пользователя и привязан к телу запроса: тот же ключ с другим телом - 422.
+
+Ключ занимается атомарно (cache.add) на время выполнения запроса, но не дольше PENDING_TIMEOUT секунд:
+повтор, пришедший раньше ответа на первый запрос, получает 409. Сохраняются только успешные ответы,
+после ошибки ключ освобождается и запрос можно повторить.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework import serializers, status
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+
+PENDING = 'pending'
+
+
+class IdempotencyKeyInProgress(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'A request with this Idempotency-Key is still in progress.'
+    default_code = 'idempotency_key_in_progress'
+
+
+class IdempotencyKeyReused(APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = 'Idempotency-Key was already used with a different request.'
+    default_code = 'idempotency_key_reused'
+
+
+def options():
+    return getattr(settings, 'POLL_IDEMPOTENCY', {})
+
+
+def fingerprint(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class IdempotencyKey:
+    """ Ключ идемпотентности запроса: контекстный менеджер вокруг выполнения запроса.
+
+        with IdempotencyKey(request, scope) as idempotency:
+            if idempotency.replay is not None:
+                return idempotency.replay
+            ...
+            idempotency.save(response)
+
+    Без заголовка ничего не делает. При исключении внутри блока ключ освобождается"""
+
+    def __init__(self, request, scope):
+        self.key = request.headers.get(options().get('HEADER', 'Idempotency-Key'), '')
+        if len(self.key) > options().get('MAX_KEY_LENGTH', 255):
+            raise serializers.ValidationError({'Idempotency-Key': 'Ensure this header has no more than %d characters.'
+                                               % options().get('MAX_KEY_LENGTH', 255)})
+        self.cache_key = 'poll:idempotency:' + hashlib.sha256(
+            ':'.join(map(str, scope + (self.key, ))).encode()).hexdigest()
+        self.fingerprint = fingerprint(request.data) if self.key else None
+        self.replay = None
+        self._claimed = False
+
+    @property
+    def cache(self):
+        return caches[options().get('ALIAS', 'default')]
+
+    def __enter__(self):
+        if not self.key:
+            return self
+        if self.cache.add(self.cache_key, {'state': PENDING, 'fingerprint': self.fingerprint},
+                          options().get('PENDING_TIMEOUT', 60)):
+            self._claimed = True
+            return self
+        record = self.cache.get(self.cache_key)
+        if record is None:
+            # Ключ истек между add и get: выполняем запрос заново
+            return self.__enter__()
+        if record['fingerprint'] != self.fingerprint:
+            raise IdempotencyKeyReused()
+        if record['state'] == PENDING:
+            raise IdempotencyKeyInProgress()
+        self.replay = Response(record['data'], status=record['status'], headers=record['headers'])
+        for cookie in record['cookies']:
+            self.replay.cookies.load(cookie)
+        self.replay['Idempotent-Replayed'] = 'true'
+        return self
+
+    def save(self, response, headers=()):
+        """ Сохранить успешный ответ для повторов вместе с его cookie и заголовками headers"""
+        if not self._claimed or not status.is_success(response.status_code):
+            return
+        self.cache.set(self.cache_key, {
+            'state': 'done', 'fingerprint': self.fingerprint, 'status': response.status_code,
+            'data': json.loads(json.dumps(response.data, default=str)),
+            'headers': {name: response[name] for name in headers if response.has_header(name)},
+            'cookies': [morsel.OutputString() for morsel in response.cookies.values()],
+        }, options().get('TIMEOUT', 24 * 60 * 60))
+        self._claimed = False
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._claimed:
+            self.cache.delete(self.cache_key)
+            self._claimed = False
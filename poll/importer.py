@@ -0,0 +1,338 @@
+""" Потоковый импорт опросов и ответов из выгрузки dumpdata в форматах XML и NDJSON (jsonl).
+
+Объекты читаются по одному (XML - через iterparse, без загрузки документа в память) и записываются пакетами
+по batch_size объектов, каждый пакет в своей транзакции. Объекты получают новые id, ссылки между ними
+переводятся по таблицам соответствия id выгрузки новым id (ответ на вопрос не из опроса своей попытки - ошибка
+данных); пользователи с уже существующим username не создаются, а сопоставляются с существующими. Ответы
+на вопросы с выбором в прежнем формате (строка "['5', '15']" без AnswerChoice) переводятся в выбранные варианты,
+как в миграции 0004_migrate_choice_answers.
+
+Если задан ключ импорта, с каждым пакетом в той же транзакции записывается контрольная точка (ImportCheckpoint):
+номер следующего объекта выгрузки и новые соответствия id. Повторный запуск с тем же ключом пропускает уже
+записанные объекты и продолжает с места остановки.
+
+Права и пароли пользователей (is_staff, is_superuser, password) переносятся только из доверенной выгрузки
+(trusted, команда import_polls); при импорте через API новые пользователи создаются без прав и с непригодным
+для входа паролем, а опросы - без пометок is_archived и is_deleted: архива (PollArchive) и задачи удаления
+для них нет. Группы и разрешения не импортируются никогда.
+
+Счетчики итогов, снимки ответов и участники опросов с one_vote после импорта пересчитываются по импортированным
+опросам; прочие модели (токены, группы, счетчики из выгрузки) пропускаются.
+"""
+import ast
+import json
+from collections import Counter
+from itertools import groupby
+
+from defusedxml import DefusedXmlException
+from defusedxml.ElementTree import ParseError, iterparse
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connection, transaction
+
+from .duplicates import record_existing_voters
+from .models import Poll, Question, Choice, Attempt, Answer, AnswerChoice, MyUser, ImportCheckpoint
+from .response_cache import response_cache
+from .schema import compile_poll_schema
+from .snapshots import render_snapshot
+from .tallies import recompute_tallies
+
+# Импортируемые модели в порядке зависимостей
+MODELS = {
+    'poll.myuser': MyUser,
+    'poll.poll': Poll,
+    'poll.question': Question,
+    'poll.choice': Choice,
+    'poll.attempt': Attempt,
+    'poll.answer': Answer,
+    'poll.answerchoice': AnswerChoice,
+}
+
+
+class ImportDataError(ValueError):
+    """ Ошибка в данных выгрузки"""
+
+
+def read_ndjson(stream):
+    """ Объекты выгрузки NDJSON: (модель, pk, {поле: значение})"""
+    for number, line in enumerate(stream, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+            yield obj['model'].lower(), obj.get('pk'), obj.get('fields', {})
+        except (ValueError, KeyError, AttributeError, TypeError):
+            raise ImportDataError('Line %d: invalid object' % number)
+
+
+def read_xml(stream):
+    """ Объекты выгрузки XML: (модель, pk, {поле: значение}). Разобранные элементы сразу удаляются из дерева.
+    Выгрузка из API недоверенная, поэтому разбирается defusedxml: сущности и внешние ссылки запрещены"""
+    try:
+        yield from _read_xml(stream)
+    except (ParseError, DefusedXmlException) as exc:
+        raise ImportDataError('Invalid XML: %s' % exc)
+
+
+def _read_xml(stream):
+    root = None
+    for event, element in iterparse(stream, events=('start', 'end')):
+        if root is None:
+            root = element
+        if event != 'end' or element.tag != 'object':
+            continue
+        fields = {}
+        for field in element.iter('field'):
+            if field.get('rel') == 'ManyToManyRel':
+                continue
+            if field.find('None') is not None:
+                value = None
+            else:
+                value = field.text or ''
+                if field.get('type') == 'JSONField':
+                    value = json.loads(value)
+            fields[field.get('name')] = value
+        yield element.get('model', '').lower(), element.get('pk'), fields
+        root.clear()
+
+
+READERS = {'ndjson': read_ndjson, 'xml': read_xml}
+
+
+def parse_legacy_answer(text):
+    """ Выбранные варианты из строкового представления списка (см. Answer.value)"""
+    try:
+        value = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return [text]
+    return [str(part) for part in value] if isinstance(value, (list, tuple)) else [str(value)]
+
+
+def insert(model, objs):
+    """ Вставить объекты пакетами с получением новых id. Как и loaddata (save_base(raw=True)), значения полей
+    пишутся как есть: auto_now_add не заменяет время из выгрузки"""
+    fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+    pk = model._meta.pk
+    if connection.features.can_return_rows_from_bulk_insert:
+        batch_size = max(connection.ops.bulk_batch_size(fields, objs), 1)
+        for start in range(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            for obj, row in zip(batch, model._base_manager._insert(batch, fields, returning_fields=[pk], raw=True)):
+                obj.pk = row[0]
+    else:
+        for obj in objs:
+            obj.pk = model._base_manager._insert([obj], fields, returning_fields=[pk], raw=True)[0][0]
+
+
+class Importer:
+    """ Импорт потока объектов выгрузки пакетами (см. описание модуля)"""
+
+    def __init__(self, key=None, batch_size=2000, progress=None, trusted=True):
+        self.key = key
+        self.trusted = trusted
+        self.batch_size = batch_size
+        self.progress = progress
+        self.maps = {label: {} for label in MODELS}
+        self.offset = 0
+        self.stats = Counter()
+        self.polls = set()
+        # Типы вопросов и варианты ответа импортированных вопросов для перевода ответов прежнего формата
+        self.question_types, self.choices = {}, {}
+        if key:
+            self.resume()
+
+    def resume(self):
+        checkpoints = ImportCheckpoint.objects.filter(key=self.key).order_by('offset')
+        for checkpoint in checkpoints.iterator():
+            for label, pairs in checkpoint.mapping.items():
+                self.maps[label].update(pairs)
+            self.offset = checkpoint.offset
+            self.stats.update(checkpoint.counts)
+        self.polls.update(self.maps['poll.poll'].values())
+        question_ids = list(self.maps['poll.question'].values())
+        self.question_types.update(Question.objects.filter(id__in=question_ids).values_list('id', 'question_type'))
+        for question_id, choice_id, text in Choice.objects.filter(question_id__in=question_ids).order_by(
+                '-id').values_list('question_id', 'id', 'choice_text'):
+            self.choices.setdefault(question_id, {})[text] = choice_id
+
+    def run(self, objects):
+        """ Импортировать объекты выгрузки, пропустив записанные при прошлых запусках с тем же ключом"""
+        batch = []
+        for position, obj in enumerate(objects):
+            if position < self.offset:
+                continue
+            batch.append(obj)
+            if len(batch) >= self.batch_size:
+                self.write(batch, position + 1)
+                batch = []
+        if batch:
+            self.write(batch, self.offset + len(batch))
+        self.finish()
+        return self.stats
+
+    def resolve(self, label, pk, pending):
+        if pk is None:
+            return None
+        pk = str(pk)
+        new_id = pending[label].get(pk, self.maps[label].get(pk))
+        if new_id is None:
+            raise ImportDataError('%s #%s is not in the import' % (label, pk))
+        return new_id
+
+    def build(self, label, pk, fields, pending):
+        """ Объект модели по полям выгрузки: ссылки переводятся в новые id"""
+        model = MODELS[label]
+        values = {}
+        for field in model._meta.concrete_fields:
+            if field.primary_key or field.name not in fields:
+                continue
+            value = fields[field.name]
+            if field.is_relation:
+                values[field.attname] = self.resolve(field.related_model._meta.label_lower, value, pending)
+                continue
+            try:
+                values[field.attname] = field.to_python(value)
+            except ValidationError as exc:
+                raise ImportDataError('%s #%s: %s: %s' % (label, pk, field.name, '; '.join(exc.messages)))
+        obj = model(**values)
+        for field in model._meta.concrete_fields:
+            if getattr(field, 'auto_now_add', False) and getattr(obj, field.attname) is None:
+                field.pre_save(obj, True)
+        return obj
+
+    def write(self, batch, offset):
+        """ Записать пакет в одной транзакции вместе с контрольной точкой"""
+        pending = {label: {} for label in MODELS}
+        counts = Counter()
+        try:
+            with transaction.atomic():
+                for label, group in groupby(batch, key=lambda obj: obj[0]):
+                    self.write_group(label, list(group), pending, counts)
+                if self.key:
+                    ImportCheckpoint.objects.create(key=self.key, offset=offset, counts=counts, mapping={
+                        label: pairs for label, pairs in pending.items() if pairs})
+        except IntegrityError as exc:
+            raise ImportDataError('Objects %d-%d: %s' % (self.offset + 1, offset, exc))
+        for label, pairs in pending.items():
+            self.maps[label].update(pairs)
+        self.offset = offset
+        self.stats.update(counts)
+        if self.progress is not None:
+            self.progress(self.offset, self.stats)
+
+    def write_group(self, label, group, pending, counts):
+        """ Записать идущие подряд объекты одной модели"""
+        if label not in MODELS:
+            counts['skipped'] += len(group)
+            return
+        sources = [str(pk) for _, pk, _ in group]
+        objs = [self.build(label, pk, fields, pending) for label, pk, fields in group]
+        if label == 'poll.myuser':
+            sources, objs = self.match_users(sources, objs, pending, counts)
+        elif label == 'poll.poll' and not self.trusted:
+            for poll in objs:
+                poll.is_archived = poll.is_deleted = False
+        if label == 'poll.answer':
+            self.check_answers(group, objs)
+        selected = self.convert_legacy_answers(objs) if label == 'poll.answer' else ()
+        insert(MODELS[label], objs)
+        pending[label].update((source, obj.pk) for source, obj in zip(sources, objs))
+        counts[label] += len(objs)
+        if selected:
+            AnswerChoice.objects.bulk_create([AnswerChoice(answer_id=objs[index].pk, choice_id=choice_id)
+                                              for index, choice_id in selected])
+            counts['poll.answerchoice'] += len(selected)
+        self.remember(label, objs)
+
+    def match_users(self, sources, users, pending, counts):
+        """ Пользователи с существующим username сопоставляются с существующими, остальные создаются
+        (из недоверенной выгрузки - без прав и пароля)"""
+        existing = dict(MyUser.objects.filter(username__in=[user.username for user in users]).values_list(
+            'username', 'id'))
+        new_sources, new_users = [], []
+        for source, user in zip(sources, users):
+            if user.username in existing:
+                pending['poll.myuser'][source] = existing[user.username]
+                counts['matched_users'] += 1
+            else:
+                if not self.trusted:
+                    user.is_staff = user.is_superuser = False
+                    user.set_unusable_password()
+                new_sources.append(source)
+                new_users.append(user)
+        return new_sources, new_users
+
+    @staticmethod
+    def check_answers(group, answers):
+        """ Вопрос ответа должен относиться к опросу попытки ответа"""
+        attempt_polls = dict(Attempt.objects.filter(id__in={answer.attempt_id for answer in answers}).values_list(
+            'id', 'poll_id'))
+        question_polls = dict(Question.objects.filter(id__in={answer.question_id for answer in answers}).values_list(
+            'id', 'poll_id'))
+        for (label, pk, fields), answer in zip(group, answers):
+            if attempt_polls.get(answer.attempt_id) != question_polls.get(answer.question_id):
+                raise ImportDataError('%s #%s: question #%s is not in the poll of attempt #%s' % (
+                    label, pk, fields.get('question'), fields.get('attempt')))
+
+    def convert_legacy_answers(self, answers):
+        """ Выбранные варианты ответов прежнего формата: [(номер ответа в пакете, id варианта)]"""
+        selected = []
+        for index, answer in enumerate(answers):
+            choices = self.choices.get(answer.question_id)
+            if not answer.answer or self.question_types.get(answer.question_id) == Question.TEXT or not choices:
+                continue
+            parts = parse_legacy_answer(answer.answer)
+            if all(part in choices for part in parts):
+                selected.extend((index, choices[part]) for part in parts)
+                answer.answer = ''
+        return selected
+
+    def remember(self, label, objs):
+        if label == 'poll.poll':
+            self.polls.update(poll.pk for poll in objs)
+        elif label == 'poll.question':
+            self.question_types.update((question.pk, question.question_type) for question in objs)
+        elif label == 'poll.choice':
+            for choice in objs:
+                # При совпадении текстов выбирается первый вариант, как в миграции
+                self.choices.setdefault(choice.question_id, {}).setdefault(choice.choice_text, choice.pk)
+
+    def finish(self):
+        """ Счетчики итогов, снимки ответов и участники (для опросов с one_vote) импортированных опросов"""
+        one_vote = set(Poll.objects.filter(pk__in=self.polls, one_vote=True).values_list('pk', flat=True))
+        for poll_id in sorted(self.polls):
+            recompute_tallies(poll_id)
+            self.write_snapshots(poll_id)
+            if poll_id in one_vote:
+                record_existing_voters(poll_id)
+        response_cache.purge('polls')
+
+    def write_snapshots(self, poll_id):
+        """ Снимки попыток опроса, импортированных без снимка. В отличие от backfill_snapshots вопросы берутся
+        из схемы опроса, а ответы читаются строками: два запроса на пакет попыток без объектов моделей"""
+        schema = compile_poll_schema(poll_id)
+        questions = {question.id: question for question in schema.questions}
+        attempts = Attempt.objects.filter(poll_id=poll_id, snapshot__isnull=True).order_by('id')
+        last_id = 0
+        while True:
+            ids = list(attempts.filter(id__gt=last_id).values_list('id', flat=True)[:self.batch_size])
+            if not ids:
+                break
+            last_id = ids[-1]
+            selected = {}
+            for answer_id, choice_id in AnswerChoice.objects.filter(answer__attempt_id__in=ids).order_by(
+                    'id').values_list('answer_id', 'choice_id'):
+                selected.setdefault(answer_id, []).append(choice_id)
+            rows = {attempt_id: [] for attempt_id in ids}
+            for answer_id, attempt_id, question_id, text in Answer.objects.filter(attempt_id__in=ids).order_by(
+                    'id').values_list('id', 'attempt_id', 'question_id', 'answer'):
+                rows[attempt_id].append((questions[question_id], text, selected.get(answer_id, ())))
+            with transaction.atomic():
+                Attempt.objects.bulk_update([Attempt(id=attempt_id, snapshot=render_snapshot(attempt_rows))
+                                             for attempt_id, attempt_rows in rows.items()], ['snapshot'])
+
+
+def import_objects(stream, format, **kwargs):
+    """ Импортировать выгрузку из потока stream в формате format (xml или ndjson)"""
+    return Importer(**kwargs).run(READERS[format](stream))
@@ -0,0 +1,191 @@
+""" Очередь голосов с отложенной пакетной записью.
+
+В режиме буферизованного голосования (settings.POLL_VOTE_BUFFER['ENABLED']) прошедший проверку голос
+ставится в ограниченную очередь в памяти процесса, а PollViewSet.vote сразу отвечает 202 с токеном попытки.
+Фоновый поток забирает голоса пакетами до BATCH_SIZE штук или по истечении FLUSH_INTERVAL секунд
+и записывает каждый пакет одной транзакцией (см. votes.write_votes).
+
+Если очередь заполнена дольше PUT_TIMEOUT секунд, голос не принимается (503). При остановке процесса
+очередь дописывается до конца. Токен попытки уникален (Attempt.token), поэтому повторная запись пакета
+после ошибки не создает дубликатов.
+
+Клиент уже получил 202, поэтому голос, который не удалось записать (кроме повторов), не отбрасывается,
+а передается фоновой задаче write_vote: она повторяет запись с задержкой (см. jobs.py). Исходы голосов
+очереди, в том числе потерянные (не удалось поставить и задачу), выводятся в /metrics
+(poll_vote_buffer_votes_total, см. metrics.py).
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import connections, transaction, IntegrityError
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from .duplicates import has_voted
+from .jobs import submit
+from .metrics import registry as metrics_registry
+from .models import Attempt
+from .votes import write_votes
+
+logger = logging.getLogger(__name__)
+
+
+class VoteQueueFull(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Vote queue is full, try again later.'
+    default_code = 'vote_queue_full'
+
+
+class VoteBuffer:
+    """ Ограниченная очередь голосов с фоновой пакетной записью"""
+
+    def __init__(self):
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self.stats = Counter()
+
+    @property
+    def options(self):
+        return getattr(settings, 'POLL_VOTE_BUFFER', {})
+
+    @property
+    def enabled(self):
+        return bool(self.options.get('ENABLED'))
+
+    def _ensure_started(self):
+        # После fork (gunicorn --preload) очередь и поток родительского процесса недоступны
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(self.options.get('MAX_SIZE', 10000))
+                self._thread = None
+                self._pid = os.getpid()
+            if self.options.get('THREAD', True) and (self._thread is None or not self._thread.is_alive()):
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name='vote-buffer', daemon=True)
+                self._thread.start()
+
+    def submit(self, vote):
+        """ Поставить голос в очередь. Если очередь заполнена, выбрасывает VoteQueueFull"""
+        self._ensure_started()
+        try:
+            self._queue.put(vote, timeout=self.options.get('PUT_TIMEOUT', 0.05))
+        except queue.Full:
+            self.stats['rejected'] += 1
+            raise VoteQueueFull()
+        self.stats['queued'] += 1
+
+    def __len__(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _take(self, block=True):
+        """ Забрать из очереди пакет голосов: до BATCH_SIZE штук, ожидая не дольше FLUSH_INTERVAL"""
+        batch_size = self.options.get('BATCH_SIZE', 500)
+        deadline = time.monotonic() + self.options.get('FLUSH_INTERVAL', 0.5)
+        batch = []
+        while len(batch) < batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if block and timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            with transaction.atomic():
+                write_votes(batch)
+            self.stats['written'] += len(batch)
+            self.stats['batches'] += 1
+            return
+        except Exception:
+            logger.exception('Failed to write a batch of %d votes, retrying one by one', len(batch))
+        for vote in batch:
+            try:
+                with transaction.atomic():
+                    write_votes([vote])
+                self.stats['written'] += 1
+            except IntegrityError:
+                if Attempt.objects.filter(token=vote.token).exists():
+                    self.stats['duplicates'] += 1
+                elif has_voted(vote):
+                    # Участник уже голосовал в опросе с ограничением "один голос" (см. duplicates.py)
+                    self.stats['already_voted'] += 1
+                else:
+                    self._dead_letter(vote)
+            except Exception:
+                self._dead_letter(vote)
+
+    def _dead_letter(self, vote):
+        """ Передать голос, который не удалось записать, фоновой задаче write_vote"""
+        logger.exception('Failed to write vote %s, retrying in a background job', vote.token)
+        try:
+            submit('write_vote', vote_params(vote))
+        except Exception:
+            logger.exception('Failed to queue vote %s, the vote is lost', vote.token)
+            self.stats['dropped'] += 1
+        else:
+            self.stats['dead_lettered'] += 1
+
+    def _run(self):
+        try:
+            while not (self._stopping.is_set() and self._queue.empty()):
+                batch = self._take()
+                if batch:
+                    self._write(batch)
+        finally:
+            connections.close_all()
+
+    def flush(self):
+        """ Записать все голоса из очереди в текущем потоке"""
+        if self._queue is None:
+            return
+        while True:
+            batch = self._take(block=False)
+            if not batch:
+                break
+            self._write(batch)
+
+    def clear(self):
+        """ Остановить фоновый поток и сбросить очередь без записи"""
+        self._stopping.set()
+        while self._queue is not None and not self._queue.empty():
+            self._queue.get_nowait()
+        if self._thread is not None:
+            self._thread.join()
+        self._queue = self._thread = self._pid = None
+        self.stats.clear()
+
+    def stop(self, timeout=None):
+        """ Остановить фоновый поток, дописав очередь до конца"""
+        self._stopping.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout if timeout is not None else self.options.get('DRAIN_TIMEOUT', 30))
+            if thread.is_alive():
+                logger.error('Vote buffer was not drained in time, %d votes left', len(self))
+                return
+        if self._pid == os.getpid():
+            self.flush()
+
+
+def vote_params(vote):
+    """ Параметры задачи write_vote для голоса"""
+    return {'poll_id': vote.poll.id, 'user_id': vote.user_id, 'answers': vote.answers, 'token': str(vote.token),
+            'voter': str(vote.voter) if vote.voter is not None else None}
+
+
+vote_buffer = VoteBuffer()
+atexit.register(vote_buffer.stop)
+metrics_registry.register('poll_vote_buffer_votes_total', 'Buffered votes by outcome.', 'outcome', vote_buffer.stats)
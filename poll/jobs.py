@@ -0,0 +1,283 @@
+""" Фоновые задачи.
+
+Долгие операции - выгрузка опроса в файл, пересчет итогов, удаление опроса со всеми попытками - не выполняются
+в запросе (их прервал бы таймаут nginx), а ставятся в таблицу Job и выполняются командой runjobs в пуле
+процессов (settings.POLL_JOBS['PROCESSES']). Процесс забирает задачу условным UPDATE по прочитанному состоянию,
+поэтому одну задачу выполняет только один процесс, в том числе на нескольких машинах с общей БД.
+
+Задача, завершившаяся ошибкой, повторяется позже с экспоненциальной задержкой (BACKOFF, 2 * BACKOFF, ...,
+не больше MAX_BACKOFF секунд), пока не исчерпаны max_attempts попыток; ошибка JobError не повторяется.
+Выполняющаяся задача отмечает прогресс (progress из total); задача, от которой дольше STALE_SECONDS не было
+отметок (процесс упал), забирается заново.
+
+Опрос удаляется пакетами по CHUNK_SIZE попыток, каждый пакет - в своей короткой транзакции, поэтому
+блокировки не держатся на все время удаления. До завершения задачи опрос помечен is_deleted и скрыт из API.
+
+Голос, который очередь голосов не смогла записать (см. ingest.py), записывает задача write_vote.
+
+Периодические задачи (job(kind, every=секунды)) ставит в очередь сам runjobs: задача типа kind ставится, если
+такой задачи нет в очереди и последняя поставлена раньше чем every секунд назад.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from uuid import UUID
+
+from django.conf import settings
+from django.db import transaction, close_old_connections, IntegrityError
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .db_connections import check_connections
+from .duplicates import has_voted
+from .export import EXPORTERS
+from .models import Poll, Question, Choice, Attempt, Answer, AnswerChoice, PollTally, ChoiceTally, PollArchive, Job
+from .questions import invalidate_poll
+from .schema import compile_poll_schema, schema_cache
+from .tallies import recompute_tallies
+from .votes import Vote, write_votes
+
+logger = logging.getLogger(__name__)
+
+# Обработчики задач: {тип задачи: функция(job, **params)}, результат функции сохраняется в Job.result
+JOBS = {}
+
+# Периодические задачи: {тип задачи: интервал, секунды}
+PERIODIC = {}
+
+# Остановка процесса: текущая задача завершается, новые не забираются
+stopping = threading.Event()
+
+
+class JobError(Exception):
+    """ Ошибка, которую бесполезно повторять (например, опроса уже нет)"""
+
+
+class JobLost(Exception):
+    """ Задачу забрал другой процесс, пока эта была без отметок дольше STALE_SECONDS"""
+
+
+def options():
+    return getattr(settings, 'POLL_JOBS', {})
+
+
+def job(kind, every=None):
+    """ Зарегистрировать обработчик задач типа kind; every - ставить задачу каждые every секунд"""
+    def register(func):
+        JOBS[kind] = func
+        if every:
+            PERIODIC[kind] = every
+        return func
+    return register
+
+
+def submit(kind, params=None, user=None):
+    """ Поставить задачу в очередь"""
+    if kind not in JOBS:
+        raise ValueError('Unknown job kind: %s' % kind)
+    return Job.objects.create(kind=kind, params=params or {}, created_by=user,
+                              max_attempts=options().get('MAX_ATTEMPTS', 3))
+
+
+def backoff(attempts):
+    """ Задержка повтора после attempts неудачных попыток, секунды"""
+    return min(options().get('BACKOFF', 10) * 2 ** (attempts - 1), options().get('MAX_BACKOFF', 600))
+
+
+def worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def schedule_periodic():
+    """ Поставить периодические задачи, которые пора выполнить. Несколько процессов могут поставить
+    задачу одновременно, поэтому повторное выполнение периодической задачи должно быть безвредным"""
+    now = timezone.now()
+    for kind, every in PERIODIC.items():
+        if not Job.objects.filter(Q(status__in=(Job.PENDING, Job.RUNNING)) | Q(
+                created_at__gt=now - timedelta(seconds=every)), kind=kind).exists():
+            submit(kind)
+
+
+def claim(worker):
+    """ Забрать следующую задачу: ожидающую, срок которой наступил, или зависшую. None, если задач нет"""
+    now = timezone.now()
+    stale = Q(status=Job.RUNNING, heartbeat_at__lt=now - timedelta(seconds=options().get('STALE_SECONDS', 300)))
+    # Зависшие задачи без оставшихся попыток больше не выполняются
+    Job.objects.filter(stale, attempts__gte=F('max_attempts')).update(
+        status=Job.FAILED, error='Worker stopped responding', finished_at=now)
+    candidates = Job.objects.filter(Q(status=Job.PENDING, run_at__lte=now) | stale).order_by('run_at', 'id')
+    for job_id, status, heartbeat_at in candidates.values_list('id', 'status', 'heartbeat_at')[:10]:
+        claimed = Job.objects.filter(pk=job_id, status=status, heartbeat_at=heartbeat_at).update(
+            status=Job.RUNNING, worker=worker, attempts=F('attempts') + 1, heartbeat_at=now,
+            started_at=now, finished_at=None)
+        if claimed:
+            return Job.objects.get(pk=job_id)
+    return None
+
+
+def report(job, progress, total=None):
+    """ Отметить прогресс выполняющейся задачи"""
+    fields = {'progress': progress, 'heartbeat_at': timezone.now()}
+    if total is not None:
+        fields['total'] = total
+    if not Job.objects.filter(pk=job.pk, status=Job.RUNNING, worker=job.worker).update(**fields):
+        raise JobLost('Job #%d was claimed by another worker' % job.pk)
+    for name, value in fields.items():
+        setattr(job, name, value)
+
+
+def run(job):
+    """ Выполнить забранную задачу и записать результат или ошибку"""
+    handler = JOBS.get(job.kind)
+    try:
+        if handler is None:
+            raise JobError('Unknown job kind: %s' % job.kind)
+        result = handler(job, **job.params)
+    except JobLost:
+        logger.warning('Job #%d was claimed by another worker', job.pk)
+        return
+    except Exception as exc:
+        logger.exception('Job #%d (%s) failed, attempt %d of %d', job.pk, job.kind, job.attempts, job.max_attempts)
+        now = timezone.now()
+        fields = {'error': '%s: %s' % (type(exc).__name__, exc), 'heartbeat_at': None}
+        if isinstance(exc, JobError) or job.attempts >= job.max_attempts:
+            fields.update(status=Job.FAILED, finished_at=now)
+        else:
+            fields.update(status=Job.PENDING, run_at=now + timedelta(seconds=backoff(job.attempts)))
+        Job.objects.filter(pk=job.pk, worker=job.worker).update(**fields)
+        return
+    Job.objects.filter(pk=job.pk, worker=job.worker).update(
+        status=Job.DONE, result=result, error='', finished_at=timezone.now())
+
+
+def work(once=False, worker=None):
+    """ Выполнять задачи до остановки (stopping); once - только до опустошения очереди"""
+    worker = worker or worker_name()
+    scheduled_at = None
+    while not stopping.is_set():
+        # Между задачами подключения проверяются так же, как между запросами
+        check_connections()
+        close_old_connections()
+        if scheduled_at is None or time.monotonic() - scheduled_at >= options().get('SCHEDULE_INTERVAL', 60):
+            schedule_periodic()
+            scheduled_at = time.monotonic()
+        job = claim(worker)
+        if job is not None:
+            run(job)
+        elif once:
+            break
+        else:
+            stopping.wait(options().get('POLL_INTERVAL', 1))
+    close_old_connections()
+
+
+def _raw_delete(queryset):
+    # Без сбора связанных объектов и сигналов: связанные строки к этому моменту уже удалены
+    return queryset._raw_delete(queryset.db)
+
+
+def delete_poll_later(poll_id, user=None):
+    """ Скрыть опрос и поставить задачу его удаления"""
+    with transaction.atomic():
+        Poll.objects.filter(pk=poll_id).update(is_deleted=True)
+        invalidate_poll(poll_id, listed=True)
+        return submit('delete_poll', {'poll_id': poll_id}, user)
+
+
+@job('delete_poll')
+def delete_poll(job, poll_id):
+    """ Удалить опрос: попытки с ответами пакетами по CHUNK_SIZE, затем вопросы, итоги и сам опрос"""
+    chunk_size = options().get('CHUNK_SIZE', 500)
+    archive = PollArchive.objects.filter(poll_id=poll_id).values_list('path', flat=True).first()
+    attempts = Attempt.objects.filter(poll_id=poll_id)
+    report(job, 0, attempts.count())
+    deleted, last_id = 0, 0
+    while True:
+        ids = list(attempts.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            break
+        with transaction.atomic():
+            _raw_delete(AnswerChoice.objects.filter(answer__attempt_id__in=ids))
+            _raw_delete(Answer.objects.filter(attempt_id__in=ids))
+            deleted += _raw_delete(Attempt.objects.filter(id__in=ids))
+        last_id = ids[-1]
+        report(job, deleted)
+    with transaction.atomic():
+        _raw_delete(ChoiceTally.objects.filter(question__poll_id=poll_id))
+        _raw_delete(PollTally.objects.filter(poll_id=poll_id))
+        # Ответы попыток других опросов на эти вопросы (например, после ручной правки данных)
+        _raw_delete(AnswerChoice.objects.filter(answer__question__poll_id=poll_id))
+        _raw_delete(Answer.objects.filter(question__poll_id=poll_id))
+        _raw_delete(Choice.objects.filter(question__poll_id=poll_id))
+        _raw_delete(Question.objects.filter(poll_id=poll_id))
+        # Через ORM, чтобы сигнал сбросил кэши опроса
+        Poll.objects.filter(pk=poll_id).delete()
+    if archive:
+        # Файл архива ответов (см. lifecycle.py)
+        Path(archive).unlink(missing_ok=True)
+    return {'poll_id': poll_id, 'attempts': deleted}
+
+
+@job('rebuild_tallies')
+def rebuild_poll_tallies(job, poll_id):
+    """ Пересчитать счетчики итогов опроса (как команда recompute_tallies)"""
+    if Poll.objects.filter(pk=poll_id, is_archived=True).exists():
+        # Ответов в таблицах нет, итоги заморожены (см. lifecycle.py)
+        raise JobError('Poll is archived')
+    report(job, 0, 1)
+    attempts, counts = recompute_tallies(poll_id)
+    report(job, 1)
+    return {'poll_id': poll_id, 'attempts': attempts}
+
+
+@job('write_vote')
+def write_vote(job, poll_id, user_id, answers, token, voter=None):
+    """ Записать голос, который не смогла записать очередь голосов (см. ingest.py).
+    Голос уже записан, если есть попытка с его токеном"""
+    if Attempt.objects.filter(token=token).exists():
+        return {'token': token, 'written': False}
+    poll = schema_cache.get(poll_id)
+    if poll is None:
+        raise JobError('Poll does not exist')
+    if poll.archived:
+        raise JobError('Poll is archived')
+    vote = Vote(poll=poll, user_id=user_id, answers=answers, token=UUID(token),
+                voter=UUID(voter) if voter is not None else None)
+    try:
+        with transaction.atomic():
+            write_votes([vote])
+    except IntegrityError:
+        if Attempt.objects.filter(token=token).exists():
+            return {'token': token, 'written': False}
+        if has_voted(vote):
+            raise JobError('Voter has already voted in this poll')
+        raise
+    return {'token': token, 'written': True}
+
+
+def export_path(job_id, export_format):
+    return Path(options().get('DIR', 'jobs')) / ('job-%d.%s' % (job_id, export_format))
+
+
+@job('export_poll')
+def export_poll(job, poll_id, format='csv'):
+    """ Выгрузить попытки опроса в файл в каталоге DIR (см. export.py)"""
+    schema = compile_poll_schema(poll_id)
+    if schema is None:
+        raise JobError('Poll not found')
+    if schema.archived:
+        raise JobError('Poll is archived, rehydrate it first')
+    report(job, 0, Attempt.objects.filter(poll_id=poll_id).count())
+    path = export_path(job.pk, format)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Сначала во временный файл: прерванная выгрузка не выдается за готовую
+    partial = path.with_name(path.name + '.part')
+    with partial.open('w', encoding='utf-8', newline='') as file:
+        for chunk in EXPORTERS[format](schema, progress=lambda count: report(job, count)):
+            file.write(chunk)
+    partial.replace(path)
+    return {'poll_id': poll_id, 'format': format, 'attempts': job.progress, 'size': path.stat().st_size}
@@ -0,0 +1,361 @@
+""" Закрытие опросов: заморозка итогов и перенос ответов в архив.
+
+Ответы закрытого опроса (finished_at наступил) больше не меняются, но строки Answer и AnswerChoice остаются
+в самых больших таблицах и их индексах, через которые идет каждый голос. Периодическая задача close_polls
+(раз в INTERVAL секунд, см. jobs.PERIODIC) ставит задачу archive_poll для каждого закрытого опроса:
+1. итоги (по выбранным вариантам, как compute_tallies) и аналитика (распределения, таблицы сопряженности пар
+   вопросов, если их не больше MAX_CROSSTABS, и динамика по часам) замораживаются в PollArchive.summary;
+2. ответы попыток пишутся в сжатый файл DIR/poll-<id>.ndjson.gz (строка JSON на попытку) с контрольной суммой;
+3. опрос помечается is_archived, и итоги и аналитика выдаются из замороженной сводки;
+4. ответы удаляются из таблиц пакетами по CHUNK_SIZE попыток, каждый пакет в своей транзакции.
+Сами попытки остаются: история /results/ читается из их снимков (см. snapshots.py), недостающие снимки
+записываются перед удалением ответов. Прерванная задача при повторе продолжает удаление.
+
+Задача rehydrate_poll возвращает ответы из файла в таблицы (например, для выгрузки или поиска по ответам,
+которые для архивного опроса недоступны) и снимает пометку; через KEEP_REHYDRATED_DAYS дней опрос
+архивируется снова. Вновь открыть архивный опрос (перенести finished_at) нельзя.
+
+Файл архива - единственная копия ответов, поэтому, пока REQUIRE_PERSISTENT не выключен, задачи не архивируют
+опросы, если каталог DIR лежит на файловой системе контейнера (overlay, tmpfs и т.п.), а не на томе.
+Пометку is_archived операции с ответами читают из БД: процесс задач может не иметь общего с сервисом кэша схем.
+"""
+import gzip
+import hashlib
+import json
+import os
+from collections import Counter
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from .analytics import BUCKETS, PollAnalytics, analytics_engine
+from .db_routing import primary
+from .jobs import JobError, job, report, submit, _raw_delete
+from .models import Poll, Question, Choice, Attempt, Answer, AnswerChoice, PollArchive, Job
+from .questions import invalidate_poll
+from .schema import compile_poll_schema
+from .snapshots import render_snapshot
+from .tallies import PollResults, compute_tallies, get_results
+
+# Версия формата файла архива
+FORMAT = 1
+
+# Таблица монтирования процесса и файловые системы, содержимое которых пропадает вместе с контейнером
+MOUNTS = '/proc/self/mounts'
+EPHEMERAL_FILESYSTEMS = {'overlay', 'aufs', 'tmpfs', 'ramfs'}
+
+
+def options():
+    return getattr(settings, 'POLL_LIFECYCLE', {})
+
+
+class PollArchived(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Poll is archived, rehydrate it first'
+    default_code = 'poll_archived'
+
+
+def archive_path(poll_id):
+    return Path(options().get('DIR', 'archive')) / ('poll-%d.ndjson.gz' % poll_id)
+
+
+def mount_type(path):
+    """ Тип файловой системы, на которой лежит path, по таблице монтирования (None, если ее нет)"""
+    path = os.path.realpath(path)
+    point, fstype = '', None
+    try:
+        with open(MOUNTS) as file:
+            for line in file:
+                fields = line.split()
+                # Пробелы в точке монтирования записаны как \040; более поздняя точка перекрывает прежнюю
+                mount = fields[1].replace('\\040', ' ')
+                if (path == mount or path.startswith(mount.rstrip('/') + '/')) and len(mount) >= len(point):
+                    point, fstype = mount, fields[2]
+    except OSError:
+        return None
+    return fstype
+
+
+def ensure_persistent_storage(path):
+    """ JobError, если каталог архива path на файловой системе контейнера: файлы пропали бы вместе с ним,
+    а ответы из таблиц уже удалены"""
+    if not options().get('REQUIRE_PERSISTENT', True):
+        return
+    fstype = mount_type(path)
+    if fstype in EPHEMERAL_FILESYSTEMS:
+        raise JobError('Archive directory %s is on an ephemeral %s filesystem and would be lost with the container, '
+                       'mount a persistent volume there' % (path, fstype))
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def closed_polls():
+    """ Закрытые опросы, которые пора архивировать: не в архиве и не возвращенные из него недавно"""
+    rehydrated = timezone.now() - timedelta(days=options().get('KEEP_REHYDRATED_DAYS', 7))
+    return Poll.objects.existing().inactive().filter(is_archived=False).exclude(
+        archive__rehydrated_at__gt=rehydrated)
+
+
+def is_archived(schema):
+    """ Перенесены ли ответы опроса в архив. Читается из БД: схема в кэше процесса могла устареть,
+    если задачи выполняет процесс без общего кэша"""
+    with primary():
+        return Poll.objects.filter(pk=schema.id, is_archived=True).exists()
+
+
+def ensure_not_archived(schema):
+    """ Для операций, которым нужны ответы опроса: PollArchived, если они перенесены в архив"""
+    if is_archived(schema):
+        raise PollArchived()
+
+
+def load_summary(schema):
+    return PollArchive.objects.filter(poll_id=schema.id).values_list('summary', flat=True).get()
+
+
+def poll_results(schema):
+    """ Итоги опроса: замороженные для архивного опроса, иначе по счетчикам итогов (см. tallies.py).
+    Пометка берется из схемы: счетчики при архивации не удаляются и совпадают со сводкой"""
+    if not schema.archived:
+        return get_results(schema)
+    summary = load_summary(schema)
+    return PollResults(schema=schema, attempts=summary['attempts'],
+                       counts={(question_id, choice_id): count for question_id, choice_id, count in summary['counts']})
+
+
+def poll_analytics(schema, crosstabs=(), bucket='day'):
+    """ Аналитика опроса (см. analytics.py): для архивного опроса - из замороженной сводки.
+    Таблицы сопряженности, не замороженные при архивации, недоступны (PollArchived)"""
+    if not is_archived(schema):
+        return analytics_engine.get(schema, crosstabs, bucket)
+    frozen = load_summary(schema)['analytics']
+    tables = {(rows, columns): table for rows, columns, table in frozen['crosstabs']}
+    results = []
+    for question_a, question_b in crosstabs:
+        if (question_a.id, question_b.id) in tables:
+            table = tables[question_a.id, question_b.id]
+        elif (question_b.id, question_a.id) in tables:
+            table = [list(row) for row in zip(*tables[question_b.id, question_a.id])]
+        else:
+            raise PollArchived('Crosstab %d,%d was not frozen when the poll was archived, rehydrate it first'
+                               % (question_a.position, question_b.position))
+        results.append((question_a, question_b, table))
+    # Интервалы динамики кратны часу и отсчитываются от начала эпохи, поэтому складываются из часовых
+    seconds = BUCKETS[bucket]
+    timeline = Counter()
+    for start, count in frozen['timeline']:
+        timeline[start // seconds * seconds] += count
+    return PollAnalytics(
+        schema=schema,
+        attempts=frozen['attempts'],
+        last_attempt=frozen['last_attempt'],
+        answered=dict(frozen['answered']),
+        counts=dict(frozen['counts']),
+        crosstabs=results,
+        bucket=bucket,
+        timeline=sorted(timeline.items()),
+    )
+
+
+def freeze_summary(schema, last_attempt):
+    """ Итоги и аналитика опроса по ответам попыток с id не больше last_attempt"""
+    attempts, counts = compute_tallies(schema.id)
+    loaded = analytics_engine.columns_class()(schema)
+    loaded.load(schema.id, last_attempt, options().get('CHUNK_SIZE', 1000))
+    spans = loaded.spans
+    questions = [question for question in schema.questions if question.id in spans]
+    pairs = [(question_a, question_b)
+             for index, question_a in enumerate(questions) for question_b in questions[index:]]
+    if len(pairs) > options().get('MAX_CROSSTABS', 55):
+        pairs = []
+    return {
+        'attempts': attempts,
+        'counts': [[question_id, choice_id, count] for (question_id, choice_id), count in sorted(counts.items())],
+        'analytics': {
+            'attempts': loaded.count,
+            'last_attempt': loaded.last_id,
+            'answered': [[question_id, loaded.answered(span)] for question_id, span in spans.items()],
+            'counts': [[question_id, loaded.choice_counts(span)] for question_id, span in spans.items()],
+            'crosstabs': [[question_a.id, question_b.id,
+                           loaded.crosstab(spans[question_a.id], spans[question_b.id])]
+                          for question_a, question_b in pairs],
+            'timeline': loaded.timeline(BUCKETS['hour']),
+        },
+    }
+
+
+def attempt_chunks(poll_id, last_attempt):
+    """ id попыток опроса (не больше last_attempt) пакетами по CHUNK_SIZE"""
+    attempts = Attempt.objects.filter(poll_id=poll_id, id__lte=last_attempt).order_by('id')
+    chunk_size = options().get('CHUNK_SIZE', 1000)
+    last_id = 0
+    while True:
+        ids = list(attempts.filter(id__gt=last_id).values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            break
+        yield ids
+        last_id = ids[-1]
+
+
+def write_archive(job, schema, last_attempt, path):
+    """ Записать ответы попыток в сжатый файл: заголовок, затем строка на попытку
+    {"attempt": id, "answers": [[id, question_id, answer, [[id AnswerChoice, choice_id], ...]], ...]}.
+    Попыткам без снимка для истории снимок записывается здесь же. Возвращает число ответов"""
+    poll_id = schema.id
+    questions = {question.id: question for question in schema.questions}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(path.name + '.part')
+    answers, done = 0, 0
+    with gzip.open(partial, 'wt', encoding='utf-8') as file:
+        file.write(json.dumps({'poll': poll_id, 'format': FORMAT, 'last_attempt': last_attempt}) + '\n')
+        for ids in attempt_chunks(poll_id, last_attempt):
+            selected = {}
+            for choice_row_id, answer_id, choice_id in AnswerChoice.objects.filter(
+                    answer__attempt_id__in=ids).order_by('id').values_list('id', 'answer_id', 'choice_id'):
+                selected.setdefault(answer_id, []).append([choice_row_id, choice_id])
+            rows = {}
+            for answer_id, attempt_id, question_id, text in Answer.objects.filter(attempt_id__in=ids).order_by(
+                    'id').values_list('id', 'attempt_id', 'question_id', 'answer'):
+                rows.setdefault(attempt_id, []).append([answer_id, question_id, text, selected.get(answer_id, [])])
+            # Снимки строятся по уже прочитанным ответам, как в importer.py
+            missing = []
+            for attempt_id in Attempt.objects.filter(id__in=ids, snapshot__isnull=True).values_list('id', flat=True):
+                snapshot = render_snapshot([(questions[question_id], text, [choice_id for _, choice_id in choices])
+                                            for _, question_id, text, choices in rows.get(attempt_id, [])])
+                missing.append(Attempt(id=attempt_id, snapshot=snapshot))
+            Attempt.objects.bulk_update(missing, ['snapshot'])
+            for attempt_id in ids:
+                if attempt_id in rows:
+                    file.write(json.dumps({'attempt': attempt_id, 'answers': rows[attempt_id]},
+                                          ensure_ascii=False) + '\n')
+                    answers += len(rows[attempt_id])
+            done += len(ids)
+            report(job, done)
+    partial.replace(path)
+    return answers
+
+
+def delete_answers(job, poll_id, last_attempt, done):
+    """ Удалить из таблиц ответы попыток с id не больше last_attempt, пакет попыток - одна транзакция"""
+    for ids in attempt_chunks(poll_id, last_attempt):
+        with transaction.atomic():
+            _raw_delete(AnswerChoice.objects.filter(answer__attempt_id__in=ids))
+            _raw_delete(Answer.objects.filter(attempt_id__in=ids))
+        done += len(ids)
+        report(job, done)
+
+
+@job('close_polls', every=options().get('INTERVAL', 60 * 60))
+def close_polls(job):
+    """ Поставить архивацию закрытых опросов (кроме уже поставленной)"""
+    ensure_persistent_storage(options().get('DIR', 'archive'))
+    queued = {params.get('poll_id') for params in Job.objects.filter(
+        kind='archive_poll', status__in=(Job.PENDING, Job.RUNNING)).values_list('params', flat=True)}
+    poll_ids = [poll_id for poll_id in closed_polls().order_by('id').values_list('id', flat=True)
+                if poll_id not in queued]
+    for poll_id in poll_ids:
+        submit('archive_poll', {'poll_id': poll_id}, job.created_by)
+    report(job, len(poll_ids), len(poll_ids))
+    return {'polls': poll_ids}
+
+
+@job('archive_poll')
+def archive_poll(job, poll_id):
+    """ Заморозить итоги закрытого опроса и перенести его ответы в файл архива"""
+    schema = compile_poll_schema(poll_id)
+    if schema is None:
+        raise JobError('Poll not found')
+    if schema.is_active:
+        raise JobError('Poll is still active')
+    attempts = Attempt.objects.filter(poll_id=poll_id)
+    if schema.archived:
+        # Повтор прерванной задачи: ответы уже в файле, осталось удалить их из таблиц
+        archive = PollArchive.objects.get(poll_id=poll_id)
+        ensure_persistent_storage(Path(archive.path).parent)
+        done = 0
+        report(job, done, attempts.filter(id__lte=archive.last_attempt).count())
+    else:
+        # Прогресс: запись попыток в файл, затем удаление их ответов
+        last_attempt = attempts.order_by('-id').values_list('id', flat=True).first() or 0
+        done = attempts.filter(id__lte=last_attempt).count()
+        report(job, 0, 2 * done)
+        path = archive_path(poll_id)
+        ensure_persistent_storage(path.parent)
+        summary = freeze_summary(schema, last_attempt)
+        answers = write_archive(job, schema, last_attempt, path)
+        with transaction.atomic():
+            archive, _ = PollArchive.objects.update_or_create(poll_id=poll_id, defaults={
+                'summary': summary, 'last_attempt': last_attempt, 'answers': answers, 'path': str(path),
+                'size': path.stat().st_size, 'checksum': file_checksum(path), 'archived_at': timezone.now(),
+                'rehydrated_at': None})
+            Poll.objects.filter(pk=poll_id).update(is_archived=True)
+            invalidate_poll(poll_id)
+    delete_answers(job, poll_id, archive.last_attempt, done)
+    return {'poll_id': poll_id, 'answers': archive.answers, 'size': archive.size}
+
+
+@job('rehydrate_poll')
+def rehydrate_poll(job, poll_id):
+    """ Вернуть ответы архивного опроса из файла в таблицы. Ответы на удаленные с тех пор вопросы
+    и варианты, а также ответы удаленных попыток пропускаются"""
+    archive = PollArchive.objects.filter(poll_id=poll_id, poll__is_archived=True).first()
+    if archive is None:
+        raise JobError('Poll is not archived')
+    path = Path(archive.path)
+    if not path.exists() or file_checksum(path) != archive.checksum:
+        raise JobError('Archive file is missing or corrupted: %s' % path)
+    question_ids = set(Question.objects.filter(poll_id=poll_id).values_list('id', flat=True))
+    choice_ids = set(Choice.objects.filter(question__poll_id=poll_id).values_list('id', flat=True))
+    chunk_size = options().get('CHUNK_SIZE', 1000)
+    report(job, 0, archive.answers)
+    restored = 0
+
+    def restore(lines):
+        attempt_ids = set(Attempt.objects.filter(id__in=[line['attempt'] for line in lines]).values_list(
+            'id', flat=True))
+        answers, selected = [], []
+        for line in lines:
+            if line['attempt'] not in attempt_ids:
+                continue
+            for answer_id, question_id, text, choices in line['answers']:
+                if question_id not in question_ids:
+                    continue
+                answers.append(Answer(id=answer_id, attempt_id=line['attempt'], question_id=question_id, answer=text))
+                selected.extend(AnswerChoice(id=row_id, answer_id=answer_id, choice_id=choice_id)
+                                for row_id, choice_id in choices if choice_id in choice_ids)
+        # ignore_conflicts: при повторе задачи часть ответов уже возвращена
+        with transaction.atomic():
+            Answer.objects.bulk_create(answers, ignore_conflicts=True)
+            AnswerChoice.objects.bulk_create(selected, ignore_conflicts=True)
+        return len(answers)
+
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        header = json.loads(file.readline())
+        if header.get('format') != FORMAT or header.get('poll') != poll_id:
+            raise JobError('Unsupported archive file: %s' % path)
+        lines = []
+        for line in file:
+            lines.append(json.loads(line))
+            if len(lines) >= chunk_size:
+                restored += restore(lines)
+                report(job, restored)
+                lines = []
+        if lines:
+            restored += restore(lines)
+    with transaction.atomic():
+        Poll.objects.filter(pk=poll_id).update(is_archived=False)
+        PollArchive.objects.filter(pk=poll_id).update(rehydrated_at=timezone.now())
+        invalidate_poll(poll_id)
+    report(job, restored)
+    return {'poll_id': poll_id, 'answers': restored}
@@ -0,0 +1,49 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    """ Ограниченный по размеру потокобезопасный LRU-кэш в памяти процесса.
+    При переполнении вытесняется запись, к которой дольше всего не обращались.
+    Если задан ttl (секунды), запись считается отсутствующей через ttl секунд после записи"""
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                return self._data.pop(key)[1]
+            except KeyError:
+                return default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
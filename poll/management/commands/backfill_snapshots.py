@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from poll.models import Attempt
+from poll.snapshots import ANSWERS_PREFETCH, answers_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Записать снимки ответов для попыток, сохраненных без них (история /results/)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('polls', nargs='*', type=int, help='id опросов (по умолчанию все опросы)')
+        parser.add_argument('--all', action='store_true', help='Перезаписать снимки всех попыток, а не только пустые')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        attempts = Attempt.objects.order_by('id').prefetch_related(*ANSWERS_PREFETCH)
+        if options['polls']:
+            attempts = attempts.filter(poll_id__in=options['polls'])
+        if not options['all']:
+            attempts = attempts.filter(snapshot__isnull=True)
+        last_id, total = 0, 0
+        while True:
+            batch = list(attempts.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            for attempt in batch:
+                attempt.snapshot = answers_snapshot(attempt)
+            with transaction.atomic():
+                Attempt.objects.bulk_update(batch, ['snapshot'])
+            total += len(batch)
+        self.stdout.write(self.style.SUCCESS('%d attempt snapshots written' % total))
@@ -0,0 +1,136 @@
+import random
+import time
+from collections import Counter
+from datetime import date, timedelta
+from uuid import UUID
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from poll.models import Poll, Question, Choice, Attempt, Answer, AnswerChoice, MyUser
+from poll.schema import compile_poll_schema
+from poll.snapshots import render_snapshot
+from poll.tallies import rebuild_tallies
+
+
+class Command(BaseCommand):
+    help = 'Сгенерировать синтетические данные для нагрузочного тестирования: опросы с вопросами и вариантами ' \
+           'ответа, пользователей и попытки с ответами, снимками и счетчиками итогов (см. benchmarks/scenarios.py)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--polls', type=int, default=10)
+        parser.add_argument('--questions', type=int, default=10, help='Вопросов в опросе')
+        parser.add_argument('--choices', type=int, default=4, help='Вариантов ответа в вопросе с выбором')
+        parser.add_argument('--attempts', type=int, default=10000, help='Попыток всего, поровну по опросам')
+        parser.add_argument('--users', type=int, default=100,
+                            help='Пользователей, от которых записываются попытки (0 - только анонимные голоса)')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Попыток в одной транзакции')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def create_polls(self, count, questions, choices):
+        # Каждый пятый опрос уже завершен, каждый пятый не ограничен по времени
+        today = date.today()
+        polls = Poll.objects.bulk_create([
+            Poll(title='Опрос %d' % n, description='Синтетический опрос',
+                 finished_at=[today - timedelta(days=1), None, today + timedelta(days=30)][min(n % 5, 2)])
+            for n in range(count)
+        ])
+        types = (Question.TEXT, Question.SINGLE_CHOICE, Question.MULTI_CHOICE)
+        question_objs = Question.objects.bulk_create([
+            Question(poll=poll, position=position, question_type=types[(position - 1) % len(types)],
+                     main_text='Вопрос %d' % position)
+            for poll in polls for position in range(1, questions + 1)
+        ])
+        Choice.objects.bulk_create([
+            Choice(question=question, choice_text='Вариант %d' % n, position=n)
+            for question in question_objs if question.question_type != Question.TEXT for n in range(choices)
+        ], batch_size=5000)
+        return polls
+
+    def create_users(self, count):
+        password = make_password(None)
+        start = MyUser.objects.count()
+        return MyUser.objects.bulk_create([
+            MyUser(username='synthetic-%d' % n, password=password) for n in range(start, start + count)
+        ], batch_size=5000)
+
+    @staticmethod
+    def insert(model, fields, rows):
+        """ Вставить строки одним executemany, минуя создание объектов моделей"""
+        quote = connection.ops.quote_name
+        columns = [model._meta.get_field(name).column for name in fields]
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            quote(model._meta.db_table), ', '.join(map(quote, columns)), ', '.join(['%s'] * len(columns)))
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, rows)
+
+    @staticmethod
+    def next_id(model):
+        return (model.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+
+    @staticmethod
+    def vote_rows(schema, rnd, n):
+        """ Случайные ответы на все вопросы: (вопрос схемы, текст ответа, id выбранных вариантов)"""
+        rows = []
+        for question in schema.questions:
+            if question.question_type == Question.TEXT:
+                rows.append((question, str(['Ответ %d' % n]), ()))
+            elif question.question_type == Question.SINGLE_CHOICE:
+                rows.append((question, '', (rnd.choice(question.choice_ids), )))
+            else:
+                rows.append((question, '', rnd.sample(question.choice_ids, rnd.randint(1, len(question.choice_ids)))))
+        return rows
+
+    def create_attempts(self, schemas, users, total, batch_size, rnd, days=90):
+        """ Попытки со снимками, ответы и выбранные варианты пакетами по batch_size попыток.
+        id попыток и ответов назначаются заранее, чтобы не читать их из БД после вставки"""
+        voter_field, snapshot_field = Attempt._meta.get_field('voter'), Attempt._meta.get_field('snapshot')
+        attempt_id, answer_id = self.next_id(Attempt), self.next_id(Answer)
+        now = timezone.now()
+        attempt_counts, tallies = Counter(), {schema.id: Counter() for schema in schemas}
+        for start in range(0, total, batch_size):
+            attempts, answers, selected = [], [], []
+            for n in range(start, min(start + batch_size, total)):
+                schema = schemas[n % len(schemas)]
+                rows = self.vote_rows(schema, rnd, n)
+                attempt_counts[schema.id] += 1
+                voter = None if users else voter_field.get_db_prep_value(UUID(int=rnd.getrandbits(128), version=4),
+                                                                         connection)
+                attempts.append((
+                    attempt_id, users[n % len(users)].pk if users else None, voter, schema.id,
+                    connection.ops.adapt_datetimefield_value(now - timedelta(seconds=rnd.randrange(days * 86400))),
+                    snapshot_field.get_db_prep_value(render_snapshot(rows), connection),
+                ))
+                for question, text, choice_ids in rows:
+                    answers.append((answer_id, attempt_id, question.id, text))
+                    for choice_id in choice_ids:
+                        selected.append((answer_id, choice_id))
+                        tallies[schema.id][question.id, choice_id] += 1
+                    answer_id += 1
+                attempt_id += 1
+            with transaction.atomic():
+                self.insert(Attempt, ('id', 'user', 'voter', 'poll', 'time', 'snapshot'), attempts)
+                self.insert(Answer, ('id', 'attempt', 'question', 'answer'), answers)
+                self.insert(AnswerChoice, ('answer', 'choice'), selected)
+            self.stdout.write('%d/%d attempts' % (start + len(attempts), total))
+        # Последовательности id после вставки с явными id (для PostgreSQL)
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [Attempt, Answer]):
+                cursor.execute(sql)
+        for schema in schemas:
+            rebuild_tallies(schema.id, attempt_counts[schema.id], tallies[schema.id])
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        rnd = random.Random(options['seed'])
+        polls = self.create_polls(options['polls'], options['questions'], options['choices'])
+        users = self.create_users(options['users'])
+        schemas = [compile_poll_schema(poll.pk) for poll in polls]
+        self.create_attempts(schemas, users, options['attempts'], options['batch_size'], rnd)
+        self.stdout.write(self.style.SUCCESS('%d polls x %d questions x %d choices, %d users, %d attempts in %.1fs' % (
+            len(polls), options['questions'], options['choices'], len(users), options['attempts'],
+            time.monotonic() - started)))
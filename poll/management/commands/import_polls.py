@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from poll.importer import READERS, ImportDataError, Importer
+from poll.models import ImportCheckpoint
+
+
+class Command(BaseCommand):
+    help = 'Импортировать опросы, пользователей и ответы из выгрузки dumpdata (xml или jsonl/ndjson) потоком, ' \
+           'пакетами с новыми id и контрольными точками для продолжения прерванного импорта (см. poll/importer.py)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Файл выгрузки или - для стандартного ввода')
+        parser.add_argument('--format', choices=sorted(READERS),
+                            help='Формат выгрузки (по умолчанию по расширению файла: .xml - xml, иначе ndjson)')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Объектов в одной транзакции')
+        parser.add_argument('--key', help='Ключ контрольных точек (по умолчанию путь и размер файла)')
+        parser.add_argument('--no-checkpoints', action='store_true', help='Не записывать контрольные точки')
+        parser.add_argument('--restart', action='store_true',
+                            help='Удалить контрольные точки ключа и импортировать выгрузку заново')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        import_format = options['format'] or ('xml' if path.lower().endswith('.xml') else 'ndjson')
+        key = None
+        if not options['no_checkpoints']:
+            key = options['key'] or ('file:%s:%d' % (os.path.abspath(path), os.path.getsize(path))
+                                     if path != '-' else None)
+        if key and options['restart']:
+            ImportCheckpoint.objects.filter(key=key).delete()
+        started = time.monotonic()
+
+        def progress(offset, stats):
+            self.stdout.write('%d objects read, %d written' % (offset, sum(
+                count for label, count in stats.items() if label.startswith('poll.'))))
+
+        importer = Importer(key=key, batch_size=options['batch_size'], progress=progress)
+        if importer.offset:
+            self.stdout.write('Resuming after %d objects' % importer.offset)
+        mode = 'rb' if import_format == 'xml' else 'r'
+        try:
+            if path == '-':
+                stats = importer.run(READERS[import_format](sys.stdin.buffer if mode == 'rb' else sys.stdin))
+            else:
+                with open(path, mode) as stream:
+                    stats = importer.run(READERS[import_format](stream))
+        except ImportDataError as exc:
+            raise CommandError('%s (written objects are kept; rerun to resume after %d objects)' % (
+                exc, importer.offset))
+        self.stdout.write(self.style.SUCCESS('%s in %.1fs' % (
+            ', '.join('%s: %d' % item for item in sorted(stats.items())), time.monotonic() - started)))
@@ -0,0 +1,41 @@
+from uuid import uuid4
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Case, When, Value, UUIDField
+
+from poll.models import Attempt, MyUser
+
+
+class Command(BaseCommand):
+    help = 'Перевести пользователей, созданных автоматически для анонимных голосов, в анонимных участников ' \
+           '(Attempt.voter) и удалить их записи MyUser'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать таких пользователей')
+
+    def auto_users(self):
+        """ Пользователи анонимных голосов: username равен id, пароль не задан, ни разу не входили"""
+        return MyUser.objects.filter(username__regex=r'^[0-9]+$', password__startswith='!', is_staff=False,
+                                     is_superuser=False, last_login__isnull=True).order_by('id')
+
+    def handle(self, *args, **options):
+        users = self.auto_users()
+        last_id, total = 0, 0
+        while True:
+            batch = list(users.filter(id__gt=last_id).values_list('id', 'username')[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            ids = [user_id for user_id, username in batch if username == str(user_id)]
+            total += len(ids)
+            if options['dry_run'] or not ids:
+                continue
+            # Каждому пользователю - свой участник: попытки одного пользователя остаются связанными
+            voters = Case(*[When(user_id=user_id, then=Value(uuid4())) for user_id in ids], output_field=UUIDField())
+            with transaction.atomic():
+                Attempt.objects.filter(user_id__in=ids).update(voter=voters, user=None)
+                MyUser.objects.filter(id__in=ids).delete()
+        action = 'found' if options['dry_run'] else 'converted to anonymous voters'
+        self.stdout.write(self.style.SUCCESS('%d auto-created users %s' % (total, action)))
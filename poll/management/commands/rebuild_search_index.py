@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, DatabaseError
+
+from poll.search import answer_search
+
+
+class Command(BaseCommand):
+    help = 'Построить заново индекс полнотекстового поиска по ответам (см. poll/search.py) или проверить его'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Псевдоним БД (по умолчанию default)')
+        parser.add_argument('--check', action='store_true', help='Только сверить индекс с таблицей ответов')
+
+    def handle(self, *args, **options):
+        search = answer_search(options['database'])
+        if options['check']:
+            try:
+                search.check()
+            except DatabaseError as exc:
+                raise CommandError('Search index is inconsistent: %s' % exc)
+            self.stdout.write(self.style.SUCCESS('Search index is consistent'))
+            return
+        answers = search.rebuild()
+        self.stdout.write(self.style.SUCCESS('%d answers indexed (%s)' % (answers, type(search).__name__)))
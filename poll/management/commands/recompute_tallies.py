@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from poll.models import Poll
+from poll.tallies import compute_tallies, lock_tallies, stored_tallies, rebuild_tallies
+
+
+class Command(BaseCommand):
+    help = 'Пересчитать счетчики итогов опросов по выбранным вариантам ответа и проверить их расхождение с сохраненными'
+
+    def add_arguments(self, parser):
+        parser.add_argument('polls', nargs='*', type=int, help='id опросов (по умолчанию все опросы)')
+        parser.add_argument('--check', action='store_true',
+                            help='Только проверить расхождение, не перезаписывая счетчики')
+
+    def handle(self, *args, **options):
+        # Ответы архивных опросов перенесены из таблиц, их итоги заморожены (см. lifecycle.py)
+        polls = Poll.objects.filter(is_archived=False)
+        if options['polls']:
+            polls = polls.filter(pk__in=options['polls'])
+        poll_ids = list(polls.order_by('id').values_list('id', flat=True))
+        drifted = []
+        for poll_id in poll_ids:
+            # Подсчет и перезапись в одной транзакции: голоса, записанные между ними, не теряются (см. tallies.py)
+            with transaction.atomic():
+                if not options['check']:
+                    lock_tallies(poll_id)
+                attempts, counts = compute_tallies(poll_id)
+                stored_attempts, stored_counts = stored_tallies(poll_id)
+                drift = {key: (stored_counts.get(key, 0), count)
+                         for key, count in counts.items() if stored_counts.get(key, 0) != count}
+                if drift or attempts != stored_attempts:
+                    drifted.append(poll_id)
+                    self.stdout.write('Poll #%d: attempts %d -> %d, %d choice counters drifted' % (
+                        poll_id, stored_attempts, attempts, len(drift)))
+                if not options['check']:
+                    rebuild_tallies(poll_id, attempts, counts)
+        if options['check'] and drifted:
+            raise CommandError('Tallies drifted for polls: %s' % ', '.join(map(str, drifted)))
+        self.stdout.write(self.style.SUCCESS('%d polls checked, %d drifted' % (len(poll_ids), len(drifted))))
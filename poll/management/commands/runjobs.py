@@ -0,0 +1,54 @@
+import multiprocessing
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from poll import jobs
+
+
+def stop(signum, frame):
+    jobs.stopping.set()
+
+
+def start_worker(once):
+    # Подключения родителя не переходят в дочерний процесс: каждый открывает свои
+    connections.close_all()
+    process = multiprocessing.get_context('fork').Process(target=jobs.work, kwargs={'once': once}, daemon=True)
+    process.start()
+    return process
+
+
+class Command(BaseCommand):
+    help = 'Выполнять фоновые задачи (см. poll/jobs.py) в пуле процессов. SIGTERM - завершить текущие задачи и выйти'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=settings.POLL_JOBS['PROCESSES'],
+                            help='Число процессов (1 - выполнять задачи в этом процессе)')
+        parser.add_argument('--once', action='store_true', help='Выйти, когда очередь опустеет')
+
+    def handle(self, *args, **options):
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        if options['processes'] <= 1:
+            jobs.work(once=options['once'])
+            return
+        processes = [start_worker(options['once']) for _ in range(options['processes'])]
+        while not jobs.stopping.is_set():
+            alive = [process for process in processes if process.is_alive()]
+            if options['once'] and not alive:
+                break
+            if not options['once']:
+                # Упавший процесс заменяется новым
+                for process in processes:
+                    if not process.is_alive():
+                        self.stderr.write('Worker %d exited with code %s, restarting' % (process.pid, process.exitcode))
+                processes = alive + [start_worker(False) for _ in range(len(processes) - len(alive))]
+            time.sleep(1)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
@@ -1,4 +1,8 @@
+from datetime import date
+
 from django.contrib.auth.base_user import BaseUserManager
+from django.db import models
+from django.db.models import Q
 
 
 class MyUserManager(BaseUserManager):
@@ -30,3 +34,22 @@ class MyUserManager(BaseUserManager):
         if extra_fields.get('is_superuser') is not True:
             raise ValueError('Superuser must have is_superuser=True.')
         return self.create_user(username, password, **extra_fields)
+
+
+class PollQuerySet(models.QuerySet):
+    """
+    Опросы с фильтрами по активности (см. Poll.is_active)
+    """
+    @staticmethod
+    def active_q():
+        return Q(finished_at__gt=date.today()) | Q(finished_at__isnull=True)
+
+    def active(self):
+        return self.filter(self.active_q())
+
+    def inactive(self):
+        return self.exclude(self.active_q())
+
+    def existing(self):
+        """ Опросы, кроме удаляемых фоновой задачей"""
+        return self.filter(is_deleted=False)
@@ -0,0 +1,293 @@
+""" Метрики запросов по маршрутам в формате Prometheus.
+
+MetricsMiddleware для каждого запроса записывает в реестр процесса по имени маршрута (url_name: poll-list,
+poll-detail, poll-vote, questions-list, results, ...) время ответа (гистограмма), количество и время
+SQL-запросов (через connection.execute_wrapper) и размер ответа. Каждый поток пишет в свою часть реестра,
+поэтому запись метрик обходится без блокировок.
+
+Под ASGI синхронные middleware и представления Django выполняет в отдельном потоке запроса, поэтому
+MetricsMiddleware подключает учет SQL к подключениям этого потока (и снимает его) через sync_to_async;
+потоки пула асинхронных представлений (aio.py) учитывают SQL сами. Метрики сохраняются в каталог вне цикла событий.
+
+Если задан каталог settings.POLL_METRICS['DIR'], каждый процесс (воркер gunicorn) не реже чем раз
+в FLUSH_INTERVAL секунд сохраняет туда свои метрики, а /metrics суммирует файлы всех процессов.
+Счетчики накопительные, поэтому файлы завершившихся воркеров остаются в сумме; каталог очищается
+при запуске сервиса (entrypoint.prod.sh).
+
+Кроме метрик маршрутов, в /metrics выводятся счетчики процесса, зарегистрированные через registry.register
+(например, исходы голосов очереди ingest.py).
+"""
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils.deprecation import MiddlewareMixin
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Строка метрик маршрута: количество запросов, суммы времени ответа, SQL-запросов, времени SQL,
+# размера ответа, далее количество запросов по интервалам гистограммы (не накопительно)
+COUNT, DURATION, QUERIES, SQL_DURATION, RESPONSE_BYTES, BUCKETS = range(6)
+
+
+class MetricsRegistry:
+    """ Метрики процесса: по словарю {маршрут: строка метрик} на каждый поток"""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self._flushed = 0
+        # Счетчики процесса: {имя метрики: (описание, имя метки, Counter {значение метки: число})}
+        self._counters = {}
+
+    @property
+    def options(self):
+        return getattr(settings, 'POLL_METRICS', {})
+
+    @property
+    def buckets(self):
+        return tuple(self.options.get('BUCKETS', DEFAULT_BUCKETS))
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None or self._pid != os.getpid():
+            with self._lock:
+                # После fork метрики родительского процесса не учитываем
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._shards = []
+                    self._local = threading.local()
+                shard = self._local.shard = {}
+                self._shards.append(shard)
+        return shard
+
+    def observe(self, route, duration, queries, sql_duration, size, flush=True):
+        """ Учесть запрос маршрута route; flush=False - не сохранять метрики в каталог (под ASGI их сохраняет
+        MetricsMiddleware вне цикла событий)"""
+        shard = self._shard()
+        buckets = self.buckets
+        row = shard.get(route)
+        if row is None:
+            row = shard[route] = [0] * (BUCKETS + len(buckets))
+        row[COUNT] += 1
+        row[DURATION] += duration
+        row[QUERIES] += queries
+        row[SQL_DURATION] += sql_duration
+        row[RESPONSE_BYTES] += size
+        index = bisect_left(buckets, duration)
+        if index < len(buckets):
+            row[BUCKETS + index] += 1
+        if flush:
+            self.maybe_flush()
+
+    def register(self, name, text, label, counter):
+        """ Выводить в метриках счетчик counter (Counter {значение метки label: число}) под именем name"""
+        self._counters[name] = (text, label, counter)
+
+    @staticmethod
+    def _merge(target, source):
+        for route, row in source.items():
+            total = target.setdefault(route, [0] * len(row))
+            for index, value in enumerate(row):
+                total[index] += value
+        return target
+
+    def snapshot(self):
+        """ Метрики текущего процесса: {маршрут: строка метрик}"""
+        if self._pid != os.getpid():
+            return {}
+        merged = {}
+        for shard in list(self._shards):
+            self._merge(merged, dict(shard))
+        return merged
+
+    def counters(self):
+        """ Зарегистрированные счетчики текущего процесса: {имя метрики: {значение метки: число}}"""
+        return {name: dict(counter) for name, (text, label, counter) in self._counters.items()}
+
+    def _path(self, directory):
+        return os.path.join(directory, 'metrics-%d.json' % os.getpid())
+
+    def flush(self):
+        """ Сохранить метрики процесса в общий каталог"""
+        directory = self.options.get('DIR')
+        if not directory:
+            return
+        self._flushed = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump({'routes': self.snapshot(), 'counters': self.counters()}, file)
+        os.replace(tmp, self._path(directory))
+
+    def flush_due(self):
+        """ Пора ли сохранить метрики в каталог; следующее сохранение отсчитывается от этого вызова"""
+        if not self.options.get('DIR') or time.monotonic() - self._flushed < self.options.get('FLUSH_INTERVAL', 5):
+            return False
+        self._flushed = time.monotonic()
+        return True
+
+    def maybe_flush(self):
+        if self.flush_due():
+            self.flush()
+
+    def collect(self):
+        """ Метрики маршрутов и счетчики всех процессов из общего каталога или, если он не задан,
+        текущего процесса"""
+        directory = self.options.get('DIR')
+        if not directory:
+            return self.snapshot(), self.counters()
+        self.flush()
+        routes, counters = {}, {}
+        for name in os.listdir(directory):
+            if not (name.startswith('metrics-') and name.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(directory, name)) as file:
+                    data = json.load(file)
+            except (OSError, ValueError):
+                continue
+            self._merge(routes, data.get('routes', {}))
+            for metric, values in data.get('counters', {}).items():
+                total = counters.setdefault(metric, {})
+                for value, count in values.items():
+                    total[value] = total.get(value, 0) + count
+        return routes, counters
+
+    def render(self):
+        """ Метрики в текстовом формате Prometheus"""
+        buckets = self.buckets
+        routes, counters = self.collect()
+        metrics = sorted(routes.items())
+        lines = [
+            '# HELP poll_http_request_duration_seconds Request latency by route.',
+            '# TYPE poll_http_request_duration_seconds histogram',
+        ]
+        for route, row in metrics:
+            cumulative = 0
+            for bound, count in zip(buckets, row[BUCKETS:]):
+                cumulative += count
+                lines.append('poll_http_request_duration_seconds_bucket{route="%s",le="%s"} %d' % (
+                    route, bound, cumulative))
+            lines.append('poll_http_request_duration_seconds_bucket{route="%s",le="+Inf"} %d' % (route, row[COUNT]))
+            lines.append('poll_http_request_duration_seconds_sum{route="%s"} %r' % (route, float(row[DURATION])))
+            lines.append('poll_http_request_duration_seconds_count{route="%s"} %d' % (route, row[COUNT]))
+        for name, index, kind, text in (
+                ('poll_http_sql_queries_total', QUERIES, 'counter', 'SQL queries by route.'),
+                ('poll_http_sql_duration_seconds_total', SQL_DURATION, 'counter', 'SQL time by route.'),
+                ('poll_http_response_bytes_total', RESPONSE_BYTES, 'counter', 'Response body size by route.')):
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for route, row in metrics:
+                lines.append('%s{route="%s"} %r' % (name, route, row[index]))
+        for name, (text, label, counter) in sorted(self._counters.items()):
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s counter' % name)
+            for value, count in sorted(counters.get(name, {}).items()):
+                lines.append('%s{%s="%s"} %d' % (name, label, value, count))
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self._pid = None
+            self._shards = []
+            self._local = threading.local()
+
+
+registry = MetricsRegistry()
+
+
+# SQL-запросы текущего запроса: [количество, время]. Потоки пула асинхронных представлений (aio.py)
+# считают запросы в тот же счетчик через count_queries
+_sql = ContextVar('metrics_sql', default=None)
+
+
+@contextmanager
+def count_queries():
+    """ Учитывать SQL-запросы подключений текущего потока в счетчике текущего запроса"""
+    sql = _sql.get()
+    if sql is None:
+        yield
+        return
+
+    def count_sql(execute, *args):
+        start = time.perf_counter()
+        try:
+            return execute(*args)
+        finally:
+            sql[0] += 1
+            sql[1] += time.perf_counter() - start
+
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(count_sql))
+        yield
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """ Время ответа, SQL-запросы и размер ответа по маршрутам (см. MetricsRegistry).
+    Для потоковых ответов время и размер учитываются по окончании передачи, SQL - до начала передачи"""
+
+    def __init__(self, get_response):
+        if not registry.options.get('ENABLED', True):
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+        start, sql = time.perf_counter(), [0, 0.0]
+        token = _sql.set(sql)
+        try:
+            with count_queries():
+                response = self.get_response(request)
+        finally:
+            _sql.reset(token)
+        return self.observe(request, response, start, sql)
+
+    async def __acall__(self, request):
+        start, sql = time.perf_counter(), [0, 0.0]
+        token = _sql.set(sql)
+        # Учет SQL в потоке, где выполняются синхронные middleware и представления запроса
+        counting = ExitStack()
+        try:
+            await sync_to_async(counting.enter_context, thread_sensitive=True)(count_queries())
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(counting.close, thread_sensitive=True)()
+            _sql.reset(token)
+        response = self.observe(request, response, start, sql, flush=False)
+        if registry.flush_due():
+            await sync_to_async(registry.flush, thread_sensitive=False)()
+        return response
+
+    def observe(self, request, response, start, sql, flush=True):
+        match = request.resolver_match
+        route = match.url_name if match is not None and match.url_name else 'unmatched'
+        if response.streaming:
+            response.streaming_content = self._stream(response.streaming_content, route, start, sql, flush)
+        else:
+            registry.observe(route, time.perf_counter() - start, sql[0], sql[1], len(response.content), flush)
+        return response
+
+    @staticmethod
+    def _stream(content, route, start, sql, flush):
+        size = 0
+        try:
+            for chunk in content:
+                size += len(chunk)
+                yield chunk
+        finally:
+            registry.observe(route, time.perf_counter() - start, sql[0], sql[1], size, flush)
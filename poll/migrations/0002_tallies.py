@@ -0,0 +1,37 @@
+# Generated by Django 4.0.2 on 2026-10-18 15:37
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poll', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='attempt',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attempts', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь'),
+        ),
+        migrations.CreateModel(
+            name='PollTally',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Количество попыток')),
+                ('poll', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='tally', to='poll.poll', verbose_name='Опрос')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ChoiceTally',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='Количество ответов')),
+                ('choice', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='tally', to='poll.choice', verbose_name='Вариант ответа')),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tallies', to='poll.question', verbose_name='Вопрос')),
+            ],
+        ),
+    ]
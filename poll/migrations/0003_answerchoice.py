@@ -0,0 +1,30 @@
+# Generated by Django 4.0.2 on 2026-10-18 15:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poll', '0002_tallies'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='answer',
+            name='answer',
+            field=models.TextField(blank=True, verbose_name='Ответ'),
+        ),
+        migrations.CreateModel(
+            name='AnswerChoice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('answer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='choices', to='poll.answer', verbose_name='Ответ')),
+                ('choice', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='answers', to='poll.choice', verbose_name='Вариант ответа')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 4.0.2 on 2026-10-18 15:38
+
+import ast
+
+from django.db import migrations
+
+TEXT = 1
+CHUNK_SIZE = 2000
+
+
+def parse_answer(text):
+    try:
+        value = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return [text]
+    return [str(part) for part in value] if isinstance(value, (list, tuple)) else [str(value)]
+
+
+def forwards(apps, schema_editor):
+    """ Перенести выбранные варианты из строкового представления списка в AnswerChoice.
+    Ответы, которые не удалось сопоставить с вариантами, остаются как есть"""
+    Answer = apps.get_model('poll', 'Answer')
+    AnswerChoice = apps.get_model('poll', 'AnswerChoice')
+    Choice = apps.get_model('poll', 'Choice')
+
+    choices = {}
+    for question_id, choice_id, choice_text in Choice.objects.exclude(
+            question__question_type=TEXT).order_by('-id').values_list('question_id', 'id', 'choice_text'):
+        choices.setdefault(question_id, {})[choice_text] = choice_id
+
+    answers = Answer.objects.filter(question_id__in=choices).exclude(answer='').order_by('id')
+    last_id = 0
+    while True:
+        batch = list(answers.filter(id__gt=last_id).values_list('id', 'question_id', 'answer')[:CHUNK_SIZE])
+        if not batch:
+            break
+        last_id = batch[-1][0]
+        converted, answer_choices = [], []
+        for answer_id, question_id, text in batch:
+            question_choices = choices[question_id]
+            parts = parse_answer(text)
+            if not all(part in question_choices for part in parts):
+                continue
+            converted.append(answer_id)
+            answer_choices.extend(AnswerChoice(answer_id=answer_id, choice_id=question_choices[part])
+                                  for part in parts)
+        AnswerChoice.objects.bulk_create(answer_choices)
+        Answer.objects.filter(id__in=converted).update(answer='')
+
+
+def backwards(apps, schema_editor):
+    Answer = apps.get_model('poll', 'Answer')
+    AnswerChoice = apps.get_model('poll', 'AnswerChoice')
+
+    texts = {}
+    for answer_id, choice_text in AnswerChoice.objects.order_by('id').values_list(
+            'answer_id', 'choice__choice_text').iterator(chunk_size=CHUNK_SIZE):
+        texts.setdefault(answer_id, []).append(choice_text)
+    for answer_id, parts in texts.items():
+        Answer.objects.filter(id=answer_id).update(answer=str(parts))
+    AnswerChoice.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poll', '0003_answerchoice'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.2 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poll', '0004_migrate_choice_answers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attempt',
+            name='token',
+            field=models.UUIDField(blank=True, editable=False, null=True, unique=True, verbose_name='Токен попытки'),
+        ),
+    ]
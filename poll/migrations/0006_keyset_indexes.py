@@ -0,0 +1,29 @@
+# Generated by Django 4.0.2 on 2026-10-18 15:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poll', '0005_attempt_token'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='attempt',
+            index=models.Index(fields=['user', '-time', '-id'], name='attempt_user_time_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='attempt',
+            index=models.Index(fields=['poll', '-time', '-id'], name='attempt_poll_time_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='poll',
+            index=models.Index(fields=['-started_at', '-id'], name='poll_started_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='poll',
+            index=models.Index(fields=['finished_at', '-started_at', '-id'], name='poll_finished_started_id_idx'),
+        ),
+    ]
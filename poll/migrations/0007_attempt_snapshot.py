@@ -0,0 +1,18 @@
+# Generated by Django 4.0.2 on 2026-10-18 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poll', '0006_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attempt',
+            name='snapshot',
+            field=models.JSONField(blank=True, editable=False, null=True, verbose_name='Снимок ответов'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.0.2 on 2026-10-18 18:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poll', '0007_attempt_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attempt',
+            name='voter',
+            field=models.UUIDField(blank=True, editable=False, null=True, verbose_name='Анонимный участник'),
+        ),
+        migrations.AlterField(
+            model_name='attempt',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='attempts', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь'),
+        ),
+        migrations.AddIndex(
+            model_name='attempt',
+            index=models.Index(fields=['voter', '-time', '-id'], name='attempt_voter_time_id_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.0.2 on 2026-10-18 16:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poll', '0008_attempt_voter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(db_index=True, max_length=255, verbose_name='Ключ импорта')),
+                ('offset', models.PositiveBigIntegerField(verbose_name='Номер следующего объекта выгрузки')),
+                ('mapping', models.JSONField(default=dict, verbose_name='Соответствие id')),
+                ('counts', models.JSONField(default=dict, verbose_name='Записано объектов')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Контрольная точка импорта',
+                'verbose_name_plural': 'Контрольные точки импорта',
+            },
+        ),
+    ]
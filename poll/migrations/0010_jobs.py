@@ -0,0 +1,51 @@
+# Generated by Django 4.0.2 on 2026-10-18 16:41
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poll', '0009_import_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='poll',
+            name='is_deleted',
+            field=models.BooleanField(default=False, editable=False, verbose_name='Удаляется'),
+        ),
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=50, verbose_name='Тип задачи')),
+                ('params', models.JSONField(default=dict, verbose_name='Параметры')),
+                ('status', models.CharField(choices=[('pending', 'Ожидает'), ('running', 'Выполняется'), ('done', 'Выполнена'), ('failed', 'Ошибка')], default='pending', max_length=10, verbose_name='Состояние')),
+                ('progress', models.PositiveBigIntegerField(default=0, verbose_name='Выполнено')),
+                ('total', models.PositiveBigIntegerField(blank=True, null=True, verbose_name='Всего')),
+                ('result', models.JSONField(blank=True, null=True, verbose_name='Результат')),
+                ('error', models.TextField(blank=True, default='', verbose_name='Последняя ошибка')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Попыток')),
+                ('max_attempts', models.PositiveSmallIntegerField(default=3, verbose_name='Наибольшее число попыток')),
+                ('run_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Выполнить после')),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True)),
+                ('worker', models.CharField(blank=True, default='', max_length=100, verbose_name='Процесс')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Автор')),
+            ],
+            options={
+                'verbose_name': 'Фоновая задача',
+                'verbose_name_plural': 'Фоновые задачи',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['status', 'run_at', 'id'], name='job_status_run_at_idx'),
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 4.0.2 on 2026-10-18 17:20
+
+from django.db import migrations
+
+# Индекс полнотекстового поиска по ответам на текстовые вопросы (см. poll/search.py).
+# Ответы на вопросы с вариантами хранятся с пустым answer и в индекс не попадают.
+SQLITE_FORWARDS = [
+    "CREATE VIRTUAL TABLE poll_answer_fts USING fts5("
+    "answer, content='poll_answer', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    # Индекс с внешним содержимым: удаление передает прежний текст, поэтому строки без текста пропускаются
+    "CREATE TRIGGER poll_answer_fts_insert AFTER INSERT ON poll_answer WHEN new.answer != '' BEGIN "
+    "INSERT INTO poll_answer_fts(rowid, answer) VALUES (new.id, new.answer); END",
+    "CREATE TRIGGER poll_answer_fts_delete AFTER DELETE ON poll_answer WHEN old.answer != '' BEGIN "
+    "INSERT INTO poll_answer_fts(poll_answer_fts, rowid, answer) VALUES ('delete', old.id, old.answer); END",
+    # Один триггер: прежний текст должен удаляться из индекса до добавления нового
+    "CREATE TRIGGER poll_answer_fts_update AFTER UPDATE OF answer ON poll_answer BEGIN "
+    "INSERT INTO poll_answer_fts(poll_answer_fts, rowid, answer) "
+    "SELECT 'delete', old.id, old.answer WHERE old.answer != ''; "
+    "INSERT INTO poll_answer_fts(rowid, answer) SELECT new.id, new.answer WHERE new.answer != ''; END",
+    "INSERT INTO poll_answer_fts(rowid, answer) SELECT id, answer FROM poll_answer WHERE answer != ''",
+]
+SQLITE_BACKWARDS = [
+    "DROP TRIGGER IF EXISTS poll_answer_fts_insert",
+    "DROP TRIGGER IF EXISTS poll_answer_fts_delete",
+    "DROP TRIGGER IF EXISTS poll_answer_fts_update",
+    "DROP TABLE IF EXISTS poll_answer_fts",
+]
+# GIN-индекс по выражению: запросы poll/search.py используют в точности это выражение и условие
+POSTGRES_FORWARDS = [
+    "CREATE INDEX poll_answer_search_idx ON poll_answer USING GIN (to_tsvector('simple', answer)) "
+    "WHERE answer <> ''",
+]
+POSTGRES_BACKWARDS = [
+    "DROP INDEX IF EXISTS poll_answer_search_idx",
+]
+
+
+def execute(schema_editor, statements):
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def forwards(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        execute(schema_editor, SQLITE_FORWARDS)
+    elif vendor == 'postgresql':
+        execute(schema_editor, POSTGRES_FORWARDS)
+
+
+def backwards(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        execute(schema_editor, SQLITE_BACKWARDS)
+    elif vendor == 'postgresql':
+        execute(schema_editor, POSTGRES_BACKWARDS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poll', '0010_jobs'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.0.2 on 2026-10-18 17:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poll', '0011_answer_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PollArchive',
+            fields=[
+                ('poll', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='archive', serialize=False, to='poll.poll', verbose_name='Опрос')),
+                ('summary', models.JSONField(verbose_name='Итоги')),
+                ('last_attempt', models.PositiveBigIntegerField(default=0, verbose_name='Последняя попытка')),
+                ('answers', models.PositiveBigIntegerField(default=0, verbose_name='Ответов в архиве')),
+                ('path', models.CharField(max_length=255, verbose_name='Файл')),
+                ('size', models.PositiveBigIntegerField(default=0, verbose_name='Размер файла')),
+                ('checksum', models.CharField(max_length=64, verbose_name='SHA-256 файла')),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата архивации')),
+                ('rehydrated_at', models.DateTimeField(blank=True, null=True, verbose_name='Дата возврата из архива')),
+            ],
+            options={
+                'verbose_name': 'Архив опроса',
+                'verbose_name_plural': 'Архивы опросов',
+            },
+        ),
+        migrations.AddField(
+            model_name='poll',
+            name='is_archived',
+            field=models.BooleanField(default=False, editable=False, verbose_name='В архиве'),
+        ),
+    ]
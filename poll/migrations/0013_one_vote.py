@@ -0,0 +1,41 @@
+# Generated by Django 4.0.2 on 2026-10-18 17:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poll', '0012_poll_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='poll',
+            name='one_vote',
+            field=models.BooleanField(default=False, verbose_name='Один голос на участника'),
+        ),
+        migrations.CreateModel(
+            name='PollVoter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('voter', models.UUIDField(blank=True, null=True, verbose_name='Анонимный участник')),
+                ('poll', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='voters', to='poll.poll', verbose_name='Опрос')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Участник опроса',
+                'verbose_name_plural': 'Участники опросов',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='pollvoter',
+            constraint=models.UniqueConstraint(condition=models.Q(('user__isnull', False)), fields=('poll', 'user'), name='poll_voter_unique_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='pollvoter',
+            constraint=models.UniqueConstraint(condition=models.Q(('voter__isnull', False)), fields=('poll', 'voter'), name='poll_voter_unique_voter'),
+        ),
+    ]
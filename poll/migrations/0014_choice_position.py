@@ -0,0 +1,41 @@
+# Generated by Django 4.0.2 on 2026-10-18 18:01
+
+from django.db import migrations, models
+
+CHUNK_SIZE = 2000
+
+
+def forwards(apps, schema_editor):
+    """ Номера вариантов по прежнему порядку вывода - порядку id внутри вопроса"""
+    Choice = apps.get_model('poll', 'Choice')
+    choices = Choice.objects.order_by('id')
+    positions, last_id = {}, 0
+    while True:
+        batch = list(choices.filter(id__gt=last_id).only('id', 'question_id')[:CHUNK_SIZE])
+        if not batch:
+            break
+        last_id = batch[-1].id
+        for choice in batch:
+            choice.position = positions.get(choice.question_id, 0)
+            positions[choice.question_id] = choice.position + 1
+        Choice.objects.bulk_update(batch, ['position'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poll', '0013_one_vote'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='choice',
+            options={'ordering': ['position', 'id']},
+        ),
+        migrations.AddField(
+            model_name='choice',
+            name='position',
+            field=models.PositiveIntegerField(default=0, verbose_name='Номер варианта в вопросе'),
+        ),
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
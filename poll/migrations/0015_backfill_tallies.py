@@ -0,0 +1,45 @@
+# Generated by Django 4.0.2 on 2026-10-18 19:10
+
+from django.db import migrations
+from django.db.models import Count
+
+TEXT = 1
+BATCH_SIZE = 2000
+
+
+def forwards(apps, schema_editor):
+    """ Счетчики итогов по ответам, записанным до их появления (как compute_tallies в poll/tallies.py).
+    Итоги архивных опросов заморожены, а опросы с пометкой is_deleted удаляются, их счетчики не нужны"""
+    Poll = apps.get_model('poll', 'Poll')
+    Choice = apps.get_model('poll', 'Choice')
+    Attempt = apps.get_model('poll', 'Attempt')
+    AnswerChoice = apps.get_model('poll', 'AnswerChoice')
+    PollTally = apps.get_model('poll', 'PollTally')
+    ChoiceTally = apps.get_model('poll', 'ChoiceTally')
+
+    polls = Poll.objects.filter(is_archived=False, is_deleted=False)
+    attempts = dict(Attempt.objects.filter(poll__in=polls).values_list('poll_id').annotate(
+        count=Count('id')).order_by())
+    counts = {(question_id, choice_id): 0 for question_id, choice_id in Choice.objects.filter(
+        question__poll__in=polls).exclude(question__question_type=TEXT).values_list('question_id', 'id')}
+    counts.update({(question_id, choice_id): count for question_id, choice_id, count in AnswerChoice.objects.filter(
+        choice__question__poll__in=polls).values_list('choice__question_id', 'choice_id').annotate(
+        count=Count('id')).order_by()})
+
+    PollTally.objects.filter(poll__in=polls).delete()
+    PollTally.objects.bulk_create([PollTally(poll_id=poll_id, attempts=attempts.get(poll_id, 0))
+                                   for poll_id in polls.values_list('id', flat=True)], batch_size=BATCH_SIZE)
+    ChoiceTally.objects.filter(question__poll__in=polls).delete()
+    ChoiceTally.objects.bulk_create([ChoiceTally(question_id=question_id, choice_id=choice_id, count=count)
+                                     for (question_id, choice_id), count in counts.items()], batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poll', '0014_choice_position'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
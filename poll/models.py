@@ -2,6 +2,9 @@ from django.db import models
 from datetime import date
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
+
+from .manager import PollQuerySet
 
 
 class MyUser(AbstractUser):
@@ -16,11 +19,24 @@ class Poll(models.Model):
     # is_active = models.BooleanField(default=True)
     started_at = models.DateField(auto_now_add=True, verbose_name='Дата старта')
     finished_at = models.DateField(null=True, blank=True, verbose_name='Дата окончания')
+    # Опрос удаляется фоновой задачей (см. jobs.py), до ее завершения он скрыт
+    is_deleted = models.BooleanField(default=False, editable=False, verbose_name='Удаляется')
+    # Ответы закрытого опроса перенесены в архив, итоги выдаются из PollArchive (см. lifecycle.py)
+    is_archived = models.BooleanField(default=False, editable=False, verbose_name='В архиве')
+    # Участник может проголосовать только один раз (см. duplicates.py)
+    one_vote = models.BooleanField(default=False, verbose_name='Один голос на участника')
+
+    objects = PollQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'Опрос'
         verbose_name_plural = 'Опросы'
         ordering = ['-started_at', ]
+        indexes = [
+            # Постраничный вывод по (started_at, id) и фильтр активных опросов (см. pagination.py)
+            models.Index(fields=['-started_at', '-id'], name='poll_started_id_idx'),
+            models.Index(fields=['finished_at', '-started_at', '-id'], name='poll_finished_started_id_idx'),
+        ]
 
     @property
     def is_active(self):
@@ -56,20 +72,169 @@ class Question(models.Model):
 class Choice(models.Model):
     choice_text = models.CharField(max_length=50, verbose_name='Текст варианта ответа',)
     question = models.ForeignKey('Question', on_delete=models.CASCADE, verbose_name='Вопрос', related_name='choices')
+    # Порядок вариантов в вопросе хранится явно: перестановка вариантов не меняет их id (см. questions.py)
+    position = models.PositiveIntegerField(default=0, verbose_name='Номер варианта в вопросе')
+
+    class Meta:
+        ordering = ['position', 'id', ]
 
     def __str__(self):
         return self.choice_text
 
 
 class Attempt(models.Model):
+    # Попытка анонимного голоса вместо пользователя помечается идентификатором участника (см. voters.py)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name='Пользователь',
-                             related_name='attempts')
+                             related_name='attempts', null=True, blank=True)
+    voter = models.UUIDField(null=True, blank=True, editable=False, verbose_name='Анонимный участник')
     poll = models.ForeignKey('Poll', on_delete=models.CASCADE, verbose_name='Опрос')
     time = models.DateTimeField(auto_now_add=True,)
+    # Токен попытки, записанной через очередь голосов (см. ingest.py)
+    token = models.UUIDField(null=True, blank=True, unique=True, editable=False, verbose_name='Токен попытки')
+    # Вопросы и ответы на момент голосования в формате истории /results/ (см. snapshots.py)
+    snapshot = models.JSONField(null=True, blank=True, editable=False, verbose_name='Снимок ответов')
     ordering = ['-time', ]
 
+    class Meta:
+        indexes = [
+            # История пользователя и попытки опроса постранично по (time, id) (см. pagination.py)
+            models.Index(fields=['user', '-time', '-id'], name='attempt_user_time_id_idx'),
+            models.Index(fields=['poll', '-time', '-id'], name='attempt_poll_time_id_idx'),
+            models.Index(fields=['voter', '-time', '-id'], name='attempt_voter_time_id_idx'),
+        ]
+
 
 class Answer(models.Model):
     attempt = models.ForeignKey('Attempt', on_delete=models.CASCADE, verbose_name='Попытка', related_name='answers')
     question = models.ForeignKey('Question', on_delete=models.CASCADE, verbose_name='Вопрос')
-    answer = models.TextField(verbose_name='Ответ',)
+    # Текст ответа хранится только для вопросов типа Question.TEXT,
+    # выбранные варианты ответа хранятся в AnswerChoice
+    answer = models.TextField(blank=True, verbose_name='Ответ',)
+
+    @property
+    def value(self):
+        """ Ответ в прежнем формате - строковое представление списка ответов: "['5', '15']"
+        """
+        if self.answer:
+            return self.answer
+        return str([answer_choice.choice.choice_text for answer_choice in self.choices.all()])
+
+
+class AnswerChoice(models.Model):
+    """ Вариант ответа, выбранный в ответе на вопрос с выбором ответа"""
+    answer = models.ForeignKey('Answer', on_delete=models.CASCADE, verbose_name='Ответ', related_name='choices')
+    choice = models.ForeignKey('Choice', on_delete=models.CASCADE, verbose_name='Вариант ответа',
+                               related_name='answers')
+
+    class Meta:
+        ordering = ['id', ]
+
+
+class PollTally(models.Model):
+    """ Счетчик попыток прохождения опроса (обновляется при голосовании, см. tallies.py)"""
+    poll = models.OneToOneField('Poll', on_delete=models.CASCADE, verbose_name='Опрос', related_name='tally')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='Количество попыток')
+
+
+class ChoiceTally(models.Model):
+    """ Счетчик выбора варианта ответа (обновляется при голосовании, см. tallies.py)"""
+    question = models.ForeignKey('Question', on_delete=models.CASCADE, verbose_name='Вопрос', related_name='tallies')
+    choice = models.OneToOneField('Choice', on_delete=models.CASCADE, verbose_name='Вариант ответа',
+                                  related_name='tally')
+    count = models.PositiveIntegerField(default=0, verbose_name='Количество ответов')
+
+
+class PollVoter(models.Model):
+    """ Проголосовавший участник опроса с ограничением "один голос" (Poll.one_vote, см. duplicates.py):
+    пользователь или анонимный участник. Уникальность обеспечивает БД"""
+    poll = models.ForeignKey('Poll', on_delete=models.CASCADE, verbose_name='Опрос', related_name='voters')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name='Пользователь',
+                             related_name='+', null=True, blank=True)
+    voter = models.UUIDField(null=True, blank=True, verbose_name='Анонимный участник')
+
+    class Meta:
+        verbose_name = 'Участник опроса'
+        verbose_name_plural = 'Участники опросов'
+        constraints = [
+            models.UniqueConstraint(fields=['poll', 'user'], condition=models.Q(user__isnull=False),
+                                    name='poll_voter_unique_user'),
+            models.UniqueConstraint(fields=['poll', 'voter'], condition=models.Q(voter__isnull=False),
+                                    name='poll_voter_unique_voter'),
+        ]
+
+
+class PollArchive(models.Model):
+    """ Архив закрытого опроса (см. lifecycle.py): итоги и аналитика, замороженные при архивации,
+    и файл с ответами, перенесенными из таблиц Answer и AnswerChoice"""
+    poll = models.OneToOneField('Poll', on_delete=models.CASCADE, primary_key=True, verbose_name='Опрос',
+                                related_name='archive')
+    summary = models.JSONField(verbose_name='Итоги')
+    # Ответы попыток с id не больше last_attempt перенесены в файл
+    last_attempt = models.PositiveBigIntegerField(default=0, verbose_name='Последняя попытка')
+    answers = models.PositiveBigIntegerField(default=0, verbose_name='Ответов в архиве')
+    path = models.CharField(max_length=255, verbose_name='Файл')
+    size = models.PositiveBigIntegerField(default=0, verbose_name='Размер файла')
+    checksum = models.CharField(max_length=64, verbose_name='SHA-256 файла')
+    archived_at = models.DateTimeField(default=timezone.now, verbose_name='Дата архивации')
+    # Ответы возвращены в таблицы; опрос архивируется снова через POLL_LIFECYCLE['KEEP_REHYDRATED_DAYS']
+    rehydrated_at = models.DateTimeField(null=True, blank=True, verbose_name='Дата возврата из архива')
+
+    class Meta:
+        verbose_name = 'Архив опроса'
+        verbose_name_plural = 'Архивы опросов'
+
+
+class ImportCheckpoint(models.Model):
+    """ Контрольная точка импорта выгрузки (см. importer.py): записанный пакет объектов"""
+    key = models.CharField(max_length=255, db_index=True, verbose_name='Ключ импорта')
+    offset = models.PositiveBigIntegerField(verbose_name='Номер следующего объекта выгрузки')
+    # {модель: {id в выгрузке: новый id}} для объектов пакета
+    mapping = models.JSONField(default=dict, verbose_name='Соответствие id')
+    counts = models.JSONField(default=dict, verbose_name='Записано объектов')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Контрольная точка импорта'
+        verbose_name_plural = 'Контрольные точки импорта'
+
+
+class Job(models.Model):
+    """ Фоновая задача (см. jobs.py): выполняется командой runjobs, повторяется при ошибке"""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'Ожидает'),
+        (RUNNING, 'Выполняется'),
+        (DONE, 'Выполнена'),
+        (FAILED, 'Ошибка'),
+    )
+
+    kind = models.CharField(max_length=50, verbose_name='Тип задачи')
+    params = models.JSONField(default=dict, verbose_name='Параметры')
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING, verbose_name='Состояние')
+    progress = models.PositiveBigIntegerField(default=0, verbose_name='Выполнено')
+    total = models.PositiveBigIntegerField(null=True, blank=True, verbose_name='Всего')
+    result = models.JSONField(null=True, blank=True, verbose_name='Результат')
+    error = models.TextField(blank=True, default='', verbose_name='Последняя ошибка')
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name='Попыток')
+    max_attempts = models.PositiveSmallIntegerField(default=3, verbose_name='Наибольшее число попыток')
+    # Ожидающая задача выполняется не раньше run_at (отложенный повтор после ошибки)
+    run_at = models.DateTimeField(default=timezone.now, verbose_name='Выполнить после')
+    # Время последней отметки выполняющейся задачи; по нему находятся задачи упавших процессов
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    worker = models.CharField(max_length=100, blank=True, default='', verbose_name='Процесс')
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True,
+                                   related_name='+', verbose_name='Автор')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Фоновая задача'
+        verbose_name_plural = 'Фоновые задачи'
+        indexes = [
+            # Выбор следующей задачи (см. jobs.claim)
+            models.Index(fields=['status', 'run_at', 'id'], name='job_status_run_at_idx'),
+        ]
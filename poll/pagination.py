@@ -0,0 +1,111 @@
+""" Постраничный вывод по ключу (keyset pagination).
+
+Страница выбирается условием по значениям полей сортировки последней записи предыдущей страницы:
+(started_at, id) < (x, y), а не через OFFSET, поэтому глубокие страницы стоят столько же, сколько первая.
+Поля сортировки задаются атрибутом keyset_ordering представления и должны покрываться индексом.
+
+Результаты полнотекстового поиска упорядочены по релевантности, а не по полям записи, поэтому выводятся
+по номерам страниц (SearchPagination).
+"""
+import base64
+import json
+from collections import OrderedDict
+from types import SimpleNamespace
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    page_size = 20
+    max_page_size = 100
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    ordering = ('-id', )
+    invalid_cursor_message = 'Invalid cursor'
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = tuple(getattr(view, 'keyset_ordering', self.ordering))
+        self.page_size = self.get_page_size(request)
+        self.model = queryset.model
+
+        queryset = queryset.order_by(*self.ordering)
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded:
+            queryset = queryset.filter(self.cursor_filter(self.decode_cursor(encoded)))
+
+        page = list(queryset[:self.page_size + 1])
+        self.next_cursor = self.encode_cursor(page[self.page_size - 1]) if len(page) > self.page_size else None
+        return page[:self.page_size]
+
+    def _fields(self):
+        for field_name in self.ordering:
+            name = field_name.lstrip('-')
+            yield name, field_name.startswith('-'), self.model._meta.get_field(name)
+
+    def cursor_filter(self, values):
+        """ Записи после курсора: a <= x AND (a < x OR (a = x AND b < y)) для убывающей сортировки.
+        Условие a <= x по первому полю позволяет БД начать просмотр индекса сразу с курсора"""
+        condition, equal = Q(), {}
+        fields = list(self._fields())
+        for (name, descending, _), value in zip(fields, values):
+            condition |= Q(**equal, **{'%s__%s' % (name, 'lt' if descending else 'gt'): value})
+            equal[name] = value
+        name, descending, _ = fields[0]
+        return Q(**{'%s__%s' % (name, 'lte' if descending else 'gte'): values[0]}) & condition
+
+    def encode_cursor(self, obj):
+        # Страница может состоять из строк .values() (см. fast.py)
+        if isinstance(obj, dict):
+            obj = SimpleNamespace(**obj)
+        values = [field.value_to_string(obj) for _, _, field in self._fields()]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, encoded):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            fields = list(self._fields())
+            if not isinstance(values, list) or len(values) != len(fields):
+                raise ValueError
+            return [field.to_python(value) for (_, _, field), value in zip(fields, values)]
+        except (ValueError, TypeError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True},
+                'results': schema,
+            },
+        }
+
+
+class SearchPagination(PageNumberPagination):
+    """ Страницы результатов поиска по ответам (см. search.SearchResults)"""
+    page_size = 20
+    max_page_size = 100
+    page_size_query_param = 'page_size'
@@ -0,0 +1,124 @@
+""" Редактирование вопросов опроса пакетом.
+
+Варианты ответа обновляются по разнице со старым списком (diff_choices): совпавшие по тексту варианты
+сохраняют id, а вместе с ним выбранные в ответах варианты и счетчики итогов, и только получают новый номер
+(Choice.position). save_questions создает и изменяет список
+вопросов в одной транзакции, shift_positions сдвигает номера вопросов одним UPDATE.
+Пакетные операции не отправляют сигналы, поэтому кэши опроса сбрасываются явно.
+"""
+from typing import NamedTuple
+
+from django.db import transaction
+from django.db.models import F
+
+from .models import Question, Choice
+from .response_cache import response_cache
+from .schema import schema_cache
+
+
+class ChoiceDiff(NamedTuple):
+    kept: dict
+    deleted: list
+    created: list
+
+
+def diff_choices(existing, texts):
+    """ Изменения вариантов ответа: existing - [(id, текст)] в текущем порядке, texts - новый список текстов.
+
+    Вариант с тем же текстом остается с прежним id, где бы он ни оказался в новом списке (повторяющиеся тексты
+    сопоставляются по порядку), остальные прежние варианты удаляются, а новые тексты создаются. Измененный текст -
+    это новый вариант: ответы за прежний текст не переносятся на другой. Возвращает kept - {id: номер},
+    deleted - [id], created - [(номер, текст)]"""
+    unmatched = {}
+    for choice_id, text in existing:
+        unmatched.setdefault(text, []).append(choice_id)
+    kept, created = {}, []
+    for position, text in enumerate(texts):
+        if unmatched.get(text):
+            kept[unmatched[text].pop(0)] = position
+        else:
+            created.append((position, text))
+    return ChoiceDiff(
+        kept=kept,
+        deleted=[choice_id for choice_id, _ in existing if choice_id not in kept],
+        created=created,
+    )
+
+
+def apply_choices(choices):
+    """ Записать варианты ответа вопросов: {id вопроса: список текстов}. Четыре запроса на весь пакет"""
+    existing, positions = {}, {}
+    for choice_id, question_id, text, position in Choice.objects.filter(question_id__in=choices).order_by(
+            'position', 'id').values_list('id', 'question_id', 'choice_text', 'position'):
+        existing.setdefault(question_id, []).append((choice_id, text))
+        positions[choice_id] = position
+    moved, deleted, created = [], [], []
+    for question_id, texts in choices.items():
+        diff = diff_choices(existing.get(question_id, []), list(texts))
+        moved.extend(Choice(id=choice_id, position=position) for choice_id, position in diff.kept.items()
+                     if positions[choice_id] != position)
+        deleted.extend(diff.deleted)
+        created.extend(Choice(question_id=question_id, choice_text=text, position=position)
+                       for position, text in diff.created)
+    if deleted:
+        # Выбранные в ответах варианты удаляются каскадом
+        Choice.objects.filter(id__in=deleted).delete()
+    if moved:
+        Choice.objects.bulk_update(moved, ['position'])
+    if created:
+        Choice.objects.bulk_create(created)
+
+
+def invalidate_poll(poll_id, listed=False):
+    schema_cache.invalidate(poll_id)
+    response_cache.purge_poll(poll_id, listed=listed)
+
+
+QUESTION_FIELDS = ('question_type', 'main_text')
+
+
+def save_questions(poll_id, items, existing):
+    """ Создать и изменить вопросы опроса в одной транзакции.
+
+    items - проверенные элементы пакета (см. BulkQuestionSerializer), existing - {position: Question}
+    вопросов опроса. Вопрос с новым номером position создается, с существующим - изменяется
+    и при заданном new_position переносится на этот номер"""
+    with transaction.atomic():
+        created, updated, changed_fields, choices = [], [], set(), {}
+        for item in items:
+            question = existing.get(item['position'])
+            if question is None:
+                question = Question(poll_id=poll_id, position=item['position'],
+                                    **{name: item[name] for name in QUESTION_FIELDS})
+                created.append((question, item.get('choices') or ()))
+                continue
+            for name in QUESTION_FIELDS:
+                if name in item:
+                    setattr(question, name, item[name])
+                    changed_fields.add(name)
+            if item.get('new_position') is not None:
+                question.position = item['new_position']
+                changed_fields.add('position')
+            updated.append(question)
+            if item.get('choices') is not None or question.question_type == Question.TEXT:
+                choices[question.id] = item.get('choices') or ()
+        if updated and changed_fields:
+            Question.objects.bulk_update(updated, sorted(changed_fields))
+        if created:
+            Question.objects.bulk_create([question for question, _ in created])
+            Choice.objects.bulk_create([Choice(question_id=question.id, choice_text=text, position=position)
+                                        for question, texts in created for position, text in enumerate(texts)])
+        if choices:
+            apply_choices(choices)
+        invalidate_poll(poll_id)
+
+
+def shift_positions(poll_id, start, offset, end=None):
+    """ Сдвинуть номера вопросов с start по end (включительно, без end - до последнего) на offset одним UPDATE"""
+    questions = Question.objects.filter(poll_id=poll_id, position__gte=start)
+    if end is not None:
+        questions = questions.filter(position__lte=end)
+    with transaction.atomic():
+        count = questions.update(position=F('position') + offset)
+        invalidate_poll(poll_id)
+    return count
@@ -0,0 +1,48 @@
+import json
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    """ JSONRenderer, который при установленном orjson кодирует ответ через него.
+    Вывод совпадает с JSONRenderer побайтно: компактный JSON в UTF-8 с экранированными U+2028 и U+2029;
+    даты и другие типы, которых нет в JSON, кодирует encoder_class DRF. Отличается только запись чисел
+    с плавающей точкой в экспоненциальной форме (1e16 вместо 1e+16), а в ответах сервиса дробные только
+    проценты в итогах опроса. С отступами (?indent=, Browsable API), при других настройках JSON DRF
+    и без orjson работает JSONRenderer"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.ensure_ascii or not self.compact \
+                or self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=self.encoder_class().default,
+                               option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # Например, целые больше 64 бит
+            return super().render(data, accepted_media_type, renderer_context)
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+
+
+class StreamingRenderer(BaseRenderer):
+    """ Рендерер потоковой выгрузки. Данные формирует само представление (StreamingHttpResponse),
+    рендерер нужен для выбора формата через ?format= и для ответов с ошибками"""
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data, ensure_ascii=False).encode(self.charset)
+
+
+class CSVRenderer(StreamingRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class NDJSONRenderer(StreamingRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
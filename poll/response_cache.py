@@ -0,0 +1,198 @@
+""" Кэш ответов списка опросов и детальной информации об опросе.
+
+ResponseCacheMiddleware сохраняет ответы GET /polls/ и /polls/{id}/ в бэкенде Django cache
+(settings.POLL_RESPONSE_CACHE['ALIAS']) по адресу запроса, заголовку Accept и аудитории: администраторы
+видят неактивные опросы, поэтому их ответы кэшируются отдельно. Ответы получают ETag и Last-Modified,
+на If-None-Match / If-Modified-Since возвращается 304.
+
+Каждый маршрут помечен суррогатными ключами (ROUTES): список - ключом polls, опрос - ключом poll:<id>.
+У ключа есть номер поколения, который входит в ключ записи кэша; сигналы сохранения/удаления Poll, Question
+и Choice увеличивают поколение (см. signals.py), после чего прежние записи больше не читаются и истекают
+по TIMEOUT. Состав активных опросов зависит от текущей даты, поэтому запись живет не дольше, чем до
+ближайшего finished_at: в этот день опрос перестает быть активным.
+"""
+import asyncio
+import hashlib
+import time
+from datetime import date, datetime, time as day_time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import transaction
+from django.db.models import Min
+from django.http import HttpResponse
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+
+from .models import Poll
+from .schema import schema_cache
+
+# Кэшируемые маршруты (url_name) и их суррогатные ключи; {pk} и др. - аргументы маршрута
+ROUTES = {
+    'poll-list': ('polls', ),
+    'poll-detail': ('poll:{pk}', ),
+}
+
+
+def seconds_until(day):
+    """ Секунд до начала дня day по местному времени (date.today() в Poll.is_active считает так же)"""
+    return (datetime.combine(day, day_time.min) - datetime.now()).total_seconds()
+
+
+def next_expiry(poll_id=None):
+    """ Ближайшая дата окончания активного опроса (или опроса poll_id) либо None"""
+    if poll_id is not None:
+        schema = schema_cache.get(poll_id)
+        finished_at = schema.finished_at if schema is not None else None
+    else:
+        finished_at = Poll.objects.filter(finished_at__gt=date.today()).aggregate(
+            first=Min('finished_at'))['first']
+    return finished_at if finished_at is not None and finished_at > date.today() else None
+
+
+class ResponseCache:
+    """ Записи ответов и поколения суррогатных ключей в бэкенде Django cache"""
+
+    @property
+    def options(self):
+        return getattr(settings, 'POLL_RESPONSE_CACHE', {})
+
+    @property
+    def backend(self):
+        return caches[self.options.get('ALIAS', 'default')]
+
+    @staticmethod
+    def _generation_key(surrogate_key):
+        return 'response-generation:%s' % surrogate_key
+
+    @staticmethod
+    def _initial_generation():
+        # Если ключ поколения вытеснен из бэкенда, новое поколение не должно совпасть ни с одним из прежних
+        return time.time_ns() // 1000
+
+    def generations(self, surrogate_keys):
+        """ Текущие поколения суррогатных ключей"""
+        keys = [self._generation_key(key) for key in surrogate_keys]
+        found = self.backend.get_many(keys)
+        for key in keys:
+            if key not in found:
+                self.backend.add(key, self._initial_generation(), None)
+                found[key] = self.backend.get(key)
+        return tuple(found[key] for key in keys)
+
+    def key(self, audience, request, surrogate_keys):
+        variant = '\n'.join([request.get_full_path(), request.headers.get('Accept', '')])
+        return 'response:%s:%s:%s' % (audience, hashlib.sha256(variant.encode()).hexdigest(),
+                                      '.'.join(map(str, self.generations(surrogate_keys))))
+
+    def _bump(self, surrogate_keys):
+        for surrogate_key in surrogate_keys:
+            key = self._generation_key(surrogate_key)
+            try:
+                self.backend.incr(key)
+            except ValueError:
+                self.backend.add(key, self._initial_generation(), None)
+
+    def purge(self, *surrogate_keys):
+        """ Сбросить записи с суррогатными ключами.
+
+        Внутри транзакции поколения увеличиваются еще раз после фиксации, иначе ответ, собранный
+        конкурентным запросом до фиксации, остался бы в кэше с новым поколением"""
+        self._bump(surrogate_keys)
+        if transaction.get_connection().in_atomic_block:
+            transaction.on_commit(lambda: self._bump(surrogate_keys))
+
+    def purge_poll(self, poll_id, listed=False):
+        """ Сбросить ответы опроса и, если изменились поля самого опроса, списка опросов"""
+        self.purge('poll:%s' % poll_id, *(('polls', ) if listed else ()))
+
+
+response_cache = ResponseCache()
+
+
+class ResponseCacheMiddleware(MiddlewareMixin):
+    """ Ответы кэшируемых маршрутов из кэша (см. ResponseCache), заголовок X-Cache: HIT или MISS"""
+
+    def __init__(self, get_response):
+        if not response_cache.options.get('ENABLED', True):
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+        response = self.get_response(request)
+        if getattr(request, '_response_cache_key', None) is None:
+            return response
+        return self.store(request, response)
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        if getattr(request, '_response_cache_key', None) is None:
+            return response
+        return await sync_to_async(self.store)(request, response)
+
+    def store(self, request, response):
+        """ Сохранить ответ в кэш по ключу, выбранному в process_view"""
+        key = request._response_cache_key
+        response['X-Cache'] = 'MISS'
+        # Browsable API показывает имя пользователя, поэтому кэшируется только JSON
+        if response.status_code != 200 or response.streaming \
+                or not response.get('Content-Type', '').startswith('application/json'):
+            return response
+        timeout = response_cache.options.get('TIMEOUT', 5 * 60)
+        expiry = next_expiry(request.resolver_match.kwargs.get('pk'))
+        if expiry is not None:
+            timeout = min(timeout, int(seconds_until(expiry)))
+        entry = (response.content, response['Content-Type'], '"%s"' % hashlib.md5(response.content).hexdigest(),
+                 int(time.time()))
+        if timeout > 0:
+            response_cache.backend.set(key, entry, timeout)
+        self.validators(response, entry)
+        return get_conditional_response(request, etag=response['ETag'], last_modified=entry[3],
+                                        response=response)
+
+    @staticmethod
+    def validators(response, entry):
+        _, _, etag, modified = entry
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(modified)
+        patch_vary_headers(response, ('Accept', 'Authorization'))
+
+    @staticmethod
+    def audience(request, view_func):
+        """ staff или public по пользователю, которого определит представление, None - ошибка аутентификации"""
+        view_class = getattr(view_func, 'cls', None)
+        authenticators = [auth() for auth in getattr(view_class, 'authentication_classes', ())]
+        drf_request = Request(request, authenticators=authenticators)
+        try:
+            user = drf_request.user
+        except APIException:
+            return None
+        if user.is_authenticated:
+            # CachedTokenAuthentication представления возьмет пользователя отсюда, не проверяя токен еще раз
+            request.authenticated_token = (user, drf_request.auth)
+        return 'staff' if user.is_staff else 'public'
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        surrogate_keys = ROUTES.get(request.resolver_match.url_name)
+        if surrogate_keys is None or request.method not in ('GET', 'HEAD'):
+            return None
+        audience = self.audience(request, view_func)
+        if audience is None:
+            return None
+        key = response_cache.key(audience, request, [key.format(**view_kwargs) for key in surrogate_keys])
+        entry = response_cache.backend.get(key)
+        if entry is None:
+            request._response_cache_key = key
+            return None
+        content, content_type, _, modified = entry
+        response = HttpResponse(content, content_type=content_type)
+        response['X-Cache'] = 'HIT'
+        self.validators(response, entry)
+        return get_conditional_response(request, etag=response['ETag'], last_modified=modified, response=response)
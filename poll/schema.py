@@ -0,0 +1,172 @@
+""" Кэш скомпилированных схем опросов.
+
+Схема опроса - компактное неизменяемое представление опроса: упорядоченные по position вопросы,
+коды типов вопросов и множества вариантов ответа. Схема используется при получении детальной
+информации об опросе и при проверке ответов (см. VoteSerializer), чтобы не обращаться к БД на каждый запрос.
+
+Кэш двухуровневый: ограниченный LRU-кэш в памяти процесса перед подключаемым бэкендом кэша Django
+(settings.POLL_SCHEMA_CACHE['ALIAS']). У каждого опроса есть номер версии, который хранится в бэкенде
+и увеличивается сигналами сохранения/удаления Poll, Question и Choice (см. signals.py).
+"""
+import time
+from collections import Counter
+from datetime import date
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .db_routing import primary
+from .lru import LRUCache
+from .models import Poll, Question, Choice
+
+
+class QuestionSchema(NamedTuple):
+    id: int
+    position: int
+    question_type: int
+    main_text: str
+    choices: tuple
+    choice_ids: tuple
+    choice_set: frozenset
+
+
+class PollSchema(NamedTuple):
+    id: int
+    version: int
+    title: str
+    description: Optional[str]
+    started_at: date
+    finished_at: Optional[date]
+    questions: tuple
+    # Ответы перенесены в архив, итоги - в PollArchive (см. lifecycle.py)
+    archived: bool = False
+    # Участник может проголосовать только один раз (см. duplicates.py)
+    one_vote: bool = False
+
+    @property
+    def is_active(self):
+        """ То же, что Poll.is_active"""
+        return not self.finished_at or (self.finished_at > date.today())
+
+
+def compile_poll_schema(poll_id, version=0):
+    """ Собрать схему опроса из БД (три запроса). Возвращает None, если опроса нет или он удаляется"""
+    poll = Poll.objects.existing().filter(pk=poll_id).values(
+        'id', 'title', 'description', 'started_at', 'finished_at', 'is_archived', 'one_vote').first()
+    if poll is None:
+        return None
+    poll['archived'] = poll.pop('is_archived')
+    choices = {}
+    for question_id, choice_id, choice_text in Choice.objects.filter(question__poll_id=poll_id).order_by(
+            'position', 'id').values_list('question_id', 'id', 'choice_text'):
+        choices.setdefault(question_id, []).append((choice_id, choice_text))
+    questions = []
+    for question in Question.objects.filter(poll_id=poll_id).order_by('position', 'id').values(
+            'id', 'position', 'question_type', 'main_text'):
+        question_choices = choices.get(question['id'], ())
+        texts = tuple(text for _, text in question_choices)
+        questions.append(QuestionSchema(
+            choices=texts,
+            choice_ids=tuple(choice_id for choice_id, _ in question_choices),
+            choice_set=frozenset(texts),
+            **question
+        ))
+    return PollSchema(version=version, questions=tuple(questions), **poll)
+
+
+class PollSchemaCache:
+    """ Версионированный двухуровневый кэш схем опросов"""
+
+    def __init__(self):
+        self._local = None
+        self.stats = Counter()
+
+    @property
+    def options(self):
+        return getattr(settings, 'POLL_SCHEMA_CACHE', {})
+
+    @property
+    def backend(self):
+        return caches[self.options.get('ALIAS', 'default')]
+
+    @property
+    def local(self):
+        if self._local is None:
+            self._local = LRUCache(self.options.get('MAX_SIZE', 512))
+        return self._local
+
+    @staticmethod
+    def _version_key(poll_id):
+        return 'poll-schema-version:%s' % poll_id
+
+    @staticmethod
+    def _schema_key(poll_id, version):
+        return 'poll-schema:%s:%s' % (poll_id, version)
+
+    @staticmethod
+    def _initial_version():
+        # Если ключ версии вытеснен из бэкенда, новая версия не должна совпасть ни с одной из прежних
+        return time.time_ns() // 1000
+
+    def version(self, poll_id):
+        """ Текущая версия схемы опроса"""
+        key = self._version_key(poll_id)
+        version = self.backend.get(key)
+        if version is None:
+            self.backend.add(key, self._initial_version(), None)
+            version = self.backend.get(key)
+        return version
+
+    def get(self, poll_id):
+        """ Получить схему опроса: из памяти процесса, из бэкенда или собрать из БД.
+        Возвращает None, если опроса нет или он удаляется"""
+        try:
+            poll_id = int(poll_id)
+        except (TypeError, ValueError):
+            return None
+        version = self.version(poll_id)
+        schema = self.local.get(poll_id)
+        if schema is not None and schema.version == version:
+            self.stats['local_hits'] += 1
+            return schema
+        key = self._schema_key(poll_id, version)
+        schema = self.backend.get(key)
+        if schema is not None:
+            self.stats['shared_hits'] += 1
+        else:
+            self.stats['misses'] += 1
+            with primary():
+                # Схема с репликой, отстающей от версии, осталась бы в кэше
+                schema = compile_poll_schema(poll_id, version)
+            if schema is None:
+                return None
+            self.backend.set(key, schema, self.options.get('TIMEOUT', 24 * 60 * 60))
+        self.local.set(poll_id, schema)
+        return schema
+
+    def _bump(self, poll_id):
+        key = self._version_key(poll_id)
+        try:
+            self.backend.incr(key)
+        except ValueError:
+            self.backend.add(key, self._initial_version(), None)
+        self.local.pop(poll_id)
+
+    def invalidate(self, poll_id):
+        """ Увеличить версию схемы опроса.
+
+        Внутри транзакции версия увеличивается еще раз после фиксации, иначе схема,
+        собранная конкурентным запросом до фиксации, осталась бы в кэше с новой версией"""
+        poll_id = int(poll_id)
+        self._bump(poll_id)
+        if transaction.get_connection().in_atomic_block:
+            transaction.on_commit(lambda: self._bump(poll_id))
+
+    def clear(self):
+        self.local.clear()
+        self.stats.clear()
+
+
+schema_cache = PollSchemaCache()
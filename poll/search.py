@@ -0,0 +1,229 @@
+""" Полнотекстовый поиск по ответам на текстовые вопросы (Question.TEXT).
+
+Поиск идет по инвертированному индексу в БД, а не сканированием таблицы ответов через LIKE '%...%':
+- SQLite - таблица FTS5 poll_answer_fts с внешним содержимым (poll_answer), ее синхронизируют триггеры
+  на poll_answer, поэтому индекс обновляется при любой записи ответов - голосовании, импорте, удалении опроса;
+- PostgreSQL - GIN-индекс по выражению to_tsvector('simple', answer), его поддерживает сама БД.
+Индекс создает миграция 0011_answer_search. Для других БД поиск сканирует ответы (LikeSearch).
+
+Запрос разбивается на слова (не больше MAX_TERMS), найденный ответ должен содержать все слова, причем
+слова ищутся как префиксы ("отве" находит "ответ"). Результаты упорядочены по релевантности:
+bm25 в SQLite, ts_rank в PostgreSQL (rank - чем больше, тем релевантнее).
+
+Триггеры SQLite теряются, если миграция пересоздает таблицу poll_answer (так Django изменяет столбцы в SQLite);
+команда rebuild_search_index создает их заново и заново строит индекс.
+"""
+import re
+from abc import ABC, abstractmethod
+from typing import NamedTuple
+
+from django.conf import settings
+from django.db import DatabaseError, connections, router, transaction
+from django.utils.dateparse import parse_datetime
+
+from .models import Answer
+from .votes import parse_answer
+
+WORD = re.compile(r'\w+')
+
+
+class SearchHit(NamedTuple):
+    id: int
+    attempt: int
+    user: int
+    time: object
+    answer: list
+    rank: float
+
+
+def options():
+    return getattr(settings, 'POLL_SEARCH', {})
+
+
+def search_terms(query):
+    """ Слова запроса в нижнем регистре без повторов, не больше MAX_TERMS"""
+    terms = []
+    for word in WORD.findall(query.lower()):
+        if word not in terms:
+            terms.append(word)
+    return terms[:options().get('MAX_TERMS', 8)]
+
+
+class AnswerSearch(ABC):
+    """ Поиск по индексу одной БД: count и hits выполняют по одному запросу"""
+    # Выбираемые столбцы: ответ, попытка и ее пользователь и время
+    columns = 'a.id, a.attempt_id, t.user_id, t.time, a.answer'
+
+    def __init__(self, using):
+        self.using = using
+
+    @property
+    def connection(self):
+        return connections[self.using]
+
+    def fetch(self, sql, params):
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def hit(self, row):
+        answer_id, attempt_id, user_id, time, text, rank = row
+        if isinstance(time, str):
+            time = parse_datetime(time)
+        return SearchHit(answer_id, attempt_id, user_id, time, parse_answer(text), round(rank, 6))
+
+    @abstractmethod
+    def count(self, question_id, terms):
+        """ Число ответов на вопрос, содержащих все слова terms"""
+
+    @abstractmethod
+    def hits(self, question_id, terms, limit, offset):
+        """ Страница найденных ответов (SearchHit): limit ответов, начиная с offset"""
+
+    def rebuild(self):
+        """ Построить индекс заново; возвращает число проиндексированных ответов"""
+        return Answer.objects.using(self.using).exclude(answer='').count()
+
+    def check(self):
+        """ Сверить индекс с таблицей ответов: DatabaseError, если индекс поврежден или отстал"""
+
+
+class FTS5Search(AnswerSearch):
+    # Те же триггеры, что создает миграция 0011_answer_search
+    TRIGGERS = [
+        "CREATE TRIGGER IF NOT EXISTS poll_answer_fts_insert AFTER INSERT ON poll_answer "
+        "WHEN new.answer != '' BEGIN "
+        "INSERT INTO poll_answer_fts(rowid, answer) VALUES (new.id, new.answer); END",
+        "CREATE TRIGGER IF NOT EXISTS poll_answer_fts_delete AFTER DELETE ON poll_answer "
+        "WHEN old.answer != '' BEGIN "
+        "INSERT INTO poll_answer_fts(poll_answer_fts, rowid, answer) VALUES ('delete', old.id, old.answer); END",
+        "CREATE TRIGGER IF NOT EXISTS poll_answer_fts_update AFTER UPDATE OF answer ON poll_answer BEGIN "
+        "INSERT INTO poll_answer_fts(poll_answer_fts, rowid, answer) "
+        "SELECT 'delete', old.id, old.answer WHERE old.answer != ''; "
+        "INSERT INTO poll_answer_fts(rowid, answer) SELECT new.id, new.answer WHERE new.answer != ''; END",
+    ]
+
+    @staticmethod
+    def match(terms):
+        # Слова состоят только из \w, поэтому кавычки внутри не встречаются
+        return ' '.join('"%s"*' % term for term in terms)
+
+    def count(self, question_id, terms):
+        # CROSS JOIN закрепляет порядок соединения в SQLite: сначала найденные индексом ответы, затем условие
+        # на вопрос. Иначе планировщик перебирает ответы вопроса по индексу question_id и для каждого
+        # заново выполняет MATCH
+        return self.fetch(
+            "SELECT COUNT(*) FROM poll_answer_fts CROSS JOIN poll_answer a ON a.id = poll_answer_fts.rowid "
+            "WHERE poll_answer_fts MATCH %s AND a.question_id = %s", [self.match(terms), question_id])[0][0]
+
+    def hits(self, question_id, terms, limit, offset):
+        # bm25 тем меньше, чем релевантнее ответ; CROSS JOIN - как в count
+        rows = self.fetch(
+            "SELECT %s, -bm25(poll_answer_fts) AS score FROM poll_answer_fts "
+            "CROSS JOIN poll_answer a ON a.id = poll_answer_fts.rowid JOIN poll_attempt t ON t.id = a.attempt_id "
+            "WHERE poll_answer_fts MATCH %%s AND a.question_id = %%s "
+            "ORDER BY score DESC, a.id LIMIT %%s OFFSET %%s" % self.columns,
+            [self.match(terms), question_id, limit, offset])
+        return [self.hit(row) for row in rows]
+
+    def rebuild(self):
+        with transaction.atomic(using=self.using), self.connection.cursor() as cursor:
+            for statement in self.TRIGGERS:
+                cursor.execute(statement)
+            cursor.execute("INSERT INTO poll_answer_fts(poll_answer_fts) VALUES ('delete-all')")
+            cursor.execute("INSERT INTO poll_answer_fts(rowid, answer) "
+                           "SELECT id, answer FROM poll_answer WHERE answer != ''")
+            cursor.execute("INSERT INTO poll_answer_fts(poll_answer_fts) VALUES ('optimize')")
+        return super().rebuild()
+
+    def check(self):
+        # Сверка FTS5 с внешним содержимым (rank = 1) требует в индексе все строки poll_answer, а ответы
+        # без текста в нем не хранятся, поэтому отдельно проверяется сам индекс и отдельно - набор ответов
+        with self.connection.cursor() as cursor:
+            cursor.execute("INSERT INTO poll_answer_fts(poll_answer_fts) VALUES ('integrity-check')")
+            cursor.execute(
+                "SELECT COUNT(*) FROM (SELECT id FROM poll_answer_fts_docsize EXCEPT "
+                "SELECT id FROM poll_answer WHERE answer != '') UNION ALL SELECT COUNT(*) FROM ("
+                "SELECT id FROM poll_answer WHERE answer != '' EXCEPT SELECT id FROM poll_answer_fts_docsize)")
+            stale, missing = [row[0] for row in cursor.fetchall()]
+        if stale or missing:
+            raise DatabaseError('%d answers missing from the index, %d deleted answers left in it' % (missing, stale))
+
+
+class PostgresSearch(AnswerSearch):
+    # Выражение и условие совпадают с индексом poll_answer_search_idx, иначе он не используется
+    condition = "a.answer <> '' AND to_tsvector('simple', a.answer) @@ to_tsquery('simple', %s)"
+
+    @staticmethod
+    def match(terms):
+        return ' & '.join('%s:*' % term for term in terms)
+
+    def count(self, question_id, terms):
+        return self.fetch("SELECT COUNT(*) FROM poll_answer a WHERE %s AND a.question_id = %%s" % self.condition,
+                          [self.match(terms), question_id])[0][0]
+
+    def hits(self, question_id, terms, limit, offset):
+        query = self.match(terms)
+        rows = self.fetch(
+            "SELECT %s, ts_rank(to_tsvector('simple', a.answer), to_tsquery('simple', %%s)) AS score "
+            "FROM poll_answer a JOIN poll_attempt t ON t.id = a.attempt_id WHERE %s AND a.question_id = %%s "
+            "ORDER BY score DESC, a.id LIMIT %%s OFFSET %%s" % (self.columns, self.condition),
+            [query, query, question_id, limit, offset])
+        return [self.hit(row) for row in rows]
+
+    def rebuild(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('REINDEX INDEX poll_answer_search_idx')
+        return super().rebuild()
+
+
+class LikeSearch(AnswerSearch):
+    """ Без индекса: каждое слово ищется как подстрока ответов вопроса (answer LIKE '%слово%')"""
+
+    def queryset(self, question_id, terms):
+        queryset = Answer.objects.using(self.using).filter(question_id=question_id).exclude(answer='')
+        for term in terms:
+            queryset = queryset.filter(answer__icontains=term)
+        return queryset
+
+    def count(self, question_id, terms):
+        return self.queryset(question_id, terms).count()
+
+    def hits(self, question_id, terms, limit, offset):
+        rows = self.queryset(question_id, terms).order_by('id').values_list(
+            'id', 'attempt_id', 'attempt__user_id', 'attempt__time', 'answer')[offset:offset + limit]
+        return [self.hit(row + (0.0, )) for row in rows]
+
+    def rebuild(self):
+        return 0
+
+
+BACKENDS = {
+    'sqlite': FTS5Search,
+    'postgresql': PostgresSearch,
+}
+
+
+def answer_search(using=None):
+    """ Поиск для БД using (по умолчанию - БД чтения ответов, в запросе с репликами - реплика)"""
+    using = using or router.db_for_read(Answer)
+    return BACKENDS.get(connections[using].vendor, LikeSearch)(using)
+
+
+class SearchResults:
+    """ Результаты поиска для постраничного вывода (django.core.paginator.Paginator): число найденных
+    ответов и срез страницы запрашиваются у индекса отдельными запросами"""
+
+    def __init__(self, question_id, terms, search=None):
+        self.question_id = question_id
+        self.terms = terms
+        self.search = search or answer_search()
+
+    def count(self):
+        return self.search.count(self.question_id, self.terms)
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.step is not None:
+            raise TypeError('SearchResults supports only slices')
+        start = item.start or 0
+        return self.search.hits(self.question_id, self.terms, item.stop - start, start)
@@ -1,7 +1,24 @@
+from collections import Counter
+from datetime import date, datetime, timezone
+from uuid import uuid4
+
+from django.db import IntegrityError, transaction
+from django.db.models import Min
 from rest_framework import serializers
+from rest_framework.exceptions import NotAuthenticated
 from rest_framework.serializers import ListSerializer
 
-from .models import Poll, Question, Choice, Attempt, Answer, MyUser
+from .analytics import BUCKETS
+from .duplicates import AlreadyVoted, check_voter, forget_voters, has_voted, record_existing_voters
+from .export import EXPORTERS
+from .jobs import submit
+from .models import Poll, Question, Choice, Attempt, Answer, Job
+from .questions import apply_choices, invalidate_poll
+from .schema import schema_cache
+from .search import search_terms
+from .snapshots import answers_snapshot, expand_snapshot
+from .ingest import vote_buffer
+from .votes import Vote, write_votes
 from django.contrib.auth import get_user_model
 
 UserModel = get_user_model()
@@ -10,8 +27,24 @@ UserModel = get_user_model()
 class PollSerializer(serializers.ModelSerializer):
     class Meta:
         model = Poll
-        fields = '__all__'
-        # exclude = ['id', ]
+        exclude = ['is_deleted', 'is_archived']
+
+    def validate_finished_at(self, value):
+        # Итоги архивного опроса заморожены: новые голоса в них бы не попали
+        if self.instance is not None and self.instance.is_archived and (value is None or value > date.today()):
+            raise serializers.ValidationError('Archived poll cannot be reopened, rehydrate it first')
+        return value
+
+    def update(self, instance, validated_data):
+        one_vote = instance.one_vote
+        with transaction.atomic():
+            instance = super().update(instance, validated_data)
+            # Ограничение "один голос" распространяется на уже проголосовавших (см. duplicates.py)
+            if instance.one_vote and not one_vote:
+                record_existing_voters(instance.pk)
+            elif one_vote and not instance.one_vote:
+                forget_voters(instance.pk)
+        return instance
 
 
 class ChoiceSerializer(serializers.ModelSerializer):
@@ -62,8 +95,11 @@ class WriteQuestionSerializer(serializers.ModelSerializer):
         # Создаем соответствующие записи в таблице Choice:
         choices_data = validated_data.pop('choices')
         question = Question.objects.create(**validated_data)
-        tmp_choices = [Choice(question=question, choice_text=choice_data) for choice_data in choices_data]
+        tmp_choices = [Choice(question=question, choice_text=choice_data, position=position)
+                       for position, choice_data in enumerate(choices_data)]
         Choice.objects.bulk_create(tmp_choices)
+        # bulk_create не отправляет сигналы, поэтому сбрасываем кэши опроса явно
+        invalidate_poll(question.poll_id)
         return question
 
     def update(self, instance, validated_data):
@@ -73,11 +109,12 @@ class WriteQuestionSerializer(serializers.ModelSerializer):
         instance.save()
 
         choices = validated_data.get('choices', None)
-        # Если нужно вписать новые либо если варианты ответа не нужны, то удаляем старые значения вариантов ответа:
+        # Если заданы новые варианты ответа либо варианты ответа не нужны, записываем разницу со старыми
+        # (см. questions.diff_choices): оставшиеся варианты сохраняют id и выбранные в ответах варианты,
+        # даже если переставлены
         if choices is not None or instance.question_type == Question.TEXT:
-            Choice.objects.filter(question=instance).delete()
-            tmp_choices = [Choice(question=instance, choice_text=choice_data) for choice_data in choices]
-            Choice.objects.bulk_create(tmp_choices)
+            apply_choices({instance.id: choices or ()})
+            invalidate_poll(instance.poll_id)
         return instance
 
     def validate_position(self, value):
@@ -113,6 +150,96 @@ class WriteQuestionSerializer(serializers.ModelSerializer):
         return data
 
 
+class BulkQuestionItemSerializer(serializers.Serializer):
+    """ Элемент пакета вопросов: вопрос с новым номером position создается, с существующим - изменяется
+    (переданные поля) и при заданном new_position переносится на новый номер"""
+    position = serializers.IntegerField()
+    new_position = serializers.IntegerField(required=False)
+    question_type = WriteQuestionSerializer.QtypeField(required=False)
+    main_text = serializers.CharField(required=False)
+    choices = serializers.ListField(child=serializers.CharField(max_length=50), required=False, allow_null=True)
+
+    def validate_question_type(self, value):
+        return WriteQuestionSerializer.validate_question_type(self, value)
+
+
+class BulkQuestionSerializer(serializers.Serializer):
+    """ Пакет вопросов опроса (см. questions.save_questions).
+    Вопросы опроса передаются в context['questions'] словарем {position: Question}: номера всего пакета
+    проверяются по нему, без запроса на каждый вопрос"""
+    questions = BulkQuestionItemSerializer(many=True, allow_empty=False)
+
+    @staticmethod
+    def validate_choices(item, question):
+        question_type = item.get('question_type', question.question_type if question else None)
+        choices = item.get('choices')
+        if question_type in (Question.SINGLE_CHOICE, Question.MULTI_CHOICE):
+            # Без новых вариантов у вопроса с выбором остаются прежние
+            if (choices is None and (question is None or question.question_type == Question.TEXT)) or \
+                    (choices is not None and len(choices) < 2):
+                return "This type of question must have at least 2 choices"
+        elif choices:
+            return "This type of question haven't choices"
+        return None
+
+    def validate_questions(self, items):
+        existing = self.context['questions']
+        errors = [{} for _ in items]
+        positions = Counter(item['position'] for item in items)
+        for item, item_errors in zip(items, errors):
+            question = existing.get(item['position'])
+            if positions[item['position']] > 1:
+                item_errors['position'] = ['Duplicate position in batch']
+            if question is None:
+                for name in ('question_type', 'main_text'):
+                    if name not in item:
+                        item_errors[name] = ['This field is required.']
+                if 'new_position' in item:
+                    item_errors['new_position'] = ['Only existing questions can be moved']
+            error = self.validate_choices(item, question)
+            if error:
+                item_errors['choices'] = [error]
+        # Номера вопросов после записи пакета: не затронутые пакетом и новые номера вопросов пакета
+        final = Counter(position for position in existing if position not in positions)
+        final.update(item.get('new_position') or item['position'] for item in items)
+        for item, item_errors in zip(items, errors):
+            if final[item.get('new_position') or item['position']] > 1:
+                item_errors.setdefault('new_position' if 'new_position' in item else 'position',
+                                       ['Position already exists!'])
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return items
+
+
+class ShiftPositionsSerializer(serializers.Serializer):
+    """ Сдвиг номеров вопросов с start по end (без end - до последнего вопроса) на offset"""
+    start = serializers.IntegerField()
+    end = serializers.IntegerField(required=False, allow_null=True)
+    offset = serializers.IntegerField()
+
+    def validate(self, data):
+        start, end, offset = data['start'], data.get('end'), data['offset']
+        if end is not None and end < start:
+            raise serializers.ValidationError({'end': 'Must be greater than or equal to start'})
+        if offset == 0:
+            raise serializers.ValidationError({'offset': 'Must not be zero'})
+        target = Question.objects.filter(poll_id=self.context['poll_pk'], position__gte=start + offset)
+        source = {'position__gte': start}
+        if end is not None:
+            target = target.filter(position__lte=end + offset)
+            source['position__lte'] = end
+        # Номера вопросов начинаются с 1
+        if offset < 0:
+            lowest = Question.objects.filter(poll_id=self.context['poll_pk'], **source).aggregate(
+                lowest=Min('position'))['lowest']
+            if lowest is not None and lowest + offset < 1:
+                raise serializers.ValidationError({'offset': 'Positions must stay greater than or equal to 1'})
+        # Номера, на которые сдвигаются вопросы, не должны быть заняты вопросами вне сдвигаемого диапазона
+        if target.exclude(**source).exists():
+            raise serializers.ValidationError('Position already exists!')
+        return data
+
+
 class PollDetailSerializer(serializers.ModelSerializer):
     questions = WriteQuestionSerializer(many=True)
 
@@ -121,6 +248,113 @@ class PollDetailSerializer(serializers.ModelSerializer):
         fields = ['id', 'title', 'description', 'started_at', 'finished_at', 'questions']
 
 
+class PollSchemaSerializer(serializers.BaseSerializer):
+    """ Детальная информация об опросе по скомпилированной схеме (см. schema.py).
+    Формат ответа совпадает с PollDetailSerializer"""
+    date_field = serializers.DateField()
+    question_types = dict(Question.QUESTION_TYPES)
+
+    def to_representation(self, schema):
+        return {
+            'id': schema.id,
+            'title': schema.title,
+            'description': schema.description,
+            'started_at': self.date_field.to_representation(schema.started_at),
+            'finished_at': self.date_field.to_representation(schema.finished_at),
+            'questions': [{'position': question.position,
+                           'question_type': self.question_types.get(question.question_type, question.question_type),
+                           'main_text': question.main_text,
+                           'choices': list(question.choices)}
+                          for question in schema.questions],
+        }
+
+
+class PollResultsSerializer(serializers.BaseSerializer):
+    """ Итоги опроса: количество попыток и количество выборов каждого варианта ответа (см. tallies.py).
+    Процент считается от количества попыток"""
+    question_types = dict(Question.QUESTION_TYPES)
+
+    def to_representation(self, results):
+        schema, attempts = results.schema, results.attempts
+
+        def percent(count):
+            return round(count * 100 / attempts, 2) if attempts else 0.0
+
+        questions = []
+        for question in schema.questions:
+            choices = []
+            for choice_text, choice_id in zip(question.choices, question.choice_ids):
+                count = results.counts.get((question.id, choice_id), 0)
+                choices.append({'choice_text': choice_text, 'count': count, 'percent': percent(count)})
+            questions.append({'position': question.position,
+                              'question_type': self.question_types.get(question.question_type,
+                                                                       question.question_type),
+                              'main_text': question.main_text,
+                              'choices': choices})
+        return {'id': schema.id, 'title': schema.title, 'attempts': attempts, 'questions': questions}
+
+
+class AnalyticsParamsSerializer(serializers.Serializer):
+    """ Параметры аналитики опроса: ?crosstab=3,7 (номера вопросов строк и столбцов, можно несколько)
+    и ?bucket=hour|day|week. Схема опроса - в контексте (schema)"""
+    crosstab = serializers.ListField(child=serializers.RegexField(r'^\d+,\d+$'), required=False, max_length=10)
+    bucket = serializers.ChoiceField(choices=sorted(BUCKETS), default='day')
+
+    def validate_crosstab(self, value):
+        questions = {question.position: question for question in self.context['schema'].questions
+                     if question.question_type != Question.TEXT}
+        pairs = []
+        for item in value:
+            positions = [int(position) for position in item.split(',')]
+            missing = [position for position in positions if position not in questions]
+            if missing:
+                raise serializers.ValidationError('Question %d is not a choice question' % missing[0])
+            pairs.append(tuple(questions[position] for position in positions))
+        return pairs
+
+
+class PollAnalyticsSerializer(serializers.BaseSerializer):
+    """ Аналитика опроса (см. analytics.py). Процент считается от количества попыток, как в итогах"""
+    datetime_field = serializers.DateTimeField()
+
+    def to_representation(self, analytics):
+        schema, attempts = analytics.schema, analytics.attempts
+
+        def percent(count):
+            return round(count * 100 / attempts, 2) if attempts else 0.0
+
+        questions = []
+        for question in schema.questions:
+            if question.id not in analytics.counts:
+                continue
+            questions.append({
+                'position': question.position,
+                'main_text': question.main_text,
+                'answered': analytics.answered[question.id],
+                'choices': [{'choice_text': choice_text, 'count': count, 'percent': percent(count)}
+                            for choice_text, count in zip(question.choices, analytics.counts[question.id])],
+            })
+        total = 0
+        timeline = []
+        for start, count in analytics.timeline:
+            total += count
+            timeline.append({'start': self.datetime_field.to_representation(
+                datetime.fromtimestamp(start, timezone.utc)), 'count': count, 'total': total})
+        return {
+            'id': schema.id,
+            'title': schema.title,
+            'attempts': attempts,
+            'last_attempt': analytics.last_attempt,
+            'questions': questions,
+            'crosstabs': [{'rows': rows.position, 'columns': columns.position,
+                           'row_choices': list(rows.choices), 'column_choices': list(columns.choices),
+                           'counts': counts}
+                          for rows, columns, counts in analytics.crosstabs],
+            'bucket': analytics.bucket,
+            'timeline': timeline,
+        }
+
+
 class VoteSerializer(serializers.ModelSerializer):
     # answers = AnswerSerializer(many=True)
     answers = serializers.ListField(write_only=True)
@@ -132,36 +366,58 @@ class VoteSerializer(serializers.ModelSerializer):
                         'poll': {'required': False},
                         }
 
-    def create(self, validated_data):
-        """ Создать записи попытки и ответов"""
+    # Анонимный участник записанного голоса (см. voters.py), None для голоса пользователя
+    voter = None
 
-        # Достаем id Опроса из контекста и добавляем его в набор данных для записи:
-        poll_pk = self.context.get('poll_pk')
-        poll = Poll.objects.get(pk=poll_pk)
-        answers_data = validated_data['answers']
+    def get_user(self, validated_data):
+        """ Пользователь, от имени которого записывается попытка. None для анонимного голоса"""
+        # Если пользователь авторизован, голосует он, а не пользователь из тела запроса
+        if self.authenticated:
+            return self.context['request'].user
+        return validated_data.get('user')
 
-        # Если пользователь авторизован, меняем контекст запроса:
+    @property
+    def authenticated(self):
         request = self.context.get('request')
-        if request and hasattr(request, 'user'):
-            validated_data['user'] = request.user
-        # Если пользователь не указан создаем нового c username=id:
-        elif not validated_data['user']:
-            user = MyUser.objects.create_user(username='auto_username')
-            user.username = str(user.id)
-            user.save()
-            validated_data['user'] = user
-
-        # Создаем соответствующие записи в таблице Answer:
-        attempt = Attempt.objects.create(user=validated_data['user'], poll=poll)
-        for answer_data in answers_data:
-            question = Question.objects.get(position=answer_data['position'], poll=poll)
-            Answer.objects.create(attempt=attempt, question=question, answer=answer_data['answer'])
-        if attempt:
-            print(attempt)
-        else:
-            print('None')
+        return request is not None and request.user.is_authenticated
+
+    def get_voter(self, user):
+        """ Анонимный участник: из токена запроса (контекст voter) или новый.
+        Для анонимного голоса запись MyUser не создается (см. voters.py)"""
+        if user is not None:
+            return None
+        return self.context.get('voter') or uuid4()
+
+    def create(self, validated_data):
+        """ Создать записи попытки и ответов"""
+
+        # Схема опроса уже получена при валидации (см. validate):
+        poll = validated_data['poll']
+        user = self.get_user(validated_data)
+        self.voter = self.get_voter(user)
+
+        vote = Vote(poll=poll, user_id=user.id if user else None, answers=validated_data['answers'], voter=self.voter)
+        try:
+            with transaction.atomic():
+                # Создаем попытку, ответы и выбранные варианты и увеличиваем счетчики итогов (см. votes.py):
+                attempt, = write_votes([vote])
+        except IntegrityError:
+            # Одновременный повторный голос другого запроса (см. duplicates.py)
+            if has_voted(vote):
+                raise AlreadyVoted()
+            raise
         return attempt
 
+    def save_buffered(self):
+        """ Поставить голос в очередь на отложенную запись (см. ingest.py).
+        Возвращает данные для ответа: токен попытки, пользователя и опрос"""
+        user = self.get_user(self.validated_data)
+        self.voter = self.get_voter(user)
+        vote = Vote(poll=self.validated_data['poll'], user_id=user.id if user else None,
+                    answers=self.validated_data['answers'], token=uuid4(), voter=self.voter)
+        vote_buffer.submit(vote)
+        return {'token': str(vote.token), 'user': vote.user_id, 'poll': vote.poll.id}
+
     def validate_user(self, value):
         """
         Проверяем что User есть в БД или значение пустое
@@ -176,53 +432,65 @@ class VoteSerializer(serializers.ModelSerializer):
     def validate(self, data):
         """
         Проверка ответов
+
+        Опрос, его вопросы и варианты ответов берутся из кэша схем опросов (см. schema.py),
+        далее проверка идет в памяти по словарю {position: question} и множествам вариантов ответа.
         """
         # Проверяем что опрос существует и активен
         poll_pk = self.context.get('poll_pk', None)
-        poll = Poll.objects.get(pk=poll_pk)
+        poll = schema_cache.get(poll_pk)
         if not poll:
             raise serializers.ValidationError("Poll #" + str(poll_pk) + " doesn't exists")
         if not poll.is_active:
             raise serializers.ValidationError("Poll #" + str(poll_pk) + " is not active")
         # Проверяем что у опроса есть вопросы
-        question_list = Question.objects.filter(poll=poll_pk)
-        question_ids = [q.id for q in question_list]
-        if not question_ids:
+        questions = {question.position: question for question in poll.questions}
+        if not questions:
             raise serializers.ValidationError("Poll #" + str(poll_pk) + " doesn't have questions")
         answers = data['answers']
+        answered = set()
         # Проверка соответствия ответов вопросам
         for answer in answers:
             position = answer['position']
             # Проверяем что ответ пришел на существующий вопрос
-            try:
-                question = Question.objects.get(position=position, poll=poll_pk)
-            except Question.DoesNotExist:
+            question = questions.get(position)
+            if question is None or position in answered:
                 raise serializers.ValidationError("Question #" + str(position) + " doesn't exists")
-            question_ids.remove(question.id)
+            answered.add(position)
             # Проверяем что список содержит 1 ответ (Для 'Ответа текстом' и 'Ответа с выбором 1 варианта')
             if question.question_type in (1, 2) and len(answer['answer']) != 1:
                 raise serializers.ValidationError("Question #" + str(position) + " required one answer")
             # Проверяем что список содержит хотя бы 1 ответ (Для 'Ответа с выбором нескольких вариантов')
             elif question.question_type == 3 and len(answer['answer']) == 0:
                 raise serializers.ValidationError("Question #" + str(position) + " required at least one answer")
-            # Проверяем что ответы совпадают с возможными вариантами
+            # Проверяем что ответы совпадают с возможными вариантами без повторов
             # (для ответов с выбором одного или нескольких вариантов)
             if question.question_type in (2, 3):
-                choices = Choice.objects.filter(question=question)
-                possible_answers = [q.choice_text for q in choices]
-                for part_answer in answer['answer']:
-                    if part_answer not in possible_answers:
-                        raise serializers.ValidationError("Question #" + str(position) + ": invalid answer")
-                    possible_answers.remove(part_answer)
+                try:
+                    part_answers = set(answer['answer'])
+                except TypeError:
+                    raise serializers.ValidationError("Question #" + str(position) + ": invalid answer")
+                if len(part_answers) != len(answer['answer']) or not part_answers <= question.choice_set:
+                    raise serializers.ValidationError("Question #" + str(position) + ": invalid answer")
         # Проверяем получены ответы на все вопросы
-        if question_ids:
+        if len(answered) != len(questions):
             raise serializers.ValidationError("You must answer every question")
-
+        # Пользователь из тела запроса и токен анонимного участника ничем не подтверждены: с ними ограничение
+        # "один голос" обходится чужим id или новым токеном, поэтому в таком опросе голосуют только авторизованные
+        if poll.one_vote and not self.authenticated:
+            raise NotAuthenticated('Authentication is required to vote in this poll.')
+        # Повторный голос в опросе с ограничением "один голос" (см. duplicates.py)
+        user = self.get_user(data)
+        check_voter(poll, user.id if user else None, self.context.get('voter') if user is None else None)
+
+        data['poll'] = poll
         return data
 
 
 class AnswerSerializer(serializers.ModelSerializer):
     question = WriteQuestionSerializer()
+    # Выбранные варианты ответа хранятся в AnswerChoice, отдаем ответ в прежнем формате (см. Answer.value)
+    answer = serializers.CharField(source='value', read_only=True)
 
     class Meta:
         model = Answer
@@ -230,10 +498,80 @@ class AnswerSerializer(serializers.ModelSerializer):
 
 
 class AttemptSerializer(serializers.ModelSerializer):
-    answers = AnswerSerializer(many=True)
+    # Вопросы и ответы берутся из снимка попытки, для попыток без снимка - из сохраненных ответов (см. snapshots.py)
+    answers = serializers.SerializerMethodField()
     poll = PollSerializer()
     time = serializers.DateTimeField(format="%Y-%m-%d")
 
     class Meta:
         model = Attempt
         fields = ['user', 'time', 'poll', 'answers']
+
+    def get_answers(self, attempt):
+        return expand_snapshot(attempt.snapshot if attempt.snapshot is not None else answers_snapshot(attempt))
+
+
+class PollJobSerializer(serializers.Serializer):
+    """ Параметры задачи над опросом"""
+    poll_id = serializers.IntegerField()
+
+    def validate_poll_id(self, value):
+        if not Poll.objects.existing().filter(pk=value).exists():
+            raise serializers.ValidationError('Poll not found')
+        return value
+
+
+class ExportJobSerializer(PollJobSerializer):
+    format = serializers.ChoiceField(choices=sorted(EXPORTERS), default='csv')
+
+
+class JobSerializer(serializers.ModelSerializer):
+    """ Фоновая задача (см. jobs.py). Через API ставятся задачи из PARAMS,
+    удаление опроса - через DELETE опроса"""
+    PARAMS = {
+        'export_poll': ExportJobSerializer,
+        'rebuild_tallies': PollJobSerializer,
+        'archive_poll': PollJobSerializer,
+        'rehydrate_poll': PollJobSerializer,
+    }
+
+    class Meta:
+        model = Job
+        fields = ['id', 'kind', 'params', 'status', 'progress', 'total', 'result', 'error', 'attempts',
+                  'max_attempts', 'run_at', 'created_at', 'started_at', 'finished_at']
+        read_only_fields = [name for name in fields if name not in ('kind', 'params')]
+
+    def validate(self, data):
+        params_serializer = self.PARAMS.get(data['kind'])
+        if params_serializer is None:
+            raise serializers.ValidationError({'kind': 'Unknown job kind'})
+        params = params_serializer(data=data.get('params') or {})
+        if not params.is_valid():
+            raise serializers.ValidationError({'params': params.errors})
+        data['params'] = params.validated_data
+        return data
+
+    def create(self, validated_data):
+        request = self.context.get('request')
+        return submit(validated_data['kind'], dict(validated_data['params']), request and request.user)
+
+
+class AnswerSearchParamsSerializer(serializers.Serializer):
+    """ Параметры поиска по ответам: ?q=слова запроса (см. search.py)"""
+    q = serializers.CharField(max_length=200)
+
+    def validate_q(self, value):
+        terms = search_terms(value)
+        if not terms:
+            raise serializers.ValidationError('Query contains no words')
+        return terms
+
+
+class AnswerSearchHitSerializer(serializers.Serializer):
+    """ Найденный ответ (search.SearchHit): answer - список ответов, как при голосовании"""
+    id = serializers.IntegerField()
+    attempt = serializers.IntegerField()
+    user = serializers.IntegerField(allow_null=True)
+    time = serializers.DateTimeField()
+    answer = serializers.ListField(child=serializers.CharField())
+    rank = serializers.FloatField()
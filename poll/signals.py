@@ -0,0 +1,47 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import token_cache
+from .models import Poll, Question, Choice, MyUser
+from .response_cache import response_cache
+from .schema import schema_cache
+
+
+@receiver([post_save, post_delete], sender=Poll)
+def invalidate_poll_schema(sender, instance, **kwargs):
+    schema_cache.invalidate(instance.pk)
+    response_cache.purge_poll(instance.pk, listed=True)
+
+
+@receiver([post_save, post_delete], sender=Question)
+def invalidate_question_schema(sender, instance, **kwargs):
+    schema_cache.invalidate(instance.poll_id)
+    response_cache.purge_poll(instance.poll_id)
+
+
+@receiver([post_save, post_delete], sender=Choice)
+def invalidate_choice_schema(sender, instance, **kwargs):
+    # Если вопрос уже загружен, берем опрос из него, иначе одним запросом по question_id
+    question = Choice.question.field.get_cached_value(instance, None)
+    if question is not None:
+        poll_id = question.poll_id
+    else:
+        poll_id = Question.objects.filter(pk=instance.question_id).values_list('poll_id', flat=True).first()
+    if poll_id is not None:
+        schema_cache.invalidate(poll_id)
+        response_cache.purge_poll(poll_id)
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+    # В том числе выход через djoser token/logout и удаление пользователя
+    token_cache.invalidate(instance.key)
+
+
+@receiver(post_save, sender=MyUser)
+def invalidate_user_tokens(sender, instance, created, update_fields=None, **kwargs):
+    # Деактивация, смена пароля и прочие изменения пользователя; время входа (update_last_login) не важно
+    if created or (update_fields is not None and set(update_fields) <= {'last_login'}):
+        return
+    token_cache.invalidate_user(instance.pk)
@@ -0,0 +1,52 @@
+""" Снимки попыток для истории прохождения опросов (/results/).
+
+Вопросы и ответы попытки записываются в Attempt.snapshot при голосовании (см. votes.write_votes) списком
+[position, question_type, main_text, choices, answer] на каждый ответ, поэтому история читается одним запросом
+без вложенной сериализации. Список, а не словарь: jsonb в PostgreSQL не сохраняет порядок ключей.
+Снимок фиксирует вопросы такими, какими их видел пользователь: последующие изменения опроса на него не влияют.
+Для попыток, записанных до появления снимков, их строит команда backfill_snapshots.
+"""
+from django.db.models import Prefetch
+
+from .models import Question, Answer, AnswerChoice
+
+QUESTION_TYPE_LABELS = dict(Question.QUESTION_TYPES)
+
+# Ответы попыток со всем необходимым для answers_snapshot - по одному запросу на уровень
+ANSWERS_PREFETCH = (
+    Prefetch('answers', queryset=Answer.objects.select_related('question').order_by('id')),
+    'answers__question__choices',
+    Prefetch('answers__choices', queryset=AnswerChoice.objects.select_related('choice')),
+)
+
+
+def render_snapshot(rows):
+    """ Снимок голоса по ответам [(вопрос схемы, текст ответа, id выбранных вариантов)]"""
+    snapshot = []
+    for question, text, selected in rows:
+        if not text:
+            # То же, что Answer.value
+            texts = dict(zip(question.choice_ids, question.choices))
+            text = str([texts[choice_id] for choice_id in selected])
+        snapshot.append([question.position, question.question_type, question.main_text, list(question.choices), text])
+    return snapshot
+
+
+def answers_snapshot(attempt):
+    """ Снимок по сохраненным ответам попытки (ответы загружаются с ANSWERS_PREFETCH)"""
+    return [[answer.question.position, answer.question.question_type, answer.question.main_text,
+             [choice.choice_text for choice in answer.question.choices.all()], answer.value]
+            for answer in attempt.answers.all()]
+
+
+def expand_snapshot(snapshot):
+    """ Снимок в формате AnswerSerializer"""
+    return [{
+        'question': {
+            'position': position,
+            'question_type': QUESTION_TYPE_LABELS.get(question_type, question_type),
+            'main_text': main_text,
+            'choices': choices,
+        },
+        'answer': answer,
+    } for position, question_type, main_text, choices, answer in snapshot]
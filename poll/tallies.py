@@ -0,0 +1,112 @@
+""" Итоги опросов: счетчики попыток (PollTally) и выборов вариантов ответа (ChoiceTally).
+
+Счетчики увеличиваются в той же транзакции, что и запись ответов (см. VoteSerializer.create),
+через F()-выражения, поэтому конкурентные голоса не теряются. Для пакетной записи голосов
+счетчики обновляются сгруппированными приращениями: один UPDATE на каждое значение приращения.
+Пересчет по ответам (recompute_tallies) считает и перезаписывает счетчики в одной транзакции
+с заблокированными строками счетчиков, поэтому голоса, записанные во время пересчета, тоже не теряются.
+"""
+from collections import Counter, defaultdict
+from typing import NamedTuple
+
+from django.db import transaction
+from django.db.models import F, Count
+
+from .models import Question, Choice, Attempt, AnswerChoice, PollTally, ChoiceTally
+from .schema import PollSchema
+
+
+class PollResults(NamedTuple):
+    schema: PollSchema
+    attempts: int
+    counts: dict
+
+
+def choice_ids(question, answer):
+    """ id выбранных вариантов ответа по их текстам (question - QuestionSchema).
+    При повторяющихся текстах вариантов выбирается первый вариант"""
+    ids = dict(zip(reversed(question.choices), reversed(question.choice_ids)))
+    return [ids[text] for text in answer if text in ids]
+
+
+def record_votes(attempts, choices):
+    """ Увеличить счетчики.
+
+    attempts - {poll_id: количество новых попыток},
+    choices - {(question_id, choice_id): количество новых выборов варианта}
+    """
+    for poll_id, delta in attempts.items():
+        if not PollTally.objects.filter(poll_id=poll_id).update(attempts=F('attempts') + delta):
+            PollTally.objects.bulk_create([PollTally(poll_id=poll_id)], ignore_conflicts=True)
+            PollTally.objects.filter(poll_id=poll_id).update(attempts=F('attempts') + delta)
+
+    by_delta = defaultdict(dict)
+    for (question_id, choice_id), delta in choices.items():
+        by_delta[delta][choice_id] = question_id
+    for delta, questions in by_delta.items():
+        updated = ChoiceTally.objects.filter(choice_id__in=questions).update(count=F('count') + delta)
+        if updated == len(questions):
+            continue
+        # Счетчиков части вариантов еще нет - создаем их с нулем и увеличиваем отдельно
+        existing = set(ChoiceTally.objects.filter(choice_id__in=questions).values_list('choice_id', flat=True))
+        missing = [choice_id for choice_id in questions if choice_id not in existing]
+        ChoiceTally.objects.bulk_create(
+            [ChoiceTally(question_id=questions[choice_id], choice_id=choice_id) for choice_id in missing],
+            ignore_conflicts=True)
+        ChoiceTally.objects.filter(choice_id__in=missing).update(count=F('count') + delta)
+
+
+def stored_tallies(poll_id):
+    """ Сохраненные счетчики опроса: два запроса независимо от количества попыток.
+    Возвращает (количество попыток, {(question_id, choice_id): count})"""
+    attempts = PollTally.objects.filter(poll_id=poll_id).values_list('attempts', flat=True).first() or 0
+    counts = {(question_id, choice_id): count for question_id, choice_id, count in ChoiceTally.objects.filter(
+        question__poll_id=poll_id).values_list('question_id', 'choice_id', 'count')}
+    return attempts, counts
+
+
+def get_results(schema):
+    """ Итоги опроса по схеме и сохраненным счетчикам"""
+    attempts, counts = stored_tallies(schema.id)
+    return PollResults(schema=schema, attempts=attempts, counts=counts)
+
+
+def compute_tallies(poll_id):
+    """ Посчитать итоги опроса по выбранным вариантам ответа (AnswerChoice) одним GROUP BY.
+    Возвращает (количество попыток, {(question_id, choice_id): count})"""
+    counts = Counter({key: 0 for key in Choice.objects.filter(question__poll_id=poll_id).exclude(
+        question__question_type=Question.TEXT).values_list('question_id', 'id')})
+    counts.update({(question_id, choice_id): count for question_id, choice_id, count in AnswerChoice.objects.filter(
+        choice__question__poll_id=poll_id).values_list('choice__question_id', 'choice_id').annotate(
+        count=Count('id')).order_by()})
+    attempts = Attempt.objects.filter(poll_id=poll_id).count()
+    return attempts, counts
+
+
+def lock_tallies(poll_id):
+    """ Заблокировать строки счетчиков опроса до конца транзакции (SELECT ... FOR UPDATE).
+    Голос увеличивает счетчик попыток раньше счетчиков вариантов, поэтому блокировки берутся в том же порядке"""
+    list(PollTally.objects.select_for_update().filter(poll_id=poll_id).values_list('id', flat=True))
+    list(ChoiceTally.objects.select_for_update(of=('self', )).filter(
+        question__poll_id=poll_id).values_list('id', flat=True))
+
+
+def recompute_tallies(poll_id):
+    """ Посчитать итоги опроса по ответам и перезаписать ими счетчики в одной транзакции.
+    Голос, уже увеличивший счетчики, учитывается в пересчете, а конкурентный голос ждет его окончания
+    и увеличивает перезаписанные счетчики. Возвращает (количество попыток, counts)"""
+    with transaction.atomic():
+        lock_tallies(poll_id)
+        attempts, counts = compute_tallies(poll_id)
+        rebuild_tallies(poll_id, attempts, counts)
+    return attempts, counts
+
+
+def rebuild_tallies(poll_id, attempts, counts):
+    """ Перезаписать счетчики опроса посчитанными значениями"""
+    with transaction.atomic():
+        PollTally.objects.filter(poll_id=poll_id).delete()
+        PollTally.objects.create(poll_id=poll_id, attempts=attempts)
+        ChoiceTally.objects.filter(question__poll_id=poll_id).delete()
+        ChoiceTally.objects.bulk_create([ChoiceTally(question_id=question_id, choice_id=choice_id, count=count)
+                                         for (question_id, choice_id), count in counts.items()])
@@ -1,3 +1,1993 @@
-from django.test import TestCase
+import asyncio
+import csv
+import json
+import os
+import tempfile
+import threading
+from datetime import date, datetime, timedelta
+from importlib import import_module
+from io import StringIO
+from unittest import mock
+from uuid import uuid4
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command, CommandError
+from django.db import connection, connections, router, OperationalError
+from django.test import TransactionTestCase, override_settings
+from django.urls import include, path, resolve
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APITestCase, APITransactionTestCase
+
+from .models import Poll, Question, Choice, Attempt, Answer, AnswerChoice, MyUser, ChoiceTally, PollTally, Job, \
+    PollArchive, PollVoter
+from . import urls as poll_urls
+from .aio import async_routes, close_request_connections
+from . import analytics, tallies
+from .analytics import analytics_engine
+from .authentication import CachedTokenAuthentication, token_cache
+from .db_connections import check_connections, sqlite_pragmas
+from .db_routing import RoutingState, _state as routing_state
+from .duplicates import BloomFilter, voter_filters
+from .export import export_ndjson
+from .ingest import vote_buffer
+from .jobs import JOBS, JobError, claim, run, submit
+from .questions import diff_choices
+from . import renderers
+from .lru import LRUCache
+from .metrics import registry as metrics_registry, QUERIES
+from .schema import schema_cache
+from .search import LikeSearch, SearchResults
+from .serializers import PollDetailSerializer, PollSerializer, WriteQuestionSerializer, AttemptSerializer, \
+    VoteSerializer
+from .snapshots import ANSWERS_PREFETCH, answers_snapshot
+from .votes import Vote
+
+
+def make_poll(questions=3, choices=4, **kwargs):
+    """ Создать опрос с вопросами всех типов по кругу: текст, один вариант, несколько вариантов"""
+    poll = Poll.objects.create(title=kwargs.pop('title', 'Опрос'), **kwargs)
+    types = (Question.TEXT, Question.SINGLE_CHOICE, Question.MULTI_CHOICE)
+    for position in range(1, questions + 1):
+        question_type = types[(position - 1) % len(types)]
+        question = Question.objects.create(poll=poll, position=position, question_type=question_type,
+                                           main_text='Вопрос %d' % position)
+        if question_type != Question.TEXT:
+            Choice.objects.bulk_create([Choice(question=question, choice_text=str(n)) for n in range(choices)])
+    return poll
+
+
+def make_answers(poll):
+    """ Сформировать корректный набор ответов на все вопросы опроса"""
+    answers = []
+    for question in poll.questions.order_by('position'):
+        if question.question_type == Question.TEXT:
+            answer = ['текст']
+        elif question.question_type == Question.SINGLE_CHOICE:
+            answer = ['0']
+        else:
+            answer = ['1', '2']
+        answers.append({'position': question.position, 'answer': answer})
+    return answers
+
+
+class PollAPITestCase(APITestCase):
+    """ Сбрасывает кэши между тестами: id объектов в тестовой БД повторяются"""
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        schema_cache.clear()
+        token_cache.clear()
+        vote_buffer.clear()
+        metrics_registry.clear()
+        analytics_engine.clear()
+        voter_filters.clear()
+
+
+class QueryBudgetMixin:
+    """ Проверка бюджета запросов: количество запросов к БД не больше заданного
+    и не растет вместе с количеством данных"""
+
+    def assertMaxQueries(self, budget, request):
+        with CaptureQueriesContext(connection) as context:
+            response = request()
+        self.assertLessEqual(len(context), budget,
+                             '\n'.join(query['sql'] for query in context.captured_queries))
+        return response
+
+    def assertQueryBudget(self, budget, request, grow, rounds=2):
+        """ Выполнить request, затем rounds раз увеличить данные (grow) и повторить.
+        Каждый раз запрос выполняется дважды: с холодными кэшами и с прогретыми"""
+        sizes = []
+        for step in range(rounds + 1):
+            if step:
+                grow()
+            self.assertMaxQueries(budget, request)
+            with CaptureQueriesContext(connection) as context:
+                response = self.assertMaxQueries(budget, request)
+            self.assertLess(response.status_code, 400)
+            sizes.append(len(context))
+        self.assertEqual(len(set(sizes)), 1, 'Query count depends on data size: %s' % sizes)
+
+
+class VoteTests(PollAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = MyUser.objects.create_user(username='voter', password=None)
+
+    def vote(self, poll, answers, user=None):
+        data = {'user': (user or self.user).pk, 'answers': answers}
+        return self.client.post('/api/v1/polls/%d/vote/' % poll.pk, data, format='json')
+
+    def test_vote_creates_attempt_and_answers(self):
+        poll = make_poll()
+        response = self.vote(poll, make_answers(poll))
+        self.assertEqual(response.status_code, 200, response.data)
+        attempt = Attempt.objects.get(pk=response.data['id'])
+        self.assertEqual(attempt.poll, poll)
+        self.assertEqual(attempt.user, self.user)
+        answers = {a.question.position: a for a in attempt.answers.select_related('question')}
+        self.assertEqual({position: a.value for position, a in answers.items()},
+                         {1: "['текст']", 2: "['0']", 3: "['1', '2']"})
+        self.assertEqual(answers[1].answer, "['текст']")
+        self.assertEqual(answers[3].answer, '')
+        self.assertEqual([c.choice.choice_text for c in answers[3].choices.all()], ['1', '2'])
+
+    def test_vote_rejects_invalid_answers(self):
+        poll = make_poll()
+        cases = {
+            'unknown choice': {2: ['9']},
+            'duplicate choice': {3: ['1', '1']},
+            'two answers for single choice': {2: ['0', '1']},
+            'empty multi choice': {3: []},
+        }
+        for name, override in cases.items():
+            with self.subTest(name):
+                answers = [{'position': a['position'], 'answer': override.get(a['position'], a['answer'])}
+                           for a in make_answers(poll)]
+                self.assertEqual(self.vote(poll, answers).status_code, 400)
+        with self.subTest('missing question'):
+            self.assertEqual(self.vote(poll, make_answers(poll)[:-1]).status_code, 400)
+        with self.subTest('repeated question'):
+            answers = make_answers(poll)
+            self.assertEqual(self.vote(poll, answers + answers[:1]).status_code, 400)
+        with self.subTest('unknown question'):
+            answers = make_answers(poll) + [{'position': 99, 'answer': ['x']}]
+            self.assertEqual(self.vote(poll, answers).status_code, 400)
+        self.assertFalse(Attempt.objects.exists())
+        self.assertFalse(Answer.objects.exists())
+
+    def test_vote_query_count_does_not_depend_on_poll_size(self):
+        counts = []
+        for size in (3, 40):
+            poll = make_poll(questions=size)
+            answers = make_answers(poll)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.vote(poll, answers)
+            self.assertEqual(response.status_code, 200, response.data)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_anonymous_votes_are_linked_by_voter_token(self):
+        poll = make_poll()
+        url = '/api/v1/polls/%d/vote/' % poll.pk
+        users = MyUser.objects.count()
+        first = self.client.post(url, {'answers': make_answers(poll)}, format='json')
+        self.assertEqual(first.status_code, 200, first.data)
+        self.assertIsNone(first.data['user'])
+        token = first['X-Voter-Token']
+        self.assertEqual(first.cookies['poll_voter'].value, token)
+        # Cookie тестового клиента подставляется автоматически, связываем второй голос заголовком
+        self.client.cookies.clear()
+        second = self.client.post(url, {'answers': make_answers(poll)}, format='json', HTTP_X_VOTER_TOKEN=token)
+        self.assertEqual(second['X-Voter-Token'], token)
+        self.assertEqual(MyUser.objects.count(), users)
+        voters = set(Attempt.objects.values_list('voter', flat=True))
+        self.assertEqual(len(voters), 1)
+        history = self.client.post('/api/v1/results/', {}, format='json', HTTP_X_VOTER_TOKEN=token).json()
+        self.assertEqual(len(history['results']), 2)
+
+        self.client.post(url, {'answers': make_answers(poll)}, format='json', HTTP_X_VOTER_TOKEN=token + 'x')
+        self.assertEqual(len(set(Attempt.objects.values_list('voter', flat=True))), 2)
+
+    def test_auto_created_users_become_anonymous_voters(self):
+        poll = make_poll()
+        legacy = []
+        for _ in range(2):
+            user = MyUser.objects.create_user(username='auto_username', password=None)
+            user.username = str(user.id)
+            user.save()
+            legacy.append(user)
+            for _ in range(2):
+                self.vote(poll, make_answers(poll), user=user)
+        self.vote(poll, make_answers(poll))
+        call_command('migrate_auto_users', batch_size=1, stdout=StringIO())
+        self.assertFalse(MyUser.objects.filter(pk__in=[user.pk for user in legacy]).exists())
+        self.assertEqual(Attempt.objects.filter(user=self.user).count(), 1)
+        anonymous = Attempt.objects.filter(user__isnull=True)
+        self.assertEqual(anonymous.count(), 4)
+        self.assertEqual(anonymous.values('voter').distinct().count(), 2)
+        self.assertEqual(PollTally.objects.get(poll=poll).attempts, 5)
+
+
+class SchemaCacheTests(PollAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+
+    def test_retrieve_matches_detail_serializer(self):
+        poll = make_poll(questions=6)
+        response = self.client.get('/api/v1/polls/%d/' % poll.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), PollDetailSerializer(poll).data)
+
+    def test_retrieve_from_cache_does_not_query_database(self):
+        poll = make_poll(questions=6)
+        self.client.get('/api/v1/polls/%d/' % poll.pk)
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/v1/polls/%d/' % poll.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(schema_cache.stats['misses'], 1)
+        self.assertEqual(schema_cache.stats['local_hits'], 1)
+
+    def test_shared_tier_serves_other_processes(self):
+        poll = make_poll()
+        schema_cache.get(poll.pk)
+        schema_cache.local.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(schema_cache.get(poll.pk).id, poll.pk)
+        self.assertEqual(schema_cache.stats['shared_hits'], 1)
+
+    def test_edits_invalidate_schema(self):
+        poll = make_poll()
+        url = '/api/v1/polls/%d/' % poll.pk
+        self.client.get(url)
+        self.client.force_authenticate(self.admin)
+        data = {'question_type': 'Ответ с выбором одного варианта', 'choices': ['a', 'b']}
+        response = self.client.patch(url + 'questions/2/', data, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(self.client.get(url).json()['questions'][1]['choices'], ['a', 'b'])
+        Choice.objects.filter(choice_text='a').update(choice_text='c')
+        Choice.objects.get(choice_text='b').delete()
+        self.assertEqual(self.client.get(url).json()['questions'][1]['choices'], ['c'])
+        Poll.objects.filter(pk=poll.pk).update(title='Новый')
+        poll.refresh_from_db()
+        poll.save()
+        self.assertEqual(self.client.get(url).json()['title'], 'Новый')
+        response = self.client.patch(url + 'questions/1/', {'main_text': 'Текст'}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(self.client.get(url).json()['questions'][0]['main_text'], 'Текст')
+
+    def test_inactive_poll_is_hidden_from_users(self):
+        poll = make_poll(finished_at=date.today() - timedelta(days=1))
+        url = '/api/v1/polls/%d/' % poll.pk
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.client.get('/api/v1/polls/abc/').status_code, 404)
+        self.client.force_authenticate(self.admin)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class ResultsTests(PollAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = MyUser.objects.create_user(username='voter', password=None)
+        self.poll = make_poll()
+        self.url = '/api/v1/polls/%d/' % self.poll.pk
+
+    def vote(self, single, multi):
+        answers = [{'position': 1, 'answer': ['текст']}, {'position': 2, 'answer': single},
+                   {'position': 3, 'answer': multi}]
+        response = self.client.post(self.url + 'vote/', {'user': self.user.pk, 'answers': answers}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+
+    def counts(self, data, position):
+        return {c['choice_text']: c['count'] for c in data['questions'][position - 1]['choices']}
+
+    def test_results_counts_votes(self):
+        self.vote(['0'], ['1', '2'])
+        self.vote(['0'], ['2'])
+        self.vote(['3'], ['0', '2', '3'])
+        self.vote(['0'], ['2'])
+        data = self.client.get(self.url + 'results/').json()
+        self.assertEqual(data['attempts'], 4)
+        self.assertEqual(self.counts(data, 1), {})
+        self.assertEqual(self.counts(data, 2), {'0': 3, '1': 0, '2': 0, '3': 1})
+        self.assertEqual(self.counts(data, 3), {'0': 1, '1': 1, '2': 4, '3': 1})
+        self.assertEqual(data['questions'][1]['choices'][0]['percent'], 75.0)
+
+    def test_results_query_count_does_not_depend_on_attempts(self):
+        self.vote(['0'], ['1'])
+        self.client.get(self.url + 'results/')
+        with CaptureQueriesContext(connection) as before:
+            self.client.get(self.url + 'results/')
+        for _ in range(5):
+            self.vote(['1'], ['2', '3'])
+        with CaptureQueriesContext(connection) as after:
+            self.client.get(self.url + 'results/')
+        self.assertEqual(len(before), len(after))
+
+    def test_recompute_tallies_fixes_drift(self):
+        self.vote(['0'], ['1', '2'])
+        self.vote(['1'], ['2'])
+        ChoiceTally.objects.update(count=0)
+        PollTally.objects.update(attempts=10)
+        with self.assertRaises(CommandError):
+            call_command('recompute_tallies', '--check', stdout=StringIO())
+        call_command('recompute_tallies', self.poll.pk, stdout=StringIO())
+        call_command('recompute_tallies', '--check', stdout=StringIO())
+        data = self.client.get(self.url + 'results/').json()
+        self.assertEqual(data['attempts'], 2)
+        self.assertEqual(self.counts(data, 2), {'0': 1, '1': 1, '2': 0, '3': 0})
+        self.assertEqual(self.counts(data, 3), {'0': 0, '1': 1, '2': 2, '3': 0})
+
+    def test_data_migration_seeds_tallies(self):
+        self.vote(['0'], ['1', '2'])
+        self.vote(['1'], ['2'])
+        archived = make_poll(finished_at=date.today() - timedelta(days=1))
+        Poll.objects.filter(pk=archived.pk).update(is_archived=True)
+        PollTally.objects.all().delete()
+        ChoiceTally.objects.all().delete()
+        import_module('poll.migrations.0015_backfill_tallies').forwards(apps, None)
+        data = self.client.get(self.url + 'results/').json()
+        self.assertEqual(data['attempts'], 2)
+        self.assertEqual(self.counts(data, 2), {'0': 1, '1': 1, '2': 0, '3': 0})
+        self.assertEqual(self.counts(data, 3), {'0': 0, '1': 1, '2': 2, '3': 0})
+        # Итоги архивных опросов заморожены
+        self.assertFalse(PollTally.objects.filter(poll=archived).exists())
+
+    def test_recompute_tallies_locks_counters_in_one_transaction(self):
+        self.vote(['0'], ['1', '2'])
+        PollTally.objects.update(attempts=10)
+        calls = []
+        depth = len(connection.savepoint_ids)
+
+        def record(name, function):
+            def wrapper(*args):
+                calls.append((name, len(connection.savepoint_ids) > depth))
+                return function(*args)
+            return wrapper
+
+        with mock.patch('poll.tallies.lock_tallies', record('lock', tallies.lock_tallies)), \
+                mock.patch('poll.tallies.compute_tallies', record('compute', tallies.compute_tallies)):
+            self.assertEqual(submit('rebuild_tallies', {'poll_id': self.poll.pk}).status, Job.PENDING)
+            run(claim('test'))
+        # Подсчет выполняется после блокировки счетчиков в той же транзакции, что и перезапись
+        self.assertEqual(calls, [('lock', True), ('compute', True)])
+        self.assertEqual(PollTally.objects.get(poll=self.poll).attempts, 1)
+
+
+class AnswerStorageTests(PollAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = MyUser.objects.create_user(username='voter', password=None)
+        self.poll = make_poll()
+
+    def test_results_history_keeps_answer_format(self):
+        answers = [{'position': 1, 'answer': ['текст']}, {'position': 2, 'answer': ['3']},
+                   {'position': 3, 'answer': ['2', '0']}]
+        self.client.post('/api/v1/polls/%d/vote/' % self.poll.pk, {'user': self.user.pk, 'answers': answers},
+                         format='json')
+        data = self.client.post('/api/v1/results/', {'user': self.user.pk}, format='json').json()
+        self.assertEqual([a['answer'] for a in data['results'][0]['answers']], ["['текст']", "['3']", "['2', '0']"])
+
+    def history(self):
+        return self.client.post('/api/v1/results/', {'user': self.user.pk}, format='json').json()['results']
+
+    def test_history_snapshot_matches_stored_answers(self):
+        for _ in range(2):
+            self.client.post('/api/v1/polls/%d/vote/' % self.poll.pk,
+                             {'user': self.user.pk, 'answers': make_answers(self.poll)}, format='json')
+        from_snapshots = self.history()
+        Attempt.objects.update(snapshot=None)
+        self.assertEqual(self.history(), from_snapshots)
+        call_command('backfill_snapshots', stdout=StringIO())
+        self.assertFalse(Attempt.objects.filter(snapshot__isnull=True).exists())
+        self.assertEqual(self.history(), from_snapshots)
+
+    def test_history_snapshot_is_frozen_at_vote_time(self):
+        self.client.post('/api/v1/polls/%d/vote/' % self.poll.pk,
+                         {'user': self.user.pk, 'answers': make_answers(self.poll)}, format='json')
+        question = self.poll.questions.get(position=1)
+        text = question.main_text
+        question.main_text = 'Новый текст'
+        question.save()
+        self.assertEqual(self.history()[0]['answers'][0]['question']['main_text'], text)
+
+    def test_data_migration_converts_legacy_answers(self):
+        migration = import_module('poll.migrations.0004_migrate_choice_answers')
+        attempt = Attempt.objects.create(user=self.user, poll=self.poll)
+        questions = {q.position: q for q in self.poll.questions.all()}
+        legacy = {1: "['текст']", 2: "['1']", 3: "['3', '0']"}
+        for position, text in legacy.items():
+            Answer.objects.create(attempt=attempt, question=questions[position], answer=text)
+        broken = Answer.objects.create(attempt=attempt, question=questions[2], answer="['нет такого']")
+        migration.forwards(apps, None)
+        answers = {a.question.position: a for a in attempt.answers.exclude(pk=broken.pk)}
+        self.assertEqual(answers[1].answer, "['текст']")
+        self.assertEqual(answers[3].answer, '')
+        self.assertEqual({position: a.value for position, a in answers.items()}, legacy)
+        self.assertEqual(Answer.objects.get(pk=broken.pk).value, "['нет такого']")
+        migration.backwards(apps, None)
+        self.assertFalse(AnswerChoice.objects.exists())
+        self.assertEqual({a.question.position: a.answer for a in attempt.answers.exclude(pk=broken.pk)}, legacy)
+
+
+BUFFER = {'ENABLED': 1, 'THREAD': False, 'MAX_SIZE': 3, 'BATCH_SIZE': 2, 'FLUSH_INTERVAL': 0.01, 'PUT_TIMEOUT': 0}
+
+
+@override_settings(POLL_VOTE_BUFFER=BUFFER)
+class BufferedVoteTests(PollAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = MyUser.objects.create_user(username='voter', password=None)
+        self.poll = make_poll()
+
+    def vote(self):
+        data = {'user': self.user.pk, 'answers': make_answers(self.poll)}
+        return self.client.post('/api/v1/polls/%d/vote/' % self.poll.pk, data, format='json')
+
+    def test_votes_are_queued_and_flushed_in_batches(self):
+        tokens = [self.vote().data['token'] for _ in range(3)]
+        self.assertFalse(Attempt.objects.exists())
+        self.assertEqual(self.vote().status_code, 503)
+        vote_buffer.flush()
+        self.assertEqual(sorted(str(t) for t in Attempt.objects.values_list('token', flat=True)), sorted(tokens))
+        self.assertEqual(vote_buffer.stats['batches'], 2)
+        self.assertEqual(Answer.objects.count(), 9)
+        self.assertEqual(PollTally.objects.get(poll=self.poll).attempts, 3)
+        self.assertEqual(self.vote().status_code, 202)
+
+    def test_rewriting_a_batch_does_not_duplicate_votes(self):
+        for _ in range(2):
+            self.vote()
+        batch = vote_buffer._take(block=False)
+        vote_buffer._write(batch)
+        with self.assertLogs('poll.ingest', level='ERROR'):
+            vote_buffer._write(batch)
+        self.assertEqual(Attempt.objects.count(), 2)
+        self.assertEqual(vote_buffer.stats['duplicates'], 2)
+
+    def test_failed_votes_are_written_by_a_job(self):
+        token = self.vote().data['token']
+        with mock.patch('poll.ingest.write_votes', side_effect=OperationalError('database is locked')), \
+                self.assertLogs('poll.ingest', level='ERROR'):
+            vote_buffer.flush()
+        self.assertFalse(Attempt.objects.exists())
+        self.assertEqual(vote_buffer.stats['dead_lettered'], 1)
+        job = Job.objects.get(kind='write_vote')
+        self.assertEqual(job.params['token'], token)
+        run(claim('test'))
+        self.assertEqual(Job.objects.get(pk=job.pk).status, Job.DONE)
+        self.assertEqual(str(Attempt.objects.get().token), token)
+        self.assertEqual(PollTally.objects.get(poll=self.poll).attempts, 1)
+        # Повтор задачи не записывает голос второй раз
+        submit('write_vote', job.params)
+        run(claim('test'))
+        self.assertEqual(Attempt.objects.count(), 1)
+
+    def test_lost_votes_are_counted_in_metrics(self):
+        self.vote()
+        self.vote()
+        with mock.patch('poll.ingest.write_votes', side_effect=OperationalError('database is locked')), \
+                mock.patch('poll.ingest.submit', side_effect=[None, OperationalError('database is locked')]), \
+                self.assertLogs('poll.ingest', level='ERROR'):
+            vote_buffer.flush()
+        metrics = self.client.get('/metrics').content.decode().splitlines()
+        self.assertIn('poll_vote_buffer_votes_total{outcome="dead_lettered"} 1', metrics)
+        self.assertIn('poll_vote_buffer_votes_total{outcome="dropped"} 1', metrics)
+        self.assertIn('poll_vote_buffer_votes_total{outcome="queued"} 2', metrics)
+
+
+class BufferedVoteThreadTests(TransactionTestCase):
+
+    def setUp(self):
+        vote_buffer.clear()
+        schema_cache.clear()
+        self.user = MyUser.objects.create_user(username='voter', password=None)
+        self.poll = make_poll()
+
+    def tearDown(self):
+        vote_buffer.clear()
+
+    @override_settings(POLL_VOTE_BUFFER=dict(BUFFER, THREAD=True, MAX_SIZE=50, BATCH_SIZE=25, PUT_TIMEOUT=5))
+    def test_concurrent_votes_are_written_once(self):
+        schema = schema_cache.get(self.poll.pk)
+        answers = make_answers(self.poll)
+
+        def produce():
+            for _ in range(100):
+                vote_buffer.submit(Vote(poll=schema, user_id=self.user.pk, answers=answers, token=uuid4()))
+
+        producers = [threading.Thread(target=produce) for _ in range(4)]
+        for producer in producers:
+            producer.start()
+        for producer in producers:
+            producer.join()
+        vote_buffer.stop()
+        self.assertEqual(Attempt.objects.count(), 400)
+        self.assertEqual(Attempt.objects.values('token').distinct().count(), 400)
+        self.assertEqual(PollTally.objects.get(poll=self.poll).attempts, 400)
+
+
+class GenerateDataTests(PollAPITestCase):
+
+    def test_generated_data_is_consistent(self):
+        call_command('generate_data', polls=3, questions=4, choices=3, attempts=50, users=5, batch_size=20,
+                     stdout=StringIO())
+        call_command('generate_data', polls=1, questions=2, attempts=10, users=0, stdout=StringIO())
+        self.assertEqual(Attempt.objects.count(), 60)
+        self.assertEqual(Attempt.objects.filter(user__isnull=True, voter__isnull=False).count(), 10)
+        self.assertEqual(Answer.objects.count(), 50 * 4 + 10 * 2)
+        call_command('recompute_tallies', check=True, stdout=StringIO())
+        attempt = Attempt.objects.prefetch_related(*ANSWERS_PREFETCH).first()
+        self.assertEqual(attempt.snapshot, answers_snapshot(attempt))
+        # После вставки с явными id новые записи получают следующие id
+        self.assertGreater(Attempt.objects.create(user=attempt.user, poll=attempt.poll).pk,
+                           Attempt.objects.filter(snapshot__isnull=False).order_by('-id').first().pk)
+
+
+class ExportTests(PollAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+        self.poll = make_poll()
+        self.url = '/api/v1/polls/%d/export/' % self.poll.pk
+        for single, multi in ((['0'], ['1', '2']), (['3'], ['0'])):
+            answers = [{'position': 1, 'answer': ['да, "нет"']}, {'position': 2, 'answer': single},
+                       {'position': 3, 'answer': multi}]
+            self.client.post('/api/v1/polls/%d/vote/' % self.poll.pk, {'user': self.admin.pk, 'answers': answers},
+                             format='json')
+        self.attempts = list(Attempt.objects.order_by('id'))
+
+    def export(self, export_format):
+        self.client.force_authenticate(self.admin)
+        response = self.client.get(self.url, {'format': export_format})
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_export_csv(self):
+        response, content = self.export('csv')
+        self.assertTrue(response['Content-Type'].startswith('text/csv'))
+        rows = list(csv.reader(StringIO(content)))
+        self.assertEqual(rows[0], ['attempt', 'user', 'voter', 'time', '1. Вопрос 1', '2. Вопрос 2', '3. Вопрос 3'])
+        self.assertEqual([row[4:] for row in rows[1:]], [['да, "нет"', '0', '1; 2'], ['да, "нет"', '3', '0']])
+        self.assertEqual(rows[1][:3], [str(self.attempts[0].pk), str(self.admin.pk), ''])
+
+    def test_export_csv_escapes_formulas_and_keeps_anonymous_voter(self):
+        answers = [{'position': 1, 'answer': ['=HYPERLINK("http://example.com")']},
+                   {'position': 2, 'answer': ['1']}, {'position': 3, 'answer': ['2']}]
+        response = self.client.post('/api/v1/polls/%d/vote/' % self.poll.pk, {'answers': answers}, format='json')
+        voter = Attempt.objects.get(pk=response.data['id']).voter
+        rows = list(csv.reader(StringIO(self.export('csv')[1])))
+        self.assertEqual(rows[3][2], str(voter))
+        self.assertEqual(rows[3][4], '\'=HYPERLINK("http://example.com")')
+        rows = [json.loads(line) for line in self.export('ndjson')[1].splitlines()]
+        self.assertEqual(rows[2]['voter'], str(voter))
+        self.assertEqual(rows[2]['answers']['1'], ['=HYPERLINK("http://example.com")'])
+
+    def test_export_ndjson(self):
+        response, content = self.export('ndjson')
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(rows[1]['attempt'], self.attempts[1].pk)
+        self.assertEqual(rows[1]['answers'], {'1': ['да, "нет"'], '2': ['3'], '3': ['0']})
+
+    def test_export_reads_attempts_in_batches(self):
+        schema = schema_cache.get(self.poll.pk)
+        with self.assertNumQueries(7):
+            self.assertEqual(len(list(export_ndjson(schema, chunk_size=1))), 2)
+
+    def test_export_is_staff_only(self):
+        self.assertIn(self.client.get(self.url).status_code, (401, 403))
+
+
+@override_settings(POLL_RESPONSE_CACHE={'ENABLED': 0})
+class ReadQueryBudgetTests(QueryBudgetMixin, PollAPITestCase):
+    """ Бюджеты запросов для всех эндпоинтов чтения (без кэша ответов, см. ResponseCacheTests)"""
+
+    def setUp(self):
+        super().setUp()
+        self.admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+        self.poll = make_poll()
+
+    def add_polls(self):
+        for _ in range(3):
+            make_poll()
+
+    def add_questions(self):
+        start = self.poll.questions.count() + 1
+        for position in range(start, start + 3):
+            question = Question.objects.create(poll=self.poll, position=position, main_text='Еще',
+                                               question_type=Question.MULTI_CHOICE)
+            Choice.objects.bulk_create([Choice(question=question, choice_text=str(n)) for n in range(3)])
+
+    def add_attempts(self):
+        for _ in range(3):
+            self.client.post('/api/v1/polls/%d/vote/' % self.poll.pk,
+                             {'user': self.admin.pk, 'answers': make_answers(self.poll)}, format='json')
+
+    def test_poll_list(self):
+        self.assertQueryBudget(1, lambda: self.client.get('/api/v1/polls/'), self.add_polls)
+
+    def test_poll_detail(self):
+        url = '/api/v1/polls/%d/' % self.poll.pk
+        self.assertQueryBudget(3, lambda: self.client.get(url), self.add_questions)
+
+    def test_question_list(self):
+        self.client.force_authenticate(self.admin)
+        url = '/api/v1/polls/%d/questions/' % self.poll.pk
+        self.assertQueryBudget(2, lambda: self.client.get(url), self.add_questions)
+
+    def test_poll_results(self):
+        url = '/api/v1/polls/%d/results/' % self.poll.pk
+        self.assertQueryBudget(5, lambda: self.client.get(url), self.add_attempts)
+
+    def test_attempt_history(self):
+        self.add_attempts()
+        request = lambda: self.client.post('/api/v1/results/', {'user': self.admin.pk}, format='json')  # noqa: E731
+        self.assertQueryBudget(1, request, self.add_attempts)
+
+
+class PaginationTests(PollAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+        self.polls = [Poll.objects.create(title=str(n)) for n in range(5)]
+        self.finished = Poll.objects.create(title='finished', finished_at=date.today() - timedelta(days=1))
+
+    def walk(self, url, method='get', data=None):
+        ids = []
+        while url:
+            response = getattr(self.client, method)(url, data, format='json')
+            self.assertEqual(response.status_code, 200, response.data)
+            ids.extend(item.get('id', item.get('poll', {}).get('id')) for item in response.data['results'])
+            url = response.data['next']
+        return ids
+
+    def test_poll_pages_follow_started_at_and_id(self):
+        self.assertEqual(self.walk('/api/v1/polls/?page_size=2'), [poll.pk for poll in reversed(self.polls)])
+
+    def test_poll_filters(self):
+        self.client.force_authenticate(self.admin)
+        self.assertEqual(len(self.walk('/api/v1/polls/?page_size=2')), 6)
+        self.assertEqual(self.walk('/api/v1/polls/?active=false'), [self.finished.pk])
+        self.assertEqual(len(self.walk('/api/v1/polls/?active=true&started_from=%s' % date.today())), 5)
+        self.assertEqual(self.walk('/api/v1/polls/?started_to=2000-01-01'), [])
+        self.assertEqual(self.client.get('/api/v1/polls/?started_to=вчера').status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/polls/?cursor=bad').status_code, 404)
+
+    def test_attempt_history_pages_and_filters(self):
+        attempts = [Attempt.objects.create(user=self.admin, poll=self.polls[n % 2]) for n in range(5)]
+        data = {'user': self.admin.pk}
+        ids = [a['poll']['id'] for a in self.client.post('/api/v1/results/', data, format='json').data['results']]
+        self.assertEqual(ids, [attempt.poll_id for attempt in reversed(attempts)])
+        pages = self.client.post('/api/v1/results/?page_size=2&poll=%d' % self.polls[0].pk, data, format='json')
+        self.assertEqual(len(pages.data['results']), 2)
+        self.assertEqual(len(self.walk(pages.data['next'], 'post', data)), 1)
+        today = self.client.post('/api/v1/results/?date_from=%s&date_to=%s' % (date.today(), date.today()), data,
+                                 format='json')
+        self.assertEqual(len(today.data['results']), 5)
+        tomorrow = self.client.post('/api/v1/results/?date_from=%s' % (date.today() + timedelta(days=1)), data,
+                                    format='json')
+        self.assertEqual(tomorrow.data['results'], [])
+
+
+@override_settings(POLL_RESPONSE_CACHE={'ENABLED': 0})
+class CachedTokenAuthTests(QueryBudgetMixin, PollAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = MyUser.objects.create_user(username='admin', password='secret-pass', is_staff=True)
+        self.token = Token.objects.create(user=self.admin)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+        make_poll(finished_at=date.today() - timedelta(days=1))
+
+    def polls(self):
+        return self.client.get('/api/v1/polls/')
+
+    def test_cached_token_skips_auth_query(self):
+        self.assertEqual(len(self.polls().data['results']), 1)
+        response = self.assertMaxQueries(1, self.polls)
+        # Неактивный опрос виден: пользователь из кэша - администратор
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(token_cache.stats['local_hits'], 1)
+        # Хэш пароля в кэш не попадает и загружается при обращении
+        self.assertTrue(token_cache.get(self.token.key).user.check_password('secret-pass'))
+
+    def test_logout_invalidates_token(self):
+        self.polls()
+        self.assertEqual(self.client.post('/api/v1/auth/token/logout/').status_code, 204)
+        self.assertEqual(self.polls().status_code, 401)
+
+    def test_user_changes_invalidate_token(self):
+        self.polls()
+        self.admin.set_password('other-pass')
+        self.admin.save()
+        self.assertIsNone(token_cache.get(self.token.key))
+        self.polls()
+        self.admin.is_active = False
+        self.admin.save()
+        self.assertEqual(self.polls().status_code, 401)
+
+    @override_settings(POLL_AUTH_CACHE={'ALIAS': 'default', 'LOCAL_TTL': 0})
+    def test_shared_backend(self):
+        token_cache.clear()
+        self.polls()
+        self.assertMaxQueries(1, self.polls)
+        self.assertEqual(token_cache.stats['shared_hits'], 1)
+        Token.objects.filter(pk=self.token.pk).delete()
+        self.assertEqual(self.polls().status_code, 401)
+        token_cache.clear()
+
+    def test_lru_ttl(self):
+        cache = LRUCache(2, ttl=60)
+        for key in 'abc':
+            cache.set(key, key)
+        self.assertEqual((cache.get('a'), cache.get('c')), (None, 'c'))
+        cache.ttl = 0
+        cache.set('d', 'd')
+        self.assertIsNone(cache.get('d'))
+
+
+@override_settings(POLL_RESPONSE_CACHE={'ENABLED': 0})
+class MetricsTests(PollAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = MyUser.objects.create_user(username='voter', password=None)
+        self.poll = make_poll()
+
+    def metrics(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        return {line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1])
+                for line in response.content.decode().splitlines() if not line.startswith('#')}
+
+    def test_requests_are_recorded_by_route(self):
+        for _ in range(2):
+            self.client.get('/api/v1/polls/')
+        self.client.post('/api/v1/polls/%d/vote/' % self.poll.pk,
+                         {'user': self.user.pk, 'answers': make_answers(self.poll)}, format='json')
+        self.client.post('/api/v1/results/', {'user': self.user.pk}, format='json')
+        metrics = self.metrics()
+        self.assertEqual(metrics['poll_http_request_duration_seconds_count{route="poll-list"}'], 2)
+        self.assertEqual(metrics['poll_http_request_duration_seconds_bucket{route="poll-list",le="+Inf"}'], 2)
+        self.assertEqual(metrics['poll_http_sql_queries_total{route="poll-list"}'], 2)
+        self.assertGreater(metrics['poll_http_response_bytes_total{route="poll-list"}'], 0)
+        self.assertEqual(metrics['poll_http_request_duration_seconds_count{route="poll-vote"}'], 1)
+        self.assertGreater(metrics['poll_http_sql_queries_total{route="poll-vote"}'], 1)
+        self.assertEqual(metrics['poll_http_request_duration_seconds_count{route="results"}'], 1)
+
+    def test_streaming_response_size_is_recorded(self):
+        admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+        self.client.force_authenticate(admin)
+        response = self.client.get('/api/v1/polls/%d/export/?format=csv' % self.poll.pk)
+        size = len(b''.join(response.streaming_content))
+        self.assertEqual(self.metrics()['poll_http_response_bytes_total{route="poll-export"}'], size)
+
+    def test_workers_are_summed_from_shared_directory(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(POLL_METRICS=dict(settings.POLL_METRICS, DIR=directory, FLUSH_INTERVAL=0)):
+            other = [3, 0.5, 7, 0.1, 100] + [0] * len(settings.POLL_METRICS['BUCKETS'])
+            other[5] = 3
+            with open(os.path.join(directory, 'metrics-1.json'), 'w') as file:
+                json.dump({'routes': {'poll-list': other}, 'counters': {}}, file)
+            self.client.get('/api/v1/polls/')
+            metrics = self.metrics()
+        self.assertEqual(metrics['poll_http_request_duration_seconds_count{route="poll-list"}'], 4)
+        self.assertEqual(metrics['poll_http_sql_queries_total{route="poll-list"}'], 8)
+        self.assertGreaterEqual(metrics['poll_http_request_duration_seconds_bucket{route="poll-list",le="0.005"}'], 3)
+
+
+class FastSerializationTests(PollAPITestCase):
+    """ Ответы из строк .values() и FastJSONRenderer совпадают побайтно с ответами сериализаторов DRF"""
+
+    def setUp(self):
+        super().setUp()
+        self.admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+        self.user = MyUser.objects.create_user(username='voter', password=None)
+        self.polls = [
+            make_poll(title='Опрос "кавычки" \\ \u2028 \U0001f600', description='Строка\nвторая\tтаб'),
+            make_poll(questions=5, finished_at=date.today() + timedelta(days=1)),
+            make_poll(questions=0, title='Пустой'),
+        ]
+        for poll in self.polls:
+            for _ in range(2):
+                self.client.post('/api/v1/polls/%d/vote/' % poll.pk,
+                                 {'user': self.user.pk, 'answers': make_answers(poll)}, format='json')
+
+    def render(self, data):
+        return JSONRenderer().render(data)
+
+    def test_poll_list(self):
+        self.client.force_authenticate(self.admin)
+        response = self.client.get('/api/v1/polls/')
+        expected = PollSerializer(Poll.objects.order_by('-started_at', '-id'), many=True).data
+        self.assertEqual(response.content, self.render({'next': None, 'results': expected}))
+
+    def test_question_list(self):
+        self.client.force_authenticate(self.admin)
+        for poll in self.polls:
+            response = self.client.get('/api/v1/polls/%d/questions/' % poll.pk)
+            expected = WriteQuestionSerializer(
+                poll.questions.order_by('position').prefetch_related('choices'), many=True).data
+            self.assertEqual(response.content, self.render(expected))
+
+    def test_history(self):
+        attempts = Attempt.objects.filter(user=self.user).order_by('-time', '-id').select_related('poll')
+        expected = self.render({'next': None, 'results': AttemptSerializer(attempts, many=True).data})
+        response = self.client.post('/api/v1/results/', {'user': self.user.pk}, format='json')
+        self.assertEqual(response.content, expected)
+        # Попытки без снимка отдаются в том же формате
+        Attempt.objects.filter(poll=self.polls[1]).update(snapshot=None)
+        response = self.client.post('/api/v1/results/', {'user': self.user.pk}, format='json')
+        self.assertEqual(response.content, expected)
+
+    def test_renderer_matches_json_renderer(self):
+        self.client.force_authenticate(self.admin)
+        urls = ['/api/v1/polls/', '/api/v1/polls/%d/' % self.polls[0].pk,
+                '/api/v1/polls/%d/results/' % self.polls[1].pk, '/api/v1/polls/%d/questions/' % self.polls[0].pk]
+        for url in urls:
+            content = self.client.get(url).content
+            with mock.patch('poll.renderers.orjson', None):
+                self.assertEqual(self.client.get(url).content, content, url)
+        # С отступами рендерер не меняет вывод JSONRenderer
+        response = self.client.get(urls[0], HTTP_ACCEPT='application/json; indent=2')
+        self.assertIn(b'\n  "next"', response.content)
+
+    def test_orjson_path(self):
+        self.client.force_authenticate(self.admin)
+        with mock.patch.object(JSONRenderer, 'render', autospec=True, side_effect=JSONRenderer.render) as render:
+            response = self.client.get('/api/v1/polls/')
+        self.assertEqual(response.status_code, 200)
+        # С orjson ответ кодируется без JSONRenderer
+        self.assertEqual(render.called, renderers.orjson is None)
+
+
+class ResponseCacheTests(QueryBudgetMixin, PollAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+        self.admin_client = self.client_class()
+        self.admin_client.force_authenticate(self.admin)
+        self.poll = make_poll(finished_at=date.today() + timedelta(days=2))
+        self.list_url, self.detail_url = '/api/v1/polls/', '/api/v1/polls/%d/' % self.poll.pk
+
+    def test_repeated_requests_are_served_from_cache(self):
+        for url in (self.list_url, self.detail_url):
+            first = self.client.get(url)
+            self.assertEqual(first['X-Cache'], 'MISS')
+            second = self.assertMaxQueries(0, lambda: self.client.get(url))
+            self.assertEqual(second['X-Cache'], 'HIT')
+            self.assertEqual(second.content, first.content)
+            self.assertEqual(second['ETag'], first['ETag'])
+
+    def test_conditional_get(self):
+        etag = self.client.get(self.list_url)['ETag']
+        for response in (self.client.get(self.list_url), self.client.get(self.list_url, HTTP_IF_NONE_MATCH=etag)):
+            if response.status_code == 200:
+                continue
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b'')
+        self.assertEqual(self.client.get(self.list_url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        modified = self.client.get(self.list_url)['Last-Modified']
+        self.assertEqual(self.client.get(self.list_url, HTTP_IF_MODIFIED_SINCE=modified).status_code, 304)
+        self.assertEqual(self.client.get(self.list_url, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_edits_purge_responses(self):
+        self.client.get(self.list_url), self.client.get(self.detail_url)
+        self.admin_client.patch(self.detail_url, {'title': 'Новое название'}, format='json')
+        self.assertEqual(self.client.get(self.list_url).json()['results'][0]['title'], 'Новое название')
+        self.assertEqual(self.client.get(self.detail_url).json()['title'], 'Новое название')
+        self.admin_client.post(self.detail_url + 'questions/', {
+            'position': 4, 'question_type': 'Ответ с выбором одного варианта', 'main_text': 'Новый вопрос',
+            'choices': ['a', 'b']}, format='json')
+        self.assertEqual(len(self.client.get(self.detail_url).json()['questions']), 4)
+        self.admin_client.patch(self.detail_url + 'questions/2/', {
+            'question_type': 'Ответ с выбором одного варианта', 'choices': ['да', 'нет']}, format='json')
+        self.assertEqual(self.client.get(self.detail_url).json()['questions'][1]['choices'], ['да', 'нет'])
+        # Вопросы не меняют список опросов
+        self.assertEqual(self.client.get(self.list_url)['X-Cache'], 'HIT')
+
+    def test_audiences_are_cached_separately(self):
+        inactive = make_poll(finished_at=date.today())
+        self.assertEqual(len(self.client.get(self.list_url).json()['results']), 1)
+        self.assertEqual(len(self.admin_client.get(self.list_url).json()['results']), 2)
+        self.assertEqual(len(self.client.get(self.list_url).json()['results']), 1)
+        self.assertEqual(self.admin_client.get('/api/v1/polls/%d/' % inactive.pk).status_code, 200)
+        self.assertEqual(self.client.get('/api/v1/polls/%d/' % inactive.pk).status_code, 404)
+        self.client.credentials(HTTP_AUTHORIZATION='Token invalid')
+        self.assertEqual(self.client.get(self.list_url).status_code, 401)
+
+    def test_token_is_checked_once_per_request(self):
+        token = Token.objects.create(user=MyUser.objects.create_user(username='staff', password=None, is_staff=True))
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        check = CachedTokenAuthentication.authenticate_credentials
+        with mock.patch.object(CachedTokenAuthentication, 'authenticate_credentials', autospec=True,
+                               side_effect=check) as authenticate_credentials:
+            response = self.client.get(self.list_url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        # Представление берет пользователя, которого определил ResponseCacheMiddleware
+        self.assertEqual(authenticate_credentials.call_count, 1)
+        self.assertEqual(len(response.json()['results']), 1)
+
+    @override_settings(POLL_RESPONSE_CACHE=dict(settings.POLL_RESPONSE_CACHE, TIMEOUT=7 * 86400))
+    def test_list_expires_when_poll_finishes(self):
+        backend = caches[settings.POLL_RESPONSE_CACHE['ALIAS']]
+        with mock.patch.object(backend, 'set', wraps=backend.set) as cache_set:
+            self.client.get(self.list_url)
+        timeout = cache_set.call_args[0][2]
+        finishes = datetime.combine(self.poll.finished_at, datetime.min.time())
+        self.assertLessEqual(timeout, (finishes - datetime.now()).total_seconds())
+        self.assertGreater(timeout, 86400)
+        # В день окончания опроса ответ уже не кэшируется
+        with mock.patch('poll.response_cache.seconds_until', return_value=0.5):
+            self.client.get(self.detail_url)
+            self.assertEqual(self.client.get(self.detail_url)['X-Cache'], 'MISS')
+
+
+class QuestionAuthoringTests(QueryBudgetMixin, PollAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+        self.client.force_authenticate(self.admin)
+        self.poll = make_poll()
+        self.url = '/api/v1/polls/%d/questions/' % self.poll.pk
+
+    def test_diff_choices(self):
+        existing = [(1, 'a'), (2, 'b'), (3, 'c')]
+        self.assertEqual(diff_choices(existing, ['a', 'b', 'c', 'd']), ({1: 0, 2: 1, 3: 2}, [], [(3, 'd')]))
+        self.assertEqual(diff_choices(existing, ['a', 'c']), ({1: 0, 3: 1}, [2], []))
+        # Измененный текст - новый вариант, а не переименование прежнего
+        self.assertEqual(diff_choices(existing, ['a', 'B', 'c']), ({1: 0, 3: 2}, [2], [(1, 'B')]))
+        self.assertEqual(diff_choices(existing, ['x', 'a', 'y', 'b', 'c']),
+                         ({1: 1, 2: 3, 3: 4}, [], [(0, 'x'), (2, 'y')]))
+        self.assertEqual(diff_choices(existing, ['c', 'a', 'b']), ({3: 0, 1: 1, 2: 2}, [], []))
+        self.assertEqual(diff_choices(existing, []), ({}, [1, 2, 3], []))
+        self.assertEqual(diff_choices([(1, 'a'), (2, 'a')], ['a']), ({1: 0}, [2], []))
+
+    def assert_choices_kept(self, choices):
+        """ Записать варианты вопроса 3, за который уже голосовали ('1' и '2'): id и голоса сохраняются"""
+        user = MyUser.objects.create_user(username='voter', password=None)
+        self.client.post('/api/v1/polls/%d/vote/' % self.poll.pk,
+                         {'user': user.pk, 'answers': make_answers(self.poll)}, format='json')
+        question = self.poll.questions.get(position=3)
+        ids = dict(question.choices.values_list('choice_text', 'id'))
+        selected = set(AnswerChoice.objects.filter(choice__question=question).values_list('choice_id', flat=True))
+        response = self.client.patch(self.url + '3/', {
+            'question_type': 'Ответ с выбором нескольких вариантов', 'choices': choices}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['choices'], choices)
+        self.assertEqual(list(question.choices.values_list('choice_text', flat=True)), choices)
+        current = dict(question.choices.values_list('choice_text', 'id'))
+        self.assertEqual({text: current[text] for text in ids}, ids)
+        self.assertEqual(set(AnswerChoice.objects.filter(choice__question=question).values_list(
+            'choice_id', flat=True)), selected)
+        results = self.client.get('/api/v1/polls/%d/results/' % self.poll.pk).json()
+        self.assertEqual({choice['choice_text']: choice['count'] for choice in results['questions'][2]['choices']},
+                         {text: int(text in ('1', '2')) for text in choices})
+        self.assertEqual(self.client.get('/api/v1/polls/%d/' % self.poll.pk).json()['questions'][2]['choices'],
+                         choices)
+
+    def test_prepend_choice_keeps_votes(self):
+        self.assert_choices_kept(['новый', '0', '1', '2', '3'])
+
+    def test_insert_choice_in_the_middle_keeps_votes(self):
+        self.assert_choices_kept(['0', '1', 'новый', '2', '3'])
+
+    def test_reorder_choices_keeps_votes(self):
+        self.assert_choices_kept(['3', '2', '1', '0'])
+
+    def test_update_keeps_selected_choices(self):
+        user = MyUser.objects.create_user(username='voter', password=None)
+        self.client.post('/api/v1/polls/%d/vote/' % self.poll.pk,
+                         {'user': user.pk, 'answers': make_answers(self.poll)}, format='json')
+        question = self.poll.questions.get(position=3)
+        ids = list(question.choices.values_list('id', flat=True))
+        response = self.client.patch(self.url + '3/', {
+            'question_type': 'Ответ с выбором нескольких вариантов', 'choices': ['0', '1', '2', '3', '4']},
+            format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(question.choices.values_list('id', flat=True))[:4], ids)
+        self.assertEqual(AnswerChoice.objects.filter(choice__question=question).count(), 2)
+        results = self.client.get('/api/v1/polls/%d/results/' % self.poll.pk).json()
+        self.assertEqual([choice['count'] for choice in results['questions'][2]['choices']], [0, 1, 1, 0, 0])
+
+    def bulk(self, questions):
+        return self.client.post(self.url + 'bulk/', {'questions': questions}, format='json')
+
+    def new_questions(self, start, count):
+        return [{'position': position, 'question_type': 'Ответ с выбором одного варианта',
+                 'main_text': 'Вопрос %d' % position, 'choices': ['да', 'нет']}
+                for position in range(start, start + count)]
+
+    def test_bulk_creates_updates_and_moves(self):
+        response = self.bulk(self.new_questions(4, 2) + [
+            {'position': 1, 'new_position': 10, 'main_text': 'Последний'},
+            {'position': 2, 'question_type': 'Ответ текстом'},
+            {'position': 3, 'choices': ['0', '1', 'два']},
+        ])
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual([question['position'] for question in response.json()], [2, 3, 4, 5, 10])
+        self.assertEqual(response.json()[-1]['main_text'], 'Последний')
+        self.assertEqual(response.json()[0], {'position': 2, 'question_type': 'Ответ текстом',
+                                              'main_text': 'Вопрос 2', 'choices': []})
+        self.assertEqual(response.json()[1]['choices'], ['0', '1', 'два'])
+        self.assertEqual(self.client.get('/api/v1/polls/%d/' % self.poll.pk).json()['questions'],
+                         response.json())
+
+    def test_bulk_query_count_does_not_depend_on_batch_size(self):
+        batch = {'start': 4, 'size': 5}
+
+        def request():
+            questions = self.new_questions(batch['start'], batch['size'])
+            batch['start'] += batch['size']
+            return self.bulk(questions)
+
+        def grow():
+            batch['size'] *= 2
+
+        self.assertQueryBudget(8, request, grow)
+
+    def test_bulk_is_validated_as_a_whole(self):
+        response = self.bulk([
+            {'position': 4, 'question_type': 'Ответ текстом', 'main_text': 'Новый'},
+            {'position': 4, 'question_type': 'Ответ текстом', 'main_text': 'Повтор'},
+            {'position': 5, 'main_text': 'Без типа'},
+            {'position': 1, 'new_position': 3},
+            {'position': 2, 'choices': ['один']},
+        ])
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()['questions']
+        self.assertEqual(errors[1]['position'], ['Duplicate position in batch'])
+        self.assertIn('question_type', errors[2])
+        self.assertEqual(errors[3]['new_position'], ['Position already exists!'])
+        self.assertIn('choices', errors[4])
+        self.assertEqual(self.poll.questions.count(), 3)
+        # Вопросы можно поменять местами в одном пакете
+        response = self.bulk([{'position': 1, 'new_position': 2}, {'position': 2, 'new_position': 1}])
+        self.assertEqual([q['main_text'] for q in response.json()], ['Вопрос 2', 'Вопрос 1', 'Вопрос 3'])
+
+    def test_reorder_shifts_positions_in_one_update(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(self.url + 'reorder/', {'start': 2, 'offset': 2}, format='json')
+        self.assertEqual(len([query for query in context.captured_queries
+                              if query['sql'].startswith('UPDATE')]), 1)
+        self.assertEqual([question['position'] for question in response.json()], [1, 4, 5])
+        response = self.client.post(self.url + 'reorder/', {'start': 4, 'end': 4, 'offset': -3}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(self.url + 'reorder/', {'start': 4, 'offset': -2}, format='json')
+        self.assertEqual([question['position'] for question in response.json()], [1, 2, 3])
+
+    def test_reorder_keeps_positions_positive(self):
+        for start, offset in ((1, -1), (2, -5), (0, -1)):
+            response = self.client.post(self.url + 'reorder/', {'start': start, 'offset': offset}, format='json')
+            self.assertEqual(response.status_code, 400, (start, offset))
+            self.assertIn('offset', response.json())
+        self.assertEqual(list(self.poll.questions.order_by('position').values_list('position', flat=True)), [1, 2, 3])
+
+
+class ImportTests(PollAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = MyUser.objects.create_user(username='voter', password=None)
+        self.poll = make_poll()
+        for _ in range(3):
+            self.client.post('/api/v1/polls/%d/vote/' % self.poll.pk,
+                             {'user': self.user.pk, 'answers': make_answers(self.poll)}, format='json')
+
+    def dump(self):
+        output = StringIO()
+        call_command('dumpdata', 'poll', format='jsonl', stdout=output)
+        return output.getvalue().splitlines(keepends=True)
+
+    def import_lines(self, lines, **options):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as file:
+            file.writelines(lines)
+        self.addCleanup(os.remove, file.name)
+        call_command('import_polls', file.name, stdout=StringIO(), **options)
+        return file.name
+
+    def results(self, poll_id):
+        data = self.client.get('/api/v1/polls/%d/results/' % poll_id).json()
+        data.pop('id')
+        return data
+
+    def test_import_remaps_ids_and_rebuilds_tallies(self):
+        self.import_lines(self.dump())
+        copy = Poll.objects.exclude(pk=self.poll.pk).get()
+        self.assertEqual(self.results(copy.pk), self.results(self.poll.pk))
+        # Пользователь с тем же username не создается заново
+        self.assertEqual(MyUser.objects.count(), 1)
+        self.assertEqual(Attempt.objects.filter(poll=copy, user=self.user, snapshot__isnull=False).count(), 3)
+
+    def test_legacy_xml_fixture(self):
+        call_command('import_polls', os.path.join(settings.BASE_DIR, 'poll_init.xml'), stdout=StringIO())
+        self.assertEqual(Poll.objects.count(), 3)
+        attempt = Attempt.objects.exclude(poll=self.poll).get()
+        self.assertEqual(str(attempt.time.date()), '2022-05-04')
+        # Ответы прежнего формата переведены в выбранные варианты
+        self.assertTrue(AnswerChoice.objects.filter(answer__attempt=attempt).exists())
+        # Снимок, построенный импортом, совпадает со снимком по объектам ответов
+        attempt = Attempt.objects.prefetch_related(*ANSWERS_PREFETCH).get(pk=attempt.pk)
+        self.assertEqual(attempt.snapshot, answers_snapshot(attempt))
+        self.assertEqual(sum(choice['count'] for question in self.results(attempt.poll_id)['questions']
+                             for choice in question['choices']), AnswerChoice.objects.filter(
+            answer__attempt=attempt).count())
+
+    def test_interrupted_import_resumes_from_checkpoint(self):
+        lines = self.dump()
+        broken = lines[:-3] + ['{"model": "poll.answer", "pk": 999, "fields": {"attempt": 999}}\n']
+        with self.assertRaises(CommandError):
+            self.import_lines(broken, batch_size=5, key='dump')
+        written = Answer.objects.count()
+        self.assertGreater(written, 9)
+        self.import_lines(lines, batch_size=5, key='dump')
+        self.assertEqual(Poll.objects.count(), 2)
+        self.assertEqual(Answer.objects.count(), 18)
+        # Завершенный импорт с тем же ключом ничего не записывает
+        self.import_lines(lines, batch_size=5, key='dump')
+        self.assertEqual(Poll.objects.count(), 2)
+
+    def test_import_endpoint(self):
+        admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+        with open(os.path.join(settings.BASE_DIR, 'poll_init.xml'), 'rb') as file:
+            body = file.read()
+        self.assertEqual(self.client.post('/api/v1/import/', body, content_type='application/xml').status_code, 401)
+        self.client.force_authenticate(admin)
+        response = self.client.post('/api/v1/import/', body, content_type='application/xml')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['counts']['poll.poll'], 2)
+        self.assertEqual(len(response.json()['polls']), 2)
+        self.assertEqual(self.client.post('/api/v1/import/', body, content_type='text/csv').status_code, 415)
+        response = self.client.post('/api/v1/import/', body[:500], content_type='application/xml')
+        self.assertEqual(response.status_code, 400)
+
+    def test_import_endpoint_rejects_xml_entities(self):
+        admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+        self.client.force_authenticate(admin)
+        body = ('<?xml version="1.0"?><!DOCTYPE d [<!ENTITY a "aaaaaaaaaa"><!ENTITY b "&a;&a;&a;&a;&a;">]>'
+                '<django-objects version="1.0"><object model="poll.poll" pk="1">'
+                '<field name="title" type="CharField">&b;</field></object></django-objects>')
+        response = self.client.post('/api/v1/import/', body, content_type='application/xml')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Invalid XML', response.json()['detail'])
+        self.assertFalse(Poll.objects.filter(title__startswith='aaa').exists())
+
+    def test_import_endpoint_strips_privileges(self):
+        admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+        self.client.force_authenticate(admin)
+        body = json.dumps({'model': 'poll.myuser', 'pk': 1, 'fields': {
+            'username': 'root', 'password': make_password('secret'), 'is_staff': True, 'is_superuser': True,
+            'groups': [1], 'user_permissions': [1]}}) + '\n'
+        response = self.client.post('/api/v1/import/', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200, response.content)
+        user = MyUser.objects.get(username='root')
+        self.assertFalse(user.is_staff or user.is_superuser)
+        self.assertFalse(user.has_usable_password())
+        self.assertFalse(user.groups.exists() or user.user_permissions.exists())
+        # Команда import_polls переносит пользователей как есть
+        self.import_lines([body.replace('"root"', '"operator"')])
+        user = MyUser.objects.get(username='operator')
+        self.assertTrue(user.is_superuser and user.check_password('secret'))
+
+    def test_answer_to_question_of_another_poll_is_rejected(self):
+        objects = [
+            ('poll.poll', 1, {'title': 'Первый', 'started_at': '2022-01-01'}),
+            ('poll.poll', 2, {'title': 'Второй', 'started_at': '2022-01-01'}),
+            ('poll.question', 1, {'poll': 2, 'position': 1, 'question_type': Question.TEXT, 'main_text': 'Вопрос'}),
+            ('poll.attempt', 1, {'poll': 1, 'user': None, 'time': '2022-01-02T00:00:00Z'}),
+            ('poll.answer', 1, {'attempt': 1, 'question': 1, 'answer': 'текст'}),
+        ]
+        body = ''.join(json.dumps({'model': model, 'pk': pk, 'fields': fields}) + '\n' for model, pk, fields in objects)
+        self.client.force_authenticate(MyUser.objects.create_user(username='admin', password=None, is_staff=True))
+        response = self.client.post('/api/v1/import/', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 400, response.content)
+        self.assertEqual(response.json()['detail'], 'poll.answer #1: question #1 is not in the poll of attempt #1')
+        self.assertFalse(Answer.objects.filter(answer='текст').exists())
+
+    def test_import_endpoint_resets_poll_lifecycle_flags(self):
+        admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+        self.client.force_authenticate(admin)
+        body = json.dumps({'model': 'poll.poll', 'pk': 1, 'fields': {
+            'title': 'Архивный', 'started_at': '2022-01-01', 'finished_at': '2022-02-01',
+            'is_archived': True, 'is_deleted': True}}) + '\n'
+        response = self.client.post('/api/v1/import/', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200, response.content)
+        poll = Poll.objects.get(title='Архивный')
+        self.assertFalse(poll.is_archived or poll.is_deleted)
+        self.assertEqual(self.client.get('/api/v1/polls/%d/results/' % poll.pk).status_code, 200)
+
+
+@override_settings(POLL_RESPONSE_CACHE={'ENABLED': 0}, POLL_DB_ROUTING={'REPLICAS': ['replica'], 'PIN_SECONDS': 60})
+class ReplicaRoutingTests(APITransactionTestCase):
+    """ Реплика - отдельный файл SQLite, в который replicate() копирует основную БД. Псевдоним добавляется
+    только на время тестов класса: тестовый раннер не создает для него тестовую БД"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with tempfile.NamedTemporaryFile(suffix='.sqlite3', delete=False) as file:
+            cls.replica_path = file.name
+        settings.DATABASES['replica'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': cls.replica_path}
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections['replica']
+        del settings.DATABASES['replica']
+        os.remove(cls.replica_path)
+        super().tearDownClass()
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        schema_cache.clear()
+        self.user = MyUser.objects.create_user(username='voter', password=None)
+        self.poll = make_poll(title='Реплицирован')
+        self.replicate()
+        Poll.objects.create(title='Только в основной БД')
+
+    @staticmethod
+    def replicate():
+        for alias in ('default', 'replica'):
+            connections[alias].ensure_connection()
+        connections['default'].connection.backup(connections['replica'].connection)
+
+    def titles(self):
+        return [poll['title'] for poll in self.client.get('/api/v1/polls/').json()['results']]
+
+    def test_reads_go_to_replica_until_client_writes(self):
+        self.assertEqual(self.titles(), ['Реплицирован'])
+        response = self.client.post('/api/v1/polls/%d/vote/' % self.poll.pk,
+                                    {'user': self.user.pk, 'answers': make_answers(self.poll)}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        # Проголосовавший клиент читает из основной БД: видит и свой голос, и новый опрос
+        self.assertEqual(len(self.titles()), 2)
+        response = self.client.post('/api/v1/results/', {'user': self.user.pk}, format='json')
+        self.assertEqual(len(response.json()['results']), 1)
+        caches['default'].clear()
+        self.assertEqual(self.titles(), ['Реплицирован'])
+        # История только читает: запрос не закрепляет клиента за основной БД
+        response = self.client.post('/api/v1/results/', {'user': self.user.pk}, format='json')
+        self.assertEqual(response.json()['results'], [])
+        self.assertEqual(self.titles(), ['Реплицирован'])
+
+    def test_anonymous_voter_pins_only_itself(self):
+        response = self.client.post('/api/v1/polls/%d/vote/' % self.poll.pk,
+                                    {'answers': make_answers(self.poll)}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        # Голосовавший с выданным токеном читает из основной БД, другой анонимный клиент с того же адреса - из реплики
+        self.assertEqual(len(self.titles()), 2)
+        self.client.cookies.clear()
+        self.assertEqual(self.titles(), ['Реплицирован'])
+        self.client.credentials(HTTP_X_VOTER_TOKEN=response['X-Voter-Token'])
+        self.assertEqual(len(self.titles()), 2)
+
+    @override_settings(POLL_DB_ROUTING={'REPLICAS': ['replica'], 'PIN_SECONDS': 60, 'TRUSTED_PROXIES': ['10.0.0.0/8']})
+    def test_forwarded_address_only_from_trusted_proxy(self):
+        def vote(**extra):
+            response = self.client.post('/api/v1/polls/%d/vote/' % self.poll.pk,
+                                        {'user': self.user.pk, 'answers': make_answers(self.poll)},
+                                        format='json', **extra)
+            self.assertEqual(response.status_code, 200, response.content)
+
+        def titles(**extra):
+            return len(self.client.get('/api/v1/polls/', **extra).json()['results'])
+
+        vote(REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='203.0.113.5')
+        self.assertEqual(titles(REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='203.0.113.5'), 2)
+        self.assertEqual(titles(REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='203.0.113.6'), 1)
+        # Адрес, подставленный клиентом левее, и X-Forwarded-For не от доверенного прокси не учитываются
+        self.assertEqual(titles(REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='203.0.113.5, 203.0.113.6'), 1)
+        self.assertEqual(titles(REMOTE_ADDR='198.51.100.1', HTTP_X_FORWARDED_FOR='203.0.113.5'), 1)
+
+    def test_write_pins_rest_of_request(self):
+        state = RoutingState()
+        state.replica = True
+        token = routing_state.set(state)
+        try:
+            self.assertEqual(router.db_for_read(Poll), 'replica')
+            # Пользователи и токены всегда читаются из основной БД
+            self.assertEqual(router.db_for_read(MyUser), 'default')
+            poll = Poll.objects.using('replica').get(pk=self.poll.pk)
+            poll.title = 'Изменен'
+            poll.save()
+            self.assertEqual(router.db_for_read(Poll), 'default')
+        finally:
+            routing_state.reset(token)
+        self.assertEqual(Poll.objects.get(pk=self.poll.pk).title, 'Изменен')
+        self.assertEqual(Poll.objects.using('replica').get(pk=self.poll.pk).title, 'Реплицирован')
+
+    @override_settings(POLL_RESPONSE_CACHE={'ENABLED': 1})
+    def test_cached_responses_are_built_from_primary(self):
+        self.assertEqual(len(self.titles()), 2)
+        self.assertEqual(len(self.titles()), 2)
+
+
+class ConnectionSetupTests(APITestCase):
+    PRAGMAS = {'journal_mode': 'wal', 'busy_timeout': 1234, 'synchronous': 'normal', 'mmap_size': None}
+
+    @override_settings(POLL_DB_CONNECTIONS={'SQLITE_PRAGMAS': PRAGMAS})
+    def test_new_sqlite_connection_gets_pragmas(self):
+        self.assertEqual(sqlite_pragmas(in_memory=True), ['PRAGMA busy_timeout = 1234', 'PRAGMA synchronous = normal'])
+        with tempfile.TemporaryDirectory() as directory:
+            default = connections['default']
+            wrapper = type(default)(dict(default.settings_dict, NAME=os.path.join(directory, 'db.sqlite3')),
+                                    alias='pragmas')
+            try:
+                with wrapper.cursor() as cursor:
+                    values = [cursor.execute('PRAGMA %s' % name).fetchone()[0]
+                              for name in ('journal_mode', 'busy_timeout', 'synchronous')]
+            finally:
+                wrapper.close()
+        # synchronous = NORMAL - 1
+        self.assertEqual(values, ['wal', 1234, 1])
+
+    @override_settings(POLL_DB_CONNECTIONS={'SQLITE_PRAGMAS': {'journal_mode': 'wal; DROP TABLE poll_poll'}})
+    def test_invalid_pragma_value(self):
+        with self.assertRaises(ImproperlyConfigured):
+            sqlite_pragmas()
+
+    def test_broken_persistent_connection_is_closed_before_request(self):
+        broken, alive = [mock.Mock(connection=object(), in_atomic_block=False, settings_dict={'CONN_MAX_AGE': 60})
+                         for _ in range(2)]
+        broken.is_usable.return_value, alive.is_usable.return_value = False, True
+        with mock.patch('poll.db_connections.connections') as connections_mock:
+            connections_mock.all.return_value = [broken, alive]
+            check_connections()
+        broken.close.assert_called_once_with()
+        alive.close.assert_not_called()
+
+
+class JobTests(PollAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+        self.client.force_authenticate(self.admin)
+        self.poll = make_poll()
+        for _ in range(5):
+            self.client.post('/api/v1/polls/%d/vote/' % self.poll.pk,
+                             {'user': self.admin.pk, 'answers': make_answers(self.poll)}, format='json')
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.settings = override_settings(POLL_JOBS=dict(settings.POLL_JOBS, DIR=directory.name, CHUNK_SIZE=2,
+                                                         BACKOFF=10))
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+    def test_destroy_deletes_poll_in_background(self):
+        other = make_poll(title='Другой')
+        self.client.post('/api/v1/polls/%d/vote/' % other.pk,
+                         {'user': self.admin.pk, 'answers': make_answers(other)}, format='json')
+        self.client.get('/api/v1/polls/')
+        response = self.client.delete('/api/v1/polls/%d/' % self.poll.pk)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual((response.data['kind'], response.data['status']), ('delete_poll', Job.PENDING))
+        # Опрос скрыт сразу, данные еще на месте
+        self.assertEqual(self.client.get('/api/v1/polls/%d/' % self.poll.pk).status_code, 404)
+        self.assertEqual([poll['id'] for poll in self.client.get('/api/v1/polls/').data['results']], [other.pk])
+        self.assertEqual(len(self.client.post('/api/v1/results/', {'user': self.admin.pk}).data['results']), 1)
+        self.assertEqual(Attempt.objects.filter(poll=self.poll).count(), 5)
+
+        call_command('runjobs', '--processes', '1', '--once')
+        job = Job.objects.get(pk=response.data['id'])
+        self.assertEqual((job.status, job.progress, job.total), (Job.DONE, 5, 5))
+        self.assertEqual(job.result, {'poll_id': self.poll.pk, 'attempts': 5})
+        self.assertFalse(Poll.objects.filter(pk=self.poll.pk).exists())
+        self.assertFalse(Question.objects.filter(poll=self.poll).exists())
+        self.assertFalse(Choice.objects.filter(question__poll=self.poll).exists())
+        self.assertFalse(ChoiceTally.objects.filter(question__poll=self.poll).exists())
+        self.assertEqual(Attempt.objects.count(), 1)
+        self.assertEqual(Answer.objects.count(), 3)
+        self.assertEqual(AnswerChoice.objects.count(), 3)
+
+    def test_submit_export_and_download(self):
+        response = self.client.post('/api/v1/jobs/', {'kind': 'export_poll', 'params': {'poll_id': self.poll.pk}},
+                                    format='json')
+        self.assertEqual(response.status_code, 202, response.data)
+        url = '/api/v1/jobs/%d/' % response.data['id']
+        self.assertEqual(self.client.get(url + 'download/').status_code, 404)
+        call_command('runjobs', '--processes', '1', '--once')
+        response = self.client.get(url)
+        self.assertEqual((response.data['status'], response.data['progress'], response.data['total']),
+                         (Job.DONE, 5, 5))
+        response = self.client.get(url + 'download/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('poll-%d.csv' % self.poll.pk, response['Content-Disposition'])
+        exported = self.client.get('/api/v1/polls/%d/export/' % self.poll.pk, {'format': 'csv'})
+        self.assertEqual(b''.join(response.streaming_content), b''.join(exported.streaming_content))
+
+    def test_submit_validation(self):
+        for data in ({'kind': 'delete_poll', 'params': {'poll_id': self.poll.pk}},
+                     {'kind': 'rebuild_tallies', 'params': {'poll_id': 0}},
+                     {'kind': 'export_poll', 'params': {'poll_id': self.poll.pk, 'format': 'xml'}}):
+            self.assertEqual(self.client.post('/api/v1/jobs/', data, format='json').status_code, 400, data)
+        self.client.force_authenticate(None)
+        response = self.client.post('/api/v1/jobs/', {'kind': 'rebuild_tallies', 'params': {'poll_id': self.poll.pk}},
+                                    format='json')
+        self.assertIn(response.status_code, (401, 403))
+
+    def test_retry_with_backoff(self):
+        calls = []
+
+        def flaky(job, fail):
+            calls.append(job.attempts)
+            if fail == 'permanent':
+                raise JobError('Poll not found')
+            raise RuntimeError('boom')
+
+        with mock.patch.dict(JOBS, flaky=flaky), self.assertLogs('poll.jobs', 'ERROR'):
+            job = submit('flaky', {'fail': 'transient'})
+            for attempt, delay in ((1, 10), (2, 20)):
+                run(claim('test'))
+                job.refresh_from_db()
+                self.assertEqual((job.status, job.attempts, job.error), (Job.PENDING, attempt, 'RuntimeError: boom'))
+                self.assertAlmostEqual((job.run_at - timezone.now()).total_seconds(), delay, delta=2)
+                # Следующая попытка - не раньше run_at
+                self.assertIsNone(claim('test'))
+                Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+            run(claim('test'))
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), (Job.FAILED, 3))
+            self.assertEqual(calls, [1, 2, 3])
+
+            job = submit('flaky', {'fail': 'permanent'})
+            run(claim('test'))
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), (Job.FAILED, 1))
+
+    def test_stale_job_is_reclaimed(self):
+        job = submit('rebuild_tallies', {'poll_id': self.poll.pk})
+        self.assertEqual(claim('crashed').pk, job.pk)
+        self.assertIsNone(claim('other'))
+        Job.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(hours=1))
+        job = claim('other')
+        self.assertEqual((job.worker, job.attempts), ('other', 2))
+        run(job)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.result), (Job.DONE, {'poll_id': self.poll.pk, 'attempts': 5}))
+
+
+class AnalyticsTests(PollAPITestCase):
+    """ С NumPy, если он установлен (ArrayColumns)"""
+    numpy = analytics.numpy
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(analytics, 'numpy', self.numpy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+        self.client.force_authenticate(self.admin)
+        self.poll = make_poll()
+        self.url = '/api/v1/polls/%d/analytics/' % self.poll.pk
+        for single, multi in ((['0'], ['1', '2']), (['0'], ['1']), (['1'], ['2', '3']), (['3'], ['0'])):
+            self.vote(single, multi)
+
+    def vote(self, single, multi):
+        answers = [{'position': 1, 'answer': ['текст']}, {'position': 2, 'answer': single},
+                   {'position': 3, 'answer': multi}]
+        response = self.client.post('/api/v1/polls/%d/vote/' % self.poll.pk,
+                                    {'user': self.admin.pk, 'answers': answers}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+
+    def test_distributions_crosstab_and_timeline(self):
+        data = self.client.get(self.url, {'crosstab': ['2,3', '3,3'], 'bucket': 'hour'}).data
+        self.assertEqual((data['attempts'], data['last_attempt']), (4, Attempt.objects.latest('id').pk))
+        self.assertEqual([question['position'] for question in data['questions']], [2, 3])
+        single, multi = data['questions']
+        self.assertEqual([choice['count'] for choice in single['choices']], [2, 1, 0, 1])
+        self.assertEqual(single['choices'][0]['percent'], 50.0)
+        self.assertEqual((single['answered'], multi['answered']), (4, 4))
+        self.assertEqual([choice['count'] for choice in multi['choices']], [1, 2, 2, 1])
+        # Из выбравших "0" во втором вопросе в третьем выбрали "1" оба, "2" - один
+        self.assertEqual(data['crosstabs'][0]['counts'], [[0, 2, 1, 0], [0, 0, 1, 1], [0, 0, 0, 0], [1, 0, 0, 0]])
+        self.assertEqual(data['crosstabs'][0]['row_choices'], ['0', '1', '2', '3'])
+        self.assertEqual(data['crosstabs'][1]['counts'], [[1, 0, 0, 0], [0, 2, 1, 0], [0, 1, 2, 1], [0, 0, 1, 1]])
+        self.assertEqual(data['timeline'][-1]['total'], 4)
+        self.assertEqual(sum(point['count'] for point in data['timeline']), 4)
+
+    def test_new_attempts_are_loaded_incrementally(self):
+        self.client.get(self.url)
+        # Без новых попыток - из кэша: только запросы пометки архива (см. lifecycle.py), id последней попытки
+        # и счетчика попыток
+        with self.assertNumQueries(3):
+            self.assertEqual(self.client.get(self.url).data['attempts'], 4)
+        last_id = Attempt.objects.latest('id').pk
+        self.vote(['2'], ['3'])
+        with CaptureQueriesContext(connection) as queries:
+            data = self.client.get(self.url).data
+        self.assertEqual(data['attempts'], 5)
+        self.assertEqual([choice['count'] for choice in data['questions'][0]['choices']], [2, 1, 1, 1])
+        # Загружается только новая попытка
+        self.assertTrue(any('"poll_attempt"."id" > %d' % last_id in query['sql'] for query in queries))
+        # Удаленная попытка: после пересчета итогов столбцы загружаются заново
+        Attempt.objects.filter(pk=Attempt.objects.order_by('id')[0].pk).delete()
+        call_command('recompute_tallies', self.poll.pk, stdout=StringIO())
+        data = self.client.get(self.url).data
+        self.assertEqual(data['attempts'], 4)
+        self.assertEqual([choice['count'] for choice in data['questions'][0]['choices']], [1, 1, 1, 1])
+
+    def test_params_and_permissions(self):
+        self.assertEqual(self.client.get(self.url, {'crosstab': '1,2'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'crosstab': '2'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'bucket': 'year'}).status_code, 400)
+        self.client.force_authenticate(None)
+        self.assertIn(self.client.get(self.url).status_code, (401, 403))
+
+    def test_columns_class(self):
+        self.client.get(self.url)
+        columns = analytics_engine.columns.get(self.poll.pk)
+        self.assertIsInstance(columns, analytics.ArrayColumns if self.numpy is not None else analytics.ListColumns)
+
+
+class ListAnalyticsTests(AnalyticsTests):
+    """ Без NumPy (ListColumns)"""
+    numpy = None
+
+
+class AnswerSearchTests(PollAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+        self.client.force_authenticate(self.admin)
+        self.poll = make_poll()
+        self.url = '/api/v1/polls/%d/questions/1/answers/search/' % self.poll.pk
+        for text in ('Кот спит на окне', 'Собака и кот', 'кот, кот и еще кот', 'Совсем другой ответ'):
+            self.vote(text)
+
+    def vote(self, text, poll=None):
+        poll = poll or self.poll
+        answers = [{'position': 1, 'answer': [text]}, {'position': 2, 'answer': ['0']},
+                   {'position': 3, 'answer': ['1']}]
+        response = self.client.post('/api/v1/polls/%d/vote/' % poll.pk,
+                                    {'user': self.admin.pk, 'answers': answers}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+
+    def search(self, query, **params):
+        response = self.client.get(self.url, {'q': query, **params})
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def test_ranked_prefix_search(self):
+        data = self.search('КОТ')
+        self.assertEqual(data['count'], 3)
+        # Ответ, где слово встречается чаще, релевантнее
+        self.assertEqual([hit['answer'] for hit in data['results']][0], ['кот, кот и еще кот'])
+        self.assertEqual(data['results'][0]['user'], self.admin.pk)
+        attempt = Attempt.objects.get(pk=data['results'][0]['attempt'])
+        self.assertEqual(parse_datetime(data['results'][0]['time']), attempt.time)
+        self.assertGreaterEqual(data['results'][0]['rank'], data['results'][1]['rank'])
+        self.assertEqual(self.search('соба')['results'][0]['answer'], ['Собака и кот'])
+        # Найденный ответ содержит все слова запроса
+        self.assertEqual([hit['answer'] for hit in self.search('кот окн')['results']], [['Кот спит на окне']])
+        self.assertEqual(self.search('попугай')['count'], 0)
+
+    def test_pages(self):
+        first = self.search('кот', page_size=2)
+        self.assertEqual(len(first['results']), 2)
+        second = self.client.get(first['next']).data
+        self.assertIsNone(second['next'])
+        ids = [hit['id'] for hit in first['results'] + second['results']]
+        self.assertEqual(len(set(ids)), 3)
+
+    def test_index_follows_votes_and_deletes(self):
+        other = make_poll()
+        self.vote('кот из другого опроса', other)
+        self.assertEqual(self.search('кот')['count'], 3)
+        Answer.objects.filter(answer__contains='окне').update(answer="['Пес спит на окне']")
+        self.assertEqual(self.search('пес')['count'], 1)
+        Attempt.objects.filter(answers__answer__contains='Собака').delete()
+        self.assertEqual(self.search('кот')['count'], 1)
+        call_command('rebuild_search_index', '--check', stdout=StringIO())
+
+    def test_rebuild_command(self):
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO poll_answer_fts(poll_answer_fts) VALUES ('delete-all')")
+            cursor.execute('DROP TRIGGER poll_answer_fts_insert')
+        self.assertEqual(self.search('кот')['count'], 0)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_search_index', '--check', stdout=StringIO())
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(self.search('кот')['count'], 3)
+        self.vote('Еще один кот')
+        self.assertEqual(self.search('кот')['count'], 4)
+
+    def test_like_search_without_index(self):
+        question = self.poll.questions.get(position=1)
+        results = SearchResults(question.id, ['спит', 'окне'], search=LikeSearch('default'))
+        self.assertEqual(results.count(), 1)
+        self.assertEqual([hit.answer for hit in results[0:10]], [['Кот спит на окне']])
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.client.get(self.url, {'q': '!!!'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url).status_code, 400)
+        url = '/api/v1/polls/%d/questions/%%d/answers/search/' % self.poll.pk
+        self.assertEqual(self.client.get(url % 2, {'q': 'кот'}).status_code, 400)
+        self.assertEqual(self.client.get(url % 9, {'q': 'кот'}).status_code, 404)
+        self.client.force_authenticate(None)
+        self.assertIn(self.client.get(self.url, {'q': 'кот'}).status_code, (401, 403))
+
+
+class LifecycleTests(PollAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+        self.client.force_authenticate(self.admin)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.settings = override_settings(POLL_LIFECYCLE=dict(settings.POLL_LIFECYCLE, DIR=directory.name,
+                                                              CHUNK_SIZE=2, REQUIRE_PERSISTENT=False))
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+        self.poll = make_poll()
+        self.active = make_poll(title='Активный')
+        for n, (single, multi) in enumerate(((['0'], ['1', '2']), (['1'], ['2']), (['0'], ['3']))):
+            self.vote(self.poll, ['ответ кот %d' % n], single, multi)
+        self.vote(self.active, ['кот'], ['1'], ['1'])
+        self.poll.finished_at = date.today()
+        self.poll.save()
+        self.url = '/api/v1/polls/%d/' % self.poll.pk
+
+    def vote(self, poll, text, single, multi):
+        answers = [{'position': 1, 'answer': text}, {'position': 2, 'answer': single},
+                   {'position': 3, 'answer': multi}]
+        response = self.client.post('/api/v1/polls/%d/vote/' % poll.pk, {'user': self.admin.pk, 'answers': answers},
+                                    format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+
+    def read(self):
+        return (self.client.get(self.url + 'results/').data,
+                self.client.get(self.url + 'analytics/', {'crosstab': ['2,3', '3,2'], 'bucket': 'week'}).data,
+                self.client.post('/api/v1/results/', {'user': self.admin.pk}).data['results'])
+
+    def archive(self):
+        call_command('runjobs', '--processes', '1', '--once')
+        self.assertTrue(Poll.objects.get(pk=self.poll.pk).is_archived)
+
+    def test_closed_poll_is_archived_and_served_from_summary(self):
+        before = self.read()
+        # Снимки попыток без них записываются при архивации
+        Attempt.objects.filter(poll=self.poll, pk__gt=Attempt.objects.filter(poll=self.poll).first().pk).update(
+            snapshot=None)
+        self.archive()
+        self.assertEqual(Answer.objects.filter(attempt__poll=self.poll).count(), 0)
+        self.assertEqual(AnswerChoice.objects.filter(answer__attempt__poll=self.poll).count(), 0)
+        self.assertEqual(Attempt.objects.filter(poll=self.poll).count(), 3)
+        self.assertEqual(Answer.objects.filter(attempt__poll=self.active).count(), 3)
+        archive = PollArchive.objects.get(poll=self.poll)
+        self.assertEqual((archive.answers, archive.rehydrated_at), (9, None))
+        self.assertTrue(os.path.exists(archive.path))
+        # Итоги, аналитика и история - те же, без обращения к ответам
+        self.assertEqual(self.read(), before)
+        self.assertEqual(self.client.get(self.url + 'export/', {'format': 'csv'}).status_code, 409)
+        self.assertEqual(self.client.get(self.url + 'questions/1/answers/search/', {'q': 'кот'}).status_code, 409)
+        response = self.client.patch(self.url, {'finished_at': None}, format='json')
+        self.assertEqual(response.status_code, 400)
+        # Повторный поиск закрытых опросов не архивирует опрос снова
+        Job.objects.filter(kind='close_polls').update(created_at=timezone.now() - timedelta(days=1))
+        call_command('runjobs', '--processes', '1', '--once')
+        self.assertEqual(Job.objects.filter(kind='archive_poll').count(), 1)
+
+    def test_rehydrate_restores_answers(self):
+        export = b''.join(self.client.get(self.url + 'export/', {'format': 'csv'}).streaming_content)
+        self.archive()
+        response = self.client.post('/api/v1/jobs/', {'kind': 'rehydrate_poll', 'params': {'poll_id': self.poll.pk}},
+                                    format='json')
+        self.assertEqual(response.status_code, 202, response.data)
+        call_command('runjobs', '--processes', '1', '--once')
+        job = Job.objects.get(pk=response.data['id'])
+        self.assertEqual((job.status, job.result), (Job.DONE, {'poll_id': self.poll.pk, 'answers': 9}))
+        self.assertFalse(Poll.objects.get(pk=self.poll.pk).is_archived)
+        self.assertIsNotNone(PollArchive.objects.get(poll=self.poll).rehydrated_at)
+        response = self.client.get(self.url + 'export/', {'format': 'csv'})
+        self.assertEqual(b''.join(response.streaming_content), export)
+        search = self.client.get(self.url + 'questions/1/answers/search/', {'q': 'кот'}).data
+        self.assertEqual(search['count'], 3)
+        # Возвращенный опрос не архивируется снова до KEEP_REHYDRATED_DAYS
+        Job.objects.filter(kind='close_polls').update(created_at=timezone.now() - timedelta(days=1))
+        call_command('runjobs', '--processes', '1', '--once')
+        self.assertEqual(Job.objects.filter(kind='archive_poll').count(), 1)
+
+    def test_archive_guards(self):
+        job = submit('archive_poll', {'poll_id': self.active.pk})
+        run(claim('test'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), (Job.FAILED, 'JobError: Poll is still active'))
+        self.archive()
+        for kind in ('rebuild_tallies', 'export_poll'):
+            job = submit(kind, {'poll_id': self.poll.pk})
+            run(claim('test'))
+            job.refresh_from_db()
+            self.assertEqual(job.status, Job.FAILED, kind)
+        self.assertEqual(ChoiceTally.objects.filter(question__poll=self.poll, count__gt=0).count(), 5)
+
+    def test_archive_requires_persistent_storage(self):
+        mounts = tempfile.NamedTemporaryFile('w', suffix='.mounts')
+        self.addCleanup(mounts.close)
+        mounts.write('overlay / overlay rw,relatime 0 0\n')
+        mounts.flush()
+        with mock.patch('poll.lifecycle.MOUNTS', mounts.name), \
+                override_settings(POLL_LIFECYCLE=dict(settings.POLL_LIFECYCLE, REQUIRE_PERSISTENT=True)):
+            job = submit('archive_poll', {'poll_id': self.poll.pk})
+            run(claim('test'))
+            job.refresh_from_db()
+            self.assertEqual(job.status, Job.FAILED)
+            self.assertIn('persistent volume', job.error)
+            self.assertFalse(Poll.objects.get(pk=self.poll.pk).is_archived)
+            self.assertEqual(Answer.objects.filter(attempt__poll=self.poll).count(), 9)
+            # Каталог архива на томе
+            mounts.write('/dev/vdb %s ext4 rw,relatime 0 0\n' % self.directory.replace(' ', '\\040'))
+            mounts.flush()
+            self.archive()
+
+    def test_archived_flag_is_read_from_database(self):
+        export_url, search_url = self.url + 'export/', self.url + 'questions/1/answers/search/'
+        self.assertEqual(self.client.get(export_url, {'format': 'csv'}).status_code, 200)
+        self.assertEqual(self.client.get(search_url, {'q': 'кот'}).status_code, 200)
+        # Процесс задач без общего с сервисом кэша: сброс схемы не доходит до кэша сервиса
+        worker = override_settings(
+            CACHES=dict(settings.CACHES, worker={'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                                 'LOCATION': 'worker'}),
+            POLL_SCHEMA_CACHE=dict(settings.POLL_SCHEMA_CACHE, ALIAS='worker'),
+            POLL_RESPONSE_CACHE=dict(settings.POLL_RESPONSE_CACHE, ALIAS='worker'))
+        with worker:
+            self.archive()
+        self.assertFalse(schema_cache.get(self.poll.pk).archived)
+        self.assertEqual(self.client.get(export_url, {'format': 'csv'}).status_code, 409)
+        self.assertEqual(self.client.get(search_url, {'q': 'кот'}).status_code, 409)
+        with worker:
+            submit('rehydrate_poll', {'poll_id': self.poll.pk})
+            run(claim('test'))
+        self.assertEqual(self.client.get(export_url, {'format': 'csv'}).status_code, 200)
+        self.assertEqual(self.client.get(search_url, {'q': 'кот'}).status_code, 200)
+
+
+class OneVoteTests(PollAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = MyUser.objects.create_user(username='voter', password=None)
+        self.poll = make_poll(one_vote=True)
+        self.url = '/api/v1/polls/%d/vote/' % self.poll.pk
+
+    def vote(self, poll=None, user=None, data=None, **extra):
+        """ Голос авторизованного пользователя user (без user - неавторизованный запрос)"""
+        poll = poll or self.poll
+        self.client.force_authenticate(user)
+        return self.client.post('/api/v1/polls/%d/vote/' % poll.pk, dict(data or {}, answers=make_answers(poll)),
+                                format='json', **extra)
+
+    def test_second_vote_is_rejected(self):
+        self.assertEqual(self.vote(user=self.user).status_code, 200)
+        response = self.vote(user=self.user)
+        self.assertEqual((response.status_code, response.data['detail'].code), (409, 'already_voted'))
+        other = MyUser.objects.create_user(username='other', password=None)
+        self.assertEqual(self.vote(user=other).status_code, 200)
+        self.assertEqual(Attempt.objects.filter(poll=self.poll).count(), 2)
+        self.assertEqual(PollTally.objects.get(poll=self.poll).attempts, 2)
+        # Без ограничения голосовать можно несколько раз
+        poll = make_poll()
+        self.assertEqual([self.vote(poll, self.user).status_code for _ in range(2)], [200, 200])
+
+    def test_unconfirmed_voters_are_rejected(self):
+        # Анонимный голос: без токена каждый запрос был бы новым участником
+        response = self.vote()
+        self.assertEqual((response.status_code, response.data['detail'].code), (401, 'not_authenticated'))
+        self.assertFalse(response.has_header('X-Voter-Token'))
+        token = self.vote(make_poll())['X-Voter-Token']
+        self.assertEqual(self.vote(HTTP_X_VOTER_TOKEN=token).status_code, 401)
+        # Пользователь из тела запроса без авторизации: можно голосовать за любого
+        self.assertEqual(self.vote(data={'user': self.user.pk}).status_code, 401)
+        self.assertFalse(Attempt.objects.filter(poll=self.poll).exists())
+        # Авторизованный пользователь голосует от своего имени, а не от имени пользователя из тела запроса
+        other = MyUser.objects.create_user(username='other', password=None)
+        response = self.vote(user=self.user, data={'user': other.pk})
+        self.assertEqual((response.status_code, response.data['user']), (200, self.user.pk))
+        self.assertEqual(self.vote(user=self.user, data={'user': other.pk}).status_code, 409)
+        self.assertEqual(self.vote(user=other).status_code, 200)
+
+    def test_filter_skips_database_for_new_voters(self):
+        users = [MyUser.objects.create_user(username='user%d' % n, password=None) for n in range(5)]
+        self.vote(user=users[0])
+        voter_filters.stats.clear()
+        for user in users[1:4]:
+            # Участники добавляются в фильтр после фиксации транзакции голоса
+            with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(self.vote(user=user).status_code, 200)
+            # Из таблицы участников ничего не читается, только запись нового участника
+            self.assertEqual([query['sql'].split()[0] for query in queries.captured_queries
+                              if 'poll_pollvoter' in query['sql']], ['INSERT'])
+        self.assertEqual((voter_filters.stats['skipped'], voter_filters.stats['checked']), (3, 0))
+        self.assertEqual(self.vote(user=users[1]).status_code, 409)
+        self.assertEqual(voter_filters.stats['checked'], 1)
+        # Голос, записанный другим процессом после построения фильтра, отклоняет уникальный индекс
+        PollVoter.objects.create(poll=self.poll, user=users[4])
+        self.assertEqual(self.vote(user=users[4]).status_code, 409)
+        self.assertEqual(Attempt.objects.filter(poll=self.poll).count(), 4)
+
+    def test_toggling_limit_records_existing_voters(self):
+        admin = MyUser.objects.create_user(username='admin', password=None, is_staff=True)
+        poll = make_poll()
+        for _ in range(2):
+            self.vote(poll, self.user)
+        self.vote(poll)
+        self.client.force_authenticate(admin)
+        url = '/api/v1/polls/%d/' % poll.pk
+        self.assertTrue(self.client.patch(url, {'one_vote': True}, format='json').data['one_vote'])
+        self.assertEqual(PollVoter.objects.filter(poll=poll).count(), 2)
+        self.assertEqual(self.vote(poll, self.user).status_code, 409)
+        self.client.force_authenticate(admin)
+        self.client.patch(url, {'one_vote': False}, format='json')
+        self.assertFalse(PollVoter.objects.filter(poll=poll).exists())
+        self.assertEqual(self.vote(poll, self.user).status_code, 200)
+
+    def test_buffered_duplicates_are_not_written(self):
+        with override_settings(POLL_VOTE_BUFFER=dict(settings.POLL_VOTE_BUFFER, ENABLED=1, THREAD=False)):
+            self.assertEqual([self.vote(user=self.user).status_code for _ in range(2)], [202, 202])
+            vote_buffer.flush()
+        self.assertEqual(Attempt.objects.filter(poll=self.poll).count(), 1)
+        self.assertEqual(vote_buffer.stats['already_voted'], 1)
+        self.assertEqual(self.vote(user=self.user).status_code, 409)
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 0.01)
+        for n in range(1000):
+            bloom.add('u%d' % n)
+        self.assertTrue(all('u%d' % n in bloom for n in range(1000)))
+        false_positives = sum('v%d' % n in bloom for n in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class IdempotencyTests(PollAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = MyUser.objects.create_user(username='voter', password=None)
+        self.poll = make_poll()
+        self.url = '/api/v1/polls/%d/vote/' % self.poll.pk
+
+    def vote(self, key, user=None, answers=None, **extra):
+        return self.client.post(self.url, {'user': user, 'answers': answers or make_answers(self.poll)},
+                                format='json', HTTP_IDEMPOTENCY_KEY=key, **extra)
+
+    def test_replay_returns_original_response(self):
+        first = self.vote('key-1', self.user.pk)
+        second = self.vote('key-1', self.user.pk)
+        self.assertEqual((second.status_code, second.data), (200, first.data))
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertFalse(first.has_header('Idempotent-Replayed'))
+        self.assertEqual(Attempt.objects.count(), 1)
+        self.assertEqual(self.vote('key-2', self.user.pk).status_code, 200)
+        self.assertEqual(Attempt.objects.count(), 2)
+        # Анонимный участник получает при повторе тот же токен
+        self.client.cookies.clear()
+        first = self.vote('key-3')
+        self.client.cookies.clear()
+        second = self.vote('key-3')
+        self.assertEqual(second['X-Voter-Token'], first['X-Voter-Token'])
+        self.assertEqual(second.cookies['poll_voter'].value, first['X-Voter-Token'])
+        self.assertEqual(Attempt.objects.count(), 3)
+
+    def test_key_reused_with_other_request(self):
+        self.vote('key', self.user.pk)
+        response = self.vote('key', self.user.pk, answers=make_answers(self.poll)[::-1])
+        self.assertEqual((response.status_code, response.data['detail'].code), (422, 'idempotency_key_reused'))
+        self.assertEqual(self.vote('x' * 256, self.user.pk).status_code, 400)
+
+    def test_key_is_scoped_to_authenticated_user(self):
+        other = MyUser.objects.create_user(username='other', password=None)
+        responses = []
+        for user in (self.user, other):
+            self.client.force_authenticate(user)
+            responses.append(self.vote('key'))
+        self.assertEqual([response.data['user'] for response in responses], [self.user.pk, other.pk])
+        self.assertFalse(responses[1].has_header('Idempotent-Replayed'))
+        self.assertEqual(Attempt.objects.count(), 2)
+
+    def test_failed_request_releases_key(self):
+        self.assertEqual(self.vote('key', self.user.pk, answers=[{'position': 1, 'answer': ['?']}]).status_code, 400)
+        self.assertEqual(self.vote('key', self.user.pk).status_code, 200)
+
+    def test_concurrent_replay_is_rejected(self):
+        save = VoteSerializer.save
+        nested = []
+
+        def save_with_retry(serializer, **kwargs):
+            nested.append(self.vote('key', self.user.pk))
+            return save(serializer, **kwargs)
+
+        with mock.patch.object(VoteSerializer, 'save', save_with_retry):
+            self.assertEqual(self.vote('key', self.user.pk).status_code, 200)
+        self.assertEqual((nested[0].status_code, nested[0].data['detail'].code), (409, 'idempotency_key_in_progress'))
+        self.assertEqual(Attempt.objects.count(), 1)
+
+
+class AsyncURLConf:
+    urlpatterns = [path('api/v1/', include(async_routes(poll_urls.urlpatterns, poll_urls.ASYNC_ROUTES)))]
+
+
+@override_settings(ROOT_URLCONF=AsyncURLConf, POLL_RESPONSE_CACHE={'ENABLED': 0})
+class AsyncViewTests(TransactionTestCase):
+    """ Асинхронные представления через ASGI-обработчик (AsyncClient); данные фиксируются в БД,
+    потому что представления читают ее из потоков пула"""
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        schema_cache.clear()
+        metrics_registry.clear()
+        self.user = MyUser.objects.create_user(username='voter', password=None)
+        self.poll = make_poll()
+
+    def test_request_connections_are_closed(self):
+        idle, in_transaction = mock.Mock(in_atomic_block=False), mock.Mock(in_atomic_block=True)
+        with mock.patch('poll.aio.connections.all', return_value=[idle, in_transaction]):
+            close_request_connections()
+        idle.close.assert_called_once_with()
+        in_transaction.close.assert_not_called()
+
+    def test_routes_are_async(self):
+        self.assertTrue(asyncio.iscoroutinefunction(resolve('/api/v1/polls/%d/vote/' % self.poll.pk).func))
+        self.assertFalse(asyncio.iscoroutinefunction(resolve('/api/v1/polls/%d/questions/' % self.poll.pk).func))
+
+    async def test_vote_and_reads(self):
+        response = await self.async_client.post('/api/v1/polls/%d/vote/' % self.poll.pk, json.dumps(
+            {'user': self.user.pk, 'answers': await sync_to_async(make_answers)(self.poll)}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        response = await self.async_client.post('/api/v1/polls/%d/vote/' % self.poll.pk, json.dumps(
+            {'user': self.user.pk, 'answers': []}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = await self.async_client.get('/api/v1/polls/')
+        self.assertEqual([poll['id'] for poll in response.json()['results']], [self.poll.pk])
+        response = await self.async_client.get('/api/v1/polls/%d/' % self.poll.pk)
+        self.assertEqual(len(response.json()['questions']), 3)
+        response = await self.async_client.get('/api/v1/polls/%d/results/' % self.poll.pk)
+        self.assertEqual(response.status_code, 200)
+        response = await self.async_client.post('/api/v1/results/', json.dumps({'user': self.user.pk}),
+                                                content_type='application/json')
+        self.assertEqual(len(response.json()['results']), 1)
+        # SQL-запросы из потоков пула учитываются в метриках маршрута
+        self.assertGreater(metrics_registry.snapshot()['poll-vote'][QUERIES], 1)
+
+    async def test_sync_views_count_sql(self):
+        admin = await sync_to_async(MyUser.objects.create_user)(username='admin', password=None, is_staff=True)
+        token = await sync_to_async(Token.objects.create)(user=admin)
+        response = await self.async_client.get('/api/v1/polls/%d/questions/' % self.poll.pk,
+                                               AUTHORIZATION='Token %s' % token.key)
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(metrics_registry.snapshot()['questions-list'][QUERIES], 0)
+
+    async def test_metrics_are_flushed_off_the_event_loop(self):
+        threads = []
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(POLL_METRICS=dict(settings.POLL_METRICS, DIR=directory, FLUSH_INTERVAL=0)), \
+                mock.patch.object(metrics_registry, 'flush', lambda: threads.append(threading.current_thread())):
+            await self.async_client.get('/api/v1/polls/')
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
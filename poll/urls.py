@@ -1,17 +1,27 @@
-from django.urls import path, include
+from django.conf import settings
+from django.urls import path
 # from rest_framework import routers
 from rest_framework_nested import routers
 
-from .views import PollViewSet, QuestionViewSet, AttemptAPIView
+from .aio import async_routes
+from .views import PollViewSet, QuestionViewSet, AttemptAPIView, ImportAPIView, JobViewSet
 
 router = routers.DefaultRouter()
 router.register(r'polls', PollViewSet, basename='poll')
+router.register(r'jobs', JobViewSet, basename='job')
 
 question_router = routers.NestedSimpleRouter(router, r'polls', lookup='poll')
 question_router.register(r'questions', QuestionViewSet, basename='questions')
 
 urlpatterns = [
-    path('', include(router.urls)),
-    path('', include(question_router.urls)),
-    path('results/', AttemptAPIView.as_view()),
+    *router.urls,
+    *question_router.urls,
+    path('results/', AttemptAPIView.as_view(), name='results'),
+    path('import/', ImportAPIView.as_view(), name='import'),
 ]
+
+# Маршруты, которые под ASGI обрабатываются асинхронно (см. aio.py)
+ASYNC_ROUTES = {'poll-list', 'poll-detail', 'poll-vote', 'poll-results', 'results'}
+
+if settings.POLL_ASYNC['ENABLED']:
+    urlpatterns = async_routes(urlpatterns, ASYNC_ROUTES)
@@ -1,27 +1,50 @@
 from rest_framework import viewsets, status, mixins
 from rest_framework.decorators import action
+from rest_framework.exceptions import UnsupportedMediaType, ValidationError
 from rest_framework.permissions import IsAdminUser, AllowAny
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from datetime import date
-from django.db.models import Q
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 
-from .models import Poll, Question, Attempt
+from .export import EXPORTERS
+from .fast import POLL_FIELDS, ATTEMPT_FIELDS, poll_rows, question_rows, attempt_rows
+from .filters import filter_polls, filter_attempts
+from .idempotency import IdempotencyKey
+from .importer import ImportDataError, Importer, READERS
+from .jobs import delete_poll_later, export_path
+from .lifecycle import ensure_not_archived, poll_analytics, poll_results
+from .models import Poll, Question, Attempt, Job
+from .ingest import vote_buffer
+from .metrics import registry
+from .pagination import KeysetPagination, SearchPagination
 from .permissions import IsAdminOrReadOnly
-from .serializers import PollSerializer, WriteQuestionSerializer, PollDetailSerializer, AttemptSerializer, \
-    VoteSerializer
+from .questions import save_questions, shift_positions
+from .renderers import CSVRenderer, NDJSONRenderer
+from .schema import schema_cache
+from .search import SearchResults
+from .serializers import PollSerializer, WriteQuestionSerializer, PollDetailSerializer, VoteSerializer, \
+    PollSchemaSerializer, PollResultsSerializer, BulkQuestionSerializer, ShiftPositionsSerializer, JobSerializer, \
+    AnalyticsParamsSerializer, PollAnalyticsSerializer, AnswerSearchParamsSerializer, AnswerSearchHitSerializer
+from .voters import request_voter, set_voter, voter_header
 
 
 class PollViewSet(viewsets.ModelViewSet):
     serializer_class = PollSerializer
     permission_classes = (IsAdminOrReadOnly, )
     http_method_names = ['get', 'post', 'head', 'delete', 'patch']
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-started_at', '-id')
+    # Методы, которые читают с реплик БД (см. db_routing.py)
+    replica_methods = ('GET', 'HEAD')
 
     def get_queryset(self):
         if self.request.user.is_staff:
-            queryset = Poll.objects.all()
+            queryset = Poll.objects.existing()
         else:
-            queryset = Poll.objects.filter(Q(finished_at__gt=date.today()) | Q(finished_at__isnull=True))
+            queryset = Poll.objects.existing().active()
+        if self.action == 'list':
+            queryset = filter_polls(queryset, self.request.query_params)
         return queryset
 
     def has_permission(self, request, view):
@@ -38,12 +61,74 @@ class PollViewSet(viewsets.ModelViewSet):
         else:
             return PollSerializer
 
+    def get_schema(self):
+        """ Схема опроса из кэша схем опросов.
+        Неактивные опросы доступны только администратору (как и в get_queryset)"""
+        schema = schema_cache.get(self.kwargs['pk'])
+        if schema is None or not (self.request.user.is_staff or schema.is_active):
+            raise Http404
+        return schema
+
+    def list(self, request, *args, **kwargs):
+        # Список строится из строк .values() в формате PollSerializer (см. fast.py)
+        queryset = self.filter_queryset(self.get_queryset()).values(*POLL_FIELDS)
+        return self.get_paginated_response(poll_rows(self.paginate_queryset(queryset)))
+
+    def retrieve(self, request, *args, **kwargs):
+        return Response(PollSchemaSerializer(self.get_schema()).data)
+
+    @action(methods=['get'], detail=True)
+    def results(self, request, *args, **kwargs):
+        return Response(PollResultsSerializer(poll_results(self.get_schema())).data)
+
+    @action(methods=['get'], detail=True, permission_classes=[IsAdminUser])
+    def analytics(self, request, *args, **kwargs):
+        """ Распределения ответов, таблицы сопряженности вопросов и динамика прохождения (см. analytics.py)"""
+        schema = self.get_schema()
+        params = AnalyticsParamsSerializer(data=request.query_params, context={'schema': schema})
+        params.is_valid(raise_exception=True)
+        analytics = poll_analytics(schema, params.validated_data.get('crosstab', ()), params.validated_data['bucket'])
+        return Response(PollAnalyticsSerializer(analytics).data)
+
+    @action(methods=['get'], detail=True, permission_classes=[IsAdminUser],
+            renderer_classes=[CSVRenderer, NDJSONRenderer])
+    def export(self, request, *args, **kwargs):
+        """ Потоковая выгрузка попыток и ответов опроса (см. export.py): ?format=csv|ndjson"""
+        renderer = request.accepted_renderer
+        schema = self.get_schema()
+        ensure_not_archived(schema)
+        response = StreamingHttpResponse(EXPORTERS[renderer.format](schema),
+                                         content_type='%s; charset=utf-8' % renderer.media_type)
+        response['Content-Disposition'] = 'attachment; filename="poll-%s.%s"' % (self.kwargs['pk'], renderer.format)
+        return response
+
+    def destroy(self, request, *args, **kwargs):
+        """ Опрос сразу скрывается, а удаляет его фоновая задача (см. jobs.delete_poll): ответ - задача"""
+        poll = self.get_object()
+        job = delete_poll_later(poll.pk, request.user)
+        return Response(JobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
     @action(methods=['post'], detail=True, permission_classes=[AllowAny])
     def vote(self, request, *args, **kwargs):
-        serializer = VoteSerializer(data=request.data, context={'poll_pk': self.kwargs['pk']})
-        serializer.is_valid(raise_exception=True)
-        serializer.save()
-        return Response(serializer.data)
+        voter = request_voter(request)
+        # Повтор запроса с тем же заголовком Idempotency-Key получает исходный ответ (см. idempotency.py)
+        with IdempotencyKey(request, (self.kwargs['pk'], voter, request.user.pk)) as idempotency:
+            if idempotency.replay is not None:
+                return idempotency.replay
+            serializer = VoteSerializer(data=request.data, context={'request': request, 'poll_pk': self.kwargs['pk'],
+                                                                    'voter': voter})
+            serializer.is_valid(raise_exception=True)
+            # В режиме буферизованного голосования попытка записывается позже пакетом (см. ingest.py)
+            if vote_buffer.enabled:
+                response = Response(serializer.save_buffered(), status=status.HTTP_202_ACCEPTED)
+            else:
+                serializer.save()
+                response = Response(serializer.data)
+            # Анонимному участнику возвращаем его токен, чтобы связать следующие голоса (см. voters.py)
+            if serializer.voter is not None:
+                set_voter(response, serializer.voter)
+            idempotency.save(response, headers=(voter_header(), ))
+        return response
 
 
 class QuestionViewSet(viewsets.ModelViewSet):
@@ -51,23 +136,135 @@ class QuestionViewSet(viewsets.ModelViewSet):
     permission_classes = (IsAdminUser, )
     lookup_field = 'position'
     http_method_names = ['get', 'post', 'head', 'delete', 'patch']
+    replica_methods = ('GET', 'HEAD')
 
     def get_queryset(self):
-        return Question.objects.filter(poll=self.kwargs['poll_pk']).order_by('position')
+        # Варианты ответа всех вопросов загружаются одним запросом (WriteQuestionSerializer.choices)
+        return Question.objects.filter(poll=self.kwargs['poll_pk']).order_by('position').prefetch_related('choices')
 
     def get_serializer_context(self):
         context = super(QuestionViewSet, self).get_serializer_context()
         context.update({'poll_pk': self.kwargs['poll_pk']})
         return context
 
+    def list(self, request, *args, **kwargs):
+        # Формат WriteQuestionSerializer без создания объектов моделей (см. fast.py)
+        return Response(question_rows(self.kwargs['poll_pk']))
+
+    @action(methods=['post'], detail=False)
+    def bulk(self, request, *args, **kwargs):
+        """ Создать и изменить список вопросов в одной транзакции (см. questions.save_questions)"""
+        poll = get_object_or_404(Poll.objects.existing().only('id'), pk=self.kwargs['poll_pk'])
+        existing = {question.position: question for question in Question.objects.filter(poll=poll)}
+        serializer = BulkQuestionSerializer(data=request.data, context={'questions': existing})
+        serializer.is_valid(raise_exception=True)
+        save_questions(poll.pk, serializer.validated_data['questions'], existing)
+        return Response(question_rows(poll.pk))
+
+    @action(methods=['post'], detail=False)
+    def reorder(self, request, *args, **kwargs):
+        """ Сдвинуть номера вопросов одним UPDATE: {"start": 3, "end": 5, "offset": 1}"""
+        poll = get_object_or_404(Poll.objects.existing().only('id'), pk=self.kwargs['poll_pk'])
+        serializer = ShiftPositionsSerializer(data=request.data, context={'poll_pk': poll.pk})
+        serializer.is_valid(raise_exception=True)
+        shift_positions(poll.pk, **serializer.validated_data)
+        return Response(question_rows(poll.pk))
+
+    @action(methods=['get'], detail=True, url_path='answers/search')
+    def search_answers(self, request, *args, **kwargs):
+        """ Полнотекстовый поиск по ответам на текстовый вопрос (см. search.py): ?q=слова&page=2"""
+        schema = schema_cache.get(self.kwargs['poll_pk'])
+        question = next((question for question in schema.questions
+                         if str(question.position) == self.kwargs['position']), None) if schema else None
+        if question is None:
+            raise Http404
+        if question.question_type != Question.TEXT:
+            raise ValidationError({'position': 'Question %d is not a text question' % question.position})
+        ensure_not_archived(schema)
+        params = AnswerSearchParamsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        paginator = SearchPagination()
+        page = paginator.paginate_queryset(SearchResults(question.id, params.validated_data['q']), request, view=self)
+        return paginator.get_paginated_response(AnswerSearchHitSerializer(page, many=True).data)
+
 
 class AttemptAPIView(APIView):
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-time', '-id')
+    # История только читает БД, хотя запрашивается через POST
+    replica_methods = ('POST', )
 
     def post(self, request, *args, **kwargs):
         user = request.data.get('user', None)
-        if user:
-            queryset = Attempt.objects.filter(user=user)
-            serializer = AttemptSerializer(queryset, many=True)
-            return Response(serializer.data)
+        # Без пользователя - история анонимного участника по его токену (см. voters.py)
+        voter = None if user else request_voter(request)
+        if user or voter:
+            # Ответы попыток берутся из снимков (см. snapshots.py): история читается одним запросом
+            # и отдается строками .values() в формате AttemptSerializer (см. fast.py)
+            queryset = Attempt.objects.filter(**({'user': user} if user else {'voter': voter}))
+            # Попытки удаляемых опросов скрыты вместе с опросом (см. jobs.py)
+            queryset = queryset.filter(poll__is_deleted=False)
+            queryset = filter_attempts(queryset, request.query_params).values(*ATTEMPT_FIELDS)
+            paginator = self.pagination_class()
+            page = paginator.paginate_queryset(queryset, request, view=self)
+            return paginator.get_paginated_response(attempt_rows(page))
         else:
             return Response(r'"detail": "User id is required"')
+
+
+class JobViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin, mixins.ListModelMixin,
+                 viewsets.GenericViewSet):
+    """ Фоновые задачи (см. jobs.py): POST - поставить задачу, GET - состояние и прогресс"""
+    serializer_class = JobSerializer
+    permission_classes = (IsAdminUser, )
+    pagination_class = KeysetPagination
+    queryset = Job.objects.all()
+
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        response.status_code = status.HTTP_202_ACCEPTED
+        return response
+
+    @action(methods=['get'], detail=True)
+    def download(self, request, *args, **kwargs):
+        """ Файл выполненной задачи выгрузки"""
+        job = self.get_object()
+        if job.kind != 'export_poll' or job.status != Job.DONE:
+            raise Http404
+        path = export_path(job.pk, job.result['format'])
+        if not path.exists():
+            raise Http404
+        return FileResponse(path.open('rb'), as_attachment=True,
+                            filename='poll-%s.%s' % (job.result['poll_id'], job.result['format']))
+
+
+class ImportAPIView(APIView):
+    """ Импорт выгрузки dumpdata (см. importer.py). Тело запроса читается потоком, минуя парсеры DRF:
+    Content-Type application/xml - XML, application/x-ndjson - NDJSON. ?key= - ключ контрольных точек.
+    Выгрузка недоверенная: пользователи создаются без прав администратора и пароля"""
+    permission_classes = (IsAdminUser, )
+    parser_classes = ()
+    formats = {
+        'application/xml': 'xml',
+        'text/xml': 'xml',
+        'application/x-ndjson': 'ndjson',
+        'application/jsonl': 'ndjson',
+    }
+
+    def post(self, request, *args, **kwargs):
+        import_format = self.formats.get(request.content_type.split(';')[0].strip().lower())
+        if import_format is None:
+            raise UnsupportedMediaType(request.content_type)
+        if request.stream is None:
+            raise ValidationError({'detail': 'Request body is empty'})
+        importer = Importer(key=request.query_params.get('key') or None, trusted=False)
+        try:
+            stats = importer.run(READERS[import_format](request.stream))
+        except ImportDataError as exc:
+            raise ValidationError({'detail': str(exc), 'offset': importer.offset})
+        return Response({'offset': importer.offset, 'counts': stats, 'polls': sorted(importer.polls)})
+
+
+def metrics_view(request):
+    """ Метрики запросов всех процессов в текстовом формате Prometheus (см. metrics.py)"""
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
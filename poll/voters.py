@@ -0,0 +1,54 @@
+""" Анонимные участники опросов.
+
+Голос без пользователя записывается без создания MyUser: попытка помечается идентификатором анонимного
+участника (Attempt.voter, UUID). Клиент получает его подписанным токеном (django.core.signing) в cookie
+и в заголовке X-Voter-Token; если вернуть токен в следующем запросе, новые голоса и история /results/
+будут привязаны к тому же участнику. Токен с неверной подписью игнорируется.
+"""
+from uuid import UUID
+
+from django.conf import settings
+from django.core import signing
+
+SALT = 'poll.voter'
+
+
+def _options():
+    return getattr(settings, 'POLL_VOTER', {})
+
+
+def voter_header():
+    """ Заголовок с токеном участника"""
+    return _options().get('HEADER', 'X-Voter-Token')
+
+
+def voter_token(voter):
+    """ Подписанный токен участника"""
+    return signing.dumps(voter.hex, salt=SALT)
+
+
+def parse_voter_token(token):
+    """ Участник из подписанного токена. None, если токена нет или подпись неверна"""
+    if not token:
+        return None
+    try:
+        return UUID(signing.loads(token, salt=SALT))
+    except (signing.BadSignature, ValueError, TypeError):
+        return None
+
+
+def request_voter(request):
+    """ Участник из заголовка или cookie запроса. None, если токена нет или подпись неверна"""
+    options = _options()
+    token = request.headers.get(voter_header()) or request.COOKIES.get(options.get('COOKIE_NAME', 'poll_voter'))
+    return parse_voter_token(token)
+
+
+def set_voter(response, voter):
+    """ Передать клиенту токен участника в заголовке и cookie ответа"""
+    options = _options()
+    token = voter_token(voter)
+    response[voter_header()] = token
+    response.set_cookie(options.get('COOKIE_NAME', 'poll_voter'), token, max_age=options.get('COOKIE_MAX_AGE'),
+                        httponly=True, samesite='Lax')
+    return response
@@ -0,0 +1,89 @@
+""" Запись прошедших проверку голосов (см. VoteSerializer).
+
+Попытки, ответы и выбранные варианты ответа пишутся через bulk_create сразу для всего набора голосов,
+поэтому количество запросов не зависит ни от количества вопросов, ни от количества голосов в наборе.
+Текст ответа сохраняется только для вопросов типа Question.TEXT, выбранные варианты - в AnswerChoice.
+Вместе с попыткой записывается снимок ее вопросов и ответов для истории /results/ (см. snapshots.py).
+В опросах с ограничением "один голос" записывается и участник (см. duplicates.py).
+"""
+import ast
+from collections import Counter
+from typing import NamedTuple, Optional
+from uuid import UUID
+
+from django.db import connection
+
+from .duplicates import record_voters
+from .models import Question, Attempt, Answer, AnswerChoice
+from .schema import PollSchema
+from .snapshots import render_snapshot
+from .tallies import choice_ids, record_votes
+
+
+class Vote(NamedTuple):
+    poll: PollSchema
+    user_id: Optional[int]
+    answers: list
+    token: Optional[UUID] = None
+    # Анонимный участник для голоса без пользователя (см. voters.py)
+    voter: Optional[UUID] = None
+
+
+def parse_answer(text):
+    """ Ответ на вопрос типа Question.TEXT хранится как строковое представление списка: "['4']" """
+    try:
+        value = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return [text]
+    return [str(part) for part in value] if isinstance(value, (list, tuple)) else [str(value)]
+
+
+def _bulk_create(model, objs):
+    """ bulk_create с заполнением id созданных объектов, если бэкенд БД их не возвращает"""
+    if connection.features.can_return_rows_from_bulk_insert:
+        return model.objects.bulk_create(objs)
+    for obj in objs:
+        obj.save(force_insert=True)
+    return objs
+
+
+def _vote_rows(vote):
+    """ Ответы голоса: (вопрос схемы, текст ответа, id выбранных вариантов)"""
+    questions = {question.position: question for question in vote.poll.questions}
+    for answer_data in vote.answers:
+        question = questions[answer_data['position']]
+        if question.question_type == Question.TEXT:
+            # Текст хранится как строковое представление списка ответов (см. parse_answer)
+            yield question, str(answer_data['answer']), ()
+        else:
+            yield question, '', choice_ids(question, answer_data['answer'])
+
+
+def write_votes(votes):
+    """ Записать попытки со снимками ответов, ответы и выбранные варианты и увеличить счетчики итогов.
+    Вызывается внутри транзакции. Возвращает созданные попытки в порядке голосов"""
+    rows = [list(_vote_rows(vote)) for vote in votes]
+    # Повторный голос в опросе с ограничением отклоняет уникальный индекс до записи попыток
+    record_voters(votes)
+    attempts = _bulk_create(Attempt, [
+        Attempt(user_id=vote.user_id, voter=vote.voter, poll_id=vote.poll.id, token=vote.token,
+                snapshot=render_snapshot(vote_rows))
+        for vote, vote_rows in zip(votes, rows)
+    ])
+
+    answers, selected = [], []
+    polls, choices = Counter(), Counter()
+    for vote, attempt, vote_rows in zip(votes, attempts, rows):
+        polls[vote.poll.id] += 1
+        for question, text, question_choices in vote_rows:
+            answer = Answer(attempt=attempt, question_id=question.id, answer=text)
+            answers.append(answer)
+            for choice_id in question_choices:
+                selected.append((answer, choice_id))
+                choices[question.id, choice_id] += 1
+
+    _bulk_create(Answer, answers)
+    AnswerChoice.objects.bulk_create([AnswerChoice(answer_id=answer.id, choice_id=choice_id)
+                                      for answer, choice_id in selected])
+    record_votes(polls, choices)
+    return attempts